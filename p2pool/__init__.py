@@ -47,4 +47,4 @@ def _get_version():
 __version__ = _get_version()
 
 DEBUG = True
-BENCH = False  # Performance benchmarking flag - prints timing info when enabled
+BENCH = False  # Hot path timing flag - enables p2pool.util.timing when set
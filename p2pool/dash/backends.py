@@ -0,0 +1,275 @@
+'''
+Several dashd backends used as one.
+
+BackendSet is a drop-in jsonrpc.Proxy over a list of Backends (an RPC
+proxy plus, optionally, the P2P factory connected to the same dashd).
+Calls are routed by rpc_scheduler.classify():
+
+    submit    sent to every backend at once; the first acceptance is
+              returned right away, otherwise the first backend's answer
+    template  raced across the healthy backends; once the first template
+              arrives the others get race_window seconds to come up with
+              a higher one, and the highest (then the fastest) wins
+    lookup    sent to the healthy backend with the lowest latency, failing
+              over to the next on connection errors and timeouts
+
+A JSON-RPC error reply is an answer, not a failure: it is returned as is.
+Every check_interval seconds each backend is asked for getblockcount; it
+is healthy if it answers, isn't more than one block behind the best
+backend and, if it has a P2P factory, that is connected. A backend that
+fails max_failures calls in a row is unhealthy until its next good check.
+If no backend is healthy, all of them are tried.
+'''
+
+from __future__ import division
+
+import time
+
+from twisted.internet import defer, reactor
+from twisted.python import failure, log
+
+from p2pool.dash import rpc_scheduler
+from p2pool.util import deferral, jsonrpc, metrics
+
+request_seconds = metrics.histogram('p2pool_dashd_backend_request_seconds', 'dashd RPC call latency, by backend', ['backend'])
+errors_counter = metrics.counter('p2pool_dashd_backend_errors', 'dashd RPC calls that failed without an answer, by backend', ['backend'])
+healthy_gauge = metrics.gauge('p2pool_dashd_backend_healthy', 'Whether a dashd backend passed its last health check', ['backend'])
+template_wins_counter = metrics.counter('p2pool_dashd_backend_template_wins', 'getblocktemplate races won, by backend', ['backend'])
+
+LATENCY_HALF_LIFE = 20 # calls
+
+def parse_spec(spec):
+    '''
+    Parses [USER:PASS@]HOST:RPC_PORT[:P2P_PORT] into
+    (username, password, host, rpc_port, p2p_port); missing parts are None
+    '''
+    username = password = None
+    if '@' in spec:
+        auth, spec = spec.rsplit('@', 1)
+        if ':' not in auth:
+            raise ValueError('expected USER:PASS@ in dashd backend %r' % (auth + '@' + spec,))
+        username, password = auth.split(':', 1)
+    parts = spec.split(':')
+    if len(parts) not in (2, 3) or not parts[0]:
+        raise ValueError('expected HOST:RPC_PORT[:P2P_PORT], got %r' % (spec,))
+    return username, password, parts[0], int(parts[1]), int(parts[2]) if len(parts) == 3 else None
+
+class Backend(object):
+    def __init__(self, name, proxy, factory=None):
+        self.name = name
+        self.proxy = proxy
+        self.factory = factory
+        self.healthy = True # until the first check says otherwise
+        self.height = None
+        self.latency = None # moving average, in seconds
+        self.calls = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        self.last_error = None
+        self.last_check = None
+        self.template_wins = 0
+        healthy_gauge.set(1, (name,))
+
+    @property
+    def p2p_connected(self):
+        return None if self.factory is None else self.factory.conn.value is not None
+
+    def set_healthy(self, healthy):
+        self.healthy = healthy
+        healthy_gauge.set(1 if healthy else 0, (self.name,))
+
+    def record(self, latency=None, error=None):
+        self.calls += 1
+        if error is None:
+            self.consecutive_failures = 0
+            request_seconds.observe(latency, (self.name,))
+            alpha = 1 - .5**(1/LATENCY_HALF_LIFE)
+            self.latency = latency if self.latency is None else self.latency + alpha*(latency - self.latency)
+        else:
+            self.failures += 1
+            self.consecutive_failures += 1
+            self.last_error = error
+            errors_counter.inc(1, (self.name,))
+
+    def get_stats(self):
+        return dict(
+            healthy=self.healthy,
+            height=self.height,
+            p2p_connected=self.p2p_connected,
+            latency_ms=self.latency*1e3 if self.latency is not None else None,
+            calls=self.calls,
+            failures=self.failures,
+            consecutive_failures=self.consecutive_failures,
+            last_error=self.last_error,
+            last_check=self.last_check,
+            template_wins=self.template_wins,
+        )
+
+class BackendSet(jsonrpc.Proxy):
+    def __init__(self, backends, race_window=.25, check_interval=15, max_failures=3):
+        assert backends
+        jsonrpc.Proxy.__init__(self, self.call, batch_func=self.batch)
+        self.backends = backends
+        self.race_window = race_window
+        self.check_interval = check_interval
+        self.max_failures = max_failures
+        self._checking = None
+        self._task = None
+
+    def _candidates(self):
+        '''Healthy backends, lowest latency first, or all of them if none is'''
+        healthy = [b for b in self.backends if b.healthy]
+        return sorted(healthy, key=lambda b: b.latency or 0) if healthy else list(self.backends)
+
+    def _timed(self, backend, func):
+        start = time.time()
+        df = defer.maybeDeferred(func)
+        def done(res):
+            if not isinstance(res, failure.Failure) or res.check(jsonrpc.Error):
+                backend.record(latency=time.time() - start)
+            elif not res.check(defer.CancelledError):
+                backend.record(error=res.getErrorMessage() or res.type.__name__)
+                if backend.consecutive_failures >= self.max_failures and backend.healthy:
+                    print 'dashd backend %s failed %i calls in a row, marking it unhealthy' % (backend.name, backend.consecutive_failures)
+                    backend.set_healthy(False)
+            return res
+        return df.addBoth(done)
+
+    def call(self, method, params):
+        kind = rpc_scheduler.classify(method, params)
+        func = lambda proxy: getattr(proxy, 'rpc_' + method)(*params)
+        if kind == 'submit':
+            return self._submit_all(func)
+        elif kind == 'template':
+            return self._race(func)
+        else:
+            return self._failover(func)
+
+    def batch(self, calls):
+        return self._failover(lambda proxy: proxy.batch(calls))
+
+    @defer.inlineCallbacks
+    def _failover(self, func):
+        last_failure = None
+        for backend in self._candidates():
+            try:
+                res = yield self._timed(backend, lambda: func(backend.proxy))
+            except (jsonrpc.Error, defer.CancelledError):
+                raise
+            except Exception:
+                last_failure = failure.Failure()
+            else:
+                defer.returnValue(res)
+        last_failure.raiseException()
+
+    def _race(self, func):
+        backends = self._candidates()
+        running = []
+        results = [] # (backend, template) in arrival order
+        failures = []
+        pending = [len(backends)]
+        window = [None]
+        result_df = defer.Deferred(lambda df: [d.cancel() for d in running if not d.called])
+
+        def finish():
+            if result_df.called:
+                return
+            if window[0] is not None and window[0].active():
+                window[0].cancel()
+            if not results:
+                result_df.errback(failures[0])
+                return
+            i, (backend, template) = max(enumerate(results), key=lambda (i, (backend, template)):
+                (template.get('height', 0) if isinstance(template, dict) else 0, -i))
+            backend.template_wins += 1
+            template_wins_counter.inc(1, (backend.name,))
+            result_df.callback(template)
+        def got(template, backend):
+            results.append((backend, template))
+            if len(results) == 1 and pending[0] > 1:
+                window[0] = reactor.callLater(self.race_window, finish)
+        def failed(fail):
+            failures.append(fail)
+        def done(_):
+            pending[0] -= 1
+            if not pending[0]:
+                finish()
+        for backend in backends:
+            df = self._timed(backend, lambda backend=backend: func(backend.proxy))
+            running.append(df)
+            df.addCallbacks(got, failed, callbackArgs=(backend,)).addCallback(done)
+        return result_df
+
+    def _submit_all(self, func):
+        results = [None]*len(self.backends) # Failure or (result,) per backend
+        result_df = defer.Deferred()
+
+        def got(res, i):
+            results[i] = res if isinstance(res, failure.Failure) else (res,)
+            if result_df.called:
+                return
+            if results[i] == (None,):
+                result_df.callback(None) # accepted
+            elif all(r is not None for r in results):
+                answers = [r for r in results if not isinstance(r, failure.Failure)]
+                if answers:
+                    result_df.callback(answers[0][0])
+                else:
+                    result_df.errback(results[0])
+        for i, backend in enumerate(self.backends):
+            self._timed(backend, lambda backend=backend: func(backend.proxy)).addBoth(got, i)
+        return result_df
+
+    @defer.inlineCallbacks
+    def check(self):
+        '''Health-checks every backend at once'''
+        def check_one(backend):
+            def got(height):
+                backend.height = height
+                return True
+            def failed(fail):
+                backend.last_error = fail.getErrorMessage() or fail.type.__name__
+                return False
+            return self._timed(backend, backend.proxy.rpc_getblockcount).addCallbacks(got, failed)
+        answered = yield defer.gatherResults([check_one(backend) for backend in self.backends])
+        best_height = max(backend.height for backend, ok in zip(self.backends, answered) if ok) if any(answered) else None
+        now = time.time()
+        for backend, ok in zip(self.backends, answered):
+            backend.last_check = now
+            lagging = ok and backend.height < best_height - 1
+            healthy = ok and not lagging and backend.p2p_connected is not False
+            if healthy != backend.healthy:
+                print 'dashd backend %s is %s' % (backend.name,
+                    'healthy again' if healthy else
+                    'unreachable' if not ok else
+                    'lagging at height %i of %i' % (backend.height, best_height) if lagging else
+                    'not connected over P2P')
+            backend.set_healthy(healthy)
+
+    def _tick(self):
+        if self._checking is not None:
+            return # previous check is still running
+        self._checking = d = defer.Deferred()
+        def done(res):
+            self._checking = None
+            d.callback(None)
+        self.check().addErrback(log.err, 'Error checking dashd backends:').addBoth(done)
+
+    def start(self):
+        assert self._task is None
+        self._task = deferral.RobustLoopingCall(self._tick)
+        self._task.start(self.check_interval)
+
+    def stop(self):
+        if self._task is not None:
+            self._task.stop()
+            self._task = None
+
+    def get_stats(self):
+        return dict((backend.name, backend.get_stats()) for backend in self.backends)
+
+def find(dashd):
+    '''Returns the BackendSet under dashd's cache and scheduler wrappers, or None'''
+    while dashd is not None and not isinstance(dashd, BackendSet):
+        dashd = getattr(dashd, 'proxy', None)
+    return dashd
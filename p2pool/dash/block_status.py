@@ -0,0 +1,191 @@
+'''
+Background reconciliation of found blocks' status against dashd.
+
+Web endpoints used to ask dashd about every listed block while building a
+response. BlockStatusReconciler instead keeps a persistent cache of every
+tracked block and refreshes the entries that are due in the background,
+sending one JSON-RPC batch request per `batch_size` blocks with at most
+`concurrency` batches in flight. Readers only ever look at the cache.
+'''
+
+from __future__ import division
+
+import json
+import os
+import time
+
+from twisted.internet import defer
+from twisted.python import log
+
+from p2pool.util import deferral, jsonrpc, variable
+
+COINBASE_MATURITY = 100 # confirmations before a block's coinbase can be spent
+FINAL_CONFIRMATIONS = 150 # confirmed blocks this deep are never checked again
+
+PENDING_TTL = 60
+ORPHANED_TTL = 300 # orphaned blocks are rechecked in case of a false positive
+CONFIRMED_TTL = 600
+
+def status_from_confirmations(confirmations):
+    # ChainLocks give finality but don't shorten coinbase maturity
+    if confirmations >= COINBASE_MATURITY:
+        return 'confirmed'
+    elif confirmations >= 0:
+        return 'pending'
+    else:
+        return 'orphaned' # dashd reports -1 for blocks not in the main chain
+
+def coinbase_value(block_info):
+    '''Sum of the coinbase outputs in a getblock (verbosity 2) result, or None'''
+    txs = block_info.get('tx')
+    if txs and isinstance(txs[0], dict) and 'vout' in txs[0]:
+        return sum(vout['value'] for vout in txs[0]['vout'])
+    return None
+
+class BlockStatusReconciler(object):
+    def __init__(self, dashd, path=None, batch_size=50, reward_batch_size=5, concurrency=2, interval=15):
+        self.dashd = dashd
+        self.path = path
+        self.batch_size = batch_size
+        self.reward_batch_size = reward_batch_size # getblock with full transactions is large
+        self.interval = interval
+
+        self.cache = {} # block_hash -> dict(status, checked, confirmations[, reward][, want_reward])
+        self.reward_found = variable.Event() # (block_hash, reward)
+
+        self._semaphore = defer.DeferredSemaphore(concurrency)
+        self._dirty = False
+        self._refreshing = None
+        self._task = None
+
+        if self.path is not None:
+            self.load()
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, 'rb') as f:
+                cache = json.loads(f.read())
+        except Exception:
+            log.err(None, 'Error loading block status cache:')
+            return
+        self.cache.update((block_hash, entry) for block_hash, entry in cache.iteritems()
+            if isinstance(entry, dict) and 'status' in entry)
+        print 'Loaded status of %i blocks' % (len(self.cache),)
+
+    def save(self):
+        if self.path is None or not self._dirty:
+            return
+        try:
+            with open(self.path + '.new', 'wb') as f:
+                f.write(json.dumps(self.cache))
+            try:
+                os.rename(self.path + '.new', self.path)
+            except:
+                os.remove(self.path)
+                os.rename(self.path + '.new', self.path)
+            self._dirty = False
+        except Exception:
+            log.err(None, 'Error saving block status cache:')
+
+    def track(self, block_hash, want_reward=False):
+        entry = self.cache.get(block_hash)
+        if entry is None:
+            entry = self.cache[block_hash] = dict(status='pending', checked=0, confirmations=None)
+            self._dirty = True
+        if want_reward and entry.get('reward') is None:
+            entry['want_reward'] = True
+
+    def get_status(self, block_hash):
+        '''Cached status of block_hash; unknown hashes are tracked from now on'''
+        if not isinstance(block_hash, (str, unicode)):
+            return 'unknown'
+        self.track(block_hash)
+        return self.cache[block_hash]['status']
+
+    def get_reward(self, block_hash):
+        '''Cached coinbase value of block_hash, or None; a missing value is fetched on the next pass'''
+        if not isinstance(block_hash, (str, unicode)):
+            return None
+        self.track(block_hash, want_reward=True)
+        return self.cache[block_hash].get('reward')
+
+    def _is_due(self, entry, now):
+        age = now - entry['checked']
+        if entry['status'] == 'confirmed':
+            confirmations = entry.get('confirmations')
+            return (confirmations is None or confirmations < FINAL_CONFIRMATIONS) and age >= CONFIRMED_TTL
+        elif entry['status'] == 'orphaned':
+            return age >= ORPHANED_TTL
+        else:
+            return age >= PENDING_TTL
+
+    @defer.inlineCallbacks
+    def refresh(self, now=None):
+        if now is None:
+            now = time.time()
+        reward_hashes = []
+        status_hashes = []
+        for block_hash, entry in self.cache.iteritems():
+            if entry.get('want_reward') and entry.get('reward') is None:
+                # blocks past FINAL_CONFIRMATIONS are otherwise never due
+                if now - entry['checked'] >= PENDING_TTL:
+                    reward_hashes.append(block_hash)
+            elif self._is_due(entry, now):
+                status_hashes.append(block_hash)
+
+        batches = [(hashes[i:i + size], with_reward)
+            for hashes, size, with_reward in [(reward_hashes, self.reward_batch_size, True), (status_hashes, self.batch_size, False)]
+            for i in xrange(0, len(hashes), size)]
+        yield defer.DeferredList([self._semaphore.run(self._refresh_batch, hashes, with_reward) for hashes, with_reward in batches])
+        self.save()
+        defer.returnValue(len(reward_hashes) + len(status_hashes))
+
+    @defer.inlineCallbacks
+    def _refresh_batch(self, hashes, with_reward):
+        try:
+            results = yield self.dashd.batch([('getblock', [block_hash, 2]) if with_reward else ('getblockheader', [block_hash]) for block_hash in hashes])
+        except Exception:
+            log.err(None, 'Error refreshing status of %i blocks:' % (len(hashes),))
+            results = [None]*len(hashes)
+
+        now = time.time()
+        for block_hash, result in zip(hashes, results):
+            entry = self.cache.get(block_hash)
+            if entry is None:
+                continue
+            # on errors (e.g. dashd doesn't know the block yet) keep the previous status and retry when due
+            entry['checked'] = now
+            if result is None or isinstance(result, jsonrpc.Error):
+                continue
+            confirmations = result.get('confirmations', 0)
+            entry['confirmations'] = confirmations
+            entry['status'] = status_from_confirmations(confirmations)
+            if with_reward:
+                reward = coinbase_value(result)
+                if reward is not None:
+                    entry['reward'] = reward
+                    entry.pop('want_reward', None)
+                    self.reward_found.happened(block_hash, reward)
+        self._dirty = True
+
+    def _tick(self):
+        if self._refreshing is not None:
+            return # previous pass is still running
+        self._refreshing = d = defer.Deferred()
+        def done(res):
+            self._refreshing = None
+            d.callback(None)
+        self.refresh().addErrback(log.err, 'Error refreshing block status:').addBoth(done)
+
+    def start(self):
+        assert self._task is None
+        self._task = deferral.RobustLoopingCall(self._tick)
+        self._task.start(self.interval)
+
+    def stop(self):
+        if self._task is not None:
+            self._task.stop()
+            self._task = None
+        self.save()
@@ -2,7 +2,7 @@ from twisted.internet import defer
 from twisted.python import log
 
 import p2pool
-from p2pool.dash import data as dash_data
+from p2pool.dash import data as dash_data, rpc_cache
 from p2pool.util import deferral, forest, jsonrpc, variable
 
 class HeaderWrapper(object):
@@ -90,12 +90,13 @@ class HeightTracker(object):
 
 @defer.inlineCallbacks
 def get_height_rel_highest_func(dashd, factory, best_block_func, net):
+    dashd = rpc_cache.view(dashd, 'height_tracker')
     if '\ngetblock ' in (yield deferral.retry()(dashd.rpc_help)()):
         @deferral.DeferredCacher
         @defer.inlineCallbacks
         def height_cacher(block_hash):
             try:
-                x = yield dashd.rpc_getblock('%064x' % (block_hash,))
+                x = yield dashd.rpc_getblockheader('%064x' % (block_hash,))
             except jsonrpc.Error_for_code(-5): # Block not found
                 if not p2pool.DEBUG:
                     raise deferral.RetrySilentlyException()
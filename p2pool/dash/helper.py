@@ -4,7 +4,7 @@ import time
 from twisted.internet import defer, error as twisted_error
 
 import p2pool
-from p2pool.dash import data as dash_data
+from p2pool.dash import data as dash_data, template_differ
 from p2pool.util import deferral, jsonrpc
 
 # Global broadcaster instance (initialized by main.py)
@@ -43,7 +43,7 @@ def check(dashd, net):
 
 @deferral.retry('Error getting work from dashd:', 3)
 @defer.inlineCallbacks
-def getwork(dashd, net, use_getblocktemplate=True):
+def getwork(dashd, net, use_getblocktemplate=True, differ=None):
     def go():
         if use_getblocktemplate:
             return dashd.rpc_getblocktemplate(dict(mode='template'))
@@ -80,14 +80,26 @@ def getwork(dashd, net, use_getblocktemplate=True):
         print >>sys.stderr, '    dashd RPC error: %s' % error_msg
         raise deferral.RetrySilentlyException()
 
+    defer.returnValue((yield _parse_work(dashd, work, use_getblocktemplate, end - start, differ)))
+
+@defer.inlineCallbacks
+def getwork_longpoll(dashd, longpoll_dashd, net, longpollid, differ=None):
+    '''
+    Waits on longpoll_dashd for the template after the one identified by
+    longpollid (BIP 22 long polling). Unlike getwork, errors aren't retried.
+    '''
+    start = time.time()
+    work = yield longpoll_dashd.rpc_getblocktemplate(dict(mode='template', longpollid=longpollid))
+    end = time.time()
+    defer.returnValue((yield _parse_work(dashd, work, True, end - start, differ)))
+
+@defer.inlineCallbacks
+def _parse_work(dashd, work, use_getblocktemplate, latency, differ=None):
     # Include ALL transactions from getblocktemplate
     # Per BIP 22, transactions are already ordered with dependencies before dependents
-    packed_transactions = []
-    for x in work.get('transactions', []):
-        if isinstance(x, dict):
-            packed_transactions.append(x['data'].decode('hex'))
-        else:
-            packed_transactions.append(x.decode('hex'))
+    if differ is None:
+        differ = template_differ.TemplateDiffer()
+    transactions, transaction_hashes = differ.update(work.get('transactions', []))
 
     if 'height' not in work:
         work['height'] = (yield dashd.rpc_getblock(work['previousblockhash']))['height'] + 1
@@ -133,8 +145,8 @@ def getwork(dashd, net, use_getblocktemplate=True):
     defer.returnValue(dict(
         version=work['version'],
         previous_block=int(work['previousblockhash'], 16),
-        transactions=map(dash_data.tx_type.unpack, packed_transactions),
-        transaction_hashes=map(dash_data.hash256, packed_transactions),
+        transactions=transactions,
+        transaction_hashes=transaction_hashes,
         transaction_fees=[x.get('fee', None) if isinstance(x, dict) else None for x in work['transactions']],
         subsidy=work['coinbasevalue'],
         time=work['time'] if 'time' in work else work['curtime'],
@@ -143,10 +155,11 @@ def getwork(dashd, net, use_getblocktemplate=True):
         height=work['height'],
         last_update=time.time(),
         use_getblocktemplate=use_getblocktemplate,
-        latency=end - start,
+        latency=latency,
         payment_amount = payment_amount,
         packed_payments = packed_payments,
         coinbase_payload = coinbase_payload,
+        longpollid=work.get('longpollid'),
     ))
 
 @deferral.retry('Error submitting primary block: (will retry)', 10, 10)
@@ -2,22 +2,96 @@
 Implementation of Dash's p2p protocol
 '''
 
+import collections
 import random
 import sys
 import time
 
-from twisted.internet import protocol
+from twisted.internet import protocol, reactor
 
 import p2pool
 from . import data as dash_data
-from p2pool.util import deferral, p2protocol, pack, variable
+from p2pool.util import deferral, metrics, p2protocol, pack, variable
+
+tx_invs_skipped = metrics.counter('p2pool_dashd_tx_invs_skipped', 'Transaction invs from dashd not requested with getdata, by reason', ['reason'])
+tx_requests_failed = metrics.counter('p2pool_dashd_tx_requests_failed', 'Transactions requested from dashd that it did not send, by reason', ['reason'])
+
+class TxInventory(object):
+    '''
+    Requests the transactions dashd announces. Hashes announced within
+    `window` seconds of each other are asked for with one getdata, and
+    ones already known or asked for are skipped until the request is
+    answered with notfound or has gone unanswered for `timeout` seconds.
+    '''
+    
+    MAX_GETDATA = 50000 # dashd's MAX_INV_SZ
+    
+    def __init__(self, send_getdata, is_known, window=.1, timeout=30, clock=reactor):
+        self.send_getdata = send_getdata
+        self.is_known = is_known
+        self.window = window
+        self.timeout = timeout
+        self.clock = clock
+        self.pending = [] # tx hashes to request at the next flush, in the order announced
+        self.in_flight = {} # tx hash -> time it was requested, including the pending ones
+        self.requested = collections.deque() # (time requested, tx hash), oldest first
+        self._delayed = None
+    
+    def got_invs(self, tx_hashes):
+        self._expire()
+        now = self.clock.seconds()
+        for tx_hash in tx_hashes:
+            if tx_hash in self.in_flight:
+                tx_invs_skipped.inc(1, ('in_flight',))
+            elif self.is_known(tx_hash):
+                tx_invs_skipped.inc(1, ('known',))
+            else:
+                self.in_flight[tx_hash] = now
+                self.requested.append((now, tx_hash))
+                self.pending.append(tx_hash)
+        if self.pending and self._delayed is None:
+            self._delayed = self.clock.callLater(self.window, self.flush)
+    
+    def got_tx(self, tx_hash):
+        self.in_flight.pop(tx_hash, None)
+    
+    def got_notfound(self, tx_hashes):
+        for tx_hash in tx_hashes:
+            if self.in_flight.pop(tx_hash, None) is not None:
+                tx_requests_failed.inc(1, ('notfound',))
+    
+    def _expire(self):
+        deadline = self.clock.seconds() - self.timeout
+        while self.requested and self.requested[0][0] <= deadline:
+            requested, tx_hash = self.requested.popleft()
+            if self.in_flight.get(tx_hash) == requested:
+                del self.in_flight[tx_hash]
+                tx_requests_failed.inc(1, ('timeout',))
+    
+    def flush(self):
+        self.stop()
+        pending, self.pending = self.pending, []
+        for i in xrange(0, len(pending), self.MAX_GETDATA):
+            self.send_getdata(requests=[dict(type='tx', hash=tx_hash) for tx_hash in pending[i:i + self.MAX_GETDATA]])
+    
+    def stop(self):
+        if self._delayed is not None:
+            if self._delayed.active():
+                self._delayed.cancel()
+            self._delayed = None
+    
+    def get_stats(self):
+        return dict(in_flight=len(self.in_flight), pending=len(self.pending))
 
 class Protocol(p2protocol.Protocol):
+    metrics_label = 'dashd'
+    
     def __init__(self, net):
         p2protocol.Protocol.__init__(self, net.P2P_PREFIX, 3145728, ignore_trailing_payload=True)
         self.net = net
 
     def connectionMade(self):
+        self.tx_inventory = TxInventory(self.send_getdata, self.is_tx_known)
         self.send_version(
             version=70238,
             services=1,
@@ -105,14 +179,25 @@ class Protocol(p2protocol.Protocol):
         ]))),
     ])
     def handle_inv(self, invs):
+        tx_hashes = []
         for inv in invs:
             if inv['type'] == 'block':
                 self.factory.new_block.happened(inv['hash'])
             elif inv['type'] == 'tx':
-                self.send_getdata(requests=[inv])
+                tx_hashes.append(inv['hash'])
             else:
                 if p2pool.DEBUG:
                     print 'Unneeded inv type', inv
+        if tx_hashes:
+            self.tx_inventory.got_invs(tx_hashes)
+
+    def is_tx_known(self, tx_hash):
+        known_txs_var = getattr(self.factory, 'known_txs_var', None)
+        return known_txs_var is not None and tx_hash in known_txs_var.value
+
+    message_notfound = message_inv
+    def handle_notfound(self, invs):
+        self.tx_inventory.got_notfound([inv['hash'] for inv in invs if inv['type'] == 'tx'])
 
     message_getdata = pack.ComposedType([
         ('requests', pack.ListType(pack.ComposedType([
@@ -192,7 +277,9 @@ class Protocol(p2protocol.Protocol):
         ('tx', dash_data.tx_type),
     ])
     def handle_tx(self, tx):
-        self.factory.new_tx.happened(tx)
+        tx_hash = dash_data.hash256(dash_data.tx_type.pack(tx))
+        self.tx_inventory.got_tx(tx_hash)
+        self.factory.new_tx.happened(tx, tx_hash)
 
     message_block = pack.ComposedType([
         ('block', dash_data.block_type),
@@ -255,6 +342,8 @@ class Protocol(p2protocol.Protocol):
             self.factory.gotConnection(None)
         if hasattr(self, 'pinger'):
             self.pinger.stop()
+        if hasattr(self, 'tx_inventory'):
+            self.tx_inventory.stop()
         if p2pool.DEBUG:
             print >>sys.stderr, 'Dashd connection lost. Reason:', reason.getErrorMessage()
 
@@ -268,8 +357,9 @@ class ClientFactory(protocol.ReconnectingClientFactory):
         self.conn = variable.Variable(None)
 
         self.new_block = variable.Event()
-        self.new_tx = variable.Event()
+        self.new_tx = variable.Event() # (tx, tx_hash)
         self.new_headers = variable.Event()
+        self.known_txs_var = None # transactions dashd announces that are in it aren't requested, set by the node
 
     def buildProtocol(self, addr):
         p = self.protocol(self.net)
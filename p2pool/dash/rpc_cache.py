@@ -0,0 +1,198 @@
+'''
+Persistent cache for dashd queries whose answers can no longer change.
+
+A getblockheader/getblock result for a block buried CACHE_CONFIRMATIONS
+deep, or the getblockhash of such a height, is fixed for good (the
+confirmation count it reports is frozen at the time it was fetched, but
+only ever grows). CachingProxy wraps the dashd proxy and answers those
+queries from, in order:
+
+1. an in-memory LRU of recent results
+2. an append-only file of every result ever cached, indexed by
+   (method, params) at startup
+3. dashd, storing the result in both tiers if it is deep enough
+
+Anything else is passed through. Results are keyed by (method, params),
+so getblock(hash) and getblock(hash, 2) are separate entries.
+
+Each consumer gets its own view, so hits and misses (i.e. RPC calls saved)
+are counted per endpoint:
+
+    dashd = rpc_cache.view(wb.dashd, 'web', 'stats')
+'''
+
+from __future__ import division
+
+import json
+import os
+
+from twisted.internet import defer
+from twisted.python import log
+
+from p2pool.dash import block_status, rpc_scheduler
+from p2pool.util import jsonrpc, memoize, metrics
+
+CACHE_CONFIRMATIONS = block_status.FINAL_CONFIRMATIONS
+MAX_ENTRY_SIZE = 100000 # bytes of JSON; full blocks with transactions aren't worth keeping
+
+requests_counter = metrics.counter('p2pool_dashd_rpc_cache_requests', 'dashd queries seen by the RPC cache, by endpoint, method and result (memory/disk hits, misses, uncacheable)', ['endpoint', 'method', 'result'])
+
+def _key(method, params):
+    return json.dumps([method, list(params)], separators=(',', ':'))
+
+class RPCCache(object):
+    def __init__(self, path=None, lru_size=20000):
+        self.path = path
+        self.lru = memoize.LRUDict(lru_size)
+        self.index = {} # key -> offset of its line in the file
+        self.best_height = None # highest chain tip seen in a result
+        self.stats = {} # endpoint -> dict(hits=, misses=, uncacheable=)
+        self._file = None
+        if path is not None:
+            self._open()
+
+    def _open(self):
+        self._file = open(self.path, 'a+b')
+        self._file.seek(0)
+        offset = 0
+        good_end = 0
+        for line in self._file:
+            if line.endswith('\n') and '\t' in line:
+                self.index[line[:line.index('\t')]] = offset
+                good_end = offset + len(line)
+            offset += len(line)
+        if good_end != offset:
+            # drop a line cut short by a crash
+            self._file.truncate(good_end)
+        self._file.seek(0, os.SEEK_END)
+        if self.index:
+            print 'Loaded %i cached dashd RPC results' % (len(self.index),)
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def _count(self, endpoint, method, result):
+        requests_counter.inc(1, (endpoint, method, result))
+        stats = self.stats.setdefault(endpoint, dict(hits=0, misses=0, uncacheable=0))
+        stats['misses' if result == 'miss' else 'uncacheable' if result == 'uncacheable' else 'hits'] += 1
+
+    def cacheable(self, method, params):
+        if method in ('getblockheader', 'getblock'):
+            return len(params) >= 1 and (len(params) < 2 or params[1] not in (0, False))
+        elif method == 'getblockhash':
+            return len(params) == 1
+        return False
+
+    def lookup(self, endpoint, method, params):
+        '''Returns (True, result) on a hit, else (False, None)'''
+        if not self.cacheable(method, params):
+            self._count(endpoint, method, 'uncacheable')
+            return False, None
+        key = _key(method, params)
+        if key in self.lru:
+            self._count(endpoint, method, 'memory')
+            return True, self.lru.get(key)
+        if key in self.index:
+            try:
+                self._file.seek(self.index[key])
+                line = self._file.readline()
+                self._file.seek(0, os.SEEK_END)
+                result = json.loads(line[line.index('\t') + 1:])
+            except Exception:
+                log.err(None, 'Error reading dashd RPC cache:')
+            else:
+                self.lru[key] = result
+                self._count(endpoint, method, 'disk')
+                return True, result
+        self._count(endpoint, method, 'miss')
+        return False, None
+
+    def _is_final(self, method, params, result):
+        if method == 'getblockhash':
+            return self.best_height is not None and self.best_height - params[0] + 1 >= CACHE_CONFIRMATIONS
+        return isinstance(result, dict) and result.get('confirmations', 0) >= CACHE_CONFIRMATIONS
+
+    def store(self, method, params, result):
+        if isinstance(result, dict) and 'height' in result and result.get('confirmations', 0) > 0:
+            self.best_height = max(self.best_height, result['height'] + result['confirmations'] - 1)
+        if not self.cacheable(method, params) or not self._is_final(method, params, result):
+            return
+        key = _key(method, params)
+        if key in self.index or key in self.lru:
+            return
+        data = json.dumps(result, separators=(',', ':'))
+        if len(data) > MAX_ENTRY_SIZE:
+            return
+        self.lru[key] = result
+        if method != 'getblockhash' and 'hash' in result and 'height' in result:
+            # a final header also answers getblockhash for its height
+            self.lru[_key('getblockhash', [result['height']])] = result['hash']
+        if self._file is not None:
+            self._file.seek(0, os.SEEK_END)
+            self.index[key] = self._file.tell()
+            self._file.write(key + '\t' + data + '\n')
+            self._file.flush()
+
+    def get_stats(self):
+        res = {}
+        for endpoint, stats in self.stats.iteritems():
+            total = stats['hits'] + stats['misses'] + stats['uncacheable']
+            res[endpoint] = dict(stats,
+                rpc_calls_saved=stats['hits'],
+                hit_rate=stats['hits']/total if total else None,
+            )
+        return dict(
+            endpoints=res,
+            memory_entries=len(self.lru),
+            disk_entries=len(self.index),
+            best_height=self.best_height,
+        )
+
+class CachingProxy(jsonrpc.Proxy):
+    def __init__(self, proxy, cache, endpoint='other'):
+        jsonrpc.Proxy.__init__(self, self.call, batch_func=self.batch)
+        self.proxy = proxy
+        self.cache = cache
+        self.endpoint = endpoint
+
+    def view(self, endpoint, priority=None):
+        return CachingProxy(rpc_scheduler.with_priority(self.proxy, priority) if priority is not None else self.proxy, self.cache, endpoint)
+
+    def cancel(self, priority):
+        if isinstance(self.proxy, rpc_scheduler.RPCScheduler):
+            self.proxy.cancel(priority)
+
+    @defer.inlineCallbacks
+    def call(self, method, params):
+        hit, result = self.cache.lookup(self.endpoint, method, params)
+        if hit:
+            defer.returnValue(result)
+        result = yield getattr(self.proxy, 'rpc_' + method)(*params)
+        self.cache.store(method, params, result)
+        defer.returnValue(result)
+
+    @defer.inlineCallbacks
+    def batch(self, calls):
+        results = [None]*len(calls)
+        missing = []
+        for i, (method, params) in enumerate(calls):
+            hit, results[i] = self.cache.lookup(self.endpoint, method, params)
+            if not hit:
+                missing.append(i)
+        if missing:
+            fetched = yield self.proxy.batch([calls[i] for i in missing])
+            for i, result in zip(missing, fetched):
+                results[i] = result
+                if not isinstance(result, jsonrpc.Error):
+                    self.cache.store(calls[i][0], calls[i][1], result)
+        defer.returnValue(results)
+
+def view(dashd, endpoint, priority=None):
+    '''Returns dashd as seen by endpoint, in the given scheduler class'''
+    if isinstance(dashd, CachingProxy):
+        return dashd.view(endpoint, priority)
+    if priority is not None:
+        return rpc_scheduler.with_priority(dashd, priority)
+    return dashd
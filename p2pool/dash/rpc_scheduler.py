@@ -0,0 +1,174 @@
+'''
+Priority scheduling of dashd RPC calls.
+
+Everything that talks to dashd shares one connection to it. RPCScheduler
+sits in front of the jsonrpc.HTTPProxy and queues calls by priority class:
+
+    submit    block submission; never waits for other classes
+    template  getblocktemplate polling
+    lookup    block/height lookups and everything not classified otherwise
+    stats     web dashboard and backfill calls
+
+Apart from submit, at most max_in_flight calls run at once, and each class
+has its own concurrency cap, so stats calls can never take every slot.
+Queued calls are started highest class first, oldest first. A call that
+waits longer than its class deadline fails with DeadlineExceeded, and
+cancelling the Deferred of a queued call drops it from the queue.
+
+The scheduler is a drop-in jsonrpc.Proxy, classifying rpc_* calls by
+method; use with_priority() to pick the class explicitly:
+
+    stats_dashd = rpc_scheduler.with_priority(wb.dashd, 'stats')
+    header = yield stats_dashd.rpc_getblockheader(block_hash)
+'''
+
+from __future__ import division
+
+import collections
+import time
+
+from twisted.internet import defer, reactor
+from twisted.python import failure
+
+from p2pool.util import jsonrpc, metrics
+
+# name, concurrency cap (None for no cap), queue deadline in seconds (None for none)
+PRIORITY_CLASSES = [
+    ('submit', None, None),
+    ('template', 2, 30),
+    ('lookup', 4, 60),
+    ('stats', 2, 30),
+]
+RESERVED_CLASSES = set(['submit']) # own lane: neither limited by nor counted against max_in_flight
+
+queued_gauge = metrics.gauge('p2pool_dashd_rpc_queued', 'dashd RPC calls waiting in the scheduler, by priority class', ['priority'])
+in_flight_gauge = metrics.gauge('p2pool_dashd_rpc_in_flight', 'dashd RPC calls being processed, by priority class', ['priority'])
+wait_seconds = metrics.histogram('p2pool_dashd_rpc_wait_seconds', 'Time dashd RPC calls spent queued in the scheduler, by priority class', ['priority'])
+expired_counter = metrics.counter('p2pool_dashd_rpc_expired', 'dashd RPC calls dropped from the scheduler queue, by priority class and reason', ['priority', 'reason'])
+
+class DeadlineExceeded(defer.TimeoutError):
+    pass
+
+def classify(method, params):
+    if method == 'submitblock':
+        return 'submit'
+    elif method == 'getblocktemplate':
+        if params and isinstance(params[0], dict) and params[0].get('mode') == 'submit':
+            return 'submit'
+        return 'template'
+    elif method == 'getmemorypool':
+        return 'submit' if params else 'template'
+    else:
+        return 'lookup'
+
+def with_priority(dashd, priority):
+    '''Returns a proxy for dashd whose calls are in the given class, if dashd is scheduled'''
+    if isinstance(dashd, RPCScheduler):
+        return dashd.with_priority(priority)
+    return dashd
+
+class _Call(object):
+    __slots__ = 'priority func df queued_at expire_call running'.split(' ')
+
+class RPCScheduler(jsonrpc.Proxy):
+    def __init__(self, proxy, max_in_flight=4, classes=PRIORITY_CLASSES):
+        jsonrpc.Proxy.__init__(self, lambda method, params: self.call(classify(method, params), method, params),
+            batch_func=lambda calls: self.batch(calls, 'lookup'))
+        self.proxy = proxy
+        self.max_in_flight = max_in_flight
+        self.order = [name for name, cap, deadline in classes]
+        self.caps = dict((name, cap) for name, cap, deadline in classes)
+        self.deadlines = dict((name, deadline) for name, cap, deadline in classes)
+        self.queues = dict((name, collections.deque()) for name in self.order)
+        self.in_flight = dict((name, 0) for name in self.order)
+        for name in self.order:
+            queued_gauge.set(0, (name,))
+            in_flight_gauge.set(0, (name,))
+
+    def with_priority(self, priority):
+        assert priority in self.queues, priority
+        return jsonrpc.Proxy(lambda method, params: self.call(priority, method, params),
+            batch_func=lambda calls: self.batch(calls, priority))
+
+    def call(self, priority, method, params):
+        return self._enqueue(priority, lambda: getattr(self.proxy, 'rpc_' + method)(*params))
+
+    def batch(self, calls, priority='lookup'):
+        return self._enqueue(priority, lambda: self.proxy.batch(calls))
+
+    def _enqueue(self, priority, func):
+        c = _Call()
+        c.priority = priority
+        c.func = func
+        c.df = defer.Deferred(lambda df: self._cancel(c))
+        c.queued_at = time.time()
+        c.expire_call = None
+        c.running = None
+        deadline = self.deadlines[priority]
+        if deadline is not None:
+            c.expire_call = reactor.callLater(deadline, self._expire, c)
+        self.queues[priority].append(c)
+        queued_gauge.inc(1, (priority,))
+        self._pump()
+        return c.df
+
+    def _unqueue(self, c):
+        self.queues[c.priority].remove(c)
+        queued_gauge.dec(1, (c.priority,))
+        if c.expire_call is not None and c.expire_call.active():
+            c.expire_call.cancel()
+
+    def _expire(self, c):
+        c.expire_call = None
+        self._unqueue(c)
+        expired_counter.inc(1, (c.priority, 'deadline'))
+        c.df.errback(DeadlineExceeded('%s call waited more than %is in the dashd RPC queue' % (c.priority, self.deadlines[c.priority])))
+
+    def _cancel(self, c):
+        if c.running is not None:
+            c.running.cancel()
+        else:
+            self._unqueue(c)
+            expired_counter.inc(1, (c.priority, 'cancelled'))
+
+    def cancel(self, priority):
+        '''Cancels every queued call of a class, e.g. stats calls nobody waits for anymore'''
+        for c in list(self.queues[priority]):
+            c.df.cancel()
+
+    def _can_start(self, priority):
+        cap = self.caps[priority]
+        if cap is not None and self.in_flight[priority] >= cap:
+            return False
+        if priority in RESERVED_CLASSES:
+            return True
+        return sum(n for name, n in self.in_flight.iteritems() if name not in RESERVED_CLASSES) < self.max_in_flight
+
+    def _pump(self):
+        while True:
+            for priority in self.order:
+                if self.queues[priority] and self._can_start(priority):
+                    break
+            else:
+                return
+            c = self.queues[priority][0]
+            self._unqueue(c)
+            self._start(c)
+
+    def _start(self, c):
+        wait_seconds.observe(time.time() - c.queued_at, (c.priority,))
+        self.in_flight[c.priority] += 1
+        in_flight_gauge.inc(1, (c.priority,))
+        c.running = defer.maybeDeferred(c.func)
+        def done(res):
+            self.in_flight[c.priority] -= 1
+            in_flight_gauge.dec(1, (c.priority,))
+            c.running = None
+            if c.df.called:
+                pass # cancelled while running
+            elif isinstance(res, failure.Failure):
+                c.df.errback(res)
+            else:
+                c.df.callback(res)
+            self._pump()
+        c.running.addBoth(done)
@@ -8,10 +8,14 @@ from twisted.python import log
 
 import p2pool
 from p2pool.dash import data as dash_data, getwork
-from p2pool.util import expiring_dict, jsonrpc, pack
+from p2pool.util import expiring_dict, jsonrpc, metrics, pack, timing
 from p2pool.util import security_config
 
 
+connections_gauge = metrics.gauge('p2pool_stratum_connections', 'Open stratum connections')
+submits_counter = metrics.counter('p2pool_stratum_submits', 'Stratum share submissions by result', ['result'])
+submitted_difficulty_counter = metrics.counter('p2pool_stratum_submitted_difficulty', 'Sum of the difficulty of stratum share submissions', ['result'])
+
 def clip(num, bot, top):
     return min(top, max(bot, num))
 
@@ -93,6 +97,7 @@ class PoolStatistics(object):
         """Register a new stratum connection"""
         self.connections[conn_id] = connection
         self.connection_count = len(self.connections)
+        connections_gauge.set(self.connection_count)
         
         # Track per-IP connections
         if ip:
@@ -105,6 +110,7 @@ class PoolStatistics(object):
         if conn_id in self.connections:
             del self.connections[conn_id]
         self.connection_count = len(self.connections)
+        connections_gauge.set(self.connection_count)
         
         # Update per-IP count
         if ip and ip in self.ip_connections:
@@ -302,6 +308,10 @@ class PoolStatistics(object):
         stats['shares'] += 1
         stats['last_seen'] = now
         
+        result = 'accepted' if accepted else 'rejected'
+        submits_counter.inc(1, (result,))
+        submitted_difficulty_counter.inc(difficulty, (result,))
+        
         if accepted:
             stats['accepted'] += 1
             self.total_shares_accepted += 1
@@ -603,8 +613,12 @@ class StratumRPCMiningProvider(object):
                 transport.loseConnection()
             return
 
-        # Connection accepted — register and subscribe to work events
-        self.watch_id = self.wb.new_work_event.watch(self._send_work)
+        # Connection accepted - register and subscribe to work events
+        if hasattr(self.wb, 'watch_work'):
+            # sent new work by the bridge's fan-out, busiest payout addresses first
+            self.watch_id = self.wb.watch_work(self._get_work_args, self._send_work)
+        else:
+            self.watch_id = self.wb.new_work_event.watch(self._send_work)
         self.conn_id = id(self)
         pool_stats.register_connection(self.conn_id, self, self.worker_ip)
     
@@ -661,7 +675,7 @@ class StratumRPCMiningProvider(object):
         #   +N : pseudoshare difficulty -> locks stratum vardiff at diff N
         #   /N : share difficulty hint  -> consensus-clamped at share-generation time
         # Note: this is a behavior change from a prior stratum-local parser that
-        # treated '/N' as '+N'. '/N' no longer locks vardiff — use '+N' for that.
+        # treated '/N' as '+N'. '/N' no longer locks vardiff - use '+N' for that.
         _, _, self.desired_share_target, self.desired_pseudoshare_target = self.wb.get_user_details(self.username)
 
         # Stratum-only extension: '+sN' selects share rate (seconds per pseudoshare).
@@ -830,11 +844,14 @@ class StratumRPCMiningProvider(object):
         print 'STRATUM: Stored session %s for reconnect' % self.session_id[:16]
         return True
     
-    def _send_work(self):
+    def _get_work_args(self):
+        return self.wb.preprocess_request('' if self.username is None else self.username)
+    
+    def _send_work(self, args=None):
         if p2pool.DEBUG:
             print 'STRATUM: _send_work called for %s (username=%s)' % (self.worker_ip, self.username)
         try:
-            x, got_response = self.wb.get_work(*self.wb.preprocess_request('' if self.username is None else self.username))
+            x, got_response = self.wb.get_work(*(self._get_work_args() if args is None else args))
             if p2pool.DEBUG:
                 print 'STRATUM: _send_work got work for %s' % self.worker_ip
         except Exception as e:
@@ -954,9 +971,9 @@ class StratumRPCMiningProvider(object):
         ).addErrback(lambda err: None)
         self.handler_map[jobid] = x, got_response, job_target  # Store job_target with the job
     
+    @timing.timed('stratum.rpc_submit')
     def rpc_submit(self, worker_name, job_id, extranonce2, ntime, nonce, version_bits=None, *args):
         # ASICBOOST: version_bits is the version mask that the miner used
-        t0 = time.time()  # Benchmarking start
         worker_name = worker_name.strip()
         
         # ==== Check if worker is banned ====
@@ -1118,14 +1135,6 @@ class StratumRPCMiningProvider(object):
                 self.recent_shares = [now]
                 self._send_work()
         
-        # Benchmarking: print timing if BENCH enabled
-        t1 = time.time()
-        try:
-            if p2pool.BENCH and (t1-t0) > 0.01:  # Only log if > 10ms
-                print "%8.3f ms for stratum:rpc_submit(%s)" % ((t1-t0)*1000., worker_name)
-        except:
-            pass
-        
         return result
     
     def rpc_set_extranonce(self, extranonce1, extranonce2_size):
@@ -1198,7 +1207,10 @@ class StratumRPCMiningProvider(object):
         """
         # Only unwatch if connection was accepted (watch_id is None for rejected connections)
         if self.watch_id is not None:
-            self.wb.new_work_event.unwatch(self.watch_id)
+            if hasattr(self.wb, 'watch_work'):
+                self.wb.unwatch_work(self.watch_id)
+            else:
+                self.wb.new_work_event.unwatch(self.watch_id)
         
         # Store session for potential resumption (only if connection was accepted)
         if self.conn_id is not None and self.session_id:
@@ -0,0 +1,58 @@
+'''
+Incremental decoding of getblocktemplate transactions.
+
+Consecutive block templates mostly list the same transactions: between
+blocks the mempool only churns a few percent. TemplateDiffer keeps the
+decoded transaction and its hash for every txid in the last template, so
+each new template only hex-decodes, unpacks and hashes the transactions
+it hasn't seen before. Transactions dropped from the template are
+forgotten.
+
+Transactions are keyed by the txid dashd reports for them, or by their
+hex data if it doesn't report one (e.g. getmemorypool).
+'''
+
+from __future__ import division
+
+from p2pool.dash import data as dash_data
+from p2pool.util import metrics
+
+transactions_counter = metrics.counter('p2pool_template_transactions', 'Block template transactions seen, by whether they were decoded or reused from the previous template', ['result'])
+
+def _key(x):
+    if isinstance(x, dict):
+        return x.get('txid') or x.get('hash') or x['data']
+    return x
+
+class TemplateDiffer(object):
+    def __init__(self):
+        self.txs = {} # key -> (tx, tx_hash)
+        self.last_stats = dict(decoded=0, reused=0, removed=0)
+
+    def update(self, template_txs):
+        '''
+        Takes the transactions list of a getblocktemplate result and returns
+        (transactions, transaction_hashes) in template order
+        '''
+        new_txs = {}
+        transactions = []
+        transaction_hashes = []
+        decoded = 0
+        for x in template_txs:
+            key = _key(x)
+            entry = self.txs.get(key)
+            if entry is None:
+                entry = new_txs.get(key)
+            if entry is None:
+                packed = (x['data'] if isinstance(x, dict) else x).decode('hex')
+                entry = dash_data.tx_type.unpack(packed), dash_data.hash256(packed)
+                decoded += 1
+            new_txs[key] = entry
+            transactions.append(entry[0])
+            transaction_hashes.append(entry[1])
+        removed = sum(1 for key in self.txs if key not in new_txs)
+        self.txs = new_txs
+        self.last_stats = dict(decoded=decoded, reused=len(transactions) - decoded, removed=removed)
+        transactions_counter.inc(decoded, ('decoded',))
+        transactions_counter.inc(len(transactions) - decoded, ('reused',))
+        return transactions, transaction_hashes
@@ -1,15 +1,18 @@
 from __future__ import division
 
 import StringIO
+import itertools
 import json
 import random
 import sys
+import time
 
 from twisted.internet import defer
+from twisted.python import log
 
 import p2pool
 from p2pool.dash import data as dash_data, getwork
-from p2pool.util import expiring_dict, jsonrpc, pack, variable
+from p2pool.util import deferral, expiring_dict, jsonrpc, pack, variable
 
 class _Provider(object):
     def __init__(self, parent, long_poll):
@@ -107,21 +110,109 @@ class WorkerInterface(object):
         defer.returnValue(res.getwork(**extra_params))
 
 class CachingWorkerBridge(object):
-    def __init__(self, inner):
+    '''
+    Caches get_work results per argument tuple until the next new work
+    event, handing out a different coinbase nonce on each call.
+    
+    Connections that register with watch_work() are sent new work by a
+    fan-out instead of by watching new_work_event themselves: watchers are
+    grouped by their get_work arguments and, busiest group first, the job
+    for a group is generated, the group's watchers are called (and so get
+    cached work) and, every slice_time seconds, control goes back to the
+    reactor so the notifies already made are sent while the rest are
+    generated. With prefetch=False every watcher is simply called when the
+    event fires.
+    '''
+    
+    def __init__(self, inner, prefetch=True, slice_time=.005):
         self._inner = inner
         self.net = self._inner.net
         
         self.COINBASE_NONCE_LENGTH = (inner.COINBASE_NONCE_LENGTH+1)//2
         self.new_work_event = inner.new_work_event
         self.preprocess_request = inner.preprocess_request
+        self.get_user_details = inner.get_user_details
         self.share_rate = inner.share_rate  # Pass through share_rate from inner bridge
         
         self._my_bits = (self._inner.COINBASE_NONCE_LENGTH - self.COINBASE_NONCE_LENGTH)*8
         
         self._cache = {}
         self._times = None
+        
+        self.prefetch = prefetch
+        self.slice_time = slice_time
+        self._watchers = {} # id -> (get_args, callback)
+        self._watcher_ids = itertools.count()
+        self.last_fan_out = None
+        self.new_work_event.watch(self._new_work)
     
-    def get_work(self, *args):
+    def watch_work(self, get_args, callback):
+        '''
+        callback(args) is called on new work with the get_work arguments
+        get_args() returned, or with None if the watcher is to get them itself
+        '''
+        watch_id = self._watcher_ids.next()
+        self._watchers[watch_id] = get_args, callback
+        return watch_id
+    
+    def unwatch_work(self, watch_id):
+        self._watchers.pop(watch_id, None)
+    
+    def _new_work(self):
+        if not self.prefetch:
+            for watch_id, (get_args, callback) in sorted(self._watchers.iteritems()):
+                self._call_watcher(watch_id, None)
+            return
+        self._fan_out(self.new_work_event.times).addErrback(log.err, 'Error while sending new work:')
+    
+    def _call_watcher(self, watch_id, args):
+        watcher = self._watchers.get(watch_id)
+        if watcher is None:
+            return # disconnected meanwhile
+        try:
+            watcher[1](args)
+        except:
+            log.err(None, 'Error in new work watcher:')
+    
+    @defer.inlineCallbacks
+    def _fan_out(self, times):
+        start = time.time()
+        groups = {}
+        for watch_id, (get_args, callback) in self._watchers.iteritems():
+            try:
+                args = tuple(get_args())
+            except Exception:
+                args = None # left to the watcher
+            groups.setdefault(args, []).append(watch_id)
+        
+        first_notify = None
+        slices = 1
+        slice_start = time.time()
+        for args, watch_ids in sorted(groups.iteritems(), key=lambda (args, watch_ids): (-len(watch_ids), min(watch_ids))):
+            if self.new_work_event.times != times:
+                return # superseded by newer work
+            if args is not None:
+                try:
+                    self.prefetch_work(args)
+                except Exception:
+                    pass # each watcher will hit and handle the error itself
+            for watch_id in sorted(watch_ids):
+                self._call_watcher(watch_id, args) # get_args isn't called again, it may draw random fees or rotate addresses
+            if first_notify is None:
+                first_notify = time.time() - start
+            if time.time() - slice_start >= self.slice_time:
+                yield deferral.sleep(0)
+                slices += 1
+                slice_start = time.time()
+        self.last_fan_out = dict(
+            watchers=sum(len(watch_ids) for watch_ids in groups.itervalues()),
+            groups=len(groups),
+            slices=slices,
+            first_notify=first_notify,
+            last_notify=time.time() - start,
+        )
+    
+    def prefetch_work(self, args):
         if self._times != self.new_work_event.times:
             self._cache = {}
             self._times = self.new_work_event.times
@@ -129,6 +220,9 @@ class CachingWorkerBridge(object):
         if args not in self._cache:
             x, handler = self._inner.get_work(*args)
             self._cache[args] = x, handler, 0
+    
+    def get_work(self, *args):
+        self.prefetch_work(args)
         
         x, handler, nonce = self._cache.pop(args)
         
@@ -10,7 +10,7 @@ from twisted.python import log
 
 import p2pool
 from p2pool.dash import data as dash_data, script, sha256
-from p2pool.util import math, forest, pack
+from p2pool.util import math, forest, pack, timing
 
 def parse_bip0034(coinbase):
     """Extract block height from coinbase transaction (BIP 34)"""
@@ -302,6 +302,7 @@ class Share(object):
     
     __slots__ = 'net peer_addr contents min_header share_info hash_link merkle_link hash share_data max_target target timestamp previous_hash new_script desired_version gentx_hash header pow_hash header_hash new_transaction_hashes time_seen absheight abswork'.split(' ')
     
+    @timing.timed('data.Share.__init__')
     def __init__(self, net, peer_addr, contents):
         self.net = net
         self.peer_addr = peer_addr
@@ -527,6 +528,7 @@ class OkayTracker(forest.Tracker):
             self.verified.add(share)
             return True
     
+    @timing.timed('data.OkayTracker.think')
     def think(self, block_rel_height_func, previous_block, bits, known_txs):
         desired = set()
         bad_peer_addresses = set()
@@ -760,6 +762,7 @@ class ShareStore(object):
         self.known = known # filename -> (set of share hashes, set of verified hashes)
         self.known_desired = dict((k, (set(a), set(b))) for k, (a, b) in known.iteritems())
     
+    @timing.timed('data.ShareStore.write')
     def _add_line(self, line, critical=False):
         """Write a line to share storage.
         
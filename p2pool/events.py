@@ -0,0 +1,231 @@
+'''
+Push feed of node events for external tools.
+
+EventBus.publish(type, **fields) encodes an event once, as a line of JSON
+like {"type": "share", "seq": 12, "time": 1700000000.0, ...fields}, and
+hands it to every subscriber. Subscribers are twisted push producers for
+the connection they feed: while its transport's buffer is full an event
+waits in the subscriber's queue, and once max_queue events are waiting
+further ones are dropped and counted. Where events were dropped the
+subscriber gets {"type": "dropped", "count": n} in their place.
+
+EventStreamFactory serves newline-delimited JSON on any server endpoint
+(TCP or a unix socket) and EventStreamResource serves Server-Sent Events
+over HTTP, where ?types=share,block_found limits the stream to some types.
+Event streams are served behind the web interface's auth and rate limit,
+to at most max_subscribers clients at a time.
+The types published by watch_node are:
+
+    share             a share was verified
+    block_found       a verified share is also a block
+    best_share        the best share changed
+    new_work          new work was pushed to miners
+    peer_connected    a p2pool peer connected
+    peer_disconnected a p2pool peer disconnected
+'''
+
+from __future__ import division
+
+import collections
+import itertools
+import json
+import time
+
+from twisted.internet import protocol
+from twisted.python import log
+from twisted.web import resource, server
+
+from p2pool.dash import data as dash_data
+from p2pool.util import metrics
+
+published_counter = metrics.counter('p2pool_events_published', 'Events published on the event feed, by type', ['type'])
+dropped_counter = metrics.counter('p2pool_events_dropped', 'Events dropped because a feed subscriber was too slow, by transport', ['transport'])
+subscribers_gauge = metrics.gauge('p2pool_event_subscribers', 'Event feed subscribers, by transport', ['transport'])
+
+class Subscriber(object):
+    def __init__(self, write, max_queue=1000, types=None, transport='local'):
+        self.write = write # called with each encoded event
+        self.max_queue = max_queue
+        self.types = types # set of event types, or None for all of them
+        self.transport = transport
+        self.queue = collections.deque()
+        self.paused = False
+        self.sent = 0
+        self.dropped = 0
+        self._unreported_drops = 0
+
+    def deliver(self, event_type, line):
+        if self.types is not None and event_type not in self.types:
+            return
+        if self.paused:
+            if len(self.queue) >= self.max_queue:
+                self.dropped += 1
+                self._unreported_drops += 1
+                dropped_counter.inc(1, (self.transport,))
+            else:
+                self.queue.append(line)
+            return
+        self._send(line)
+
+    def _send(self, line):
+        self.write(line)
+        self.sent += 1
+
+    # IPushProducer
+
+    def pauseProducing(self):
+        self.paused = True
+
+    def resumeProducing(self):
+        self.paused = False
+        while self.queue and not self.paused:
+            self._send(self.queue.popleft())
+        if self._unreported_drops and not self.paused:
+            count, self._unreported_drops = self._unreported_drops, 0
+            self.write(json.dumps(dict(type='dropped', count=count)))
+
+    def stopProducing(self):
+        self.paused = True
+        self.queue.clear()
+
+    def get_stats(self):
+        return dict(transport=self.transport, sent=self.sent, queued=len(self.queue), dropped=self.dropped)
+
+class EventBus(object):
+    def __init__(self, max_queue=1000):
+        self.max_queue = max_queue
+        self.subscribers = []
+        self._seq = itertools.count(1)
+        self.published = collections.defaultdict(int) # type -> count
+
+    def subscribe(self, write, types=None, transport='local'):
+        subscriber = Subscriber(write, self.max_queue, types, transport)
+        self.subscribers.append(subscriber)
+        subscribers_gauge.inc(1, (transport,))
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        if subscriber in self.subscribers:
+            self.subscribers.remove(subscriber)
+            subscribers_gauge.dec(1, (subscriber.transport,))
+
+    def publish(self, event_type, **fields):
+        self.published[event_type] += 1
+        published_counter.inc(1, (event_type,))
+        if not self.subscribers:
+            return
+        line = json.dumps(dict(fields, type=event_type, seq=self._seq.next(), time=time.time()))
+        for subscriber in list(self.subscribers):
+            try:
+                subscriber.deliver(event_type, line)
+            except Exception:
+                log.err(None, 'Error delivering event to subscriber:')
+                self.unsubscribe(subscriber)
+
+    def get_stats(self):
+        return dict(
+            published=dict(self.published),
+            subscribers=[subscriber.get_stats() for subscriber in self.subscribers],
+        )
+
+def parse_types(value):
+    '''Parses a comma-separated list of event types; None (all types) if it is empty'''
+    types = set(x for x in value.split(',') if x)
+    return types if types else None
+
+# newline-delimited JSON over a stream socket
+
+class EventStreamProtocol(protocol.Protocol):
+    def connectionMade(self):
+        self.subscriber = self.factory.bus.subscribe(lambda line: self.transport.write(line + '\n'),
+            self.factory.types, 'socket')
+        self.transport.registerProducer(self.subscriber, True)
+
+    def connectionLost(self, reason):
+        self.factory.bus.unsubscribe(self.subscriber)
+
+class EventStreamFactory(protocol.ServerFactory):
+    protocol = EventStreamProtocol
+
+    def __init__(self, bus, types=None):
+        self.bus = bus
+        self.types = types
+
+# Server-Sent Events over HTTP
+
+class EventStreamResource(resource.Resource):
+    isLeaf = True
+
+    def __init__(self, bus, max_subscribers=50):
+        resource.Resource.__init__(self)
+        self.bus = bus
+        self.max_subscribers = max_subscribers # each can hold max_queue events while it's slow
+
+    def render_GET(self, request):
+        from p2pool import web # web imports this module
+        error = web.check_request(request)
+        if error is not None:
+            return error
+        if sum(1 for subscriber in self.bus.subscribers if subscriber.transport == 'sse') >= self.max_subscribers:
+            request.setResponseCode(503)
+            request.setHeader('Content-Type', 'application/json')
+            return json.dumps({'error': 'Too many event stream subscribers'})
+        request.setHeader('Content-Type', 'text/event-stream')
+        request.setHeader('Cache-Control', 'no-cache')
+        request.setHeader('Access-Control-Allow-Origin', '*')
+        types = parse_types(request.args['types'][0]) if 'types' in request.args else None
+        subscriber = self.bus.subscribe(lambda line: request.write('data: %s\n\n' % (line,)), types, 'sse')
+        request.registerProducer(subscriber, True)
+        request.notifyFinish().addBoth(lambda _: self.bus.unsubscribe(subscriber))
+        request.write(': p2pool events\n\n') # sends the headers right away
+        return server.NOT_DONE_YET
+
+# node hookup
+
+def watch_node(bus, node, wb):
+    '''Publishes the node's share, block, work and peer events on bus'''
+    net = node.net
+
+    def share_fields(share):
+        return dict(
+            hash='%064x' % (share.hash,),
+            previous_hash='%064x' % (share.previous_hash,) if share.previous_hash is not None else None,
+            timestamp=share.timestamp,
+            difficulty=dash_data.target_to_difficulty(share.target),
+            miner=dash_data.script2_to_address(share.new_script, net.PARENT),
+        )
+
+    @node.tracker.verified.added.watch
+    def _(share):
+        fields = share_fields(share) if bus.subscribers else {} # with nobody to send it to, publish only counts it
+        bus.publish('share', **fields)
+        if share.pow_hash <= share.header['bits'].target:
+            bus.publish('block_found', block_hash='%064x' % (share.header_hash,), share=fields)
+
+    @node.best_share_var.changed.watch
+    def _(share_hash):
+        bus.publish('best_share',
+            hash='%064x' % (share_hash,) if share_hash is not None else None,
+            height=node.tracker.get_height(share_hash) if share_hash is not None else 0,
+        )
+
+    @wb.new_work_event.watch
+    def _():
+        work = wb.current_work.value
+        if work is None:
+            return
+        bus.publish('new_work',
+            previous_block='%064x' % (work['previous_block'],),
+            height=work['height'],
+            transactions=len(work['transactions']),
+        )
+
+    def peer_fields(conn):
+        return dict(
+            address='%s:%i' % conn.addr,
+            incoming=conn.incoming,
+            version=conn.other_sub_version,
+        )
+    node.p2p_node.peer_connected.watch(lambda conn: bus.publish('peer_connected', **peer_fields(conn)))
+    node.p2p_node.peer_disconnected.watch(lambda conn, reason: bus.publish('peer_disconnected',
+        reason=reason.getErrorMessage(), **peer_fields(conn)))
@@ -6,9 +6,248 @@ from twisted.internet import defer, reactor
 from twisted.python import log
 
 import p2pool
-from p2pool import data as p2pool_data, p2p
-from p2pool.dash import data as dash_data, helper, height_tracker
-from p2pool.util import deferral, variable
+from p2pool import data as p2pool_data, p2p, txstore
+from p2pool.dash import data as dash_data, helper, height_tracker, template_differ
+from p2pool.util import deferral, timing, variable
+
+
+class ShareRange(object):
+    '''Up to `count` consecutive shares from `start` back, stopping short of `stop`'''
+    
+    __slots__ = ['start', 'stop', 'count', 'rest', 'shares', 'peers', 'tried', 'requested_at']
+    
+    def __init__(self, start, stop, count):
+        self.start = start
+        self.stop = stop
+        self.count = count
+        self.rest = 0 # shares above `stop` left past `count` by splitting the range, asked for once it's in
+        self.shares = None # newest first once received; [] if no peer had them
+        self.peers = set() # peers asked for it that haven't answered yet
+        self.tried = set() # addresses of the peers it has been asked of
+        self.requested_at = None
+
+class ShareWalk(object):
+    '''The ranges fetched going down the chain from a desired share, newest first'''
+    
+    def __init__(self, peer_addr, remaining):
+        self.peer_addr = peer_addr # of the peer that sent the share whose parent is desired
+        self.remaining = remaining # shares that may still be asked for
+        self.ranges = []
+
+class ShareDownloader(object):
+    '''
+    Downloads the shares the tracker desires from several peers at once.
+    
+    Every desired share starts a walk down its chain, fetched as ranges of
+    consecutive shares, each asked of a peer with get_shares. Each share
+    names its 100th parent (far_share_hash), so when the range at the
+    bottom of a walk arrives, the walk goes on from 100 shares below it
+    while the 99 in between are fetched from another peer as a range with
+    an exact stop. A range whose peer fails or doesn't have it is asked of
+    another; one that is slow is also asked of an idle peer, and whichever
+    answers first is used. Replies arriving out of order are held until
+    the ranges above them are in, so shares are handed on parent first in
+    batches that attach to the tails the tracker already has.
+    '''
+    
+    FAR_DISTANCE = 100 # far_share_hash is the hash of this many shares back
+    
+    def __init__(self, tracker, get_desired, get_peers, handle_shares, walk_length, request_size=500, max_requests=4, max_walks=4, max_attempts=3, hedge_after=3, clock=reactor):
+        self.tracker = tracker
+        self.get_desired = get_desired # -> [(peer_addr, share hash)] of missing shares, as Node.desired_var
+        self.get_peers = get_peers
+        self.handle_shares = handle_shares # called with lists of shares, parent first
+        self.walk_length = walk_length
+        self.request_size = request_size
+        self.max_requests = max_requests
+        self.max_walks = max_walks
+        self.max_attempts = max_attempts
+        self.hedge_after = hedge_after
+        self.clock = clock
+        
+        self.walks = []
+        self.covered = {} # share hash -> walk, for range starts and shares received but not handed on yet
+        self.busy = {} # peer -> range it was asked for
+        self.peer_speeds = {} # peer address -> seconds per share of its replies, averaged
+        self._delayed = None
+    
+    def poll(self):
+        '''Starts walks for newly desired shares and sends what requests it can; repeats every second while there's anything to do'''
+        self.stop()
+        desired = self.get_desired() or []
+        for peer_addr, share_hash in desired:
+            if len(self.walks) >= self.max_walks:
+                break
+            if share_hash in self.covered or share_hash in self.tracker.items:
+                continue
+            print 'Requesting parent share %s' % (p2pool_data.format_hash(share_hash),)
+            walk = ShareWalk(peer_addr, self.walk_length)
+            self.walks.append(walk)
+            self._add_range(walk, len(walk.ranges), ShareRange(share_hash, None, min(self.request_size, walk.remaining)))
+        self._dispatch()
+        if self.walks or desired:
+            self._delayed = self.clock.callLater(1, self.poll)
+    
+    def stop(self):
+        if self._delayed is not None:
+            if self._delayed.active():
+                self._delayed.cancel()
+            self._delayed = None
+    
+    def get_stats(self):
+        return dict(
+            walks=len(self.walks),
+            requests=len(self.busy),
+            ranges=sum(len(walk.ranges) for walk in self.walks),
+            held_shares=sum(len(r.shares) for walk in self.walks for r in walk.ranges if r.shares),
+        )
+    
+    def _add_range(self, walk, index, r):
+        walk.ranges.insert(index, r)
+        walk.remaining -= r.count
+        self.covered[r.start] = walk
+    
+    def _get_stops(self, r):
+        stops = set(self.tracker.heads) | set(
+            self.tracker.get_nth_parent_hash(head, min(max(0, self.tracker.get_height_and_last(head)[0] - 1), 10)) for head in self.tracker.heads
+        )
+        return ([r.stop] if r.stop is not None else []) + list(stops)[:100]
+    
+    def _choose_peer(self, walk, r, idle):
+        candidates = [peer for peer in idle if peer.addr not in r.tried]
+        for peer in candidates:
+            if r is walk.ranges[0] and peer.addr == walk.peer_addr:
+                return peer
+        # peers not heard from yet are tried before ones known to be slow
+        return min(candidates, key=lambda peer: (self.peer_speeds.get(peer.addr, 0), random.random())) if candidates else None
+    
+    def _get_hedge_wait(self, r):
+        '''Seconds after which a range is also asked of another peer: twice what the typical peer takes for it, once that's known'''
+        if not self.peer_speeds:
+            return self.hedge_after
+        speeds = sorted(self.peer_speeds.itervalues())
+        return min(self.hedge_after, max(.5, 2*speeds[len(speeds)//2]*r.count))
+    
+    def _dispatch(self):
+        peers = self.get_peers()
+        idle = [peer for peer in peers if peer not in self.busy]
+        addrs = set(peer.addr for peer in peers)
+        # the bottom of each walk first, as it's what the rest of the walk waits for
+        waiting = sorted([(r is not walk.ranges[-1], i, walk, r) for walk in self.walks for i, r in enumerate(walk.ranges) if r.shares is None], key=lambda item: item[:2])
+        for bottom, i, walk, r in waiting:
+            if r.peers:
+                continue
+            if len(r.tried) >= self.max_attempts or addrs.issubset(r.tried) and peers:
+                self._fail(walk, r)
+                continue
+            if len(self.busy) >= self.max_requests:
+                continue
+            peer = self._choose_peer(walk, r, idle)
+            if peer is not None:
+                idle.remove(peer)
+                self._request(walk, r, peer)
+        now = self.clock.seconds()
+        for bottom, i, walk, r in waiting:
+            if r.shares is None and len(r.peers) == 1 and now - r.requested_at >= self._get_hedge_wait(r) and len(self.busy) < self.max_requests:
+                peer = self._choose_peer(walk, r, idle)
+                if peer is not None:
+                    idle.remove(peer)
+                    self._request(walk, r, peer)
+    
+    def _request(self, walk, r, peer):
+        r.peers.add(peer)
+        r.tried.add(peer.addr)
+        requested_at = r.requested_at = self.clock.seconds()
+        self.busy[peer] = r
+        df = peer.get_shares(
+            hashes=[r.start],
+            parents=r.count - 1,
+            stops=self._get_stops(r),
+        )
+        def got_error(fail):
+            if fail.check(p2p.Protocol.ShareReplyError) and fail.value.args[0] == 'too long' and r.count > 1:
+                return None # peers from before shares replies were cut to fit ask for fewer
+            if fail.check(defer.TimeoutError):
+                print 'Share request timed out!'
+            else:
+                log.err(fail, 'in download_shares:')
+            return []
+        df.addErrback(got_error)
+        df.addCallback(lambda shares: self._got_shares(walk, r, peer, shares, requested_at))
+    
+    def _got_shares(self, walk, r, peer, shares, requested_at):
+        if self.busy.get(peer) is r:
+            del self.busy[peer]
+        r.peers.discard(peer)
+        if r.shares is not None or walk not in self.walks:
+            self._dispatch() # answered by another peer first
+            return
+        if shares is None:
+            # too many shares to send at once: ask for half, without it counting as an attempt
+            r.tried.discard(peer.addr)
+            self._split(walk, r)
+            self._dispatch()
+            return
+        chain = []
+        for share in shares:
+            if share.hash != (chain[-1].previous_hash if chain else r.start) or len(chain) == r.count:
+                break
+            chain.append(share)
+        if chain:
+            speed = (self.clock.seconds() - requested_at)/len(chain)
+            self.peer_speeds[peer.addr] = (self.peer_speeds[peer.addr] + speed)/2 if peer.addr in self.peer_speeds else speed
+            r.shares = chain
+            for share in chain:
+                self.covered[share.hash] = walk
+            self._extend(walk, r)
+            self._release(walk)
+        self._dispatch()
+    
+    def _extend(self, walk, r):
+        next_hash = r.shares[-1].previous_hash
+        index = walk.ranges.index(r) + 1
+        if r.stop is None:
+            walk.remaining += r.count - len(r.shares)
+        if next_hash is None or next_hash == r.stop or next_hash in self.tracker.items or next_hash in self.covered:
+            return
+        if r.stop is not None:
+            # the peer sent less than the range, ask for the rest
+            self._add_range(walk, index, ShareRange(next_hash, r.stop, r.count + r.rest - len(r.shares)))
+            return
+        if walk.remaining <= 0:
+            return
+        far_hash = r.shares[-1].share_info['far_share_hash']
+        if far_hash is not None and walk.remaining > self.FAR_DISTANCE - 1 and far_hash not in self.tracker.items and far_hash not in self.covered:
+            self._add_range(walk, index, ShareRange(next_hash, far_hash, self.FAR_DISTANCE - 1))
+            self._add_range(walk, index + 1, ShareRange(far_hash, None, min(self.request_size, walk.remaining)))
+        else:
+            self._add_range(walk, index, ShareRange(next_hash, None, min(self.request_size, walk.remaining)))
+    
+    def _split(self, walk, r):
+        half = r.count//2
+        r.count -= half
+        if r.stop is None:
+            walk.remaining += half
+        else:
+            r.rest += half
+    
+    def _fail(self, walk, r):
+        r.shares = []
+        self._release(walk)
+    
+    def _release(self, walk):
+        batch = []
+        while walk.ranges and walk.ranges[0].shares is not None:
+            r = walk.ranges.pop(0)
+            self.covered.pop(r.start, None)
+            for share in r.shares:
+                self.covered.pop(share.hash, None)
+            batch.extend(r.shares)
+        if not walk.ranges:
+            self.walks.remove(walk)
+        if batch:
+            batch.reverse()
+            self.handle_shares(batch)
 
 
 class P2PNode(p2p.Node):
@@ -21,6 +260,7 @@ class P2PNode(p2p.Node):
             mining_txs_var=node.mining_txs_var,
         **kwargs)
     
+    @timing.timed('node.handle_shares')
     def handle_shares(self, shares, peer):
         if len(shares) > 5:
             print 'Processing %i shares from %s...' % (len(shares), '%s:%i' % peer.addr if peer is not None else None)
@@ -78,6 +318,29 @@ class P2PNode(p2p.Node):
             print 'Sending %i shares to %s:%i' % (len(shares), peer.addr[0], peer.addr[1])
         return shares
     
+    def remembered_txs_changed(self, peer, added, removed):
+        # keep the txs a peer remembered for its shares while it does
+        known_txs = self.node.known_txs_var.value
+        missing = dict((tx_hash, peer.remembered_txs[tx_hash]) for tx_hash in added if tx_hash not in known_txs)
+        if missing:
+            self.node.known_txs_var.add(missing)
+        known_txs.ref(added)
+        known_txs.unref(removed)
+    
+    def lost_conn(self, conn, reason):
+        p2p.Node.lost_conn(self, conn, reason)
+        self.node.known_txs_var.value.unref(conn.remembered_txs)
+    
+    def handle_get_share_txs(self, share_hash, indexes, peer):
+        share = self.node.tracker.items.get(share_hash)
+        if share is None:
+            return []
+        tx_hashes = share.share_info['new_transaction_hashes']
+        known_txs = self.node.known_txs_var.value
+        if not all(0 <= i < len(tx_hashes) and tx_hashes[i] in known_txs for i in indexes):
+            return []
+        return [known_txs[tx_hashes[i]] for i in indexes]
+    
     def handle_bestblock(self, header, peer):
         if self.node.net.PARENT.POW_FUNC(dash_data.block_header_type.pack(header)) > header['bits'].target:
             raise p2p.PeerMisbehavingError('received block header fails PoW test')
@@ -91,8 +354,9 @@ class P2PNode(p2p.Node):
             self.shared_share_hashes.add(share.hash)
             shares.append(share)
         
+        encoder = p2p.BroadcastEncoder(self.node.known_txs_var.value)
         for peer in self.peers.itervalues():
-            peer.sendShares([share for share in shares if share.peer_addr != peer.addr], self.node.tracker, self.node.known_txs_var.value, include_txs_with=[share_hash])
+            peer.sendShares([share for share in shares if share.peer_addr != peer.addr], self.node.tracker, self.node.known_txs_var.value, include_txs_with=[share_hash], encoder=encoder)
     
     def start(self):
         p2p.Node.start(self)
@@ -100,38 +364,14 @@ class P2PNode(p2p.Node):
         self.shared_share_hashes = set(self.node.tracker.items)
         self.node.tracker.removed.watch_weakref(self, lambda self, share: self.shared_share_hashes.discard(share.hash))
         
-        @apply
-        @defer.inlineCallbacks
-        def download_shares():
-            while True:
-                desired = yield self.node.desired_var.get_when_satisfies(lambda val: len(val) != 0)
-                peer_addr, share_hash = random.choice(desired)
-                
-                if len(self.peers) == 0:
-                    yield deferral.sleep(1)
-                    continue
-                peer = random.choice(self.peers.values())
-                
-                print 'Requesting parent share %s from %s' % (p2pool_data.format_hash(share_hash), '%s:%i' % peer.addr)
-                try:
-                    shares = yield peer.get_shares(
-                        hashes=[share_hash],
-                        parents=random.randrange(500), # randomize parents so that we eventually get past a too large block of shares
-                        stops=list(set(self.node.tracker.heads) | set(
-                            self.node.tracker.get_nth_parent_hash(head, min(max(0, self.node.tracker.get_height_and_last(head)[0] - 1), 10)) for head in self.node.tracker.heads
-                        ))[:100],
-                    )
-                except defer.TimeoutError:
-                    print 'Share request timed out!'
-                    continue
-                except:
-                    log.err(None, 'in download_shares:')
-                    continue
-                
-                if not shares:
-                    yield deferral.sleep(1) # sleep so we don't keep rerequesting the same share nobody has
-                    continue
-                self.handle_shares([(share, []) for share in shares], peer)
+        self.share_downloader = ShareDownloader(self.node.tracker,
+            get_desired=lambda: self.node.desired_var.value,
+            get_peers=lambda: self.peers.values(),
+            handle_shares=lambda shares: self.handle_shares([(share, []) for share in shares], None),
+            walk_length=2*self.node.net.CHAIN_LENGTH,
+        )
+        self.node.desired_var.changed.watch(lambda desired: self.share_downloader.poll())
+        self.share_downloader.poll()
         
         
         @self.node.best_block_header.changed.watch
@@ -156,10 +396,12 @@ class P2PNode(p2p.Node):
         
 
 class Node(object):
-    def __init__(self, factory, dashd, shares, known_verified_share_hashes, net):
+    def __init__(self, factory, dashd, shares, known_verified_share_hashes, net, longpoll_dashd=None):
         self.factory = factory
         self.dashd = dashd
+        self.longpoll_dashd = longpoll_dashd # separate connection for getblocktemplate long polling, if any
         self.net = net
+        self.template_differ = template_differ.TemplateDiffer()
         
         self.tracker = p2pool_data.OkayTracker(self.net)
         
@@ -179,16 +421,48 @@ class Node(object):
         
         # DASHD WORK
         
-        self.dashd_work = variable.Variable((yield helper.getwork(self.dashd, self.net)))
+        self.dashd_work = variable.Variable((yield helper.getwork(self.dashd, self.net, differ=self.template_differ)))
+        @defer.inlineCallbacks
+        def longpoll(longpollid):
+            # returns the next template, or None after an error and a 15 second pause
+            try:
+                work = yield helper.getwork_longpoll(self.dashd, self.longpoll_dashd, self.net, longpollid, self.template_differ)
+            except defer.CancelledError:
+                raise
+            except defer.TimeoutError:
+                # nothing changed for the whole timeout; poll normally and wait again
+                defer.returnValue(None)
+            except:
+                log.err(None, 'Error while long polling dashd:')
+                yield deferral.sleep(15)
+                defer.returnValue(None)
+            defer.returnValue(work)
         @defer.inlineCallbacks
         def work_poller():
+            work = None
             while stop_signal.times == 0:
                 flag = self.factory.new_block.get_deferred()
-                try:
-                    self.dashd_work.set((yield helper.getwork(self.dashd, self.net, self.dashd_work.value['use_getblocktemplate'])))
-                except:
-                    log.err()
-                yield defer.DeferredList([flag, deferral.sleep(15)], fireOnOneCallback=True)
+                if work is None:
+                    try:
+                        work = yield helper.getwork(self.dashd, self.net, self.dashd_work.value['use_getblocktemplate'], self.template_differ)
+                    except:
+                        log.err()
+                if work is not None:
+                    self.dashd_work.set(work)
+                    work = None
+                longpollid = self.dashd_work.value.get('longpollid')
+                if self.longpoll_dashd is None or longpollid is None or not self.dashd_work.value['use_getblocktemplate']:
+                    yield defer.DeferredList([flag, deferral.sleep(15)], fireOnOneCallback=True)
+                    continue
+                # dashd answers as soon as the template changes; a new block seen
+                # over P2P first abandons the long poll for an immediate getwork
+                longpoll_df = longpoll(longpollid)
+                result, index = yield defer.DeferredList([flag, longpoll_df], fireOnOneCallback=True)
+                if index == 1:
+                    work = result
+                else:
+                    longpoll_df.addErrback(lambda fail: fail.trap(defer.CancelledError))
+                    longpoll_df.cancel()
         work_poller()
         
         # PEER WORK
@@ -228,7 +502,7 @@ class Node(object):
         
         # BEST SHARE
         
-        self.known_txs_var = variable.VariableDict({}) # hash -> tx
+        self.known_txs_var = variable.VariableDict(txstore.TxStore()) # hash -> tx
         self.mining_txs_var = variable.Variable({}) # hash -> tx
         self.get_height_rel_highest = yield height_tracker.get_height_rel_highest_func(self.dashd, self.factory, lambda: self.dashd_work.value['previous_block'], self.net)
         
@@ -247,13 +521,15 @@ class Node(object):
             for tx_hash, tx in zip(self.dashd_work.value['transaction_hashes'], self.dashd_work.value['transactions']):
                 new_mining_txs[tx_hash] = tx
                 added_known_txs[tx_hash] = tx
-            self.mining_txs_var.set(new_mining_txs)
             self.known_txs_var.add(added_known_txs)
+            self.mining_txs_var.set(new_mining_txs)
+            self.known_txs_var.value.set_refs('template', new_mining_txs)
         # add p2p transactions from dashd to known_txs
+        self.factory.known_txs_var = self.known_txs_var
         @self.factory.new_tx.watch
-        def _(tx):
+        def _(tx, tx_hash):
             self.known_txs_var.add({
-                dash_data.hash256(dash_data.tx_type.pack(tx)): tx,
+                tx_hash: tx,
             })
         # forward transactions seen to dashd
         @self.known_txs_var.added.watch
@@ -281,17 +557,32 @@ class Node(object):
             print
             self.factory.new_block.happened(share.hash)
         
+        # keep the transactions of the shares blocks are built from
+        tx_window = set() # hashes of the last 120 shares of the best chain
+        tx_window_pending = {} # share hash -> new_transaction_hashes of the window shares some of whose txs weren't known yet
+        def set_window_refs(share_hash, tx_hashes):
+            known_txs = self.known_txs_var.value
+            known_txs.set_refs(share_hash, tx_hashes)
+            if len(known_txs.holders.get(share_hash, ())) < len(set(tx_hashes)):
+                tx_window_pending[share_hash] = tx_hashes
+            else:
+                tx_window_pending.pop(share_hash, None)
+        @self.best_share_var.changed.run_and_watch
+        def _(_=None):
+            window = dict((share.hash, share) for share in self.tracker.get_chain(self.best_share_var.value, min(120, self.tracker.get_height(self.best_share_var.value))))
+            for share_hash in set(window) - tx_window:
+                set_window_refs(share_hash, window[share_hash].new_transaction_hashes)
+            for share_hash in tx_window - set(window):
+                set_window_refs(share_hash, [])
+            tx_window.clear()
+            tx_window.update(window)
+        
         def forget_old_txs():
-            new_known_txs = {}
-            if self.p2p_node is not None:
-                for peer in self.p2p_node.peers.itervalues():
-                    new_known_txs.update(peer.remembered_txs)
-            new_known_txs.update(self.mining_txs_var.value)
-            for share in self.tracker.get_chain(self.best_share_var.value, min(120, self.tracker.get_height(self.best_share_var.value))):
-                for tx_hash in share.new_transaction_hashes:
-                    if tx_hash in self.known_txs_var.value:
-                        new_known_txs[tx_hash] = self.known_txs_var.value[tx_hash]
-            self.known_txs_var.set(new_known_txs)
+            # txs that became known since their share entered the window (e.g. shares downloaded without them) are referred to first
+            for share_hash, tx_hashes in tx_window_pending.items():
+                set_window_refs(share_hash, tx_hashes)
+            # only the txs that nothing has referred to for a couple of runs are forgotten, see txstore
+            self.known_txs_var.remove(self.known_txs_var.value.advance())
         t = deferral.RobustLoopingCall(forget_old_txs)
         t.start(10)
         stop_signal.watch(t.stop)
@@ -1,5 +1,6 @@
 from __future__ import division
 
+import hashlib
 import math
 import random
 import sys
@@ -9,26 +10,263 @@ from twisted.internet import defer, protocol, reactor
 from twisted.python import failure, log
 
 import p2pool
-from p2pool import data as p2pool_data
+from p2pool import data as p2pool_data, txstore
 from p2pool.dash import data as dash_data
-from p2pool.util import deferral, p2protocol, pack, variable
+from p2pool.util import deferral, iblt, metrics, p2protocol, pack, variable
+
+peers_gauge = metrics.gauge('p2pool_peers', 'Connected p2pool peers', ['direction'])
+tx_announcements_cancelled = metrics.counter('p2pool_p2p_tx_announcements_cancelled', 'Transaction announcements to peers not sent because the change was undone within the batching window, by kind', ['kind'])
 
 class PeerMisbehavingError(Exception):
     pass
 
 
-def fragment(f, **kwargs):
-    try:
-        f(**kwargs)
-    except p2protocol.TooLong:
-        fragment(f, **dict((k, v[:len(v)//2]) for k, v in kwargs.iteritems()))
-        fragment(f, **dict((k, v[len(v)//2:]) for k, v in kwargs.iteritems()))
+def varint_size(n):
+    return 1 if n < 0xfd else 3 if n <= 0xffff else 5 if n <= 0xffffffff else 9
+
+def plan_batches(sizes, max_size, overhead=0, lists=1):
+    '''
+    Cuts items with the given packed sizes into consecutive batches, each
+    as large as fits in a payload of max_size bytes, in one pass. A batch
+    is sent as overhead bytes followed by its items in `lists` length
+    prefixed lists. Returns (start, end) index pairs; there is always at
+    least one batch.
+    '''
+    batches = []
+    start = total = 0
+    for i, size in enumerate(sizes):
+        if i > start and overhead + lists*varint_size(i + 1 - start) + total + size > max_size:
+            batches.append((start, i))
+            start, total = i, 0
+        total += size
+        if overhead + lists*varint_size(i + 1 - start) + total > max_size:
+            raise p2protocol.TooLong('item too long')
+    batches.append((start, len(sizes)))
+    return batches
+
+_list_length_type = pack.VarIntType()
+
+def get_dict_changes(before, after):
+    '''Returns (added, removed): the items of after whose keys aren't in before, and the reverse'''
+    return (dict((k, v) for k, v in after.iteritems() if k not in before),
+        dict((k, v) for k, v in before.iteritems() if k not in after))
+
+def frame_lists(peer, command, lists, head=''):
+    '''
+    Frames command messages made of head followed by lists of already
+    packed items, cutting the lists across as few messages as they fit in
+    '''
+    items = [item for items in lists for item in items]
+    frames = []
+    for start, end in plan_batches(map(len, items), peer._max_payload_length, len(head), len(lists)):
+        parts = [head]
+        offset = 0
+        for items in lists:
+            part = items[max(0, start - offset):max(0, end - offset)]
+            parts.append(_list_length_type.pack(len(part)))
+            parts.extend(part)
+            offset += len(items)
+        frames.append(peer.framePayload(command, ''.join(parts)))
+    return frames
+
+def compact_short_id(key, tx_hash):
+    '''6-byte id of tx_hash in a cmpctshares message whose nonce gave key'''
+    return hashlib.sha256(key + '%064x' % (tx_hash,)).digest()[:6]
+
+compact_share_type = pack.ComposedType([
+    ('hash', pack.IntType(256)),
+    ('type', pack.VarIntType()),
+    ('contents', pack.VarStrType()), # the share with an empty new_transaction_hashes
+    ('short_ids', pack.ListType(pack.FixedStrType(6))), # of new_transaction_hashes
+    ('prefilled', pack.ListType(pack.ComposedType([
+        ('index', pack.VarIntType()),
+        ('tx', dash_data.tx_type),
+    ]))),
+])
+
+class BroadcastEncoder(object):
+    '''
+    Encodes a share broadcast once rather than once per peer. Framed shares
+    messages are kept by the shares they hold, so peers that are sent the
+    same shares get the same bytes, and each share and transaction is
+    packed once; a peer's remember_tx message is put together from the
+    packed transactions it is missing. Transactions in known_txs, if it is
+    a TxStore, are taken in the packed form it keeps across broadcasts.
+    '''
+    
+    _hash = pack.IntType(256)
+    
+    def __init__(self, known_txs=None):
+        self.known_txs = known_txs if isinstance(known_txs, txstore.TxStore) else None
+        self._packed_shares = {} # share hash -> packed share
+        self._frames = {} # tuple of share hashes -> framed messages
+        self._packed_txs = {} # tx hash -> packed tx
+        self._compact_contents = {} # share hash -> packed share without its new_transaction_hashes
+        self._compact_frames = {} # (tuple of share hashes, prefilled indexes) -> framed messages
+        self.nonce = random.randrange(2**64)
+        self.key = hashlib.sha256(pack.IntType(64).pack(self.nonce)).digest()
+        self.encoded = 0
+        self.reused = 0
+    
+    def get_packed_tx(self, tx_hash, tx):
+        if tx_hash not in self._packed_txs:
+            if self.known_txs is not None and tx_hash in self.known_txs:
+                self._packed_txs[tx_hash] = self.known_txs.get_packed(tx_hash)
+            else:
+                self._packed_txs[tx_hash] = dash_data.tx_type.pack(tx)
+        return self._packed_txs[tx_hash]
+    
+    def get_packed_share(self, share):
+        if share.hash not in self._packed_shares:
+            self._packed_shares[share.hash] = p2pool_data.share_type.pack(share.as_share())
+        return self._packed_shares[share.hash]
+    
+    def get_remember_tx_frames(self, peer, tx_hashes, txs):
+        '''txs are (tx hash, tx) pairs'''
+        return frame_lists(peer, 'remember_tx', [map(self._hash.pack, tx_hashes), [self.get_packed_tx(tx_hash, tx) for tx_hash, tx in txs]])
+    
+    def get_frames(self, peer, shares):
+        key = tuple(share.hash for share in shares)
+        if key in self._frames:
+            self.reused += 1
+            return self._frames[key]
+        frames = self._frames[key] = frame_lists(peer, 'shares', [map(self.get_packed_share, shares)])
+        self.encoded += 1
+        return frames
+    
+    def get_compact_contents(self, share):
+        if share.hash not in self._compact_contents:
+            contents = dict(share.contents)
+            contents['share_info'] = dict(share.share_info, new_transaction_hashes=[])
+            self._compact_contents[share.hash] = share.share_type.pack(contents)
+        return self._compact_contents[share.hash]
+    
+    def get_compact_frames(self, peer, shares, known_txs):
+        '''
+        cmpctshares messages for peer, with the transactions it is not
+        known to have prefilled
+        '''
+        prefilled = tuple(tuple(i for i, tx_hash in enumerate(share.share_info['new_transaction_hashes'])
+            if tx_hash not in peer.remote_tx_hashes and tx_hash in known_txs) for share in shares)
+        key = tuple(share.hash for share in shares), prefilled
+        if key in self._compact_frames:
+            self.reused += 1
+            return self._compact_frames[key]
+        entries = []
+        for share, indexes in zip(shares, prefilled):
+            tx_hashes = share.share_info['new_transaction_hashes']
+            entries.append(compact_share_type.pack(dict(
+                hash=share.hash,
+                type=share.VERSION,
+                contents=self.get_compact_contents(share),
+                short_ids=[compact_short_id(self.key, tx_hash) for tx_hash in tx_hashes],
+                prefilled=[dict(index=i, tx=known_txs[tx_hashes[i]]) for i in indexes],
+            )))
+        frames = self._compact_frames[key] = frame_lists(peer, 'cmpctshares', [entries], pack.IntType(64).pack(self.nonce))
+        self.encoded += 1
+        return frames
+
+class TxAnnouncer(object):
+    '''
+    Collects the changes to our known and mining transactions a peer is to
+    be told about for `window` seconds, then sends them as at most one
+    forget_tx, losing_tx, have_tx and remember_tx. A change undone within
+    the window, like a transaction added and removed again, is not sent.
+    '''
+    
+    def __init__(self, peer, window=.1, clock=reactor):
+        self.peer = peer
+        self.window = window
+        self.clock = clock
+        self.have = set() # tx hashes to announce with have_tx
+        self.losing = set() # ... with losing_tx
+        self.remember = {} # tx hash -> tx to have the peer remember
+        self.forget = {} # tx hash -> remembered size of a tx to have the peer forget
+        self.encoder = None # packs the txs to remember, shared with the other peers told about the same change
+        self._delayed = None
+    
+    def known_txs_changed(self, added, removed):
+        for tx_hash in added:
+            if tx_hash in self.losing:
+                self.losing.remove(tx_hash)
+                tx_announcements_cancelled.inc(1, ('losing_tx',))
+            else:
+                self.have.add(tx_hash)
+        for tx_hash in removed:
+            if tx_hash in self.have:
+                self.have.remove(tx_hash)
+                tx_announcements_cancelled.inc(1, ('have_tx',))
+            else:
+                self.losing.add(tx_hash)
+        self._schedule()
+    
+    def mining_txs_changed(self, added, removed, encoder=None):
+        if encoder is None:
+            encoder = BroadcastEncoder(self.peer.node.known_txs_var.value)
+        for tx_hash, tx in added.iteritems():
+            if tx_hash in self.forget:
+                del self.forget[tx_hash]
+                tx_announcements_cancelled.inc(1, ('forget_tx',))
+            else:
+                self.remember[tx_hash] = tx
+                self.encoder = encoder
+        for tx_hash, tx in removed.iteritems():
+            if tx_hash in self.remember:
+                del self.remember[tx_hash]
+                tx_announcements_cancelled.inc(1, ('remember_tx',))
+            else:
+                self.forget[tx_hash] = 100 + len(encoder.get_packed_tx(tx_hash, tx))
+        self._schedule()
+    
+    def _schedule(self):
+        if self._delayed is None and (self.have or self.losing or self.remember or self.forget):
+            self._delayed = self.clock.callLater(self.window, self.flush)
+    
+    def flush(self):
+        '''Sends what has been collected now; done before anything that relies on the peer's view being current'''
+        self.stop()
+        peer = self.peer
+        forget, losing, have, remember, encoder = self.forget, self.losing, self.have, self.remember, self.encoder
+        self.forget, self.losing, self.have, self.remember, self.encoder = {}, set(), set(), {}, None
+        if forget:
+            peer.send_forget_tx(tx_hashes=list(forget))
+            peer.remote_remembered_txs_size -= sum(forget.itervalues())
+        if losing:
+            peer.send_losing_tx(tx_hashes=list(losing))
+        if have:
+            peer.send_have_tx(tx_hashes=list(have))
+        if remember:
+            peer.remote_remembered_txs_size += sum(100 + len(encoder.get_packed_tx(x, tx)) for x, tx in remember.iteritems())
+            assert peer.remote_remembered_txs_size <= peer.max_remembered_txs_size
+            peer.sendRememberTx([x for x in remember if x in peer.remote_tx_hashes], [(x, tx) for x, tx in remember.iteritems() if x not in peer.remote_tx_hashes], encoder)
+    
+    def stop(self):
+        if self._delayed is not None:
+            if self._delayed.active():
+                self._delayed.cancel()
+            self._delayed = None
 
 class Protocol(p2protocol.Protocol):
-    VERSION = 1700
+    VERSION = 1900
+    TX_SKETCH_VERSION = 1800 # from here on peers reconcile their known transactions with tx_sketch
+    COMPACT_SHARE_VERSION = 1900 # from here on shares are relayed as cmpctshares
+    MAX_TX_RESKETCHES = 3
+    metrics_label = 'p2pool'
     
     max_remembered_txs_size = 2500000
     
+    # a share waits for bulk traffic only while that is in the transport's
+    # buffer. remember_tx/forget_tx are barriers because shares sent after
+    # them may use the transactions they remember.
+    send_lanes = ['share', 'sync', 'tx', 'addr']
+    send_lane_commands = dict(
+        shares='share', bestblock='share', cmpctshares='share', getsharetxs='share', sharetxs='share',
+        sharereq='sync', sharereply='sync',
+        have_tx='tx', losing_tx='tx', remember_tx='tx', forget_tx='tx', tx_sketch='tx', tx_resketch='tx',
+        addrs='addr', addrme='addr', getaddrs='addr',
+    )
+    send_barriers = set(['remember_tx', 'forget_tx'])
+    
     def __init__(self, node, incoming):
         p2protocol.Protocol.__init__(self, node.net.PREFIX, 3145728, node.traffic_happened)
         self.node = node
@@ -42,6 +280,8 @@ class Protocol(p2protocol.Protocol):
     def connectionMade(self):
         self.factory.proto_made_connection(self)
         
+        self.startSendQueue()
+        
         self.connection_lost_event = variable.Event()
         
         self.addr = self.transport.getPeer().host, self.transport.getPeer().port
@@ -73,13 +313,21 @@ class Protocol(p2protocol.Protocol):
             timeout=15,
             on_timeout=self.disconnect,
         )
+        self.get_share_txs = deferral.GenericDeferrer(
+            max_id=2**256,
+            func=lambda id, share_hash, indexes: self.send_getsharetxs(id=id, share_hash=share_hash, indexes=indexes),
+            timeout=15,
+        )
         
         self.remote_tx_hashes = set() # view of peer's known_txs # not actually initially empty, but sending txs instead of tx hashes won't hurt
+        self.remote_tx_short_ids = set() # short ids of txs the peer's tx_sketch had that we didn't know then
+        self.tx_resketches = 0
         self.remote_remembered_txs_size = 0
         
         self.remembered_txs = {} # view of peer's mining_txs
         self.remembered_txs_size = 0
         self.known_txs_cache = {}
+        self.tx_announcer = TxAnnouncer(self)
     
     def _connect_timeout(self):
         self.timeout_delayed = None
@@ -189,6 +437,7 @@ class Protocol(p2protocol.Protocol):
             return
         
         self.nonce = nonce
+        self.tx_salt = hashlib.sha256('%016x%016x' % tuple(sorted([self.node.nonce, nonce]))).digest()
         self.connected2 = True
         self.connection_time = time.time()
         
@@ -216,57 +465,14 @@ class Protocol(p2protocol.Protocol):
         if best_share_hash is not None:
             self.node.handle_share_hashes([best_share_hash], self)
         
-        def add_to_remote_view_of_my_known_txs(added):
-            if added:
-                self.send_have_tx(tx_hashes=list(added.keys()))
-        
-        watch_id0 = self.node.known_txs_var.added.watch(add_to_remote_view_of_my_known_txs)
-        self.connection_lost_event.watch(lambda: self.node.known_txs_var.added.unwatch(watch_id0))
+        # from here on the node tells us about changes to its known and mining txs, see Node.start
+        self.sendTxInventory()
         
-        def remove_from_remote_view_of_my_known_txs(removed):
-            if removed:
-                self.send_losing_tx(tx_hashes=list(removed.keys()))
-                
-                # cache forgotten txs here for a little while so latency of "losing_tx" packets doesn't cause problems
-                key = max(self.known_txs_cache) + 1 if self.known_txs_cache else 0
-                self.known_txs_cache[key] = removed #dict((h, before[h]) for h in removed)
-                reactor.callLater(20, self.known_txs_cache.pop, key)
-        watch_id1 = self.node.known_txs_var.removed.watch(remove_from_remote_view_of_my_known_txs)
-        self.connection_lost_event.watch(lambda: self.node.known_txs_var.removed.unwatch(watch_id1))
-        
-        def update_remote_view_of_my_known_txs(before, after):
-            added = set(after) - set(before)
-            removed = set(before) - set(after)
-            if added:
-                self.send_have_tx(tx_hashes=list(added))
-            if removed:
-                self.send_losing_tx(tx_hashes=list(removed))
-                
-                # cache forgotten txs here for a little while so latency of "losing_tx" packets doesn't cause problems
-                key = max(self.known_txs_cache) + 1 if self.known_txs_cache else 0
-                self.known_txs_cache[key] = dict((h, before[h]) for h in removed)
-                reactor.callLater(20, self.known_txs_cache.pop, key)
-        watch_id2 = self.node.known_txs_var.transitioned.watch(update_remote_view_of_my_known_txs)
-        self.connection_lost_event.watch(lambda: self.node.known_txs_var.transitioned.unwatch(watch_id2))
-        
-        self.send_have_tx(tx_hashes=self.node.known_txs_var.value.keys())
-        
-        def update_remote_view_of_my_mining_txs(before, after):
-            added = set(after) - set(before)
-            removed = set(before) - set(after)
-            if removed:
-                self.send_forget_tx(tx_hashes=list(removed))
-                self.remote_remembered_txs_size -= sum(100 + dash_data.tx_type.packed_size(before[x]) for x in removed)
-            if added:
-                self.remote_remembered_txs_size += sum(100 + dash_data.tx_type.packed_size(after[x]) for x in added)
-                assert self.remote_remembered_txs_size <= self.max_remembered_txs_size
-                fragment(self.send_remember_tx, tx_hashes=[x for x in added if x in self.remote_tx_hashes], txs=[after[x] for x in added if x not in self.remote_tx_hashes])
-        watch_id2 = self.node.mining_txs_var.transitioned.watch(update_remote_view_of_my_mining_txs)
-        self.connection_lost_event.watch(lambda: self.node.mining_txs_var.transitioned.unwatch(watch_id2))
-        
-        self.remote_remembered_txs_size += sum(100 + dash_data.tx_type.packed_size(x) for x in self.node.mining_txs_var.value.values())
+        encoder = BroadcastEncoder(self.node.known_txs_var.value)
+        mining_txs = self.node.mining_txs_var.value.items()
+        self.remote_remembered_txs_size += sum(100 + len(encoder.get_packed_tx(tx_hash, tx)) for tx_hash, tx in mining_txs)
         assert self.remote_remembered_txs_size <= self.max_remembered_txs_size
-        fragment(self.send_remember_tx, tx_hashes=[], txs=self.node.mining_txs_var.value.values())
+        self.sendRememberTx([], mining_txs, encoder)
     
     message_ping = pack.ComposedType([])
     def handle_ping(self):
@@ -357,7 +563,18 @@ class Protocol(p2protocol.Protocol):
             
         self.node.handle_shares(result, self)
     
-    def sendShares(self, shares, tracker, known_txs, include_txs_with=[]):
+    def sendShares(self, shares, tracker, known_txs, include_txs_with=[], encoder=None):
+        self.tx_announcer.flush() # what follows relies on the peer's view of our txs
+        
+        if encoder is None:
+            encoder = BroadcastEncoder(known_txs)
+        
+        if self.other_version >= self.COMPACT_SHARE_VERSION:
+            # the peer rebuilds the shares' transactions from those it knows and asks for the rest
+            for data in encoder.get_compact_frames(self, shares, known_txs):
+                self.sendEncoded('cmpctshares', data)
+            return
+        
         tx_hashes = set()
         for share in shares:
             if share.VERSION >= 13:
@@ -376,19 +593,114 @@ class Protocol(p2protocol.Protocol):
         
         hashes_to_send = [x for x in tx_hashes if x not in self.node.mining_txs_var.value and x in known_txs]
         
-        new_remote_remembered_txs_size = self.remote_remembered_txs_size + sum(100 + dash_data.tx_type.packed_size(known_txs[x]) for x in hashes_to_send)
+        remembered_size = sum(100 + len(encoder.get_packed_tx(x, known_txs[x])) for x in hashes_to_send)
+        new_remote_remembered_txs_size = self.remote_remembered_txs_size + remembered_size
         if new_remote_remembered_txs_size > self.max_remembered_txs_size:
             raise ValueError('shares have too many txs')
         self.remote_remembered_txs_size = new_remote_remembered_txs_size
         
-        fragment(self.send_remember_tx, tx_hashes=[x for x in hashes_to_send if x in self.remote_tx_hashes], txs=[known_txs[x] for x in hashes_to_send if x not in self.remote_tx_hashes])
+        self.sendRememberTx([x for x in hashes_to_send if x in self.remote_tx_hashes], [(x, known_txs[x]) for x in hashes_to_send if x not in self.remote_tx_hashes], encoder)
         
-        fragment(self.send_shares, shares=[share.as_share() for share in shares])
+        for data in encoder.get_frames(self, shares):
+            self.sendEncoded('shares', data)
         
         self.send_forget_tx(tx_hashes=hashes_to_send)
         
-        self.remote_remembered_txs_size -= sum(100 + dash_data.tx_type.packed_size(known_txs[x]) for x in hashes_to_send)
+        self.remote_remembered_txs_size -= remembered_size
+    
+    def sendRememberTx(self, tx_hashes, txs, encoder):
+        '''txs are (tx hash, tx) pairs; sent in as few remember_tx messages as they fit in'''
+        for data in encoder.get_remember_tx_frames(self, tx_hashes, txs):
+            self.sendEncoded('remember_tx', data)
+    
+    
+    message_cmpctshares = pack.ComposedType([
+        ('nonce', pack.IntType(64)),
+        ('shares', pack.ListType(compact_share_type)),
+    ])
+    def handle_cmpctshares(self, nonce, shares):
+        key = hashlib.sha256(pack.IntType(64).pack(nonce)).digest()
+        candidates = None
+        for entry in shares:
+            if entry['type'] < p2pool_data.Share.VERSION:
+                continue
+            txs = [None]*len(entry['short_ids']) # (tx hash, tx) pairs
+            for prefilled in entry['prefilled']:
+                if not 0 <= prefilled['index'] < len(txs):
+                    raise PeerMisbehavingError('invalid prefilled transaction index')
+                txs[prefilled['index']] = dash_data.hash256(dash_data.tx_type.pack(prefilled['tx'])), prefilled['tx']
+            if None in txs:
+                if candidates is None:
+                    candidates = self._get_compact_candidates(key)
+                for i, short_id in enumerate(entry['short_ids']):
+                    if txs[i] is None:
+                        txs[i] = candidates.get(short_id)
+            missing = [i for i, tx in enumerate(txs) if tx is None]
+            if missing:
+                self._fetch_compact_share_txs(key, entry, txs, missing)
+            else:
+                self._handle_compact_share(key, entry, txs)
     
+    def _get_compact_candidates(self, key):
+        '''short id -> (tx hash, tx) of the transactions we could rebuild a share from, None where two collide'''
+        candidates = {}
+        for txs in [self.node.known_txs_var.value, self.remembered_txs] + self.known_txs_cache.values():
+            for tx_hash, tx in txs.iteritems():
+                short_id = compact_short_id(key, tx_hash)
+                if short_id in candidates and (candidates[short_id] is None or candidates[short_id][0] != tx_hash):
+                    candidates[short_id] = None
+                else:
+                    candidates[short_id] = tx_hash, tx
+        return candidates
+    
+    @defer.inlineCallbacks
+    def _fetch_compact_share_txs(self, key, entry, txs, missing):
+        try:
+            fetched = yield self.get_share_txs(share_hash=entry['hash'], indexes=missing)
+        except Exception:
+            fetched = []
+        if len(fetched) != len(missing):
+            if self.connected2:
+                self.node.handle_share_hashes([entry['hash']], self)
+            return
+        for i, tx in zip(missing, fetched):
+            txs[i] = dash_data.hash256(dash_data.tx_type.pack(tx)), tx
+        try:
+            self._handle_compact_share(key, entry, txs)
+        except PeerMisbehavingError, e:
+            print 'Peer %s:%i misbehaving, will drop and ban. Reason:' % self.addr, e.message
+            self.badPeerHappened()
+    
+    def _handle_compact_share(self, key, entry, txs):
+        tx_hashes = [tx_hash for tx_hash, tx in txs]
+        if [compact_short_id(key, tx_hash) for tx_hash in tx_hashes] == entry['short_ids']:
+            contents = p2pool_data.Share.share_type.unpack(entry['contents'])
+            contents['share_info']['new_transaction_hashes'] = tx_hashes
+            share = p2pool_data.load_share(dict(type=entry['type'], contents=p2pool_data.Share.share_type.pack(contents)), self.node.net, self.addr)
+            if share.hash == entry['hash']:
+                self.node.handle_shares([(share, [tx for tx_hash, tx in txs])], self)
+                return
+        # a transaction that only shares the short id of one in the share; get the share the usual way
+        self.node.handle_share_hashes([entry['hash']], self)
+    
+    message_getsharetxs = pack.ComposedType([
+        ('id', pack.IntType(256)),
+        ('share_hash', pack.IntType(256)),
+        ('indexes', pack.ListType(pack.VarIntType())),
+    ])
+    def handle_getsharetxs(self, id, share_hash, indexes):
+        txs = self.node.handle_get_share_txs(share_hash, indexes, self)
+        try:
+            self.send_sharetxs(id=id, txs=txs)
+        except p2protocol.TooLong:
+            self.send_sharetxs(id=id, txs=[])
+    
+    message_sharetxs = pack.ComposedType([
+        ('id', pack.IntType(256)),
+        ('txs', pack.ListType(dash_data.tx_type)),
+    ])
+    def handle_sharetxs(self, id, txs):
+        self.get_share_txs.got_response(id, txs)
     
     message_sharereq = pack.ComposedType([
         ('id', pack.IntType(256)),
@@ -398,10 +710,16 @@ class Protocol(p2protocol.Protocol):
     ])
     def handle_sharereq(self, id, hashes, parents, stops):
         shares = self.node.handle_get_shares(hashes, parents, stops, self)
+        # the reply takes as many shares as fit in one message; the rest are requested again
+        head = self.message_sharereply.pack(dict(id=id, result='good', shares=[]))[:-1]
+        packed = [p2pool_data.share_type.pack(share.as_share()) for share in shares]
         try:
-            self.send_sharereply(id=id, result='good', shares=[share.as_share() for share in shares])
+            start, end = plan_batches(map(len, packed), self._max_payload_length, len(head))[0]
+            data, = frame_lists(self, 'sharereply', [packed[:end]], head)
         except p2protocol.TooLong:
             self.send_sharereply(id=id, result='too long', shares=[])
+        else:
+            self.sendEncoded('sharereply', data)
     
     message_sharereply = pack.ComposedType([
         ('id', pack.IntType(256)),
@@ -438,6 +756,80 @@ class Protocol(p2protocol.Protocol):
     def handle_losing_tx(self, tx_hashes):
         #assert self.remote_tx_hashes.issuperset(tx_hashes)
         self.remote_tx_hashes.difference_update(tx_hashes)
+        if self.remote_tx_short_ids:
+            self.remote_tx_short_ids.difference_update(iblt.short_id(self.tx_salt, tx_hash) for tx_hash in tx_hashes)
+    
+    def known_txs_changed(self, added, removed):
+        '''Called by the node with the txs (tx hash -> tx) added to and removed from its known_txs'''
+        if added and self.remote_tx_short_ids:
+            for tx_hash in added:
+                short_id = iblt.short_id(self.tx_salt, tx_hash)
+                if short_id in self.remote_tx_short_ids:
+                    self.remote_tx_short_ids.remove(short_id)
+                    self.remote_tx_hashes.add(tx_hash)
+        if removed:
+            # cache forgotten txs here for a little while so latency of "losing_tx" packets doesn't cause problems
+            key = max(self.known_txs_cache) + 1 if self.known_txs_cache else 0
+            self.known_txs_cache[key] = removed
+            reactor.callLater(20, self.known_txs_cache.pop, key)
+        self.tx_announcer.known_txs_changed(added, removed)
+    
+    def sendTxInventory(self, cell_count=None):
+        '''
+        Tells the peer all the transactions we know: as a tx_sketch if it
+        reconciles and the sketch is smaller, otherwise as a have_tx
+        '''
+        self.tx_announcer.flush()
+        tx_hashes = self.node.known_txs_var.value.keys()
+        if self.other_version >= self.TX_SKETCH_VERSION:
+            if cell_count is None:
+                cell_count = iblt.get_cell_count(len(tx_hashes))
+            if cell_count*iblt.IBLT.CELL_SIZE < 32*len(tx_hashes):
+                sketch = iblt.IBLT.from_keys(cell_count, [iblt.short_id(self.tx_salt, tx_hash) for tx_hash in tx_hashes])
+                self.send_tx_sketch(size=len(tx_hashes), cells=sketch.get_cells())
+                return
+        self.send_have_tx(tx_hashes=tx_hashes)
+    
+    message_tx_sketch = pack.ComposedType([
+        ('size', pack.VarIntType()),
+        ('cells', pack.ListType(pack.ComposedType([
+            ('count', pack.StructType('<i')),
+            ('key_sum', pack.IntType(64)),
+            ('check_sum', pack.IntType(32)),
+        ]))),
+    ])
+    def handle_tx_sketch(self, size, cells):
+        if self.other_version < self.TX_SKETCH_VERSION:
+            raise PeerMisbehavingError('tx_sketch from a peer that does not reconcile')
+        if len(cells) > iblt.get_cell_count(size)*4**self.MAX_TX_RESKETCHES:
+            raise PeerMisbehavingError('tx_sketch larger than any resketch of it')
+        try:
+            remote = iblt.IBLT.from_cells(cells)
+        except ValueError:
+            raise PeerMisbehavingError('invalid tx_sketch')
+        local = dict((iblt.short_id(self.tx_salt, tx_hash), tx_hash) for tx_hash in self.node.known_txs_var.value)
+        difference = iblt.IBLT.from_keys(remote.cell_count, local).subtract(remote).decode()
+        if difference is None or not difference[0].issubset(local) or len(local) - len(difference[0]) + len(difference[1]) != size:
+            # the difference was too large for the sketch. Growing it 4x at a time, the third
+            # resketch at the latest is bigger than a have_tx, which is sent instead
+            self.send_tx_resketch(cell_count=4*remote.cell_count)
+            return
+        local_only, remote_only = difference
+        self.remote_tx_hashes = set(tx_hash for short_id, tx_hash in local.iteritems() if short_id not in local_only)
+        while len(self.remote_tx_hashes) > 10000:
+            self.remote_tx_hashes.pop()
+        self.remote_tx_short_ids = remote_only
+    
+    message_tx_resketch = pack.ComposedType([
+        ('cell_count', pack.VarIntType()),
+    ])
+    def handle_tx_resketch(self, cell_count):
+        self.tx_resketches += 1
+        if self.tx_resketches > self.MAX_TX_RESKETCHES:
+            raise PeerMisbehavingError('too many tx_resketch requests')
+        if cell_count < iblt.get_cell_count(0):
+            raise PeerMisbehavingError('tx_resketch smaller than any sketch')
+        self.sendTxInventory(cell_count)
     
     
     message_remember_tx = pack.ComposedType([
@@ -445,6 +837,17 @@ class Protocol(p2protocol.Protocol):
         ('txs', pack.ListType(dash_data.tx_type)),
     ])
     def handle_remember_tx(self, tx_hashes, txs):
+        added_known_txs = {}
+        remembered = [] # everything put in remembered_txs is passed to remembered_txs_changed, even if we disconnect half way
+        try:
+            self._remember_txs(tx_hashes, txs, added_known_txs, remembered)
+        finally:
+            self.node.known_txs_var.add(added_known_txs)
+            self.node.remembered_txs_changed(self, remembered, [])
+        if self.remembered_txs_size >= self.max_remembered_txs_size:
+            raise PeerMisbehavingError('too much transaction data stored')
+    
+    def _remember_txs(self, tx_hashes, txs, added_known_txs, remembered):
         for tx_hash in tx_hashes:
             if tx_hash in self.remembered_txs:
                 print >>sys.stderr, 'Peer referenced transaction twice, disconnecting'
@@ -467,7 +870,7 @@ class Protocol(p2protocol.Protocol):
             
             self.remembered_txs[tx_hash] = tx
             self.remembered_txs_size += 100 + dash_data.tx_type.packed_size(tx)
-        added_known_txs = {}
+            remembered.append(tx_hash)
         warned = False
         for tx in txs:
             tx_hash = dash_data.hash256(dash_data.tx_type.pack(tx))
@@ -484,17 +887,20 @@ class Protocol(p2protocol.Protocol):
             self.remembered_txs[tx_hash] = tx
             self.remembered_txs_size += 100 + dash_data.tx_type.packed_size(tx)
             added_known_txs[tx_hash] = tx
-        self.node.known_txs_var.add(added_known_txs)
-        if self.remembered_txs_size >= self.max_remembered_txs_size:
-            raise PeerMisbehavingError('too much transaction data stored')
+            remembered.append(tx_hash)
     message_forget_tx = pack.ComposedType([
         ('tx_hashes', pack.ListType(pack.IntType(256))),
     ])
     def handle_forget_tx(self, tx_hashes):
-        for tx_hash in tx_hashes:
-            self.remembered_txs_size -= 100 + dash_data.tx_type.packed_size(self.remembered_txs[tx_hash])
-            assert self.remembered_txs_size >= 0
-            del self.remembered_txs[tx_hash]
+        forgotten = []
+        try:
+            for tx_hash in tx_hashes:
+                self.remembered_txs_size -= 100 + dash_data.tx_type.packed_size(self.remembered_txs[tx_hash])
+                assert self.remembered_txs_size >= 0
+                del self.remembered_txs[tx_hash]
+                forgotten.append(tx_hash)
+        finally:
+            self.node.remembered_txs_changed(self, [], forgotten)
     
     
     def connectionLost(self, reason):
@@ -515,6 +921,8 @@ class Protocol(p2protocol.Protocol):
         if p2pool.DEBUG:
             print "Peer connection lost:", self.addr, reason
         self.get_shares.respond_all(reason)
+        self.get_share_txs.respond_all(reason)
+        self.tx_announcer.stop()
     
     @defer.inlineCallbacks
     def do_ping(self):
@@ -575,8 +983,9 @@ class ServerFactory(protocol.ServerFactory):
         self.running = False
         
         # Gracefully disconnect all incoming peers
-        print 'P2P: Disconnecting %d incoming peers...' % len(self.node.conns)
-        for proto in list(self.node.conns):
+        incoming_peers = [peer for peer in self.node.peers.itervalues() if peer.incoming]
+        print 'P2P: Disconnecting %d incoming peers...' % len(incoming_peers)
+        for proto in incoming_peers:
             try:
                 proto.transport.loseConnection()
             except:
@@ -708,6 +1117,8 @@ class Node(object):
         self.external_ip = external_ip
         
         self.traffic_happened = variable.Event()
+        self.peer_connected = variable.Event() # (conn)
+        self.peer_disconnected = variable.Event() # (conn, reason)
         self.nonce = random.randrange(2**64)
         self.peers = {}
         self.bans = {} # address -> end_time
@@ -729,6 +1140,36 @@ class Node(object):
         self.running = True
         
         self._stop_thinking = deferral.run_repeatedly(self._think)
+        self._stop_watching_txs = self.watch_txs()
+    
+    def watch_txs(self):
+        '''
+        Passes changes to known_txs_var and mining_txs_var on to the
+        connected peers, working them out once for all of them rather than
+        once per peer. Returns a function that stops it.
+        '''
+        watches = [
+            (self.known_txs_var.added, self.known_txs_var.added.watch(lambda added: self._known_txs_changed(added, {}))),
+            (self.known_txs_var.removed, self.known_txs_var.removed.watch(lambda removed: self._known_txs_changed({}, removed))),
+            (self.known_txs_var.transitioned, self.known_txs_var.transitioned.watch(lambda before, after: self._known_txs_changed(*get_dict_changes(before, after)))),
+            (self.mining_txs_var.transitioned, self.mining_txs_var.transitioned.watch(self._mining_txs_transitioned)),
+        ]
+        def stop():
+            for event, watch_id in watches:
+                event.unwatch(watch_id)
+        return stop
+    
+    def _known_txs_changed(self, added, removed):
+        if added or removed:
+            for peer in self.peers.itervalues():
+                peer.known_txs_changed(added, removed)
+    
+    def _mining_txs_transitioned(self, before, after):
+        if self.peers:
+            added, removed = get_dict_changes(before, after)
+            encoder = BroadcastEncoder(self.known_txs_var.value)
+            for peer in self.peers.itervalues():
+                peer.tx_announcer.mining_txs_changed(added, removed, encoder)
     
     def _think(self):
         try:
@@ -748,6 +1189,7 @@ class Node(object):
         self.stopping = True  # Set BEFORE disconnecting peers to suppress lost_conn logs
         
         self._stop_thinking()
+        self._stop_watching_txs()
         yield self.clientfactory.stop()
         yield self.serverfactory.stop()
         for singleclientconnector in self.singleclientconnectors:
@@ -760,8 +1202,10 @@ class Node(object):
         if conn.nonce in self.peers:
             raise ValueError('already have peer')
         self.peers[conn.nonce] = conn
+        peers_gauge.inc(1, ('incoming' if conn.incoming else 'outgoing',))
         
         print '%s peer %s:%i established. p2pool version: %i %r' % ('Incoming connection from' if conn.incoming else 'Outgoing connection to', conn.addr[0], conn.addr[1], conn.other_version, conn.other_sub_version)
+        self.peer_connected.happened(conn)
         
     def lost_conn(self, conn, reason):
         if conn.nonce not in self.peers:
@@ -769,11 +1213,13 @@ class Node(object):
         if conn is not self.peers[conn.nonce]:
             raise ValueError('wrong conn')
         del self.peers[conn.nonce]
+        peers_gauge.dec(1, ('incoming' if conn.incoming else 'outgoing',))
         
         # Don't log peer disconnections during graceful shutdown
         is_stopping = getattr(self, 'stopping', False)
         if not is_stopping:
             print 'Lost peer %s:%i - %s' % (conn.addr[0], conn.addr[1], reason.getErrorMessage())
+        self.peer_disconnected.happened(conn, reason)
     
     
     def got_addr(self, (host, port), services, timestamp):
@@ -800,6 +1246,13 @@ class Node(object):
     def handle_get_shares(self, hashes, parents, stops, peer):
         print 'handle_get_shares', (hashes, parents, stops, peer)
     
+    def handle_get_share_txs(self, share_hash, indexes, peer):
+        print 'handle_get_share_txs', (share_hash, indexes, peer)
+        return []
+    
+    def remembered_txs_changed(self, peer, added, removed):
+        pass
+    
     def handle_bestblock(self, header, peer):
         print 'handle_bestblock', header
     
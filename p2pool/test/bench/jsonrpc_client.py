@@ -0,0 +1,155 @@
+'''
+JSON-RPC client benchmark.
+
+Serves a stub dashd (getblockcount and getblockheader answered from memory
+by jsonrpc.HTTPServer) over loopback and measures how many RPC calls per
+second jsonrpc.HTTPProxy completes with N calls in flight, in these modes:
+
+- getpage: the previous client, a new twisted.web.client.getPage
+  connection per call
+- nopool: HTTPProxy with pool_size=0, a new connection per call
+- pool: HTTPProxy with keep-alive connections
+- batch: HTTPProxy.batch, --batch-size getblockheader calls per request
+
+Client and server share one process and one reactor, so the figures
+include the cost of the stub server.
+
+    python -m p2pool.test.bench.jsonrpc_client --concurrency 4 --duration 5
+'''
+
+from __future__ import division
+
+import argparse
+import json
+import sys
+import time
+
+from twisted.internet import defer, reactor
+from twisted.web import client, resource, server
+
+from p2pool.test.bench.stratum_load import cpu_time, percentiles
+from p2pool.util import jsonrpc
+
+MODES = ['getpage', 'nopool', 'pool', 'batch']
+
+class StubDashd(object):
+    def __init__(self, height=1000):
+        self.height = height
+        self.calls = 0
+
+    def rpc_getblockcount(self, request):
+        self.calls += 1
+        return self.height
+
+    def rpc_getblockheader(self, request, block_hash):
+        self.calls += 1
+        return dict(hash=block_hash, confirmations=1, height=self.height)
+
+class BatchServer(jsonrpc.HTTPServer):
+    '''jsonrpc.HTTPServer that also answers batch arrays'''
+
+    @defer.inlineCallbacks
+    def render_POST(self, request):
+        data = request.content.read()
+        reqs = json.loads(data)
+        if isinstance(reqs, list):
+            responses = yield defer.gatherResults([jsonrpc._handle(json.dumps(req), self._provider, preargs=[request]) for req in reqs])
+            data = '[%s]' % (','.join(responses),)
+        else:
+            data = yield jsonrpc._handle(data, self._provider, preargs=[request])
+        request.setHeader('Content-Type', 'application/json')
+        request.setHeader('Content-Length', str(len(data)))
+        request.write(data)
+
+def make_getpage_proxy(url, timeout=5):
+    '''The getPage-based client that HTTPProxy replaced, for comparison'''
+    @defer.inlineCallbacks
+    def call(method, params):
+        data = yield client.getPage(
+            url=url,
+            method='POST',
+            headers={'Content-Type': 'application/json'},
+            postdata=json.dumps(dict(jsonrpc='2.0', method=method, params=params, id=0)),
+            timeout=timeout,
+        )
+        defer.returnValue(json.loads(data)['result'])
+    return jsonrpc.Proxy(call)
+
+@defer.inlineCallbacks
+def run_mode(mode, url, args):
+    if mode == 'getpage':
+        proxy = make_getpage_proxy(url)
+    else:
+        proxy = jsonrpc.HTTPProxy(url, pool_size=0 if mode == 'nopool' else args.concurrency)
+    latencies = []
+    calls = [0]
+    deadline = time.time() + args.duration
+
+    @defer.inlineCallbacks
+    def worker():
+        while time.time() < deadline:
+            t0 = time.time()
+            if mode == 'batch':
+                yield proxy.batch([('getblockheader', ['%064x' % (i,)]) for i in xrange(args.batch_size)])
+                calls[0] += args.batch_size
+            else:
+                yield proxy.rpc_getblockcount()
+                calls[0] += 1
+            latencies.append(time.time() - t0)
+
+    c0, t0 = cpu_time(), time.time()
+    yield defer.gatherResults([worker() for i in xrange(args.concurrency)])
+    c1, t1 = cpu_time(), time.time()
+    if mode != 'getpage':
+        yield proxy.close()
+    defer.returnValue(dict(
+        calls=calls[0],
+        requests=len(latencies),
+        calls_per_second=calls[0]/(t1 - t0),
+        cpu_per_call_us=(c1 - c0)*1e6/max(1, calls[0]),
+        latency_ms=dict((k, v*1e3 if v is not None else None) for k, v in percentiles(latencies).iteritems()),
+    ))
+
+@defer.inlineCallbacks
+def run(args, results):
+    root = resource.Resource()
+    root.putChild('', BatchServer(StubDashd()))
+    port = reactor.listenTCP(0, server.Site(root), interface='127.0.0.1')
+    url = 'http://127.0.0.1:%i/' % (port.getHost().port,)
+    try:
+        for mode in args.modes:
+            results[mode] = yield run_mode(mode, url, args)
+    finally:
+        yield port.stopListening()
+
+def format_results(args, results):
+    lines = ['', 'JSON-RPC client: %i in flight, %gs per mode' % (args.concurrency, args.duration)]
+    for mode in args.modes:
+        r = results[mode]
+        lat = r['latency_ms']
+        lines.append('  %-8s %8.0f calls/s  %5.0f us CPU/call  request latency ms p50 %.2f p99 %.2f' % (
+            mode, r['calls_per_second'], r['cpu_per_call_us'], lat['p50'], lat['p99']))
+    return '\n'.join(lines)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='JSON-RPC client benchmark against a loopback stub dashd')
+    parser.add_argument('--concurrency', type=int, default=4, help='calls in flight (default: %(default)s)')
+    parser.add_argument('--duration', type=float, default=5, help='seconds per mode (default: %(default)s)')
+    parser.add_argument('--batch-size', type=int, default=50, help='calls per batch request (default: %(default)s)')
+    parser.add_argument('--modes', nargs='+', choices=MODES, default=MODES)
+    parser.add_argument('--json', metavar='PATH', help='also write results as JSON to PATH')
+    args = parser.parse_args(argv)
+
+    results = {}
+    reactor.callWhenRunning(lambda: run(args, results).addErrback(lambda fail: fail.printTraceback(sys.stderr)).addBoth(lambda _: reactor.stop()))
+    reactor.run()
+
+    if any(mode not in results for mode in args.modes):
+        sys.exit(1)
+    print format_results(args, results)
+    if args.json:
+        with open(args.json, 'wb') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+if __name__ == '__main__':
+    main()
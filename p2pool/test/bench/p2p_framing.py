@@ -0,0 +1,139 @@
+'''
+P2P message framing benchmark.
+
+Splits a stream of p2pool P2P messages into frames with:
+
+- chunker: the previous decoder, a generator driven by DataChunker that
+  reads the prefix one byte at a time and each header field separately
+- decoder: p2protocol.FrameDecoder
+
+The stream is either a recording of raw bytes received from a peer
+(--capture, e.g. the TCP payload of one direction of a connection) or a
+synthetic one: shares, remember_tx, have_tx and ping messages for a
+generated sharechain, as a peer sends them while syncing. It is fed in
+--chunk sized pieces, as reads from a socket would hand it over.
+Checksums are not verified and messages are not unpacked, so only the
+framing is measured.
+
+    python -m p2pool.test.bench.p2p_framing --shares 400 --chunk 1448
+'''
+
+from __future__ import division
+
+import argparse
+import hashlib
+import json
+import struct
+import time
+
+from p2pool import p2p
+from p2pool.test.bench import sharechain
+from p2pool.test.bench.stratum_load import cpu_time
+from p2pool.util import datachunker, p2protocol
+
+MODES = ['chunker', 'decoder']
+
+def make_frame(prefix, command, payload):
+    return prefix + struct.pack('<12sI', command, len(payload)) + hashlib.sha256(hashlib.sha256(payload).digest()).digest()[:4] + payload
+
+def make_traffic(args):
+    chain = sharechain.make_chain(args.shares, chain_length=args.shares, txs_per_share=args.txs_per_share)
+    prefix = chain.net.PREFIX
+    frames = []
+    shares = chain.shares
+    for i in xrange(0, len(shares), args.shares_per_message):
+        batch = shares[i:i + args.shares_per_message]
+        tx_hashes = [tx_hash for share in batch for tx_hash in share.share_info['new_transaction_hashes'] if tx_hash in chain.known_txs]
+        if tx_hashes:
+            frames.append(make_frame(prefix, 'have_tx', p2p.Protocol.message_have_tx.pack(dict(tx_hashes=tx_hashes))))
+            frames.append(make_frame(prefix, 'remember_tx', p2p.Protocol.message_remember_tx.pack(dict(
+                tx_hashes=[], txs=[chain.known_txs[tx_hash] for tx_hash in tx_hashes]))))
+        frames.append(make_frame(prefix, 'shares', p2p.Protocol.message_shares.pack(dict(shares=[share.as_share() for share in batch]))))
+        frames.append(make_frame(prefix, 'ping', ''))
+    return prefix, ''.join(frames)
+
+def chunker_receiver(prefix, max_payload_length, frames):
+    # the framing part of the previous p2protocol.Protocol.dataReceiver
+    while True:
+        start = ''
+        while start != prefix:
+            start = (start + (yield 1))[-len(prefix):]
+        command = (yield 12).rstrip('\0')
+        length, = struct.unpack('<I', (yield 4))
+        if length > max_payload_length:
+            frames.append((command, length, None, None))
+            continue
+        checksum = yield 4
+        payload = yield length
+        frames.append((command, length, checksum, payload))
+
+def run_mode(mode, prefix, stream, chunk, repeat):
+    chunks = [stream[i:i + chunk] for i in xrange(0, len(stream), chunk)]
+    times = []
+    c0 = cpu_time()
+    for i in xrange(repeat):
+        t0 = time.time()
+        if mode == 'chunker':
+            frames = []
+            feed = datachunker.DataChunker(chunker_receiver(prefix, 3145728, frames))
+            for data in chunks:
+                feed(data)
+        else:
+            decoder = p2protocol.FrameDecoder(prefix, 3145728)
+            frames = []
+            for data in chunks:
+                frames.extend(decoder.feed(data))
+        times.append(time.time() - t0)
+    c1 = cpu_time()
+    best = min(times)
+    return dict(
+        frames=len(frames),
+        seconds=best,
+        mb_per_s=len(stream)/best/1e6,
+        frames_per_s=len(frames)/best,
+        cpu_seconds=(c1 - c0)/repeat,
+    ), frames
+
+def format_results(args, results):
+    lines = ['', 'P2P framing: %.2f MB in %i-byte chunks, %s' % (results['bytes']/1e6, args.chunk,
+        'recorded from %s' % (args.capture,) if args.capture else 'synthetic, %i shares' % (args.shares,))]
+    for mode in args.modes:
+        r = results[mode]
+        lines.append('  %-8s %8.1f MB/s  %9.0f frames/s  (%i frames)' % (mode, r['mb_per_s'], r['frames_per_s'], r['frames']))
+    if 'chunker' in results and 'decoder' in results:
+        lines.append('  speedup %.1fx' % (results['decoder']['mb_per_s']/results['chunker']['mb_per_s'],))
+    return '\n'.join(lines)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='P2P message framing benchmark')
+    parser.add_argument('--capture', metavar='PATH', help='raw received bytes to split instead of synthetic traffic')
+    parser.add_argument('--prefix', metavar='HEX', help='message prefix of the captured traffic (default: the dash p2pool prefix)')
+    parser.add_argument('--shares', type=int, default=400, help='shares in the synthetic traffic (default: %(default)s)')
+    parser.add_argument('--shares-per-message', type=int, default=10, help='shares per synthetic shares message (default: %(default)s)')
+    parser.add_argument('--txs-per-share', type=int, default=20, help='new transactions per synthetic share (default: %(default)s)')
+    parser.add_argument('--chunk', type=int, default=1448, help='bytes handed to the decoder at a time (default: %(default)s)')
+    parser.add_argument('--repeat', type=int, default=5, help='runs per mode, the fastest is reported (default: %(default)s)')
+    parser.add_argument('--modes', nargs='+', choices=MODES, default=MODES)
+    parser.add_argument('--json', metavar='PATH', help='also write results as JSON to PATH')
+    args = parser.parse_args(argv)
+
+    if args.capture:
+        with open(args.capture, 'rb') as f:
+            stream = f.read()
+        prefix = args.prefix.decode('hex') if args.prefix else sharechain.make_net().PREFIX
+    else:
+        prefix, stream = make_traffic(args)
+
+    results = dict(bytes=len(stream))
+    outputs = []
+    for mode in args.modes:
+        results[mode], frames = run_mode(mode, prefix, stream, args.chunk, args.repeat)
+        outputs.append(frames)
+    assert all(frames == outputs[0] for frames in outputs), 'decoders disagree'
+    print format_results(args, results)
+    if args.json:
+        with open(args.json, 'wb') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+if __name__ == '__main__':
+    main()
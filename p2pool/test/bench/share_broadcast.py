@@ -0,0 +1,115 @@
+'''
+Share broadcast benchmark.
+
+Broadcasts the last --shares shares of a synthetic chain to --peers
+p2pool peers the way P2PNode.broadcast_share does, with:
+
+- per_peer: every peer's shares and remember_tx messages are packed for it
+- shared: one p2p.BroadcastEncoder for the broadcast, so shares and
+  transactions are packed once and peers sent the same shares get the same framed bytes
+
+Peers are p2p.Protocol instances on in-memory transports, so only the
+sending side is measured. Half of them already know the shares'
+transactions, and --relayed of them sent us the newest share (and are
+not sent it back), so they get different remember_tx messages and some a
+different shares message.
+
+    python -m p2pool.test.bench.share_broadcast --peers 50
+'''
+
+from __future__ import division
+
+import argparse
+import json
+import time
+
+from twisted.test import proto_helpers
+
+from p2pool import p2p
+from p2pool.test.bench import sharechain
+from p2pool.test.bench.stratum_load import cpu_time
+
+MODES = ['per_peer', 'shared']
+
+def make_peers(chain, count, relayed=0):
+    node = p2p.Node(lambda: None, 0, chain.net)
+    peers = []
+    for i in xrange(count):
+        peer = p2p.Protocol(node, False)
+        peer.transport = proto_helpers.StringTransport()
+        peer.addr = '10.0.%i.%i' % (i//256, i % 256), 8999
+        peer.remote_tx_hashes = set(chain.known_txs) if i % 2 else set()
+        peer.remote_remembered_txs_size = 0
+        peer.tx_announcer = p2p.TxAnnouncer(peer)
+        peers.append(peer)
+    return peers
+
+def broadcast(chain, peers, shares, mode):
+    encoder = p2p.BroadcastEncoder() if mode == 'shared' else None
+    for peer in peers:
+        peer.sendShares([share for share in shares if share.peer_addr != peer.addr], chain.tracker, chain.known_txs,
+            include_txs_with=[shares[0].hash], encoder=encoder)
+    return encoder
+
+def get_broadcast_shares(chain, count, peers, relayed):
+    shares = list(chain.tracker.get_chain(chain.tip, count))
+    # the newest share came from the first `relayed` peers
+    shares[0].peer_addr = peers[0].addr if relayed else None
+    for peer in peers[1:relayed]:
+        peer.addr = peers[0].addr
+    return shares
+
+def run_mode(mode, chain, peers, shares, repeat):
+    c0 = cpu_time()
+    t0 = time.time()
+    for i in xrange(repeat):
+        for peer in peers:
+            peer.transport.clear()
+        encoder = broadcast(chain, peers, shares, mode)
+    t1 = time.time()
+    c1 = cpu_time()
+    return dict(
+        ms_per_broadcast=(t1 - t0)/repeat*1e3,
+        cpu_ms_per_broadcast=(c1 - c0)/repeat*1e3,
+        bytes_per_broadcast=sum(len(peer.transport.value()) for peer in peers),
+        encodes_per_broadcast=encoder.encoded if encoder is not None else len(peers),
+    ), [peer.transport.value() for peer in peers]
+
+def format_results(args, results):
+    lines = ['', 'Share broadcast: %i shares to %i peers (%i of them relayed the newest share)' % (args.shares, args.peers, args.relayed)]
+    for mode in args.modes:
+        r = results[mode]
+        lines.append('  %-9s %7.2f ms/broadcast  CPU %.2f ms  %i shares messages encoded  %.0f kB sent' % (
+            mode, r['ms_per_broadcast'], r['cpu_ms_per_broadcast'], r['encodes_per_broadcast'], r['bytes_per_broadcast']/1e3))
+    if 'per_peer' in results and 'shared' in results:
+        lines.append('  speedup %.1fx' % (results['per_peer']['cpu_ms_per_broadcast']/results['shared']['cpu_ms_per_broadcast'],))
+    return '\n'.join(lines)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Share broadcast encoding benchmark')
+    parser.add_argument('--peers', type=int, default=50, help='connected peers (default: %(default)s)')
+    parser.add_argument('--shares', type=int, default=5, help='shares per broadcast, as broadcast_share sends (default: %(default)s)')
+    parser.add_argument('--relayed', type=int, default=2, help='peers the newest share came from (default: %(default)s)')
+    parser.add_argument('--txs-per-share', type=int, default=20, help='new transactions per synthetic share (default: %(default)s)')
+    parser.add_argument('--repeat', type=int, default=50, help='broadcasts per mode (default: %(default)s)')
+    parser.add_argument('--modes', nargs='+', choices=MODES, default=MODES)
+    parser.add_argument('--json', metavar='PATH', help='also write results as JSON to PATH')
+    args = parser.parse_args(argv)
+
+    chain = sharechain.make_chain(50, chain_length=50, txs_per_share=args.txs_per_share)
+    peers = make_peers(chain, args.peers)
+    shares = get_broadcast_shares(chain, args.shares, peers, args.relayed)
+
+    results = {}
+    outputs = []
+    for mode in args.modes:
+        results[mode], sent = run_mode(mode, chain, peers, shares, args.repeat)
+        outputs.append(sent)
+    assert all(sent == outputs[0] for sent in outputs), 'modes sent different bytes'
+    print format_results(args, results)
+    if args.json:
+        with open(args.json, 'wb') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+if __name__ == '__main__':
+    main()
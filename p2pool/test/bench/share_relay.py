@@ -0,0 +1,167 @@
+'''
+Two-node share relay harness.
+
+Relays the last --shares shares of a synthetic chain from one p2pool peer
+to another over a simulated link (--delay seconds one way, --rate bytes
+per second) and measures, per share, the bytes sent both ways and the
+time until the receiver hands the share and its transactions to its
+node. Modes:
+
+- shares: remember_tx with the transactions the receiver is not known to
+  have, the full shares message, then forget_tx (peers before 1900)
+- compact: a cmpctshares message with 6-byte short ids and those
+  transactions prefilled; the receiver rebuilds the rest from the
+  transactions it knows and asks for any it lacks with getsharetxs
+
+The receiver lacks --missing of the shares' transactions. In compact
+mode the sender wrongly believes it has --stale of those, so they cost a
+getsharetxs round trip; the shares path cannot recover from that (the
+receiver disconnects), so it always gets an accurate view. Time is
+simulated with task.Clock.
+
+    python -m p2pool.test.bench.share_relay --missing .05 --stale .5
+'''
+
+from __future__ import division
+
+import argparse
+import json
+import random
+
+from twisted.internet import task
+from twisted.test import proto_helpers
+
+from p2pool import p2p
+from p2pool.test.bench import sharechain
+from p2pool.util import deferral, variable
+
+MODES = ['shares', 'compact']
+
+class LinkTransport(proto_helpers.StringTransport):
+    '''Delivers what is written to `remote` after delay seconds plus the time to send it at rate bytes per second'''
+    
+    def __init__(self, clock, delay, rate):
+        proto_helpers.StringTransport.__init__(self)
+        self.clock = clock
+        self.delay = delay
+        self.rate = rate
+        self.remote = None
+        self.sent = 0
+        self._free_at = 0
+    
+    def write(self, data):
+        self.sent += len(data)
+        self._free_at = max(self.clock.seconds(), self._free_at) + len(data)/self.rate
+        self.clock.callLater(self._free_at + self.delay - self.clock.seconds(), self.remote.dataReceived, data)
+
+class RelayNode(p2p.Node):
+    def __init__(self, chain, clock, known_txs):
+        p2p.Node.__init__(self, lambda: None, 0, chain.net, known_txs_var=variable.VariableDict(known_txs))
+        self.chain = chain
+        self.clock = clock
+        self.received = {} # share hash -> time it was handled
+        self.received_txs = {} # share hash -> its new transactions
+        self.requested = [] # share hashes asked for with sharereq
+    
+    def handle_shares(self, shares, peer):
+        for share, txs in shares:
+            self.received[share.hash] = self.clock.seconds()
+            self.received_txs[share.hash] = txs
+        self.known_txs_var.add(dict((tx_hash, tx) for share, txs in shares for tx_hash, tx in zip(share.share_info['new_transaction_hashes'], txs)))
+    
+    def handle_share_hashes(self, hashes, peer):
+        self.requested.extend(hashes)
+    
+    def handle_get_share_txs(self, share_hash, indexes, peer):
+        tx_hashes = self.chain.tracker.items[share_hash].share_info['new_transaction_hashes']
+        return [self.chain.known_txs[tx_hashes[i]] for i in indexes]
+
+def make_link(chain, clock, args, version, receiver_txs, view):
+    nodes = [RelayNode(chain, clock, chain.known_txs), RelayNode(chain, clock, receiver_txs)]
+    peers = []
+    for i, node in enumerate(nodes):
+        peer = p2p.Protocol(node, bool(i))
+        peer.transport = LinkTransport(clock, args.delay, args.rate)
+        peer.addr = '10.0.0.%i' % (2 - i,), 8999
+        peer.other_version = version
+        peer.connected = peer.connected2 = True
+        peer.remote_tx_hashes = set()
+        peer.remote_remembered_txs_size = 0
+        peer.remembered_txs = {}
+        peer.remembered_txs_size = 0
+        peer.known_txs_cache = {}
+        peer.tx_announcer = p2p.TxAnnouncer(peer, clock=clock)
+        peer.share_txs_requests = 0
+        def request_share_txs(id, share_hash, indexes, peer=peer):
+            peer.share_txs_requests += 1
+            peer.send_getsharetxs(id=id, share_hash=share_hash, indexes=indexes)
+        peer.get_share_txs = deferral.GenericDeferrer(max_id=2**256, func=request_share_txs, timeout=15)
+        peers.append(peer)
+    sender, receiver = peers
+    sender.transport.remote, receiver.transport.remote = receiver, sender
+    sender.remote_tx_hashes = view
+    return nodes, peers
+
+def run_mode(mode, args, chain):
+    rng = random.Random(0)
+    shares = chain.shares[-args.shares:]
+    share_tx_hashes = set(tx_hash for share in shares for tx_hash in share.share_info['new_transaction_hashes'])
+    missing = set(tx_hash for tx_hash in sorted(share_tx_hashes) if rng.random() < args.missing)
+    stale = set(tx_hash for tx_hash in sorted(missing) if rng.random() < args.stale) if mode == 'compact' else set()
+    receiver_txs = dict((tx_hash, tx) for tx_hash, tx in chain.known_txs.iteritems() if tx_hash not in missing)
+    
+    clock = task.Clock()
+    (sender_node, receiver_node), (sender, receiver) = make_link(chain, clock, args,
+        p2p.Protocol.COMPACT_SHARE_VERSION if mode == 'compact' else p2p.Protocol.TX_SKETCH_VERSION,
+        receiver_txs, set(receiver_txs) | stale)
+    latencies = []
+    for share in shares:
+        sent_at = clock.seconds()
+        sender.sendShares([share], chain.tracker, chain.known_txs)
+        while share.hash not in receiver_node.received and share.hash not in receiver_node.requested:
+            clock.advance(.0005)
+        if share.hash in receiver_node.received:
+            assert receiver_node.received_txs[share.hash] == [chain.known_txs[tx_hash] for tx_hash in share.share_info['new_transaction_hashes']]
+            latencies.append(receiver_node.received[share.hash] - sent_at)
+        clock.advance(1) # let forget_tx and anything else in flight arrive
+    return dict(
+        bytes_per_share=(sender.transport.sent + receiver.transport.sent)/len(shares),
+        mean_latency_ms=sum(latencies)/len(latencies)*1e3,
+        max_latency_ms=max(latencies)*1e3,
+        round_trips=receiver.share_txs_requests,
+        fallbacks=len(receiver_node.requested),
+        txs_per_share=sum(len(share.share_info['new_transaction_hashes']) for share in shares)/len(shares),
+    )
+
+def format_results(args, results):
+    lines = ['', 'Share relay: %i shares over a %.0f ms, %.0f kB/s link; receiver lacks %.0f%% of their txs, %.0f%% of those unknown to the sender' % (
+        args.shares, args.delay*1e3, args.rate/1e3, args.missing*100, args.stale*100)]
+    for mode in args.modes:
+        r = results[mode]
+        lines.append('  %-7s %7.0f bytes/share (%.1f txs)  latency mean %6.1f ms  max %6.1f ms  %i getsharetxs  %i fallbacks' % (
+            mode, r['bytes_per_share'], r['txs_per_share'], r['mean_latency_ms'], r['max_latency_ms'], r['round_trips'], r['fallbacks']))
+    return '\n'.join(lines)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Two-node share relay harness')
+    parser.add_argument('--shares', type=int, default=50, help='shares relayed (default: %(default)s)')
+    parser.add_argument('--txs-per-share', type=int, default=20, help='new transactions per synthetic share (default: %(default)s)')
+    parser.add_argument('--missing', type=float, default=.05, help="fraction of the shares' transactions the receiver lacks (default: %(default)s)")
+    parser.add_argument('--stale', type=float, default=.5, help='fraction of the missing ones the sender thinks the receiver has (default: %(default)s)')
+    parser.add_argument('--delay', type=float, default=.05, help='one-way link delay in seconds (default: %(default)s)')
+    parser.add_argument('--rate', type=float, default=1e6, help='link bytes per second (default: %(default)s)')
+    parser.add_argument('--modes', nargs='+', choices=MODES, default=MODES)
+    parser.add_argument('--json', metavar='PATH', help='also write results as JSON to PATH')
+    args = parser.parse_args(argv)
+    
+    chain = sharechain.make_chain(args.shares + 10, chain_length=args.shares + 10, txs_per_share=args.txs_per_share)
+    results = {}
+    for mode in args.modes:
+        results[mode] = run_mode(mode, args, chain)
+    print format_results(args, results)
+    if args.json:
+        with open(args.json, 'wb') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+if __name__ == '__main__':
+    main()
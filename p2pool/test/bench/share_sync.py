@@ -0,0 +1,195 @@
+'''
+Initial sharechain sync benchmark.
+
+A node with an empty tracker downloads the --window shares below the tip
+of a synthetic chain from --peers simulated p2pool peers that all have
+it. Each peer is a p2p.Protocol pair on a link with its own delay (from
+--delay to twice that, one way) and --rate bytes per second, except
+that --slow of them only manage --slow-rate. Time is simulated with
+task.Clock. Modes:
+
+- legacy: the previous P2PNode.download_shares loop, one get_shares at
+  a time for a random desired share from a random peer, with
+  parents=random.randrange(500)
+- pipelined: node.ShareDownloader
+
+Reported are the simulated time until the window is in the tracker, the
+get_shares requests sent, the bytes received and the CPU time spent
+adding the shares to the tracker.
+
+    python -m p2pool.test.bench.share_sync --window 4320 --peers 8 --slow 1
+'''
+
+from __future__ import division
+
+import argparse
+import json
+import random
+import sys
+
+from twisted.internet import defer, task
+
+from p2pool import data as p2pool_data, node as p2pool_node, p2p
+from p2pool.test.bench import sharechain
+from p2pool.test.bench.share_relay import LinkTransport
+from p2pool.test.bench.stratum_load import cpu_time
+from p2pool.util import deferral
+
+MODES = ['legacy', 'pipelined']
+
+class ServingNode(p2p.Node):
+    '''A peer that has the whole chain and answers sharereq as P2PNode does'''
+
+    handle_get_shares = p2pool_node.P2PNode.__dict__['handle_get_shares']
+
+    def __init__(self, chain):
+        p2p.Node.__init__(self, lambda: None, 0, chain.net)
+        self.node = chain
+
+class SyncingNode(p2p.Node):
+    def __init__(self, net, clock, window, tip):
+        p2p.Node.__init__(self, lambda: None, 0, net)
+        self.tracker = p2pool_data.OkayTracker(net)
+        self.clock = clock
+        self.window = window
+        self.tip = tip
+        self.requests = 0
+        self.add_cpu = 0
+        self.desired_changed = lambda: None
+
+    def get_desired(self):
+        if self.tip not in self.tracker.items:
+            return [(None, self.tip)]
+        height, last = self.tracker.get_height_and_last(self.tip)
+        return [(None, last)] if height < self.window and last is not None else []
+
+    def add_shares(self, shares):
+        c0 = cpu_time()
+        for share in shares:
+            if share.hash not in self.tracker.items:
+                self.tracker.add(share)
+        self.add_cpu += cpu_time() - c0
+        self.desired_changed()
+
+def make_peers(chain, clock, args):
+    syncing = SyncingNode(chain.net, clock, args.window, chain.tip)
+    peers = []
+    for i in xrange(args.peers):
+        serving = ServingNode(chain)
+        delay = args.delay*(1 + i/max(1, args.peers - 1))
+        rate = args.slow_rate if i < args.slow else args.rate
+        pair = []
+        for j, node in enumerate([serving, syncing]):
+            peer = p2p.Protocol(node, bool(j))
+            peer.transport = LinkTransport(clock, delay, rate)
+            peer.addr = '10.0.%i.%i' % (i, 2 - j), 8999
+            peer.other_version = p2p.Protocol.VERSION
+            peer.connected = peer.connected2 = True
+            pair.append(peer)
+        remote, peer = pair
+        remote.transport.remote, peer.transport.remote = peer, remote
+        def request_shares(id, hashes, parents, stops, peer=peer):
+            syncing.requests += 1
+            peer.send_sharereq(id=id, hashes=hashes, parents=parents, stops=stops)
+        peer.get_shares = deferral.GenericDeferrer(max_id=2**256, func=request_shares, timeout=600)
+        syncing.peers[i] = peer
+        peers.append(peer)
+    return syncing, peers
+
+@defer.inlineCallbacks
+def legacy_download(syncing, peers, clock, rng):
+    # the previous P2PNode.download_shares, minus the printing and the error handling nothing here triggers
+    while True:
+        desired = syncing.get_desired()
+        if not desired:
+            break
+        peer_addr, share_hash = rng.choice(desired)
+        peer = rng.choice(peers)
+        shares = yield peer.get_shares(
+            hashes=[share_hash],
+            parents=rng.randrange(500),
+            stops=list(set(syncing.tracker.heads) | set(
+                syncing.tracker.get_nth_parent_hash(head, min(max(0, syncing.tracker.get_height_and_last(head)[0] - 1), 10)) for head in syncing.tracker.heads
+            ))[:100],
+        )
+        if not shares:
+            yield task.deferLater(clock, 1, lambda: None)
+            continue
+        syncing.add_shares(shares)
+
+class Quiet(object):
+    def write(self, data):
+        pass
+
+def run_mode(mode, chain, args):
+    random.seed(0) # ShareDownloader picks among untried peers at random
+    clock = task.Clock()
+    syncing, peers = make_peers(chain, clock, args)
+    stdout, sys.stdout = sys.stdout, Quiet()
+    try:
+        c0 = cpu_time()
+        if mode == 'legacy':
+            legacy_download(syncing, peers, clock, random.Random(0))
+            busy = lambda: False
+        else:
+            downloader = p2pool_node.ShareDownloader(syncing.tracker, syncing.get_desired, lambda: peers, syncing.add_shares,
+                walk_length=args.window, request_size=args.request_size, max_requests=args.max_requests, clock=clock)
+            syncing.desired_changed = downloader.poll
+            downloader.poll()
+            busy = lambda: downloader.walks
+        while syncing.get_desired() or busy():
+            clock.advance(.005)
+        c1 = cpu_time()
+        synced_at = clock.seconds()
+        if mode != 'legacy':
+            downloader.stop()
+        clock.advance(600) # let anything still in flight arrive
+    finally:
+        sys.stdout = stdout
+    height, last = syncing.tracker.get_height_and_last(chain.tip)
+    assert height >= args.window
+    return dict(
+        seconds_to_synced=synced_at,
+        requests=syncing.requests,
+        kb_received=sum(peer.transport.remote.transport.sent for peer in peers)/1e3,
+        add_cpu_ms=syncing.add_cpu*1e3,
+        cpu_seconds=c1 - c0,
+        shares=len(syncing.tracker.items),
+    )
+
+def format_results(args, results):
+    lines = ['', 'Sharechain sync: %i-share window from %i peers, %.0f-%.0f ms one way at %.0f kB/s (%i of them at %.0f kB/s)' % (
+        args.window, args.peers, args.delay*1e3, 2*args.delay*1e3, args.rate/1e3, args.slow, args.slow_rate/1e3)]
+    for mode in args.modes:
+        r = results[mode]
+        lines.append('  %-9s %6.2f s to synced  %4i requests  %6.0f kB received  %5i shares  tracker adds %6.1f ms  CPU %.2f s' % (
+            mode, r['seconds_to_synced'], r['requests'], r['kb_received'], r['shares'], r['add_cpu_ms'], r['cpu_seconds']))
+    if 'legacy' in results and 'pipelined' in results:
+        lines.append('  speedup %.1fx' % (results['legacy']['seconds_to_synced']/results['pipelined']['seconds_to_synced'],))
+    return '\n'.join(lines)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Initial sharechain sync benchmark')
+    parser.add_argument('--window', type=int, default=4320, help='shares to sync (default: %(default)s)')
+    parser.add_argument('--peers', type=int, default=8, help='peers that have the chain (default: %(default)s)')
+    parser.add_argument('--delay', type=float, default=.05, help='one-way delay of the fastest link in seconds (default: %(default)s)')
+    parser.add_argument('--rate', type=float, default=1e6, help='link bytes per second (default: %(default)s)')
+    parser.add_argument('--slow', type=int, default=1, help='peers on a slow link (default: %(default)s)')
+    parser.add_argument('--slow-rate', type=float, default=20e3, help='bytes per second of the slow links (default: %(default)s)')
+    parser.add_argument('--request-size', type=int, default=500, help='shares per request of the pipelined mode (default: %(default)s)')
+    parser.add_argument('--max-requests', type=int, default=4, help='concurrent requests of the pipelined mode (default: %(default)s)')
+    parser.add_argument('--modes', nargs='+', choices=MODES, default=MODES)
+    parser.add_argument('--json', metavar='PATH', help='also write results as JSON to PATH')
+    args = parser.parse_args(argv)
+
+    chain = sharechain.make_chain(args.window + 200, chain_length=args.window + 200, txs_per_share=2)
+    results = {}
+    for mode in args.modes:
+        results[mode] = run_mode(mode, chain, args)
+    print format_results(args, results)
+    if args.json:
+        with open(args.json, 'wb') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,211 @@
+'''
+Deterministic synthetic sharechains.
+
+make_chain() mines a share chain in which every share is built by
+Share.generate_transaction and passes Share.__init__ and Share.check, so the
+real code paths can be benchmarked or tested without peers or dashd.
+
+The chain runs on a copy of a real p2pool network definition with MAX_TARGET
+raised to the maximum, so each share needs only a nonce or two of real PoW.
+Everything else (coinbase and payment layout, payout weights, tx references,
+forks, stale info) follows the parameters, and the same parameters always
+produce the same share hashes.
+'''
+
+from __future__ import division
+
+import hashlib
+import random
+
+from p2pool import data as p2pool_data, networks
+from p2pool.dash import data as dash_data
+from p2pool.util import math, pack
+
+def make_net(base='dash', chain_length=None, **overrides):
+    '''
+    Returns a copy of p2pool network `base` with an unlimited share target.
+    chain_length overrides both CHAIN_LENGTH and REAL_CHAIN_LENGTH.
+    '''
+    base_net = networks.nets[base]
+    attrs = dict((k, getattr(base_net, k)) for k in dir(base_net) if k.isupper())
+    attrs.update(
+        NAME=base_net.NAME + '_bench',
+        MIN_TARGET=0,
+        MAX_TARGET=2**256 - 1,
+        PERSIST=False,
+    )
+    if chain_length is not None:
+        attrs.update(CHAIN_LENGTH=chain_length, REAL_CHAIN_LENGTH=chain_length)
+    attrs.update(overrides)
+    return math.Object(**attrs)
+
+def make_tx(rng, inputs=1, outputs=2):
+    return dict(
+        version=1,
+        type=0,
+        tx_ins=[dict(
+            previous_output=dict(hash=rng.getrandbits(256), index=rng.randrange(4)),
+            script=''.join(chr(rng.getrandbits(8)) for i in xrange(107)),
+            sequence=None,
+        ) for i in xrange(inputs)],
+        tx_outs=[dict(
+            value=rng.randrange(10**5, 10**9),
+            script=dash_data.pubkey_hash_to_script2(rng.getrandbits(160)),
+        ) for i in xrange(outputs)],
+        lock_time=0,
+        extra_payload=None,
+    )
+
+class SyntheticChain(object):
+    '''
+    A generated chain: `tracker` (an OkayTracker holding every share),
+    `shares` in insertion order (parents always before children),
+    `main_hashes` from genesis to tip, `fork_heads` and `known_txs`.
+    '''
+
+    def __init__(self, net, seed, length, forks=0, fork_length=3, miners=20,
+            txs_per_share=20, tx_reuse=0.5, stale_prop=0.05, payments=1,
+            payload_size=180, shares_per_block=8, genesis_timestamp=1500000000):
+        self.net = net
+        self.params = dict(seed=seed, length=length, forks=forks, fork_length=fork_length,
+            miners=miners, txs_per_share=txs_per_share, tx_reuse=tx_reuse, stale_prop=stale_prop,
+            payments=payments, payload_size=payload_size, shares_per_block=shares_per_block)
+        self._rng = rng = random.Random(seed)
+        self._txs_per_share = txs_per_share
+        self._tx_reuse = tx_reuse
+        self._stale_prop = stale_prop
+        self._payload_size = payload_size
+        self._shares_per_block = shares_per_block
+
+        self.miner_pubkey_hashes = [rng.getrandbits(160) for i in xrange(miners)]
+        self._miner_weights = [1/(i + 1) for i in xrange(miners)] # a few big miners and a long tail
+        self.payment_scripts = [dash_data.pubkey_hash_to_script2(rng.getrandbits(160)) for i in xrange(payments)]
+        self.block_bits = dash_data.FloatingInteger.from_target_upper_bound(2**256//2**64)
+        self.previous_blocks = [rng.getrandbits(256)]
+        self.genesis_timestamp = genesis_timestamp
+
+        self.tracker = p2pool_data.OkayTracker(net)
+        self.known_txs = {}
+        self.shares = []
+        self.main_hashes = []
+        self.fork_heads = []
+
+        for i in xrange(length):
+            self.main_hashes.append(self._add_share(self.main_hashes[-1] if self.main_hashes else None).hash)
+        for i in xrange(forks):
+            if len(self.main_hashes) < 2:
+                break
+            head = self.main_hashes[rng.randrange(len(self.main_hashes)//2, len(self.main_hashes) - 1)]
+            for j in xrange(rng.randint(1, fork_length)):
+                head = self._add_share(head).hash
+            self.fork_heads.append(head)
+
+    @property
+    def tip(self):
+        return self.main_hashes[-1]
+
+    @property
+    def fingerprint(self):
+        return hashlib.sha256(''.join(pack.IntType(256).pack(share.hash) for share in self.shares)).hexdigest()
+
+    def _choose_miner(self):
+        x = self._rng.uniform(0, sum(self._miner_weights))
+        for pubkey_hash, weight in zip(self.miner_pubkey_hashes, self._miner_weights):
+            x -= weight
+            if x <= 0:
+                return pubkey_hash
+        return self.miner_pubkey_hashes[-1]
+
+    def _new_tx_hash(self):
+        tx = make_tx(self._rng)
+        tx_hash = dash_data.hash256(dash_data.tx_type.pack(tx))
+        self.known_txs[tx_hash] = tx
+        return tx_hash
+
+    def desired_txs(self, previous_share_hash):
+        '''
+        Picks txs_per_share (hash, fee) pairs for a share on top of
+        previous_share_hash: about tx_reuse of them already referenced by
+        recent ancestors, the rest new.
+        '''
+        rng = self._rng
+        recent = []
+        if previous_share_hash is not None:
+            for share in self.tracker.get_chain(previous_share_hash, min(10, self.tracker.get_height(previous_share_hash))):
+                recent.extend(share.share_info['new_transaction_hashes'])
+        reused = rng.sample(recent, min(len(recent), int(self._txs_per_share*self._tx_reuse)))
+        new = [self._new_tx_hash() for i in xrange(self._txs_per_share - len(reused))]
+        return [(tx_hash, rng.randrange(1000, 100000)) for tx_hash in reused + new]
+
+    def share_data(self, previous_share_hash, height):
+        rng = self._rng
+        subsidy = 180000000
+        payment_amount = subsidy*6//10//max(1, len(self.payment_scripts))
+        return dict(
+            previous_share_hash=previous_share_hash,
+            coinbase=('\x03' + pack.IntType(24).pack(height % 2**24) + pack.IntType(64).pack(rng.getrandbits(64)) + self.net.COINBASEEXT)[:100],
+            coinbase_payload=''.join(chr(rng.getrandbits(8)) for i in xrange(self._payload_size)) if self._payload_size else None,
+            nonce=rng.getrandbits(32),
+            pubkey_hash=self._choose_miner(),
+            subsidy=subsidy,
+            donation=rng.choice([0, 0, 0, 50, 100]),
+            stale_info=rng.choice(['orphan', 'doa']) if rng.random() < self._stale_prop else None,
+            desired_version=p2pool_data.Share.VOTING_VERSION,
+            payment_amount=payment_amount*len(self.payment_scripts),
+            packed_payments=[dict(payee='!' + script.encode('hex'), amount=payment_amount) for script in self.payment_scripts],
+        )
+
+    def _add_share(self, previous_share_hash):
+        net = self.net
+        height = self.tracker.get_height(previous_share_hash) if previous_share_hash is not None else 0
+        previous_share = self.tracker.items[previous_share_hash] if previous_share_hash is not None else None
+        block_index = height//self._shares_per_block
+        while len(self.previous_blocks) <= block_index:
+            self.previous_blocks.append(self._rng.getrandbits(256))
+
+        desired_timestamp = previous_share.timestamp + net.SHARE_PERIOD if previous_share is not None else self.genesis_timestamp
+        share_info, gentx, other_transaction_hashes, get_share = p2pool_data.Share.generate_transaction(
+            tracker=self.tracker,
+            share_data=self.share_data(previous_share_hash, height),
+            block_target=self.block_bits.target,
+            desired_timestamp=desired_timestamp,
+            desired_target=2**256 - 1,
+            ref_merkle_link=dict(branch=[], index=0),
+            desired_other_transaction_hashes_and_fees=self.desired_txs(previous_share_hash),
+            net=net,
+            known_txs=self.known_txs,
+        )
+        merkle_root = dash_data.check_merkle_link(dash_data.hash256(dash_data.tx_type.pack(gentx)),
+            dash_data.calculate_merkle_link([None] + other_transaction_hashes, 0))
+        header = dict(
+            version=0x20000000,
+            previous_block=self.previous_blocks[block_index],
+            merkle_root=merkle_root,
+            timestamp=share_info['timestamp'],
+            bits=self.block_bits,
+            nonce=0,
+        )
+        while net.PARENT.POW_FUNC(dash_data.block_header_type.pack(header)) > share_info['bits'].target:
+            header['nonce'] += 1
+
+        share = get_share(header)
+        self.tracker.add(share)
+        self.shares.append(share)
+        return share
+
+    def new_tracker(self, verified=False):
+        '''Returns a fresh OkayTracker holding the same shares.'''
+        tracker = p2pool_data.OkayTracker(self.net)
+        for share in self.shares:
+            tracker.add(share)
+            if verified:
+                tracker.verified.add(share)
+        return tracker
+
+def make_chain(length=200, chain_length=None, seed=0, base_net='dash', **kwargs):
+    '''
+    Builds a SyntheticChain of `length` main-chain shares. chain_length sets
+    the network's CHAIN_LENGTH/REAL_CHAIN_LENGTH (default: the base
+    network's); see SyntheticChain for the remaining parameters.
+    '''
+    return SyntheticChain(make_net(base_net, chain_length), seed, length, **kwargs)
@@ -0,0 +1,148 @@
+'''
+Share latency to a peer on a slow link.
+
+Queues a flood of bulk messages for one p2pool peer: have_tx
+announcements, sharereply messages as while the peer syncs and addrs.
+Then, --share-at seconds in, a share is broadcast to it. The link carries
+--rate bytes per simulated second, so the share is delivered once
+everything written before it has drained. Modes:
+
+- direct: messages are written to the transport as they are sent
+- queued: p2protocol.SendQueue holds them in priority lanes while the
+  transport's buffer is over its high-water mark
+
+Time is simulated with task.Clock, so the results do not depend on the
+machine.
+
+    python -m p2pool.test.bench.slow_peer --rate 100000 --flood-kb 2000
+'''
+
+from __future__ import division
+
+import argparse
+import json
+
+from twisted.internet import task
+from twisted.test import proto_helpers
+
+from p2pool import p2p
+from p2pool.test.bench import sharechain
+
+MODES = ['direct', 'queued']
+
+class SlowLinkTransport(proto_helpers.StringTransport):
+    '''
+    Puts `rate` bytes per second of what is written on the wire as clock
+    is advanced with drain(). Like a TCP transport it pauses a streaming
+    producer while more than bufferSize bytes are buffered and resumes it
+    once the buffer is empty.
+    '''
+    
+    def __init__(self, clock, rate, bufferSize=2**16):
+        proto_helpers.StringTransport.__init__(self)
+        self.clock = clock
+        self.rate = rate
+        self.bufferSize = bufferSize
+        self.written = 0 # bytes written
+        self.delivered = 0 # bytes put on the wire
+        self.producer_paused = False
+        self.delivery_times = [] # (end offset, time) of each write once it is delivered
+        self._pending = [] # end offsets of writes not yet delivered
+    
+    def write(self, data):
+        proto_helpers.StringTransport.write(self, data)
+        self.written += len(data)
+        self._pending.append(self.written)
+        if self.producer is not None and self.streaming and not self.producer_paused and self.written - self.delivered > self.bufferSize:
+            self.producer_paused = True
+            self.producer.pauseProducing()
+    
+    def drain(self, dt):
+        self.clock.advance(dt)
+        self.delivered = min(self.written, self.delivered + self.rate*dt)
+        while self._pending and self._pending[0] <= self.delivered:
+            self.delivery_times.append((self._pending.pop(0), self.clock.seconds()))
+        if self.producer_paused and self.delivered == self.written:
+            self.producer_paused = False
+            self.producer.resumeProducing()
+    
+    def get_delivery_time(self, data):
+        end = self.value().find(data) + len(data)
+        for offset, t in self.delivery_times:
+            if offset >= end:
+                return t
+        return None
+
+def make_peer(chain, clock, rate, queued):
+    node = p2p.Node(lambda: None, 0, chain.net)
+    peer = p2p.Protocol(node, False)
+    peer.transport = SlowLinkTransport(clock, rate)
+    peer.addr = '10.0.0.1', 8999
+    peer.remote_tx_hashes = set(chain.known_txs)
+    peer.remote_remembered_txs_size = 0
+    peer.tx_announcer = p2p.TxAnnouncer(peer, clock=clock)
+    if queued:
+        peer.startSendQueue(clock)
+    return peer
+
+def send_flood(chain, peer, flood_bytes):
+    sent = 0
+    shares = [share.as_share() for share in chain.shares[:50]]
+    tx_hashes = range(1000)
+    addrs = [dict(timestamp=0, address=dict(services=0, address='10.1.%i.%i' % (i//256, i % 256), port=8999)) for i in xrange(100)]
+    while sent < flood_bytes:
+        for command, payload in [
+            ('have_tx', dict(tx_hashes=tx_hashes)),
+            ('sharereply', dict(id=sent, result='good', shares=shares)),
+            ('addrs', dict(addrs=addrs)),
+        ]:
+            data = peer.encodePacket(command, payload)
+            peer.sendEncoded(command, data)
+            sent += len(data)
+
+def run_mode(mode, args, chain):
+    clock = task.Clock()
+    peer = make_peer(chain, clock, args.rate, mode == 'queued')
+    send_flood(chain, peer, args.flood_kb*1000)
+    while clock.seconds() < args.share_at:
+        peer.transport.drain(args.tick)
+    share = chain.shares[-1]
+    shared_at = clock.seconds()
+    peer.sendShares([share], chain.tracker, chain.known_txs)
+    share_data = p2p.BroadcastEncoder().get_frames(peer, [share])[0]
+    while peer.transport.delivered < peer.transport.written or (peer.send_queue is not None and any(peer.send_queue.queues)):
+        peer.transport.drain(args.tick)
+    return dict(
+        share_latency_ms=(peer.transport.get_delivery_time(share_data) - shared_at)*1e3,
+        drain_s=clock.seconds(),
+        bytes=peer.transport.written,
+    )
+
+def format_results(args, results):
+    lines = ['', 'Slow peer: %.0f kB of bulk messages on a %.0f kB/s link, share sent %.1f s in' % (args.flood_kb, args.rate/1e3, args.share_at)]
+    for mode in args.modes:
+        r = results[mode]
+        lines.append('  %-7s share delivered after %8.1f ms  all %.0f kB delivered after %.1f s' % (mode, r['share_latency_ms'], r['bytes']/1e3, r['drain_s']))
+    return '\n'.join(lines)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Share latency to a peer on a slow link')
+    parser.add_argument('--rate', type=float, default=100000, help='link bytes per second (default: %(default)s)')
+    parser.add_argument('--flood-kb', type=float, default=2000, help='kB of bulk messages queued first (default: %(default)s)')
+    parser.add_argument('--share-at', type=float, default=1, help='seconds into the flood the share is sent (default: %(default)s)')
+    parser.add_argument('--tick', type=float, default=.001, help='simulation step in seconds (default: %(default)s)')
+    parser.add_argument('--modes', nargs='+', choices=MODES, default=MODES)
+    parser.add_argument('--json', metavar='PATH', help='also write results as JSON to PATH')
+    args = parser.parse_args(argv)
+    
+    chain = sharechain.make_chain(60, chain_length=60)
+    results = {}
+    for mode in args.modes:
+        results[mode] = run_mode(mode, args, chain)
+    print format_results(args, results)
+    if args.json:
+        with open(args.json, 'wb') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+if __name__ == '__main__':
+    main()
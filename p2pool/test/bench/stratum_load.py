@@ -0,0 +1,429 @@
+'''
+Stratum load generator.
+
+Opens N simulated stratum miners over loopback against a real
+StratumServerFactory backed by a fake WorkerBridge (no dashd, no peers, no
+sharechain) and reports:
+
+- notify fan-out latency: time from new_work_event until the first and
+  the last miner have received their mining.notify
+- submit round-trip percentiles for mining.submit
+- CPU time per connection and resident memory
+
+Miners and server share one process and one reactor, so CPU figures include
+the cost of the simulated clients. Each in-process connection uses two file
+descriptors; 10k miners need RLIMIT_NOFILE above 20k.
+
+    python -m p2pool.test.bench.stratum_load --miners 10000 --duration 60
+
+--work-cost-ms makes every get_work call that long, to stand in for
+generating a real job; --addresses spreads the miners over that many
+payout addresses instead of one each.
+'''
+
+from __future__ import division
+
+import argparse
+import json
+import os
+import random
+import resource
+import struct
+import sys
+import time
+
+from twisted.internet import defer, protocol, reactor
+
+import p2pool
+from p2pool.dash import data as dash_data, networks, stratum, worker_interface
+from p2pool.util import deferral, jsonrpc, memory
+
+def percentiles(values, ps=(50, 90, 99, 100)):
+    if not values:
+        return dict(('p%i' % p, None) for p in ps)
+    values = sorted(values)
+    return dict(('p%i' % p, values[min(len(values) - 1, max(0, int(len(values)*p/100 + .5) - 1))]) for p in ps)
+
+def cpu_time():
+    r = resource.getrusage(resource.RUSAGE_SELF)
+    return r.ru_utime + r.ru_stime
+
+# fake worker bridge
+
+class FakeWorkerBridge(worker_interface.WorkerBridge):
+    '''
+    Hands out a synthetic but well-formed job (random coinbase halves and
+    merkle branch) and accepts every submission. Call new_template() to
+    simulate a new block or best share.
+    '''
+
+    COINBASE_NONCE_LENGTH = 8
+
+    def __init__(self, net, share_rate=10, merkle_branch_length=11, coinbase_size=250, work_cost=0):
+        worker_interface.WorkerBridge.__init__(self)
+        self.net = net
+        self.share_rate = share_rate
+        self.work_cost = work_cost
+        self._merkle_branch_length = merkle_branch_length
+        self._coinbase_size = coinbase_size
+
+        self.get_work_count = 0
+        self.submit_count = 0
+        self.template = None
+        self.new_template()
+
+    def new_template(self):
+        self.template = dict(
+            version=0x20000000,
+            previous_block=random.getrandbits(256),
+            bits=dash_data.FloatingInteger.from_target_upper_bound(self.net.SANE_TARGET_RANGE[0]),
+            timestamp=int(time.time()),
+            merkle_link=dict(branch=[random.getrandbits(256) for i in xrange(self._merkle_branch_length)], index=0),
+            coinb1=os.urandom(self._coinbase_size*2//3),
+            coinb2=os.urandom(self._coinbase_size//3),
+        )
+        self.new_work_event.happened()
+
+    def get_user_details(self, username):
+        desired_pseudoshare_target = None
+        if '+' in username:
+            try:
+                desired_pseudoshare_target = dash_data.difficulty_to_target(float(username.split('+')[1]))
+            except ValueError:
+                pass
+        return username, dash_data.hash160(username), None, desired_pseudoshare_target
+
+    def preprocess_request(self, user):
+        user, pubkey_hash, desired_share_target, desired_pseudoshare_target = self.get_user_details(user)
+        return pubkey_hash, desired_share_target, desired_pseudoshare_target
+
+    def get_work(self, pubkey_hash, desired_share_target, desired_pseudoshare_target):
+        self.get_work_count += 1
+        if self.work_cost:
+            end = time.time() + self.work_cost
+            while time.time() < end:
+                pass
+        t = self.template
+        ba = dict(
+            version=t['version'],
+            previous_block=t['previous_block'],
+            merkle_link=t['merkle_link'],
+            coinb1=t['coinb1'],
+            coinb2=t['coinb2'],
+            timestamp=t['timestamp'],
+            bits=t['bits'],
+            min_share_target=self.net.SANE_TARGET_RANGE[0],
+            share_target=desired_pseudoshare_target or self.net.SANE_TARGET_RANGE[1],
+        )
+        def got_response(header, user, coinbase_nonce, submitted_target=None):
+            self.submit_count += 1
+            self.net.POW_FUNC(dash_data.block_header_type.pack(header))
+            return True
+        return ba, got_response
+
+# simulated miner
+
+class _MinerService(object):
+    def __init__(self, miner):
+        self.miner = miner
+
+    def rpc_notify(self, job_id, prevhash, coinb1, coinb2, merkle_branch, version, nbits, ntime, clean_jobs):
+        self.miner.got_notify(job_id, ntime)
+        return True
+
+    def rpc_set_difficulty(self, difficulty):
+        self.miner.difficulty = difficulty
+        return True
+
+    def rpc_set_extranonce(self, extranonce1, extranonce2_size):
+        self.miner.extranonce2_size = extranonce2_size
+        return True
+
+class StratumMiner(jsonrpc.LineBasedPeer):
+    def connectionMade(self):
+        self.svc_mining = _MinerService(self)
+        self.job_id = None
+        self.ntime = None
+        self.difficulty = None
+        self.extranonce2_size = None
+        self.notified_generation = None
+        self.submit_timer = None
+        self.factory.bench.miner_connected(self)
+        bench = self.factory.bench
+        index = bench.miner_count % bench.addresses if bench.addresses else bench.miner_count
+        self.username = self.factory.username % index if '%' in self.factory.username else self.factory.username
+        self._start().addErrback(self.factory.bench.miner_failed)
+
+    @defer.inlineCallbacks
+    def _start(self):
+        yield self.other.svc_mining.rpc_configure(['version-rolling'], {'version-rolling.mask': '1fffe000'})
+        res = yield self.other.svc_mining.rpc_subscribe('p2pool-bench/1.0')
+        self.extranonce2_size = res[2]
+        yield self.other.svc_mining.rpc_authorize(self.username, 'x')
+        self.notified_generation = self.factory.bench.generation
+        self.factory.bench.miner_ready(self)
+
+    def got_notify(self, job_id, ntime):
+        self.job_id, self.ntime = job_id, ntime
+        bench = self.factory.bench
+        if self.notified_generation is not None and self.notified_generation < bench.generation:
+            self.notified_generation = bench.generation
+            bench.miner_notified(self)
+
+    def start_submitting(self, interval):
+        self.submit_timer = reactor.callLater(random.uniform(0, interval), self._submit, interval)
+
+    def _submit(self, interval):
+        self.submit_timer = reactor.callLater(random.expovariate(1/interval), self._submit, interval)
+        if self.job_id is None:
+            return
+        t0 = time.time()
+        df = self.other.svc_mining.rpc_submit(
+            self.username,
+            self.job_id,
+            os.urandom(self.extranonce2_size).encode('hex'),
+            self.ntime,
+            struct.pack('>I', random.getrandbits(32)).encode('hex'),
+        )
+        df.addCallbacks(lambda res: self.factory.bench.submit_done(time.time() - t0, res), self.factory.bench.submit_failed)
+
+    def connectionLost(self, reason):
+        if self.submit_timer is not None and self.submit_timer.active():
+            self.submit_timer.cancel()
+
+class StratumMinerFactory(protocol.ClientFactory):
+    protocol = StratumMiner
+
+    def __init__(self, bench, username):
+        self.bench = bench
+        self.username = username
+
+    def clientConnectionFailed(self, connector, reason):
+        self.bench.miner_failed(reason)
+
+# benchmark driver
+
+class StratumLoadBench(object):
+    def __init__(self, bridge, miners, username='XbenchMinerAddress.w%i', addresses=0):
+        self.bridge = bridge
+        self.miners = miners
+        self.username = username
+        self.addresses = addresses
+
+        self.miner_count = 0
+        self.connected = []
+        self.ready = 0
+        self.failures = 0
+        self.generation = 0
+        self.announce_time = None
+        self.notify_latencies = []
+        self.submit_rtts = []
+        self.submit_rejected = 0
+        self.submit_errors = 0
+
+        self._ready_df = None
+        self._notified = 0
+        self._notified_df = None
+
+    def miner_connected(self, miner):
+        self.miner_count += 1
+        self.connected.append(miner)
+
+    def miner_ready(self, miner):
+        self.ready += 1
+        self._check_ready()
+
+    def miner_failed(self, fail):
+        self.failures += 1
+        self._check_ready()
+
+    def _check_ready(self):
+        if self._ready_df is not None and self.ready + self.failures >= self.miners:
+            df, self._ready_df = self._ready_df, None
+            df.callback(None)
+
+    def miner_notified(self, miner):
+        self.notify_latencies.append(time.time() - self.announce_time)
+        self._notified += 1
+        if self._notified_df is not None and self._notified >= self.ready:
+            df, self._notified_df = self._notified_df, None
+            df.callback(None)
+
+    def submit_done(self, rtt, result):
+        self.submit_rtts.append(rtt)
+        if not result:
+            self.submit_rejected += 1
+
+    def submit_failed(self, fail):
+        self.submit_errors += 1
+
+    def _wait(self, df, timeout):
+        timer = reactor.callLater(timeout, lambda: df.called or df.callback(None))
+        df.addBoth(lambda res: timer.cancel() if timer.active() else None)
+        return df
+
+    @defer.inlineCallbacks
+    def connect(self, port, rate, timeout):
+        self._ready_df = defer.Deferred()
+        factory = StratumMinerFactory(self, self.username)
+        for i in xrange(self.miners):
+            reactor.connectTCP('127.0.0.1', port, factory, timeout=timeout)
+            if (i + 1) % max(1, rate//20) == 0:
+                yield deferral.sleep(.05)
+        self._check_ready()
+        yield self._wait(self._ready_df, timeout)
+
+    @defer.inlineCallbacks
+    def fan_out(self, timeout):
+        self.generation += 1
+        self._notified = 0
+        self._notified_df = defer.Deferred()
+        self.announce_time = time.time()
+        self.bridge.new_template()
+        dispatch = time.time() - self.announce_time
+        yield self._wait(self._notified_df, timeout)
+        defer.returnValue((dispatch, time.time() - self.announce_time, self._notified))
+
+    def start_submitting(self, interval):
+        for miner in self.connected:
+            miner.start_submitting(interval)
+
+    def stop_submitting(self):
+        for miner in self.connected:
+            if miner.submit_timer is not None and miner.submit_timer.active():
+                miner.submit_timer.cancel()
+
+def raise_fd_limit(needed):
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+        soft = hard
+    if soft < needed:
+        print >>sys.stderr, 'Warning: RLIMIT_NOFILE is %i but %i miners need about %i descriptors' % (soft, needed//2, needed)
+
+@defer.inlineCallbacks
+def run(args, results):
+    net = networks.nets[args.net]
+    inner = FakeWorkerBridge(net, share_rate=args.share_rate, work_cost=args.work_cost_ms/1e3)
+    wb = worker_interface.CachingWorkerBridge(inner, prefetch=not args.no_prefetch) if not args.no_caching else inner
+    stratum.pool_stats.MAX_CONNECTIONS = stratum.pool_stats.MAX_CONNECTIONS_PER_IP = args.miners + 1
+    stratum.pool_stats.MIN_DIFFICULTY_FLOOR = args.min_difficulty
+
+    port = reactor.listenTCP(0, stratum.StratumServerFactory(wb, net), interface='127.0.0.1')
+    bench = StratumLoadBench(inner, args.miners, args.username, args.addresses)
+    try:
+        rss0, cpu0, t0 = memory.resident(), cpu_time(), time.time()
+        yield bench.connect(port.getHost().port, args.connect_rate, args.timeout)
+        yield deferral.sleep(args.settle)
+        rss1, cpu1, t1 = memory.resident(), cpu_time(), time.time()
+        print 'Connected %i/%i miners in %.2fs (%i failed)' % (bench.ready, args.miners, t1 - t0, bench.failures)
+        results['connect'] = dict(
+            ready=bench.ready,
+            failed=bench.failures,
+            seconds=t1 - t0,
+            cpu_per_connection_ms=(cpu1 - cpu0)*1e3/max(1, bench.ready),
+            rss_bytes=rss1,
+            rss_per_connection_bytes=(rss1 - rss0)/max(1, bench.ready),
+        )
+
+        rounds = []
+        for i in xrange(args.rounds):
+            bench.notify_latencies = []
+            c0 = cpu_time()
+            dispatch, total, notified = yield bench.fan_out(args.timeout)
+            c1 = cpu_time()
+            first = min(bench.notify_latencies) if bench.notify_latencies else None
+            print 'Fan-out round %i: %i/%i notified, dispatch %.1f ms, first notify %s ms, last notify %.1f ms' % (
+                i, notified, bench.ready, dispatch*1e3, '%.1f' % (first*1e3,) if first is not None else '-', total*1e3)
+            rounds.append(dict(
+                notified=notified,
+                dispatch_ms=dispatch*1e3,
+                first_notify_ms=first*1e3 if first is not None else None,
+                last_notify_ms=total*1e3,
+                cpu_per_connection_us=(c1 - c0)*1e6/max(1, bench.ready),
+                latency_ms=dict((k, v*1e3 if v is not None else None) for k, v in percentiles(bench.notify_latencies).iteritems()),
+            ))
+            yield deferral.sleep(args.round_interval)
+        results['fan_out'] = rounds
+
+        if args.duration > 0:
+            c0, t0 = cpu_time(), time.time()
+            bench.start_submitting(args.submit_interval)
+            yield deferral.sleep(args.duration)
+            bench.stop_submitting()
+            yield deferral.sleep(min(args.timeout, 2))
+            c1, t1 = cpu_time(), time.time()
+            results['submit'] = dict(
+                submitted=len(bench.submit_rtts) + bench.submit_errors,
+                rejected=bench.submit_rejected,
+                errors=bench.submit_errors,
+                rate=len(bench.submit_rtts)/(t1 - t0),
+                cpu_fraction=(c1 - c0)/(t1 - t0),
+                cpu_per_connection_us_per_s=(c1 - c0)*1e6/(t1 - t0)/max(1, bench.ready),
+                rtt_ms=dict((k, v*1e3 if v is not None else None) for k, v in percentiles(bench.submit_rtts).iteritems()),
+            )
+        results['rss_bytes'] = memory.resident()
+        results['get_work_calls'] = inner.get_work_count
+    finally:
+        port.stopListening()
+        reactor.stop()
+
+def format_results(args, results):
+    lines = ['', 'Stratum load: %i miners, %s' % (args.miners, 'plain bridge' if args.no_caching else
+        'CachingWorkerBridge without prefetch' if args.no_prefetch else 'CachingWorkerBridge')]
+    c = results.get('connect')
+    if c:
+        lines.append('  connect: %.2fs, %.3f ms CPU/conn, RSS %.1f MB (%.1f kB/conn)' % (
+            c['seconds'], c['cpu_per_connection_ms'], c['rss_bytes']/1e6, c['rss_per_connection_bytes']/1e3))
+    for i, r in enumerate(results.get('fan_out', [])):
+        lat = r['latency_ms']
+        lines.append('  fan-out %i: dispatch %.1f ms, notify first %s p50 %s p99 %s last %.1f ms, %.1f us CPU/conn' % (
+            i, r['dispatch_ms'], '%.1f' % r['first_notify_ms'] if r['first_notify_ms'] is not None else '-',
+            '%.1f' % lat['p50'] if lat['p50'] is not None else '-',
+            '%.1f' % lat['p99'] if lat['p99'] is not None else '-', r['last_notify_ms'], r['cpu_per_connection_us']))
+    s = results.get('submit')
+    if s:
+        rtt = s['rtt_ms']
+        lines.append('  submit: %i sent (%i rejected, %i errors), %.1f/s, CPU %.1f%%' % (
+            s['submitted'], s['rejected'], s['errors'], s['rate'], s['cpu_fraction']*100))
+        if rtt['p50'] is not None:
+            lines.append('  submit RTT ms: p50 %.2f p90 %.2f p99 %.2f max %.2f' % (rtt['p50'], rtt['p90'], rtt['p99'], rtt['p100']))
+    if 'rss_bytes' in results:
+        lines.append('  final RSS: %.1f MB' % (results['rss_bytes']/1e6,))
+    return '\n'.join(lines)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Stratum server load generator (loopback, no external services)')
+    parser.add_argument('--net', default='dash', choices=sorted(networks.nets))
+    parser.add_argument('--miners', type=int, default=1000, help='number of simulated miners (default: %(default)s)')
+    parser.add_argument('--connect-rate', type=int, default=2000, help='new connections per second (default: %(default)s)')
+    parser.add_argument('--rounds', type=int, default=5, help='number of new_work_event fan-out rounds (default: %(default)s)')
+    parser.add_argument('--round-interval', type=float, default=1, help='seconds between fan-out rounds (default: %(default)s)')
+    parser.add_argument('--duration', type=float, default=30, help='seconds of share submission, 0 to skip (default: %(default)s)')
+    parser.add_argument('--submit-interval', type=float, default=10, help='mean seconds between submits per miner (default: %(default)s)')
+    parser.add_argument('--share-rate', type=float, default=10, help='stratum vardiff target seconds per pseudoshare (default: %(default)s)')
+    parser.add_argument('--min-difficulty', type=float, default=64, help='pool difficulty floor (default: %(default)s)')
+    parser.add_argument('--username', default='XbenchMinerAddress.w%i', help='miner username, %%i is replaced by the miner index')
+    parser.add_argument('--settle', type=float, default=1, help='seconds to wait after connecting (default: %(default)s)')
+    parser.add_argument('--timeout', type=float, default=30, help='phase timeout in seconds (default: %(default)s)')
+    parser.add_argument('--addresses', type=int, default=0, help='number of distinct payout addresses, 0 for one per miner (default: %(default)s)')
+    parser.add_argument('--work-cost-ms', type=float, default=0, help='milliseconds of CPU each get_work call takes (default: %(default)s)')
+    parser.add_argument('--no-caching', action='store_true', default=False, help='do not wrap the bridge in CachingWorkerBridge')
+    parser.add_argument('--no-prefetch', action='store_true', default=False, help='notify miners in one synchronous pass instead of prefetching work for them busiest first')
+    parser.add_argument('--json', metavar='PATH', help='also write results as JSON to PATH')
+    args = parser.parse_args(argv)
+
+    p2pool.DEBUG = False
+    raise_fd_limit(2*args.miners + 64)
+
+    results = {}
+    reactor.callWhenRunning(lambda: run(args, results).addErrback(lambda fail: fail.printTraceback(sys.stderr)))
+    reactor.run()
+
+    print format_results(args, results)
+    if args.json:
+        with open(args.json, 'wb') as f:
+            json.dump(dict(results, miners=args.miners), f, indent=2, sort_keys=True)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,270 @@
+'''
+Sharechain microbenchmarks.
+
+Times the hot sharechain paths (share unpack/init/pack/check,
+generate_transaction, OkayTracker.think, get_cumulative_weights, ShareStore
+save/load and p2p message pack/unpack) on a deterministic synthetic chain and
+writes the results as JSON, so that runs from two commits can be compared:
+
+    python -m p2pool.test.bench.suite --json before.json
+    (switch commits)
+    python -m p2pool.test.bench.suite --json after.json --compare before.json
+
+--compare exits with status 1 if any benchmark got slower by more than
+--threshold.
+'''
+
+from __future__ import division
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import p2pool
+from p2pool import data as p2pool_data, p2p
+from p2pool.test.bench import sharechain
+
+RESULTS_FORMAT = 1
+
+def measure(func, repeat, items=1, min_time=.05, calibrate=True):
+    '''
+    Calls func() repeat times, each sample looping it enough times to take
+    at least min_time; returns timing stats in seconds per call.
+    '''
+    loops = 1
+    if calibrate:
+        t0 = time.time()
+        func()
+        loops = max(1, int(min_time/max(time.time() - t0, 1e-6)))
+    times = []
+    for i in xrange(repeat):
+        t0 = time.time()
+        for j in xrange(loops):
+            func()
+        times.append((time.time() - t0)/loops)
+    times.sort()
+    return dict(
+        items=items,
+        repeat=repeat,
+        loops=loops,
+        best=times[0],
+        median=times[len(times)//2],
+        per_item_us=times[0]/items*1e6,
+    )
+
+def bench_shares(chain, repeat):
+    res = {}
+    net = chain.net
+    shares = chain.shares
+    packed = [p2pool_data.Share.share_type.pack(share.contents) for share in shares]
+    contents = [share.contents for share in shares]
+
+    res['share_unpack'] = measure(lambda: [p2pool_data.Share.share_type.unpack(x) for x in packed], repeat, len(packed))
+    res['share_init'] = measure(lambda: [p2pool_data.Share(net, None, x) for x in contents], repeat, len(contents))
+    res['share_as_share'] = measure(lambda: [share.as_share() for share in shares], repeat, len(shares))
+
+    to_check = [chain.tracker.items[h] for h in chain.main_hashes[-min(100, len(chain.main_hashes)):]]
+    res['share_check'] = measure(lambda: [share.check(chain.tracker) for share in to_check], repeat, len(to_check))
+    return res
+
+def bench_generate_transaction(chain, repeat):
+    tip = chain.tracker.items[chain.tip]
+    share_data = chain.share_data(chain.tip, chain.tracker.get_height(chain.tip))
+    desired_txs = chain.desired_txs(chain.tip)
+    def f():
+        for i in xrange(10):
+            p2pool_data.Share.generate_transaction(
+                tracker=chain.tracker,
+                share_data=share_data,
+                block_target=chain.block_bits.target,
+                desired_timestamp=tip.timestamp + chain.net.SHARE_PERIOD,
+                desired_target=2**256 - 1,
+                ref_merkle_link=dict(branch=[], index=0),
+                desired_other_transaction_hashes_and_fees=desired_txs,
+                net=chain.net,
+                known_txs=chain.known_txs,
+            )
+    return dict(generate_transaction=measure(f, repeat, 10))
+
+def bench_cumulative_weights(chain, repeat):
+    from p2pool.dash import data as dash_data
+    desired_weight = 65535*chain.net.SPREAD*dash_data.target_to_average_attempts(chain.block_bits.target)
+    max_shares = chain.net.REAL_CHAIN_LENGTH
+    heads = chain.main_hashes[-min(50, len(chain.main_hashes)):]
+    def cold():
+        skiplist = p2pool_data.WeightsSkipList(chain.tracker)
+        skiplist(chain.tip, min(max_shares, chain.tracker.get_height(chain.tip)), desired_weight)
+    skiplist = p2pool_data.WeightsSkipList(chain.tracker)
+    def warm():
+        for head in heads:
+            skiplist(head, min(max_shares, chain.tracker.get_height(head)), desired_weight)
+    warm()
+    return dict(
+        get_cumulative_weights_cold=measure(cold, repeat),
+        get_cumulative_weights_warm=measure(warm, repeat, len(heads)),
+    )
+
+def bench_think(chain, repeat):
+    args = (lambda block_hash: 0, chain.previous_blocks[-1], chain.block_bits, chain.known_txs)
+    trackers = [chain.new_tracker() for i in xrange(repeat)]
+    def cold():
+        tracker = trackers.pop()
+        tracker.think(*args)
+    res = dict(think_cold=measure(cold, repeat, len(chain.shares), calibrate=False))
+    tracker = chain.new_tracker()
+    tracker.think(*args)
+    res['think_warm'] = measure(lambda: tracker.think(*args), repeat)
+    return res
+
+def bench_sharestore(chain, repeat):
+    res = {}
+    tmpdir = tempfile.mkdtemp(prefix='p2pool-bench-')
+    try:
+        def save():
+            dirname = tempfile.mkdtemp(dir=tmpdir)
+            store = p2pool_data.ShareStore(os.path.join(dirname, 'shares.'), chain.net, lambda share: None, lambda share_hash: None)
+            for share in chain.shares:
+                store.add_share(share)
+            for share in chain.shares:
+                store.add_verified_hash(share.hash)
+        res['sharestore_save'] = measure(save, repeat, len(chain.shares), calibrate=False)
+
+        dirname = os.path.join(tmpdir, os.listdir(tmpdir)[0])
+        def load():
+            loaded = []
+            p2pool_data.ShareStore(os.path.join(dirname, 'shares.'), chain.net, loaded.append, lambda share_hash: None)
+            assert len(loaded) == len(chain.shares)
+        res['sharestore_load'] = measure(load, repeat, len(chain.shares))
+    finally:
+        shutil.rmtree(tmpdir)
+    return res
+
+def bench_messages(chain, repeat):
+    res = {}
+    batch = [chain.tracker.items[h].as_share() for h in chain.main_hashes[-min(50, len(chain.main_hashes)):]]
+    tx_hashes = list(chain.known_txs)[:2000]
+    txs = [chain.known_txs[h] for h in tx_hashes[:500]]
+
+    messages = dict(
+        shares=(p2p.Protocol.message_shares, dict(shares=batch), len(batch)),
+        sharereply=(p2p.Protocol.message_sharereply, dict(id=2**255, result='good', shares=batch), len(batch)),
+        remember_tx=(p2p.Protocol.message_remember_tx, dict(tx_hashes=tx_hashes[500:1000], txs=txs), len(txs) + 500),
+        have_tx=(p2p.Protocol.message_have_tx, dict(tx_hashes=tx_hashes), len(tx_hashes)),
+    )
+    for name, (message_type, payload, items) in sorted(messages.iteritems()):
+        packed = message_type.pack(payload)
+        res['p2p_%s_pack' % (name,)] = measure(lambda: message_type.pack(payload), repeat, items)
+        res['p2p_%s_unpack' % (name,)] = measure(lambda: message_type.unpack(packed), repeat, items)
+        res['p2p_%s_pack' % (name,)]['bytes'] = len(packed)
+    return res
+
+BENCHMARKS = [
+    ('shares', bench_shares),
+    ('generate_transaction', bench_generate_transaction),
+    ('cumulative_weights', bench_cumulative_weights),
+    ('think', bench_think),
+    ('sharestore', bench_sharestore),
+    ('messages', bench_messages),
+]
+
+def get_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)), stderr=open(os.devnull, 'w')).strip()
+    except Exception:
+        return None
+
+def run(args):
+    t0 = time.time()
+    chain = sharechain.make_chain(args.length, chain_length=args.chain_length, seed=args.seed, base_net=args.net,
+        forks=args.forks, miners=args.miners, txs_per_share=args.txs_per_share)
+    print >>sys.stderr, 'Generated %i shares in %.1fs (fingerprint %s)' % (len(chain.shares), time.time() - t0, chain.fingerprint[:16])
+
+    results = {}
+    for name, func in BENCHMARKS:
+        if args.only and name not in args.only:
+            continue
+        t0 = time.time()
+        results.update(func(chain, args.repeat))
+        print >>sys.stderr, '%s: %.1fs' % (name, time.time() - t0)
+
+    return dict(
+        format=RESULTS_FORMAT,
+        commit=get_commit(),
+        time=time.time(),
+        python=platform.python_version(),
+        platform=platform.platform(),
+        params=dict(chain.params, chain_length=chain.net.CHAIN_LENGTH, net=args.net, repeat=args.repeat),
+        fingerprint=chain.fingerprint,
+        results=results,
+    )
+
+def format_results(doc):
+    lines = ['%-34s %10s %12s' % ('benchmark', 'items', 'us/item')]
+    for name, r in sorted(doc['results'].iteritems()):
+        lines.append('%-34s %10i %12.2f' % (name, r['items'], r['per_item_us']))
+    return '\n'.join(lines)
+
+def compare(base, doc, threshold):
+    '''Returns (report lines, names of benchmarks slower than base by more than threshold).'''
+    lines = []
+    if base.get('fingerprint') != doc.get('fingerprint'):
+        lines.append('WARNING: synthetic chains differ (different parameters?), comparison may be meaningless')
+    lines.append('%-34s %12s %12s %8s' % ('benchmark', 'base us', 'new us', 'ratio'))
+    regressions = []
+    for name, r in sorted(doc['results'].iteritems()):
+        if name not in base['results']:
+            lines.append('%-34s %12s %12.2f %8s' % (name, '-', r['per_item_us'], 'new'))
+            continue
+        old = base['results'][name]['per_item_us']
+        ratio = r['per_item_us']/old if old else float('inf')
+        flag = ''
+        if ratio > 1 + threshold:
+            regressions.append(name)
+            flag = ' SLOWER'
+        elif ratio < 1 - threshold:
+            flag = ' faster'
+        lines.append('%-34s %12.2f %12.2f %8.3f%s' % (name, old, r['per_item_us'], ratio, flag))
+    return lines, regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Sharechain microbenchmarks on a synthetic chain')
+    parser.add_argument('--net', default='dash', help='p2pool network to base the synthetic chain on (default: %(default)s)')
+    parser.add_argument('--length', type=int, default=600, help='main chain length in shares (default: %(default)s)')
+    parser.add_argument('--chain-length', type=int, default=500, help='CHAIN_LENGTH/REAL_CHAIN_LENGTH of the synthetic network (default: %(default)s)')
+    parser.add_argument('--forks', type=int, default=10, help='number of short side forks (default: %(default)s)')
+    parser.add_argument('--miners', type=int, default=50, help='distinct payout addresses (default: %(default)s)')
+    parser.add_argument('--txs-per-share', type=int, default=50, help='transactions referenced per share (default: %(default)s)')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--repeat', type=int, default=3, help='repetitions per benchmark, best is reported (default: %(default)s)')
+    parser.add_argument('--only', action='append', choices=[name for name, func in BENCHMARKS], help='run only this group (repeatable)')
+    parser.add_argument('--json', metavar='PATH', help='write results to PATH')
+    parser.add_argument('--compare', metavar='PATH', help='compare against results previously written with --json')
+    parser.add_argument('--threshold', type=float, default=0.25, help='relative slowdown reported as a regression (default: %(default)s)')
+    args = parser.parse_args(argv)
+
+    p2pool.DEBUG = False
+    doc = run(args)
+    print format_results(doc)
+
+    if args.json:
+        with open(args.json, 'wb') as f:
+            json.dump(doc, f, indent=2, sort_keys=True)
+
+    if args.compare:
+        with open(args.compare, 'rb') as f:
+            base = json.load(f)
+        lines, regressions = compare(base, doc, args.threshold)
+        print
+        print '\n'.join(lines)
+        if regressions:
+            print '%i benchmark(s) slower by more than %i%%: %s' % (len(regressions), args.threshold*100, ', '.join(regressions))
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,104 @@
+'''
+Block template ingestion benchmark.
+
+Builds a synthetic getblocktemplate transaction list (--mempool
+transactions, as dashd returns them) and feeds --templates successive
+templates to:
+
+- full: the previous getwork code path, hex-decoding, unpacking and
+  hashing every transaction of every template
+- differ: template_differ.TemplateDiffer, decoding only the transactions
+  not in the previous template
+
+Between templates --churn of the transactions are replaced by new ones.
+
+    python -m p2pool.test.bench.template_diff --mempool 2000 --churn 0.05
+'''
+
+from __future__ import division
+
+import argparse
+import json
+import random
+import time
+
+from p2pool.dash import data as dash_data, template_differ
+from p2pool.test.bench import sharechain
+from p2pool.test.bench.stratum_load import cpu_time
+
+MODES = ['full', 'differ']
+
+def make_gbt_tx(rng):
+    packed = dash_data.tx_type.pack(sharechain.make_tx(rng, inputs=rng.randint(1, 3)))
+    txid = '%064x' % (dash_data.hash256(packed),)
+    return dict(data=packed.encode('hex'), txid=txid, hash=txid, fee=rng.randrange(1000, 100000))
+
+def make_templates(args):
+    rng = random.Random(args.seed)
+    txs = [make_gbt_tx(rng) for i in xrange(args.mempool)]
+    churn = int(round(args.mempool*args.churn))
+    templates = [list(txs)]
+    for i in xrange(args.templates - 1):
+        for j in rng.sample(xrange(len(txs)), churn):
+            txs[j] = make_gbt_tx(rng)
+        templates.append(list(txs))
+    return templates
+
+def full(template_txs):
+    packed_transactions = [x['data'].decode('hex') for x in template_txs]
+    return map(dash_data.tx_type.unpack, packed_transactions), map(dash_data.hash256, packed_transactions)
+
+def run_mode(mode, templates):
+    if mode == 'full':
+        func = full
+    else:
+        func = template_differ.TemplateDiffer().update
+    func(templates[0]) # the first template is decoded in full either way
+    times = []
+    c0 = cpu_time()
+    for template_txs in templates[1:]:
+        t0 = time.time()
+        transactions, transaction_hashes = func(template_txs)
+        times.append(time.time() - t0)
+    c1 = cpu_time()
+    assert transaction_hashes == [int(x['txid'], 16) for x in templates[-1]]
+    times.sort()
+    return dict(
+        templates=len(times),
+        ms_per_template=sum(times)/len(times)*1e3,
+        ms_p50=times[len(times)//2]*1e3,
+        ms_max=times[-1]*1e3,
+        cpu_ms_per_template=(c1 - c0)/len(times)*1e3,
+    )
+
+def format_results(args, results):
+    lines = ['', 'Template ingestion: %i transactions, %g%% churn per template, %i templates' % (args.mempool, args.churn*100, args.templates)]
+    for mode in args.modes:
+        r = results[mode]
+        lines.append('  %-6s %8.2f ms/template  p50 %.2f  max %.2f  CPU %.2f ms/template' % (
+            mode, r['ms_per_template'], r['ms_p50'], r['ms_max'], r['cpu_ms_per_template']))
+    if 'full' in results and 'differ' in results:
+        lines.append('  speedup %.1fx' % (results['full']['ms_per_template']/results['differ']['ms_per_template'],))
+    return '\n'.join(lines)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='getblocktemplate transaction ingestion benchmark')
+    parser.add_argument('--mempool', type=int, default=2000, help='transactions per template (default: %(default)s)')
+    parser.add_argument('--churn', type=float, default=0.05, help='fraction of transactions replaced between templates (default: %(default)s)')
+    parser.add_argument('--templates', type=int, default=20, help='templates to ingest (default: %(default)s)')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--modes', nargs='+', choices=MODES, default=MODES)
+    parser.add_argument('--json', metavar='PATH', help='also write results as JSON to PATH')
+    args = parser.parse_args(argv)
+
+    templates = make_templates(args)
+    results = {}
+    for mode in args.modes:
+        results[mode] = run_mode(mode, templates)
+    print format_results(args, results)
+    if args.json:
+        with open(args.json, 'wb') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+if __name__ == '__main__':
+    main()
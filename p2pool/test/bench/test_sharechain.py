@@ -0,0 +1,22 @@
+import unittest
+
+from p2pool.test.bench import sharechain
+
+class Test(unittest.TestCase):
+    def test_deterministic(self):
+        a = sharechain.make_chain(30, chain_length=20, forks=2, txs_per_share=5, seed=3)
+        b = sharechain.make_chain(30, chain_length=20, forks=2, txs_per_share=5, seed=3)
+        assert a.fingerprint == b.fingerprint
+        assert sharechain.make_chain(30, chain_length=20, forks=2, txs_per_share=5, seed=4).fingerprint != a.fingerprint
+    
+    def test_shares_verify(self):
+        chain = sharechain.make_chain(40, chain_length=20, forks=3, txs_per_share=5, seed=5)
+        assert len(chain.shares) > 40
+        tracker = chain.new_tracker()
+        best, desired, decorated_heads, bad_peer_addresses = tracker.think(lambda block_hash: 0, chain.previous_blocks[-1], chain.block_bits, chain.known_txs)
+        assert best == chain.tip
+        assert not bad_peer_addresses
+        for share in chain.shares:
+            share.check(tracker)
+            for tx_hash in share.share_info['new_transaction_hashes']:
+                assert tx_hash in chain.known_txs
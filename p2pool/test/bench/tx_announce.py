@@ -0,0 +1,201 @@
+'''
+Transaction announcement benchmark.
+
+Replays a mempool burst against a p2p.Node with --peers connected peers
+and counts the have_tx, losing_tx, remember_tx and forget_tx messages it
+sends them, with:
+
+- immediate: the previous per-peer watchers, which work out the changes
+  to known_txs_var and mining_txs_var for every peer and announce them
+  as soon as they happen
+- batched: Node.watch_txs, which works the changes out once, and a
+  p2p.TxAnnouncer per peer sending what collected over its window
+
+Transactions arrive at --rate per second and are added to known_txs_var
+one at a time, as dashd relays them. A --evicted fraction of them is
+dropped again --evict-after seconds later (conflicts), the block
+template (mining_txs_var) is replaced every --template-interval seconds
+with the newest --template-size transactions, and every 10 seconds the
+transactions in neither are forgotten, as forget_old_txs does. Time is
+simulated with task.Clock, so only the CPU spent is real.
+
+    python -m p2pool.test.bench.tx_announce --peers 20 --rate 500
+'''
+
+from __future__ import division
+
+import argparse
+import json
+import random
+
+from twisted.internet import reactor, task
+from twisted.test import proto_helpers
+
+from p2pool import p2p
+from p2pool.dash import data as dash_data
+from p2pool.test.bench import sharechain
+from p2pool.test.bench.stratum_load import cpu_time
+from p2pool.util import variable
+
+MODES = ['immediate', 'batched']
+
+class CountingTransport(proto_helpers.StringTransport):
+    '''Counts writes (one per message, without a send queue) and their bytes instead of keeping them'''
+    
+    def __init__(self):
+        proto_helpers.StringTransport.__init__(self)
+        self.messages = 0
+        self.sent = 0
+    
+    def write(self, data):
+        self.messages += 1
+        self.sent += len(data)
+
+def watch_immediately(peer):
+    # the previous watchers from p2p.Protocol.handle_version
+    node = peer.node
+    def add_to_remote_view_of_my_known_txs(added):
+        if added:
+            peer.send_have_tx(tx_hashes=list(added.keys()))
+    node.known_txs_var.added.watch(add_to_remote_view_of_my_known_txs)
+    
+    def update_remote_view_of_my_known_txs(before, after):
+        added = set(after) - set(before)
+        removed = set(before) - set(after)
+        if added:
+            peer.send_have_tx(tx_hashes=list(added))
+        if removed:
+            peer.send_losing_tx(tx_hashes=list(removed))
+            key = max(peer.known_txs_cache) + 1 if peer.known_txs_cache else 0
+            peer.known_txs_cache[key] = dict((h, before[h]) for h in removed)
+            reactor.callLater(20, peer.known_txs_cache.pop, key)
+    node.known_txs_var.transitioned.watch(update_remote_view_of_my_known_txs)
+    
+    def update_remote_view_of_my_mining_txs(before, after):
+        added = set(after) - set(before)
+        removed = set(before) - set(after)
+        if removed:
+            peer.send_forget_tx(tx_hashes=list(removed))
+            peer.remote_remembered_txs_size -= sum(100 + dash_data.tx_type.packed_size(before[x]) for x in removed)
+        if added:
+            encoder = p2p.BroadcastEncoder()
+            peer.remote_remembered_txs_size += sum(100 + len(encoder.get_packed_tx(x, after[x])) for x in added)
+            assert peer.remote_remembered_txs_size <= peer.max_remembered_txs_size
+            peer.sendRememberTx([x for x in added if x in peer.remote_tx_hashes], [(x, after[x]) for x in added if x not in peer.remote_tx_hashes], encoder)
+    node.mining_txs_var.transitioned.watch(update_remote_view_of_my_mining_txs)
+
+def make_node(args, clock, mode, mempool):
+    node = p2p.Node(lambda: None, 0, sharechain.make_net(),
+        known_txs_var=variable.VariableDict(dict(mempool)), mining_txs_var=variable.Variable({}))
+    for i in xrange(args.peers):
+        peer = p2p.Protocol(node, False)
+        peer.transport = CountingTransport()
+        peer.addr = '10.0.%i.%i' % (i//256, i % 256), 8999
+        peer.nonce = i
+        peer.other_version = p2p.Protocol.VERSION
+        peer.remote_tx_hashes = set(mempool) if i % 2 else set()
+        peer.remote_tx_short_ids = set()
+        peer.remote_remembered_txs_size = 0
+        peer.known_txs_cache = {}
+        peer.tx_announcer = p2p.TxAnnouncer(peer, args.window, clock)
+        node.peers[peer.nonce] = peer
+        if mode == 'immediate':
+            watch_immediately(peer)
+    if mode == 'batched':
+        node.watch_txs()
+    return node
+
+def make_burst(args):
+    '''Returns the initial mempool and the (time, action, argument) events of the burst'''
+    rng = random.Random(0)
+    txs = []
+    for i in xrange(args.mempool + int(args.rate*args.seconds)):
+        tx = sharechain.make_tx(rng)
+        txs.append((dash_data.hash256(dash_data.tx_type.pack(tx)), tx))
+    mempool, arriving = dict(txs[:args.mempool]), txs[args.mempool:]
+    events = []
+    for i, (tx_hash, tx) in enumerate(arriving):
+        t = i/args.rate
+        events.append((t, 'add', (tx_hash, tx)))
+        if rng.random() < args.evicted:
+            events.append((t + args.evict_after, 'evict', tx_hash))
+    t = 0
+    while t < args.seconds:
+        events.append((t, 'template', None))
+        t += args.template_interval
+    for t in xrange(10, int(args.seconds) + 1, 10):
+        events.append((t, 'forget', None))
+    events.sort(key=lambda (t, action, arg): t)
+    return mempool, events
+
+def run_mode(mode, args, mempool, events):
+    clock = task.Clock()
+    node = make_node(args, clock, mode, mempool)
+    arrived = mempool.items() # in order of arrival, for the template
+    evicted = set()
+    c0 = cpu_time()
+    for t, action, arg in events:
+        clock.advance(t - clock.seconds())
+        if action == 'add':
+            tx_hash, tx = arg
+            node.known_txs_var.add({tx_hash: tx})
+            arrived.append((tx_hash, tx))
+        elif action == 'evict':
+            evicted.add(arg)
+            if arg in node.known_txs_var.value:
+                node.known_txs_var.set(dict((h, tx) for h, tx in node.known_txs_var.value.iteritems() if h != arg))
+        elif action == 'template':
+            template = [(h, tx) for h, tx in arrived[-args.template_size:] if h not in evicted]
+            node.mining_txs_var.set(dict(template))
+            node.known_txs_var.add(dict(template))
+        elif action == 'forget':
+            node.known_txs_var.set(dict(node.mining_txs_var.value))
+    clock.advance(args.window)
+    c1 = cpu_time()
+    peers = node.peers.values()
+    return dict(
+        cpu_seconds=c1 - c0,
+        cpu_percent=(c1 - c0)/args.seconds*100,
+        messages_per_s=sum(peer.transport.messages for peer in peers)/args.seconds,
+        kb_per_s=sum(peer.transport.sent for peer in peers)/args.seconds/1e3,
+    )
+
+def format_results(args, results):
+    lines = ['', 'Tx announcements: %i tx/s for %.0f s to %i peers, %.0f%% evicted after %.0f ms, template every %.1f s' % (
+        args.rate, args.seconds, args.peers, args.evicted*100, args.evict_after*1e3, args.template_interval)]
+    for mode in args.modes:
+        r = results[mode]
+        lines.append('  %-9s CPU %6.2f s (%5.1f%% of a core)  %8.0f messages/s  %7.1f kB/s' % (
+            mode, r['cpu_seconds'], r['cpu_percent'], r['messages_per_s'], r['kb_per_s']))
+    if 'immediate' in results and 'batched' in results:
+        lines.append('  CPU %.1fx less, %.1fx fewer messages' % (
+            results['immediate']['cpu_seconds']/results['batched']['cpu_seconds'],
+            results['immediate']['messages_per_s']/results['batched']['messages_per_s']))
+    return '\n'.join(lines)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Transaction announcement benchmark')
+    parser.add_argument('--peers', type=int, default=20, help='connected peers (default: %(default)s)')
+    parser.add_argument('--rate', type=int, default=500, help='arriving transactions per second (default: %(default)s)')
+    parser.add_argument('--seconds', type=float, default=10, help='length of the burst (default: %(default)s)')
+    parser.add_argument('--mempool', type=int, default=2000, help='transactions known before the burst (default: %(default)s)')
+    parser.add_argument('--evicted', type=float, default=.05, help='fraction of arriving transactions dropped again (default: %(default)s)')
+    parser.add_argument('--evict-after', type=float, default=.05, help='seconds until they are (default: %(default)s)')
+    parser.add_argument('--template-interval', type=float, default=1, help='seconds between block templates (default: %(default)s)')
+    parser.add_argument('--template-size', type=int, default=2000, help='transactions in a block template (default: %(default)s)')
+    parser.add_argument('--window', type=float, default=.1, help='TxAnnouncer window in seconds (default: %(default)s)')
+    parser.add_argument('--modes', nargs='+', choices=MODES, default=MODES)
+    parser.add_argument('--json', metavar='PATH', help='also write results as JSON to PATH')
+    args = parser.parse_args(argv)
+    
+    mempool, events = make_burst(args)
+    results = {}
+    for mode in args.modes:
+        results[mode] = run_mode(mode, args, mempool, events)
+    print format_results(args, results)
+    if args.json:
+        with open(args.json, 'wb') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+if __name__ == '__main__':
+    main()
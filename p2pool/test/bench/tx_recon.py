@@ -0,0 +1,118 @@
+'''
+Known-transaction inventory exchange simulation.
+
+Two p2pool peers with mempools of --txs transactions, of which each has
+--divergence*txs the other lacks, tell each other what they know the way
+they do on connect:
+
+- have_tx: every known tx hash, as peers before version 1800 do
+- sketch: a tx_sketch of salted short ids, as peers at version 1800 do,
+  followed by tx_resketch rounds while the difference does not decode
+
+Messages are passed between two p2p.Protocol instances until both are
+quiet, and each side's view of the other's transactions is checked
+against the real intersection.
+
+    python -m p2pool.test.bench.tx_recon --txs 5000 --divergence .02
+'''
+
+from __future__ import division
+
+import argparse
+import hashlib
+import json
+import random
+import time
+
+from twisted.test import proto_helpers
+
+from p2pool import p2p
+from p2pool.test.bench import sharechain
+from p2pool.util import variable
+
+MODES = ['have_tx', 'sketch']
+
+def make_mempools(rng, txs, divergence):
+    common = [rng.getrandbits(256) for i in xrange(txs - int(divergence*txs))]
+    return [dict((tx_hash, None) for tx_hash in common + [rng.getrandbits(256) for i in xrange(int(divergence*txs))]) for side in xrange(2)]
+
+def make_pair(net, mempools, version):
+    peers = []
+    for mempool in mempools:
+        node = p2p.Node(lambda: None, 0, net, known_txs_var=variable.VariableDict(mempool))
+        node.nonce = len(peers) + 1 # so that the salt, and the results, are repeatable
+        peer = p2p.Protocol(node, False)
+        peer.transport = proto_helpers.StringTransport()
+        peer.addr = '10.0.0.%i' % (len(peers) + 1,), 8999
+        peer.other_version = version
+        peer.connected = peer.connected2 = True
+        peer.remote_tx_hashes = set()
+        peer.remote_tx_short_ids = set()
+        peer.tx_resketches = 0
+        peer.tx_announcer = p2p.TxAnnouncer(peer)
+        peers.append(peer)
+    salt = hashlib.sha256('%016x%016x' % tuple(sorted(peer.node.nonce for peer in peers))).digest()
+    for peer in peers:
+        peer.tx_salt = salt
+    return peers
+
+def exchange(peers):
+    '''Passes messages between the peers until both are quiet; returns the bytes sent'''
+    for peer in peers:
+        peer.sendTxInventory()
+    sent = 0
+    while any(peer.transport.value() for peer in peers):
+        for peer, other in [peers, peers[::-1]]:
+            data = peer.transport.value()
+            peer.transport.clear()
+            if data:
+                sent += len(data)
+                other.dataReceived(data)
+    return sent
+
+def run_mode(mode, args, net, seed):
+    rng = random.Random(seed)
+    mempools = make_mempools(rng, args.txs, args.divergence)
+    peers = make_pair(net, mempools, p2p.Protocol.TX_SKETCH_VERSION if mode == 'sketch' else 1700)
+    t0 = time.time()
+    sent = exchange(peers)
+    t1 = time.time()
+    # a sketch tells a peer which of its own transactions the other has, have_tx all of the other's
+    for peer, own, other in [(peers[0],) + tuple(mempools), (peers[1],) + tuple(mempools[::-1])]:
+        assert set(own) & set(other) <= peer.remote_tx_hashes <= set(other), "wrong view of the peer's transactions"
+    return dict(bytes=sent, seconds=t1 - t0, resketches=sum(peer.tx_resketches for peer in peers))
+
+def format_results(args, results):
+    lines = ['', 'Tx inventory exchange: %i txs per peer, %.1f%% of them unknown to the other, %i trials' % (args.txs, args.divergence*100, args.trials)]
+    for mode in args.modes:
+        r = results[mode]
+        lines.append('  %-8s %8.1f kB per connection  %6.1f ms  %i tx_resketch rounds' % (mode, r['bytes']/1e3, r['seconds']*1e3, r['resketches']))
+    if 'have_tx' in results and 'sketch' in results:
+        lines.append('  %.1fx fewer bytes' % (results['have_tx']['bytes']/results['sketch']['bytes'],))
+    return '\n'.join(lines)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Known-transaction inventory exchange simulation')
+    parser.add_argument('--txs', type=int, default=5000, help='transactions each peer knows (default: %(default)s)')
+    parser.add_argument('--divergence', type=float, default=.02, help='fraction of each mempool the other peer lacks (default: %(default)s)')
+    parser.add_argument('--trials', type=int, default=20, help='mempool pairs simulated (default: %(default)s)')
+    parser.add_argument('--modes', nargs='+', choices=MODES, default=MODES)
+    parser.add_argument('--json', metavar='PATH', help='also write results as JSON to PATH')
+    args = parser.parse_args(argv)
+    
+    net = sharechain.make_net()
+    results = {}
+    for mode in args.modes:
+        trials = [run_mode(mode, args, net, seed) for seed in xrange(args.trials)]
+        results[mode] = dict(
+            bytes=sum(r['bytes'] for r in trials)/len(trials),
+            seconds=sum(r['seconds'] for r in trials)/len(trials),
+            resketches=sum(r['resketches'] for r in trials),
+        )
+    print format_results(args, results)
+    if args.json:
+        with open(args.json, 'wb') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,180 @@
+'''
+Known transaction store benchmark.
+
+Runs a node's known_txs through --seconds of a --mempool transaction
+mempool with --peers connected peers, with:
+
+- rebuild: the previous forget_old_txs, which every 10 seconds built a
+  new known_txs dict from the peers' remembered transactions and the
+  block template and set() it, so every run compared and diffed the
+  whole of it
+- generational: txstore.TxStore, where the template and the peers refer
+  to the transactions they hold and every 10 seconds advance() hands
+  back just the ones that nothing referred to for two runs
+
+Transactions arrive at --rate per second and are added to known_txs as
+dashd relays them. Every second the block template becomes the newest
+--mempool of them and every peer remembers (and forgets) what it
+gained (and lost), as peers with the same mempool would. Shares aren't
+simulated. Changes reach the peers through Node.watch_txs and their
+TxAnnouncers. Each mode runs in a forked process, whose resident memory
+growth is reported; time is simulated with task.Clock.
+
+    python -m p2pool.test.bench.tx_store --mempool 20000 --peers 20
+'''
+
+from __future__ import division
+
+import argparse
+import json
+import os
+import random
+
+from twisted.internet import task
+from twisted.test import proto_helpers
+
+from p2pool import p2p, txstore
+from p2pool.dash import data as dash_data
+from p2pool.test.bench import sharechain
+from p2pool.test.bench.stratum_load import cpu_time
+from p2pool.util import memory, variable
+
+MODES = ['rebuild', 'generational']
+
+class CountingTransport(proto_helpers.StringTransport):
+    def __init__(self):
+        proto_helpers.StringTransport.__init__(self)
+        self.sent = 0
+    
+    def write(self, data):
+        self.sent += len(data)
+
+def make_txs(args):
+    rng = random.Random(0)
+    txs = []
+    for i in xrange(args.mempool + int(args.rate*args.seconds)):
+        tx = sharechain.make_tx(rng, inputs=rng.randrange(1, 3), outputs=2)
+        txs.append((dash_data.hash256(dash_data.tx_type.pack(tx)), tx))
+    return txs
+
+def make_node(args, clock, mode, template):
+    known_txs = txstore.TxStore(template) if mode == 'generational' else dict(template)
+    node = p2p.Node(lambda: None, 0, sharechain.make_net(),
+        known_txs_var=variable.VariableDict(known_txs), mining_txs_var=variable.Variable(dict(template)))
+    if mode == 'generational':
+        known_txs.set_refs('template', template)
+    for i in xrange(args.peers):
+        peer = p2p.Protocol(node, False)
+        peer.transport = CountingTransport()
+        peer.addr = '10.0.%i.%i' % (i//256, i % 256), 8999
+        peer.nonce = i
+        peer.other_version = p2p.Protocol.VERSION
+        peer.remote_tx_hashes = set(template)
+        peer.remote_tx_short_ids = set()
+        peer.remote_remembered_txs_size = 0
+        peer.remembered_txs = dict(template)
+        peer.known_txs_cache = {}
+        peer.tx_announcer = p2p.TxAnnouncer(peer, clock=clock)
+        node.peers[peer.nonce] = peer
+        if mode == 'generational':
+            known_txs.ref(peer.remembered_txs)
+    node.watch_txs()
+    return node
+
+def forget_old_txs(mode, node):
+    if mode == 'rebuild':
+        # the previous Node.forget_old_txs, without the shares
+        new_known_txs = {}
+        for peer in node.peers.itervalues():
+            new_known_txs.update(peer.remembered_txs)
+        new_known_txs.update(node.mining_txs_var.value)
+        node.known_txs_var.set(new_known_txs)
+    else:
+        node.known_txs_var.remove(node.known_txs_var.value.advance())
+
+def run_mode(mode, args, txs):
+    clock = task.Clock()
+    rss0 = memory.resident()
+    node = make_node(args, clock, mode, dict(txs[:args.mempool]))
+    arrived = args.mempool
+    c0 = cpu_time()
+    tick_cpu = 0
+    ticks = 0
+    for second in xrange(1, int(args.seconds) + 1):
+        for i in xrange(args.rate):
+            clock.advance(1/args.rate)
+            tx_hash, tx = txs[arrived]
+            node.known_txs_var.add({tx_hash: tx})
+            arrived += 1
+        before = node.mining_txs_var.value
+        template = dict(txs[arrived - args.mempool:arrived])
+        node.known_txs_var.add(template)
+        node.mining_txs_var.set(template)
+        added, removed = p2p.get_dict_changes(before, template)
+        if mode == 'generational':
+            node.known_txs_var.value.set_refs('template', template)
+        for peer in node.peers.itervalues():
+            peer.remembered_txs.update(added)
+            for tx_hash in removed:
+                del peer.remembered_txs[tx_hash]
+            if mode == 'generational':
+                node.known_txs_var.value.ref(added)
+                node.known_txs_var.value.unref(removed)
+        if second % 10 == 0:
+            t0 = cpu_time()
+            forget_old_txs(mode, node)
+            tick_cpu += cpu_time() - t0
+            ticks += 1
+    clock.advance(1)
+    c1 = cpu_time()
+    return dict(
+        cpu_seconds=c1 - c0,
+        tick_ms=tick_cpu/ticks*1e3,
+        known_txs=len(node.known_txs_var.value),
+        rss_mb=(memory.resident() - rss0)/2**20,
+        kb_sent=sum(peer.transport.sent for peer in node.peers.itervalues())/1e3,
+    )
+
+def run_forked(mode, args, txs):
+    r, w = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(r)
+        with os.fdopen(w, 'wb') as f:
+            json.dump(run_mode(mode, args, txs), f)
+        os._exit(0)
+    os.close(w)
+    with os.fdopen(r, 'rb') as f:
+        data = f.read()
+    os.waitpid(pid, 0)
+    return json.loads(data)
+
+def format_results(args, results):
+    lines = ['', 'Known txs: %i-tx mempool, %i new tx/s for %.0f s, %i peers' % (args.mempool, args.rate, args.seconds, args.peers)]
+    for mode in args.modes:
+        r = results[mode]
+        lines.append('  %-12s CPU %6.2f s  forget_old_txs %7.1f ms  %6i known txs  +%5.1f MB resident  %7.0f kB sent' % (
+            mode, r['cpu_seconds'], r['tick_ms'], r['known_txs'], r['rss_mb'], r['kb_sent']))
+    return '\n'.join(lines)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Known transaction store benchmark')
+    parser.add_argument('--mempool', type=int, default=20000, help='transactions in the mempool and block template (default: %(default)s)')
+    parser.add_argument('--rate', type=int, default=50, help='arriving transactions per second (default: %(default)s)')
+    parser.add_argument('--seconds', type=float, default=60, help='simulated seconds (default: %(default)s)')
+    parser.add_argument('--peers', type=int, default=20, help='connected peers (default: %(default)s)')
+    parser.add_argument('--modes', nargs='+', choices=MODES, default=MODES)
+    parser.add_argument('--json', metavar='PATH', help='also write results as JSON to PATH')
+    args = parser.parse_args(argv)
+    
+    txs = make_txs(args)
+    results = {}
+    for mode in args.modes:
+        results[mode] = run_forked(mode, args, txs)
+    print format_results(args, results)
+    if args.json:
+        with open(args.json, 'wb') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+if __name__ == '__main__':
+    main()
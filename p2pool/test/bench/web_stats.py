@@ -0,0 +1,252 @@
+'''
+Dashboard web API load benchmark.
+
+Builds a node and a real WorkerBridge on a synthetic sharechain (no dashd,
+no peers), serves the real web.get_web_root over loopback and lets N
+concurrent keep-alive clients poll the dashboard stats endpoints
+(local_stats, global_stats, users, current_payouts, miner_stats) while the
+best share keeps changing. Reports requests per second, request latency
+percentiles, CPU use and how many times the PPLNS payouts were computed.
+
+With --mode endpoints or --mode snapshot each client loop is one dashboard
+refresh instead: every panel endpoint the dashboard used to poll, one after
+the other, or a single /dashboard_snapshot fetch that accepts gzip and
+revalidates with If-None-Match, as a browser does. Figures are then per
+refresh.
+
+Clients and server share one process and one reactor, so throughput
+figures include the cost of the simulated clients.
+
+    python -m p2pool.test.bench.web_stats --clients 100 --duration 20
+    python -m p2pool.test.bench.web_stats --mode snapshot
+'''
+
+from __future__ import division
+
+import argparse
+import json
+import shutil
+import sys
+import tempfile
+import time
+
+from twisted.internet import defer, reactor, task
+from twisted.web import client, http_headers, server
+
+import p2pool
+from p2pool import node as p2pool_node, p2p, web, work
+from p2pool.dash import data as dash_data
+from p2pool.test.bench import sharechain
+from p2pool.test.bench.stratum_load import cpu_time, percentiles
+from p2pool.util import math, variable
+
+DASHBOARD_PATHS = ['local_stats', 'global_stats', 'users', 'current_payouts', 'miner_stats/%s']
+REFRESH_PATHS = ['local_stats', 'global_stats', 'current_payouts', 'payout_addrs', 'recent_blocks', 'luck_stats', 'peer_list', 'broadcaster_status']
+MODES = ['requests', 'endpoints', 'snapshot']
+
+def make_web_node(chain, pseudoshares=2000):
+    '''
+    Returns (node, wb) for a synthetic chain: a p2pool.node.Node holding every
+    share as verified and a work.WorkerBridge that owns the shares of the
+    chain's biggest miner and has recent pseudoshares from each miner.
+    '''
+    net = chain.net
+    n = p2pool_node.Node(None, None, chain.shares, [share.hash for share in chain.shares], net)
+    n.best_share_var = variable.Variable(chain.tip)
+    n.desired_var = variable.Variable([])
+    n.best_block_header = variable.Variable(None)
+    n.known_txs_var = variable.VariableDict(dict(chain.known_txs))
+    n.mining_txs_var = variable.Variable({})
+    n.dashd_work = variable.Variable(dict(
+        version=0x20000000,
+        previous_block=chain.previous_blocks[-1],
+        bits=chain.block_bits,
+        coinbaseflags='',
+        height=len(chain.previous_blocks),
+        time=int(time.time()),
+        transactions=[],
+        transaction_hashes=[],
+        transaction_fees=[],
+        merkle_link=dash_data.calculate_merkle_link([None], 0),
+        subsidy=180000000,
+        payment_amount=0,
+        packed_payments=[],
+        coinbase_payload=None,
+        last_update=time.time(),
+        use_getblocktemplate=True,
+        latency=0.01,
+    ))
+    n.get_height_rel_highest = lambda block_hash: 0
+    n.p2p_node = p2p.Node(lambda: n.best_share_var.value, 0, net, {}, set(), 0, 0, 0,
+        known_txs_var=n.known_txs_var, mining_txs_var=n.mining_txs_var)
+
+    my_pubkey_hash = chain.miner_pubkey_hashes[0]
+    args = math.Object(donation_percentage=1, worker_fee=0, share_rate=net.STRATUM_SHARE_RATE, address=None, timeaddresses=0,
+        work_update_fee_threshold=0.001, work_update_max_age=30)
+    pubkeys = math.Object(keys=[my_pubkey_hash])
+    wb = work.WorkerBridge(n, my_pubkey_hash, 1, [], 0, args, pubkeys, None)
+    wb.my_share_hashes.update(share.hash for share in chain.shares if share.share_data['pubkey_hash'] == my_pubkey_hash)
+
+    users = [dash_data.pubkey_hash_to_address(pubkey_hash, net.PARENT) for pubkey_hash in chain.miner_pubkey_hashes]
+    for i in xrange(pseudoshares):
+        user = users[i % len(users)]
+        wb.local_rate_monitor.add_datum(dict(work=2**32, dead=i % 50 == 0, user=user, share_target=2**224))
+        wb.local_addr_rate_monitor.add_datum(dict(work=2**32, pubkey_hash=chain.miner_pubkey_hashes[i % len(users)]))
+    return n, wb, users
+
+class DashboardClients(object):
+    def __init__(self, base_url, clients, paths, mode='requests'):
+        self.base_url = base_url
+        self.clients = clients
+        self.paths = paths
+        self.mode = mode
+        self.pool = client.HTTPConnectionPool(reactor)
+        self.pool.maxPersistentPerHost = clients
+        self.agent = client.Agent(reactor, pool=self.pool)
+        self.latencies = [] # per request, or per refresh
+        self.errors = 0
+        self.bytes = 0
+        self.not_modified = 0
+
+    @defer.inlineCallbacks
+    def _get(self, path, headers=None):
+        response = yield self.agent.request('GET', self.base_url + path, headers)
+        body = yield client.readBody(response)
+        if response.code not in (200, 304):
+            raise ValueError('HTTP %i' % (response.code,))
+        self.bytes += len(body)
+        defer.returnValue(response)
+
+    @defer.inlineCallbacks
+    def _client(self, index, deadline):
+        i = index
+        etag = None
+        while time.time() < deadline:
+            t0 = time.time()
+            try:
+                if self.mode == 'requests':
+                    yield self._get(self.paths[i % len(self.paths)])
+                    i += 1
+                elif self.mode == 'endpoints':
+                    for path in self.paths:
+                        yield self._get(path)
+                else:
+                    headers = http_headers.Headers({'Accept-Encoding': ['gzip']})
+                    if etag is not None:
+                        headers.setRawHeaders('If-None-Match', [etag])
+                    response = yield self._get('dashboard_snapshot', headers)
+                    if response.code == 304:
+                        self.not_modified += 1
+                    else:
+                        etag = response.headers.getRawHeaders('ETag', [None])[0]
+            except Exception:
+                self.errors += 1
+                continue
+            self.latencies.append(time.time() - t0)
+
+    def run(self, duration):
+        deadline = time.time() + duration
+        return defer.DeferredList([self._client(i, deadline) for i in xrange(self.clients)])
+
+    def close(self):
+        return self.pool.closeCachedConnections()
+
+@defer.inlineCallbacks
+def run(args, results):
+    t0 = time.time()
+    chain = sharechain.make_chain(args.length, chain_length=args.chain_length, seed=args.seed, miners=args.miners)
+    print 'Generated %i shares in %.1fs' % (len(chain.shares), time.time() - t0)
+
+    n, wb, users = make_web_node(chain)
+    payout_computations = [0]
+    get_current_txouts = n.get_current_txouts
+    def counting_get_current_txouts():
+        payout_computations[0] += 1
+        return get_current_txouts()
+    n.get_current_txouts = counting_get_current_txouts
+
+    datadir = tempfile.mkdtemp(prefix='p2pool-bench-')
+    stop_event = variable.Event()
+    web_root = web.get_web_root(wb, datadir, variable.Variable(dict(version=180000, warnings='')), stop_event)[0]
+    web.web_rate_limiter.requests_per_minute = web.web_rate_limiter.burst_limit = 10**9
+    port = reactor.listenTCP(0, server.Site(web_root), interface='127.0.0.1')
+
+    # alternate the best share between the tip and its parent, as if new shares kept arriving
+    heads = [chain.main_hashes[-2], chain.tip]
+    share_changes = [0]
+    def change_best_share():
+        share_changes[0] += 1
+        n.best_share_var.set(heads[share_changes[0] % 2])
+    changer = task.LoopingCall(change_best_share)
+
+    paths = [path % (users[0],) if '%s' in path else path for path in (DASHBOARD_PATHS if args.mode == 'requests' else REFRESH_PATHS)]
+    clients = DashboardClients('http://127.0.0.1:%i/' % (port.getHost().port,), args.clients, paths, args.mode)
+    try:
+        changer.start(args.share_interval, now=False)
+        payout_computations[0] = 0
+        c0, t0 = cpu_time(), time.time()
+        yield clients.run(args.duration)
+        c1, t1 = cpu_time(), time.time()
+        changer.stop()
+
+        results.update(
+            mode=args.mode,
+            clients=args.clients,
+            requests=len(clients.latencies),
+            errors=clients.errors,
+            not_modified=clients.not_modified,
+            requests_per_second=len(clients.latencies)/(t1 - t0),
+            bytes_per_request=clients.bytes/max(1, len(clients.latencies)),
+            cpu_fraction=(c1 - c0)/(t1 - t0),
+            cpu_per_request_us=(c1 - c0)*1e6/max(1, len(clients.latencies)),
+            best_share_changes=share_changes[0],
+            payout_computations=payout_computations[0],
+            latency_ms=dict((k, v*1e3 if v is not None else None) for k, v in percentiles(clients.latencies).iteritems()),
+        )
+    finally:
+        yield clients.close()
+        stop_event.happened()
+        yield port.stopListening()
+        shutil.rmtree(datadir)
+
+def format_results(results):
+    lat = results['latency_ms']
+    unit = 'request' if results['mode'] == 'requests' else 'refresh'
+    return '\n'.join([
+        '',
+        'Dashboard load: %i clients, %s' % (results['clients'], results['mode']),
+        '  %i %s (%i errors, %i not modified), %.1f/s, %.0f bytes/%s' % (
+            results['requests'], 'requests' if unit == 'request' else 'refreshes', results['errors'], results['not_modified'], results['requests_per_second'], results['bytes_per_request'], unit),
+        '  latency ms: p50 %.1f p90 %.1f p99 %.1f max %.1f' % (lat['p50'], lat['p90'], lat['p99'], lat['p100']),
+        '  CPU %.1f%%, %.0f us/%s' % (results['cpu_fraction']*100, results['cpu_per_request_us'], unit),
+        '  %i best share changes, %i payout computations' % (results['best_share_changes'], results['payout_computations']),
+    ])
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Dashboard web API load benchmark (loopback, synthetic sharechain)')
+    parser.add_argument('--clients', type=int, default=100, help='concurrent dashboard clients (default: %(default)s)')
+    parser.add_argument('--mode', choices=MODES, default='requests', help='what each client loop fetches (default: %(default)s)')
+    parser.add_argument('--duration', type=float, default=20, help='seconds of load (default: %(default)s)')
+    parser.add_argument('--share-interval', type=float, default=2, help='seconds between best share changes (default: %(default)s)')
+    parser.add_argument('--length', type=int, default=400, help='synthetic chain length in shares (default: %(default)s)')
+    parser.add_argument('--chain-length', type=int, default=400, help='CHAIN_LENGTH of the synthetic network (default: %(default)s)')
+    parser.add_argument('--miners', type=int, default=50, help='distinct payout addresses (default: %(default)s)')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', metavar='PATH', help='also write results as JSON to PATH')
+    args = parser.parse_args(argv)
+
+    p2pool.DEBUG = False
+
+    results = {}
+    reactor.callWhenRunning(lambda: run(args, results).addErrback(lambda fail: fail.printTraceback(sys.stderr)).addBoth(lambda _: reactor.stop()))
+    reactor.run()
+
+    if 'requests' not in results:
+        sys.exit(1)
+    print format_results(results)
+    if args.json:
+        with open(args.json, 'wb') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+if __name__ == '__main__':
+    main()
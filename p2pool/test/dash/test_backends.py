@@ -0,0 +1,138 @@
+from twisted.internet import defer, error, reactor
+from twisted.trial import unittest
+from twisted.web import resource, server
+
+from p2pool.dash import backends
+from p2pool.util import deferral, jsonrpc, variable
+
+class FakeDashd(object):
+    '''Answers every call after `delay` seconds, at chain height `height`'''
+    def __init__(self, name, delay=0, height=1000, accept=True):
+        self.name = name
+        self.delay = delay
+        self.height = height
+        self.accept = accept
+        self.submitted = []
+
+    @defer.inlineCallbacks
+    def rpc_getblocktemplate(self, request, params):
+        yield deferral.sleep(self.delay)
+        defer.returnValue(dict(height=self.height + 1, source=self.name))
+
+    @defer.inlineCallbacks
+    def rpc_submitblock(self, request, data):
+        yield deferral.sleep(self.delay)
+        self.submitted.append(data)
+        defer.returnValue(None if self.accept else 'rejected')
+
+    @defer.inlineCallbacks
+    def rpc_getblockcount(self, request):
+        yield deferral.sleep(self.delay)
+        defer.returnValue(self.height)
+
+    @defer.inlineCallbacks
+    def rpc_getblockhash(self, request, height):
+        yield deferral.sleep(self.delay)
+        if height > self.height:
+            raise jsonrpc.Error_for_code(-8)(u'Block height out of range')
+        defer.returnValue(self.name)
+
+class FakeFactory(object):
+    def __init__(self, connected):
+        self.conn = variable.Variable(object() if connected else None)
+
+class Test(unittest.TestCase):
+    def setUp(self):
+        self.ports = []
+        self.proxies = []
+
+    @defer.inlineCallbacks
+    def tearDown(self):
+        yield deferral.sleep(.7) # let the losers of races finish
+        for proxy in self.proxies:
+            yield proxy.close()
+        for port in self.ports:
+            yield port.stopListening()
+
+    def make_backend(self, fake, factory=None):
+        if fake is None:
+            # a dashd that is down
+            return backends.Backend('dead', jsonrpc.Proxy(lambda method, params: defer.fail(error.ConnectionRefusedError())), factory)
+        root = resource.Resource()
+        root.putChild('', jsonrpc.HTTPServer(fake))
+        port = reactor.listenTCP(0, server.Site(root), interface='127.0.0.1')
+        self.ports.append(port)
+        proxy = jsonrpc.HTTPProxy('http://127.0.0.1:%i/' % (port.getHost().port,), timeout=2)
+        self.proxies.append(proxy)
+        return backends.Backend(fake.name, proxy, factory)
+
+    @defer.inlineCallbacks
+    def test_race_fastest(self):
+        fakes = [FakeDashd('slow', delay=.5), FakeDashd('fast', delay=.05), FakeDashd('medium', delay=.3)]
+        backend_set = backends.BackendSet([self.make_backend(fake) for fake in fakes] + [self.make_backend(None)], race_window=.1)
+        template = yield backend_set.rpc_getblocktemplate(dict(mode='template'))
+        assert template['source'] == 'fast'
+        stats = backend_set.get_stats()
+        assert stats['fast']['template_wins'] == 1
+        assert stats['dead']['failures'] == 1
+
+    @defer.inlineCallbacks
+    def test_race_freshest(self):
+        fakes = [FakeDashd('fast', delay=0), FakeDashd('fresh', delay=.1, height=1001), FakeDashd('late', delay=.5, height=1002)]
+        backend_set = backends.BackendSet([self.make_backend(fake) for fake in fakes], race_window=.25)
+        template = yield backend_set.rpc_getblocktemplate(dict(mode='template'))
+        assert template['source'] == 'fresh'
+        assert template['height'] == 1002
+
+    @defer.inlineCallbacks
+    def test_submit_all(self):
+        fakes = [FakeDashd('rejecting', delay=0, accept=False), FakeDashd('accepting', delay=.2), FakeDashd('slow', delay=.5)]
+        backend_set = backends.BackendSet([self.make_backend(fake) for fake in fakes] + [self.make_backend(None)])
+        result = yield backend_set.rpc_submitblock('00')
+        assert result is None
+        assert [len(fake.submitted) for fake in fakes] == [1, 1, 0]
+        yield deferral.sleep(.4)
+        assert fakes[2].submitted == ['00']
+
+        # without an acceptance the first backend's answer is returned
+        for fake in fakes:
+            fake.accept = False
+        result = yield backend_set.rpc_submitblock('01')
+        assert result == 'rejected'
+
+        dead_set = backends.BackendSet([self.make_backend(None)])
+        yield self.assertFailure(dead_set.rpc_submitblock('02'), Exception)
+
+    @defer.inlineCallbacks
+    def test_failover_and_health(self):
+        fakes = [FakeDashd('behind', height=900), FakeDashd('ok', delay=.05), FakeDashd('no_p2p')]
+        backend_list = [self.make_backend(None), self.make_backend(fakes[0]), self.make_backend(fakes[1], FakeFactory(True)), self.make_backend(fakes[2], FakeFactory(False))]
+        backend_set = backends.BackendSet(backend_list, max_failures=2)
+
+        # lookups fail over past the dead backend until it is marked unhealthy
+        for i in xrange(3):
+            res = yield backend_set.rpc_getblockhash(100)
+            assert res in ('behind', 'ok', 'no_p2p')
+        assert backend_list[0].failures == 2
+        assert not backend_list[0].healthy
+        # JSON-RPC errors are answers, not failures
+        yield self.assertFailure(backend_set.rpc_getblockhash(5000), jsonrpc.Error_for_code(-8))
+
+        yield backend_set.check()
+        assert [backend.healthy for backend in backend_list] == [False, False, True, False]
+        assert [backend.height for backend in backend_list] == [None, 900, 1000, 1000]
+        assert backend_set._candidates() == [backend_list[2]]
+        res = yield backend_set.rpc_getblockhash(100)
+        assert res == 'ok'
+
+        stats = backend_set.get_stats()
+        assert stats['ok']['healthy'] and stats['ok']['p2p_connected']
+        assert stats['ok']['latency_ms'] >= 40
+        assert stats['dead']['last_error'] is not None
+        assert backends.find(jsonrpc.Proxy(None)) is None
+
+    def test_parse_spec(self):
+        assert backends.parse_spec('10.0.0.2:9998') == (None, None, '10.0.0.2', 9998, None)
+        assert backends.parse_spec('user:p@ss:word@host:9998:9999') == ('user', 'p@ss:word', 'host', 9998, 9999)
+        self.assertRaises(ValueError, backends.parse_spec, 'host')
+        self.assertRaises(ValueError, backends.parse_spec, 'nopass@host:1')
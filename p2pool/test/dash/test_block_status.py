@@ -0,0 +1,131 @@
+import json
+import os
+import shutil
+import tempfile
+
+from twisted.internet import defer, reactor
+from twisted.trial import unittest
+from twisted.web import resource, server
+
+from p2pool.dash import block_status
+from p2pool.util import deferral, jsonrpc
+
+class FakeDashd(resource.Resource):
+    '''JSON-RPC batch server answering getblockheader/getblock from a dict of blocks'''
+    isLeaf = True
+
+    def __init__(self, blocks, delay=.01):
+        resource.Resource.__init__(self)
+        self.blocks = blocks # block_hash -> confirmations
+        self.delay = delay
+        self.batches = []
+        self.in_flight = self.max_in_flight = 0
+
+    def _answer(self, req):
+        block_hash = req['params'][0]
+        if block_hash not in self.blocks:
+            return dict(id=req['id'], result=None, error=dict(code=-5, message='Block not found'))
+        result = dict(hash=block_hash, confirmations=self.blocks[block_hash])
+        if req['method'] == 'getblock' and req['params'][1] == 2:
+            result['tx'] = [dict(txid='00'*32, vout=[dict(value=1.5), dict(value=0.25)])]
+        return dict(id=req['id'], result=result, error=None)
+
+    def render_POST(self, request):
+        reqs = json.loads(request.content.read())
+        assert isinstance(reqs, list)
+        self.batches.append([(req['method'], req['params'][0]) for req in reqs])
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        def finish():
+            self.in_flight -= 1
+            request.write(json.dumps([self._answer(req) for req in reversed(reqs)]))
+            request.finish()
+        reactor.callLater(self.delay, finish)
+        return server.NOT_DONE_YET
+
+class Test(unittest.TestCase):
+    def setUp(self):
+        self.blocks = {}
+        for i in xrange(1000):
+            self.blocks['%064x' % (i,)] = [-1, 0, 50, 99, 100, 200][i % 6]
+        self.dashd = FakeDashd(self.blocks)
+        self.port = reactor.listenTCP(0, server.Site(self.dashd), interface='127.0.0.1')
+        self.proxy = jsonrpc.HTTPProxy('http://127.0.0.1:%i/' % (self.port.getHost().port,))
+        self.datadir = tempfile.mkdtemp()
+        self.path = os.path.join(self.datadir, 'block_status_cache.json')
+
+    @defer.inlineCallbacks
+    def tearDown(self):
+        shutil.rmtree(self.datadir)
+        yield self.proxy.close()
+        yield self.port.stopListening()
+
+    @defer.inlineCallbacks
+    def test_batched_refresh(self):
+        reconciler = block_status.BlockStatusReconciler(self.proxy, self.path, batch_size=50, concurrency=2)
+        missing = '%064x' % (10**6,)
+        for block_hash in self.blocks:
+            reconciler.track(block_hash)
+        reconciler.track(missing)
+
+        refreshed = yield reconciler.refresh()
+        assert refreshed == 1001
+        assert len(self.dashd.batches) == 21
+        assert max(len(batch) for batch in self.dashd.batches) == 50
+        assert set(method for batch in self.dashd.batches for method, block_hash in batch) == set(['getblockheader'])
+        assert self.dashd.max_in_flight == 2
+
+        # reads only touch the cache
+        self.dashd.batches = []
+        for block_hash, confirmations in self.blocks.iteritems():
+            assert reconciler.get_status(block_hash) == block_status.status_from_confirmations(confirmations)
+        assert reconciler.get_status('%064x' % (1,)) == 'pending'
+        assert reconciler.get_status('%064x' % (5,)) == 'confirmed'
+        assert reconciler.get_status('%064x' % (0,)) == 'orphaned'
+        assert reconciler.get_status(missing) == 'pending'
+        assert reconciler.get_status(None) == 'unknown'
+        assert self.dashd.batches == []
+
+        # nothing is due right away; pending blocks are, a minute later
+        refreshed = yield reconciler.refresh()
+        assert refreshed == 0 and self.dashd.batches == []
+        refreshed = yield reconciler.refresh(now=reconciler.cache[missing]['checked'] + block_status.PENDING_TTL + 1)
+        pending = sum(1 for confirmations in self.blocks.itervalues() if 0 <= confirmations < 100) + 1
+        assert refreshed == pending
+        assert len(self.dashd.batches) == (pending + 49)//50
+
+        # the cache survives a restart
+        reconciler2 = block_status.BlockStatusReconciler(self.proxy, self.path)
+        assert reconciler2.cache == reconciler.cache
+
+    @defer.inlineCallbacks
+    def test_rewards(self):
+        reconciler = block_status.BlockStatusReconciler(self.proxy, self.path, reward_batch_size=5)
+        found = []
+        reconciler.reward_found.watch(lambda block_hash, reward: found.append((block_hash, reward)))
+        hashes = sorted(self.blocks)[:12]
+        for block_hash in hashes:
+            reconciler.track(block_hash)
+        assert reconciler.get_reward(hashes[0]) is None
+        reconciler.track(hashes[1], want_reward=True)
+
+        yield reconciler.refresh()
+        assert sorted(self.dashd.batches[0]) == [('getblock', hashes[0]), ('getblock', hashes[1])]
+        assert len(self.dashd.batches) == 2 # rewards, then the other ten statuses
+        assert sorted(found) == [(hashes[0], 1.75), (hashes[1], 1.75)]
+        assert reconciler.get_reward(hashes[0]) == 1.75
+        assert reconciler.get_status(hashes[1]) == 'pending'
+
+    @defer.inlineCallbacks
+    def test_start_stop(self):
+        reconciler = block_status.BlockStatusReconciler(self.proxy, self.path, interval=.05)
+        for block_hash in sorted(self.blocks)[:100]:
+            reconciler.track(block_hash)
+        reconciler.start()
+        for i in xrange(50):
+            if all(entry['checked'] for entry in reconciler.cache.itervalues()):
+                break
+            yield deferral.sleep(.1)
+        reconciler.stop()
+        assert len(self.dashd.batches) == 2
+        assert os.path.exists(self.path)
@@ -0,0 +1,124 @@
+import os
+import shutil
+import tempfile
+
+from twisted.internet import defer
+from twisted.trial import unittest
+
+from p2pool.dash import rpc_cache
+from p2pool.util import jsonrpc
+
+class FakeDashd(object):
+    '''A chain of `height` + 1 blocks answering getblockcount/getblockhash/getblockheader and counting calls'''
+    def __init__(self, height=1000):
+        self.height = height
+        self.calls = []
+
+    def _header(self, block_hash):
+        height = int(block_hash, 16)
+        if height > self.height:
+            raise jsonrpc.Error_for_code(-5)(u'Block not found')
+        return dict(hash=block_hash, height=height, confirmations=self.height - height + 1, time=1700000000 + 150*height)
+
+    def __getattr__(self, attr):
+        if not attr.startswith('rpc_'):
+            raise AttributeError(attr)
+        method = attr[len('rpc_'):]
+        def call(*params):
+            self.calls.append((method,) + params)
+            if method == 'getblockcount':
+                return defer.succeed(self.height)
+            if method == 'getblockhash':
+                return defer.succeed('%064x' % (params[0],))
+            return defer.maybeDeferred(self._header, params[0])
+        return call
+
+    def batch(self, calls):
+        results = []
+        for method, params in calls:
+            self.calls.append((method,) + tuple(params))
+            try:
+                results.append(self._header(params[0]))
+            except jsonrpc.Error, e:
+                results.append(e)
+        return defer.succeed(results)
+
+class Test(unittest.TestCase):
+    def setUp(self):
+        self.datadir = tempfile.mkdtemp()
+        self.path = os.path.join(self.datadir, 'dashd_rpc_cache')
+        self.dashd = FakeDashd()
+        self.cache = rpc_cache.RPCCache(self.path, lru_size=100)
+        self.proxy = rpc_cache.CachingProxy(self.dashd, self.cache)
+
+    def tearDown(self):
+        self.cache.close()
+        shutil.rmtree(self.datadir)
+
+    @defer.inlineCallbacks
+    def test_depth_rule(self):
+        backfill = self.proxy.view('backfill')
+        deep, shallow = '%064x' % (100,), '%064x' % (900,)
+        for i in xrange(3):
+            header = yield backfill.rpc_getblockheader(deep)
+            assert header['height'] == 100
+            yield backfill.rpc_getblockheader(shallow)
+        assert self.dashd.calls.count(('getblockheader', deep)) == 1
+        assert self.dashd.calls.count(('getblockheader', shallow)) == 3
+
+        # the tip seen in the headers makes deep heights' hashes cacheable
+        for i in xrange(2):
+            res = yield backfill.rpc_getblockhash(200)
+            assert res == '%064x' % (200,)
+            yield backfill.rpc_getblockhash(950)
+        assert self.dashd.calls.count(('getblockhash', 200)) == 1
+        assert self.dashd.calls.count(('getblockhash', 950)) == 2
+        # and a final header answers getblockhash for its height
+        res = yield backfill.rpc_getblockhash(100)
+        assert res == deep
+        assert ('getblockhash', 100) not in self.dashd.calls
+
+        yield self.proxy.rpc_getblockcount()
+        stats = self.cache.get_stats()['endpoints']
+        assert stats['backfill']['rpc_calls_saved'] == 2 + 1 + 1
+        assert stats['backfill']['misses'] == 1 + 3 + 1 + 2
+        assert stats['other'] == dict(hits=0, misses=0, uncacheable=1, rpc_calls_saved=0, hit_rate=0)
+
+    @defer.inlineCallbacks
+    def test_persistence(self):
+        hashes = ['%064x' % (height,) for height in xrange(0, 500, 5)]
+        for block_hash in hashes:
+            yield self.proxy.rpc_getblockheader(block_hash)
+        self.cache.close()
+        # a write cut short by a crash is dropped
+        with open(self.path, 'ab') as f:
+            f.write('["getblockheader",["%064x"]]\t{"hash"' % (1,))
+
+        self.cache = rpc_cache.RPCCache(self.path, lru_size=10)
+        proxy = rpc_cache.CachingProxy(self.dashd, self.cache, 'restarted')
+        del self.dashd.calls[:]
+        for block_hash in hashes:
+            header = yield proxy.rpc_getblockheader(block_hash)
+            assert header['hash'] == block_hash
+        assert self.dashd.calls == []
+        assert self.cache.get_stats()['endpoints']['restarted']['hits'] == len(hashes)
+        assert len(self.cache.index) == len(hashes)
+
+        # new entries are appended after the dropped partial line
+        yield proxy.rpc_getblockheader('%064x' % (1,))
+        cache2 = rpc_cache.RPCCache(self.path)
+        assert len(cache2.index) == len(hashes) + 1
+        cache2.close()
+
+    @defer.inlineCallbacks
+    def test_batch(self):
+        yield self.proxy.rpc_getblockheader('%064x' % (10,))
+        del self.dashd.calls[:]
+        calls = [('getblockheader', ['%064x' % (height,)]) for height in [10, 20, 990, 5000]]
+        results = yield self.proxy.batch(calls)
+        assert [res['height'] for res in results[:3]] == [10, 20, 990]
+        assert isinstance(results[3], jsonrpc.Error_for_code(-5))
+        assert self.dashd.calls == [('getblockheader', '%064x' % (height,)) for height in [20, 990, 5000]]
+        del self.dashd.calls[:]
+        yield self.proxy.batch(calls[:2])
+        assert self.dashd.calls == []
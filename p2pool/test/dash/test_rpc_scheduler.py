@@ -0,0 +1,119 @@
+import time
+
+from twisted.internet import defer, reactor
+from twisted.trial import unittest
+from twisted.web import resource, server
+
+from p2pool.dash import rpc_scheduler
+from p2pool.util import deferral, jsonrpc
+
+class SlowDashd(object):
+    '''Every call but submitblock takes `delay` seconds'''
+    def __init__(self, delay):
+        self.delay = delay
+
+    def rpc_getblockhash(self, request, height):
+        return deferral.sleep(self.delay).addCallback(lambda _: '%064x' % (height,))
+
+    def rpc_getblocktemplate(self, request, params):
+        return deferral.sleep(self.delay).addCallback(lambda _: dict(height=1))
+
+    def rpc_submitblock(self, request, data):
+        return None
+
+class FakeProxy(object):
+    '''Records calls and leaves them pending until finish() is called'''
+    def __init__(self):
+        self.started = []
+        self.pending = {}
+
+    def __getattr__(self, attr):
+        if not attr.startswith('rpc_'):
+            raise AttributeError(attr)
+        def call(*params):
+            name = params[0] if params else attr[len('rpc_'):]
+            self.started.append(name)
+            df = self.pending[name] = defer.Deferred()
+            return df
+        return call
+
+    def finish(self, name):
+        self.pending.pop(name).callback(name)
+
+class Test(unittest.TestCase):
+    def test_classify(self):
+        assert rpc_scheduler.classify('submitblock', ['00']) == 'submit'
+        assert rpc_scheduler.classify('getblocktemplate', [dict(mode='submit', data='00')]) == 'submit'
+        assert rpc_scheduler.classify('getblocktemplate', [dict(mode='template')]) == 'template'
+        assert rpc_scheduler.classify('getmemorypool', []) == 'template'
+        assert rpc_scheduler.classify('getblock', ['00']) == 'lookup'
+
+    def test_order_and_caps(self):
+        proxy = FakeProxy()
+        scheduler = rpc_scheduler.RPCScheduler(proxy, max_in_flight=3)
+        stats = scheduler.with_priority('stats')
+        results = []
+        for i in xrange(3):
+            stats.rpc_x('stats%i' % (i,)).addCallback(results.append)
+        # the stats cap leaves the third slot free
+        assert proxy.started == ['stats0', 'stats1']
+        scheduler.rpc_getblock('lookup0').addCallback(results.append)
+        scheduler.rpc_getblock('lookup1').addCallback(results.append)
+        scheduler.with_priority('template').rpc_getblocktemplate('template0').addCallback(results.append)
+        assert proxy.started == ['stats0', 'stats1', 'lookup0']
+
+        # freed slots go to the highest class first
+        proxy.finish('stats0')
+        assert proxy.started[3:] == ['template0']
+        proxy.finish('lookup0')
+        assert proxy.started[4:] == ['lookup1']
+        proxy.finish('stats1')
+        assert proxy.started[5:] == ['stats2']
+
+        # submissions never wait for a slot
+        scheduler.rpc_submitblock('submit0').addCallback(results.append)
+        assert proxy.started[6:] == ['submit0']
+        for name in ['submit0', 'template0', 'lookup1', 'stats2']:
+            proxy.finish(name)
+        assert results == ['stats0', 'lookup0', 'stats1', 'submit0', 'template0', 'lookup1', 'stats2']
+        assert scheduler.in_flight == dict(submit=0, template=0, lookup=0, stats=0)
+
+    @defer.inlineCallbacks
+    def test_deadline_and_cancel(self):
+        proxy = FakeProxy()
+        scheduler = rpc_scheduler.RPCScheduler(proxy, max_in_flight=1, classes=[('lookup', None, None), ('stats', None, .1)])
+        scheduler.rpc_getblock('lookup0')
+        stats = scheduler.with_priority('stats')
+        cancelled = [stats.rpc_x('stats%i' % (i,)) for i in xrange(1, 3)]
+        scheduler.cancel('stats')
+        expired = stats.rpc_x('stats0')
+        for df in cancelled:
+            yield self.assertFailure(df, defer.CancelledError)
+        yield self.assertFailure(expired, rpc_scheduler.DeadlineExceeded)
+        proxy.finish('lookup0')
+        assert proxy.started == ['lookup0']
+        assert not any(scheduler.queues.itervalues())
+
+    @defer.inlineCallbacks
+    def test_submit_not_queued_behind_web_calls(self):
+        root = resource.Resource()
+        root.putChild('', jsonrpc.HTTPServer(SlowDashd(delay=.5)))
+        port = reactor.listenTCP(0, server.Site(root), interface='127.0.0.1')
+        proxy = jsonrpc.HTTPProxy('http://127.0.0.1:%i/' % (port.getHost().port,))
+        scheduler = rpc_scheduler.RPCScheduler(proxy, max_in_flight=4)
+        try:
+            stats = scheduler.with_priority('stats')
+            web_calls = [stats.rpc_getblockhash(h) for h in xrange(20)] + [scheduler.rpc_getblockhash(h) for h in xrange(10)]
+            template = scheduler.rpc_getblocktemplate(dict(mode='template'))
+            yield deferral.sleep(.1)
+
+            t0 = time.time()
+            yield scheduler.rpc_submitblock('00')
+            assert time.time() - t0 < .4
+            assert not any(df.called for df in web_calls)
+
+            res = yield defer.gatherResults(web_calls + [template])
+            assert res[:20] == ['%064x' % (h,) for h in xrange(20)]
+        finally:
+            yield proxy.close()
+            yield port.stopListening()
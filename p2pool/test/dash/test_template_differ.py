@@ -0,0 +1,106 @@
+import random
+
+from twisted.internet import defer, reactor
+from twisted.trial import unittest
+from twisted.web import resource, server
+
+from p2pool.dash import data as dash_data, helper, template_differ
+from p2pool.test.bench import sharechain
+from p2pool.util import deferral, jsonrpc, variable
+
+def make_gbt_tx(rng):
+    packed = dash_data.tx_type.pack(sharechain.make_tx(rng))
+    return dict(data=packed.encode('hex'), txid='%064x' % (dash_data.hash256(packed),), fee=1000)
+
+class FakeDashd(object):
+    '''Serves a getblocktemplate whose transactions change on update(), answering long polls when they do'''
+    def __init__(self, size=100):
+        self.rng = random.Random(0)
+        self.txs = [make_gbt_tx(self.rng) for i in xrange(size)]
+        self.template_id = 0
+        self.changed = variable.Event()
+        self.calls = []
+
+    def update(self, churn):
+        self.txs = self.txs[churn:] + [make_gbt_tx(self.rng) for i in xrange(churn)]
+        self.template_id += 1
+        self.changed.happened()
+
+    def _template(self):
+        return dict(
+            version=0x20000000,
+            previousblockhash='%064x' % (1,),
+            transactions=list(self.txs),
+            coinbasevalue=180000000,
+            curtime=1700000000 + self.template_id,
+            bits='1d00ffff',
+            height=1000,
+            longpollid='%064x%i' % (1, self.template_id),
+        )
+
+    @defer.inlineCallbacks
+    def rpc_getblocktemplate(self, request, params):
+        self.calls.append(params)
+        if params.get('longpollid') == self._template()['longpollid']:
+            yield self.changed.get_deferred()
+        defer.returnValue(self._template())
+
+    def rpc_getblock(self, request, block_hash):
+        return dict(hash=block_hash, height=999)
+
+class Test(unittest.TestCase):
+    def test_update(self):
+        rng = random.Random(1)
+        txs = [make_gbt_tx(rng) for i in xrange(50)]
+        differ = template_differ.TemplateDiffer()
+        transactions, hashes = differ.update(txs)
+        assert differ.last_stats == dict(decoded=50, reused=0, removed=0)
+        assert hashes == [int(x['txid'], 16) for x in txs]
+        assert transactions == [dash_data.tx_type.unpack(x['data'].decode('hex')) for x in txs]
+
+        new_txs = txs[5:] + [make_gbt_tx(rng) for i in xrange(5)]
+        new_transactions, new_hashes = differ.update(new_txs)
+        assert differ.last_stats == dict(decoded=5, reused=45, removed=5)
+        assert new_hashes == [int(x['txid'], 16) for x in new_txs]
+        assert all(a is b for a, b in zip(new_transactions[:45], transactions[5:]))
+        assert len(differ.txs) == 50
+
+        # plain hex transactions (getmemorypool) are keyed by their data
+        hex_txs = [x['data'] for x in new_txs]
+        differ.update(hex_txs)
+        assert differ.last_stats['decoded'] == 50
+        assert differ.update(hex_txs)[1] == new_hashes
+        assert differ.last_stats['reused'] == 50
+
+    @defer.inlineCallbacks
+    def test_longpoll(self):
+        fake = FakeDashd()
+        root = resource.Resource()
+        root.putChild('', jsonrpc.HTTPServer(fake))
+        port = reactor.listenTCP(0, server.Site(root), interface='127.0.0.1')
+        url = 'http://127.0.0.1:%i/' % (port.getHost().port,)
+        dashd = jsonrpc.HTTPProxy(url)
+        longpoll_dashd = jsonrpc.HTTPProxy(url, timeout=10, pool_size=1)
+        differ = template_differ.TemplateDiffer()
+        try:
+            work = yield helper.getwork(dashd, None, differ=differ)
+            assert len(work['transactions']) == 100
+            assert work['longpollid'] is not None
+
+            df = helper.getwork_longpoll(dashd, longpoll_dashd, None, work['longpollid'], differ)
+            yield deferral.sleep(.2)
+            assert not df.called
+            fake.update(churn=5)
+            new_work = yield df
+            assert new_work['longpollid'] != work['longpollid']
+            assert new_work['transaction_hashes'] == [int(x['txid'], 16) for x in fake.txs]
+            assert differ.last_stats == dict(decoded=5, reused=95, removed=5)
+
+            # an abandoned long poll can be cancelled
+            df = helper.getwork_longpoll(dashd, longpoll_dashd, None, new_work['longpollid'], differ)
+            df.cancel()
+            yield self.assertFailure(df, defer.CancelledError)
+        finally:
+            yield dashd.close()
+            yield longpoll_dashd.close()
+            yield port.stopListening()
@@ -0,0 +1,104 @@
+import hashlib
+import random
+import struct
+import unittest
+
+from twisted.internet import task
+from twisted.test import proto_helpers
+
+from p2pool.dash import data, networks, p2p
+from p2pool.test.bench import sharechain
+from p2pool.util import p2protocol, variable
+
+def frame(prefix, command, payload):
+    return prefix + struct.pack('<12sI', command, len(payload)) + hashlib.sha256(hashlib.sha256(payload).digest()).digest()[:4] + payload
+
+class FakeDashd(object):
+    '''The dashd end of a p2p.Protocol connection, flooding it with invs'''
+
+    def __init__(self, clock):
+        self.factory = p2p.ClientFactory(networks.nets['dash'])
+        self.factory.known_txs_var = variable.VariableDict({})
+        self.conn = self.factory.buildProtocol(None)
+        self.conn.makeConnection(proto_helpers.StringTransport())
+        self.conn.tx_inventory = p2p.TxInventory(self.conn.send_getdata, self.conn.is_tx_known, clock=clock)
+        self.conn.transport.clear()
+        self.factory.new_tx.watch(lambda tx, tx_hash: self.factory.known_txs_var.add({tx_hash: tx}))
+
+    def send(self, command, **payload):
+        self.conn.dataReceived(frame(self.conn._message_prefix, command, getattr(self.conn, 'message_' + command).pack(payload)))
+
+    def send_invs(self, tx_hashes):
+        self.send('inv', invs=[dict(type='tx', hash=tx_hash) for tx_hash in tx_hashes])
+
+    def get_getdatas(self):
+        decoder = p2protocol.FrameDecoder(self.conn._message_prefix, self.conn._max_payload_length)
+        frames = decoder.feed(self.conn.transport.value())
+        self.conn.transport.clear()
+        assert all(command == 'getdata' for command, length, checksum, payload in frames)
+        return [[request['hash'] for request in self.conn.message_getdata.unpack(payload)['requests']] for command, length, checksum, payload in frames]
+
+def make_txs(count):
+    rng = random.Random(0)
+    txs = [sharechain.make_tx(rng) for i in xrange(count)]
+    return [(data.hash256(data.tx_type.pack(tx)), tx) for tx in txs]
+
+class Test(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.dashd = FakeDashd(self.clock)
+
+    def tearDown(self):
+        self.dashd.conn.tx_inventory.stop()
+
+    def test_flood(self):
+        rng = random.Random(1)
+        tx_hashes = [rng.getrandbits(256) for i in xrange(1000)]
+        known = tx_hashes[:100]
+        self.dashd.factory.known_txs_var.add(dict((tx_hash, None) for tx_hash in known))
+        skipped = p2p.tx_invs_skipped.get(('known',)), p2p.tx_invs_skipped.get(('in_flight',))
+
+        invs = []
+        for i in xrange(10):
+            # overlapping announcements, like several dashd peers relaying the same txs
+            batch = tx_hashes[i*90:i*90 + 200]
+            invs.extend(batch)
+            self.dashd.send_invs(batch)
+            self.clock.advance(.005)
+        assert self.dashd.get_getdatas() == []
+        self.clock.advance(.1)
+        requested = self.dashd.get_getdatas()
+        assert requested == [[tx_hash for tx_hash in tx_hashes if tx_hash not in known]]
+        assert p2p.tx_invs_skipped.get(('known',)) - skipped[0] == sum(1 for tx_hash in invs if tx_hash in known)
+        unknown_invs = [tx_hash for tx_hash in invs if tx_hash not in known]
+        assert p2p.tx_invs_skipped.get(('in_flight',)) - skipped[1] == len(unknown_invs) - len(set(unknown_invs))
+        assert self.dashd.conn.tx_inventory.get_stats() == dict(in_flight=900, pending=0)
+
+        # announcing them again doesn't request them again
+        self.dashd.send_invs(tx_hashes)
+        self.clock.advance(1)
+        assert self.dashd.get_getdatas() == []
+
+    def test_answers(self):
+        txs = make_txs(4)
+        self.dashd.send_invs([tx_hash for tx_hash, tx in txs])
+        self.clock.advance(.1)
+        assert self.dashd.get_getdatas() == [[tx_hash for tx_hash, tx in txs]]
+
+        self.dashd.send('tx', tx=txs[0][1])
+        self.dashd.send('notfound', invs=[dict(type='tx', hash=txs[1][0])])
+        assert sorted(self.dashd.conn.tx_inventory.in_flight) == sorted(tx_hash for tx_hash, tx in txs[2:])
+        self.clock.advance(30)
+
+        # the received one is known now; the one not found and the timed out ones are asked for again
+        failed = p2p.tx_requests_failed.get(('timeout',))
+        self.dashd.send_invs([tx_hash for tx_hash, tx in txs])
+        assert p2p.tx_requests_failed.get(('timeout',)) - failed == 2
+        self.clock.advance(.1)
+        assert self.dashd.get_getdatas() == [[tx_hash for tx_hash, tx in txs[1:]]]
+
+    def test_large(self):
+        tx_hashes = range(1, p2p.TxInventory.MAX_GETDATA + 11)
+        self.dashd.conn.handle_inv([dict(type='tx', hash=tx_hash) for tx_hash in tx_hashes])
+        self.clock.advance(.1)
+        assert map(len, self.dashd.get_getdatas()) == [p2p.TxInventory.MAX_GETDATA, 10]
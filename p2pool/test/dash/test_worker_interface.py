@@ -0,0 +1,80 @@
+from twisted.internet import defer
+from twisted.trial import unittest
+
+from p2pool.dash import worker_interface
+from p2pool.util import deferral, variable
+
+class FakeBridge(object):
+    COINBASE_NONCE_LENGTH = 4
+
+    def __init__(self):
+        self.net = None
+        self.new_work_event = variable.Event()
+        self.share_rate = 10
+        self.generated = []
+
+    def preprocess_request(self, user):
+        return user, None, None
+
+    def get_user_details(self, user):
+        return user, user, None, None
+
+    def get_work(self, *args):
+        self.generated.append(args)
+        return dict(args=args, coinb1=''), lambda *a: None
+
+class Test(unittest.TestCase):
+    def setUp(self):
+        self.inner = FakeBridge()
+        self.notified = []
+        self.get_args_calls = 0
+
+    def watch(self, wb, user):
+        def get_args():
+            self.get_args_calls += 1
+            return user, None, None
+        def callback(args):
+            x, handler = wb.get_work(*(get_args() if args is None else args))
+            self.notified.append((user, len(self.inner.generated)))
+        return wb.watch_work(get_args, callback)
+
+    @defer.inlineCallbacks
+    def test_fan_out(self):
+        wb = worker_interface.CachingWorkerBridge(self.inner, slice_time=0)
+        for user in ['a', 'b', 'b', 'c', 'b', 'c']:
+            self.watch(wb, user)
+        gone = self.watch(wb, 'd')
+        wb.unwatch_work(gone)
+
+        self.inner.new_work_event.happened()
+        # the busiest group is served right away, the rest after going back to the reactor
+        assert self.notified == [('b', 1), ('b', 1), ('b', 1)]
+        yield deferral.sleep(.1)
+        # busiest payout first, each job generated once and before its miners are notified
+        assert self.notified == [('b', 1), ('b', 1), ('b', 1), ('c', 2), ('c', 2), ('a', 3)]
+        assert self.inner.generated == [('b', None, None), ('c', None, None), ('a', None, None)]
+        assert wb.last_fan_out['watchers'] == 6
+        assert wb.last_fan_out['groups'] == 3
+        assert wb.last_fan_out['slices'] == 4
+        # each watcher's arguments are got once and passed on
+        assert self.get_args_calls == 6
+
+    @defer.inlineCallbacks
+    def test_superseded(self):
+        wb = worker_interface.CachingWorkerBridge(self.inner, slice_time=0)
+        for user in ['a', 'b', 'c']:
+            self.watch(wb, user)
+        self.inner.new_work_event.happened()
+        self.inner.new_work_event.happened()
+        yield deferral.sleep(.1)
+        # the first fan-out stops at its first slice, the second one sends everything
+        assert [user for user, n in self.notified] == ['a', 'a', 'b', 'c']
+        assert wb.last_fan_out['watchers'] == 3
+
+    def test_no_prefetch(self):
+        wb = worker_interface.CachingWorkerBridge(self.inner, prefetch=False)
+        for user in ['a', 'b', 'a']:
+            self.watch(wb, user)
+        self.inner.new_work_event.happened()
+        assert [user for user, n in self.notified] == ['a', 'b', 'a']
+        assert len(self.inner.generated) == 2
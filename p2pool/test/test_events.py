@@ -0,0 +1,134 @@
+import json
+
+from twisted.internet import defer, protocol, reactor
+from twisted.protocols import basic
+from twisted.trial import unittest
+from twisted.web import resource, server
+from twisted.web.test import requesthelper
+
+from p2pool import events, node, p2p
+from p2pool.test.bench import sharechain
+from p2pool.util import deferral, math, variable
+
+class LineCollector(basic.LineReceiver):
+    delimiter = '\n'
+
+    def connectionMade(self):
+        self.factory.lines = []
+        self.factory.connected.callback(self)
+
+    def lineReceived(self, line):
+        self.factory.lines.append(line)
+
+class Test(unittest.TestCase):
+    def test_bus(self):
+        bus = events.EventBus(max_queue=3)
+        received = []
+        subscriber = bus.subscribe(lambda line: received.append(json.loads(line)))
+        blocks = []
+        bus.subscribe(lambda line: blocks.append(json.loads(line)), types=events.parse_types('block_found,'))
+
+        bus.publish('share', hash='00')
+        bus.publish('block_found', block_hash='01')
+        assert [(e['type'], e['seq']) for e in received] == [('share', 1), ('block_found', 2)]
+        assert received[0]['hash'] == '00'
+        assert [e['block_hash'] for e in blocks] == ['01']
+
+        # a paused subscriber queues up to max_queue events, then drops
+        subscriber.pauseProducing()
+        for i in xrange(5):
+            bus.publish('share', hash=str(i))
+        assert len(received) == 2
+        subscriber.resumeProducing()
+        assert [e.get('hash') for e in received[2:]] == ['0', '1', '2', None]
+        assert received[-1] == dict(type='dropped', count=2)
+        bus.publish('share', hash='5')
+        assert received[-1]['hash'] == '5'
+        assert subscriber.get_stats() == dict(transport='local', sent=6, queued=0, dropped=2)
+
+        bus.unsubscribe(subscriber)
+        bus.publish('share', hash='6')
+        assert len(received) == 7
+        assert bus.get_stats()['published'] == dict(share=8, block_found=1)
+
+    def test_watch_node(self):
+        chain = sharechain.make_chain(5, chain_length=20)
+        n = node.Node(None, None, [], [], chain.net)
+        n.best_share_var = variable.Variable(None)
+        n.p2p_node = p2p.Node(lambda: None, 0, chain.net, {}, set(), 0, 0, 10)
+        wb = math.Object(new_work_event=variable.Event(), current_work=variable.Variable(None))
+        bus = events.EventBus()
+        received = []
+        bus.subscribe(lambda line: received.append(json.loads(line)))
+        events.watch_node(bus, n, wb)
+
+        for share in chain.shares:
+            n.tracker.add(share)
+            n.tracker.verified.add(share)
+        n.best_share_var.set(chain.tip)
+        wb.current_work.set(dict(previous_block=chain.previous_blocks[-1], height=1000, transactions=['tx']))
+        wb.new_work_event.happened()
+        conn = math.Object(addr=('10.0.0.1', 8999), incoming=True, other_sub_version='1.0')
+        n.p2p_node.peer_connected.happened(conn)
+        n.p2p_node.peer_disconnected.happened(conn, math.Object(getErrorMessage=lambda: 'gone'))
+
+        shares = [e for e in received if e['type'] == 'share']
+        assert [e['hash'] for e in shares] == ['%064x' % (share.hash,) for share in chain.shares]
+        assert shares[1]['previous_hash'] == shares[0]['hash']
+        others = [e for e in received if e['type'] not in ('share', 'block_found')]
+        assert [e['type'] for e in others] == ['best_share', 'new_work', 'peer_connected', 'peer_disconnected']
+        assert others[0]['height'] == 5
+        assert others[1]['transactions'] == 1
+        assert others[3]['address'] == '10.0.0.1:8999' and others[3]['reason'] == 'gone'
+
+    @defer.inlineCallbacks
+    def test_socket_and_sse(self):
+        bus = events.EventBus()
+        root = resource.Resource()
+        root.putChild('events', events.EventStreamResource(bus))
+        ports = [
+            reactor.listenTCP(0, events.EventStreamFactory(bus), interface='127.0.0.1'),
+            reactor.listenTCP(0, server.Site(root), interface='127.0.0.1'),
+        ]
+        try:
+            factories = []
+            for port, request in zip(ports, [None, 'GET /events?types=block_found HTTP/1.0\r\n\r\n']):
+                factory = protocol.ClientFactory()
+                factory.protocol = LineCollector
+                factory.connected = defer.Deferred()
+                reactor.connectTCP('127.0.0.1', port.getHost().port, factory)
+                client = yield factory.connected
+                if request is not None:
+                    client.transport.write(request)
+                factories.append((factory, client))
+            for i in xrange(50):
+                if len(bus.subscribers) == 2:
+                    break
+                yield deferral.sleep(.05)
+            assert sorted(s.transport for s in bus.subscribers) == ['socket', 'sse']
+
+            bus.publish('share', hash='00')
+            bus.publish('block_found', block_hash='01')
+            yield deferral.sleep(.2)
+            (socket_factory, socket_client), (sse_factory, sse_client) = factories
+            assert [json.loads(line)['type'] for line in socket_factory.lines] == ['share', 'block_found']
+            data = [line for line in sse_factory.lines if line.startswith('data: ')]
+            assert [json.loads(line[len('data: '):])['block_hash'] for line in data] == ['01']
+            assert 'Content-Type: text/event-stream\r' in sse_factory.lines
+
+            # past max_subscribers, streams are turned down
+            res = events.EventStreamResource(bus, max_subscribers=1)
+            request = requesthelper.DummyRequest([''])
+            assert json.loads(res.render_GET(request))['error'] == 'Too many event stream subscribers'
+            assert request.responseCode == 503
+
+            for factory, client in factories:
+                client.transport.loseConnection()
+            for i in xrange(50):
+                if not bus.subscribers:
+                    break
+                yield deferral.sleep(.05)
+            assert bus.subscribers == []
+        finally:
+            for port in ports:
+                yield port.stopListening()
@@ -0,0 +1,95 @@
+from twisted.test import proto_helpers
+from twisted.trial import unittest
+
+from p2pool import p2p
+from p2pool.test.bench import sharechain
+from p2pool.util import p2protocol
+
+def make_peers(chain, count):
+    node = p2p.Node(lambda: None, 0, chain.net)
+    peers = []
+    for i in xrange(count):
+        peer = p2p.Protocol(node, False)
+        peer.transport = proto_helpers.StringTransport()
+        peer.addr = '10.0.0.%i' % (i,), 8999
+        peer.remote_tx_hashes = set(chain.known_txs) if i % 2 else set()
+        peer.remote_remembered_txs_size = 0
+        peer.tx_announcer = p2p.TxAnnouncer(peer)
+        peers.append(peer)
+    return peers
+
+class Test(unittest.TestCase):
+    def test_shared_encoder(self):
+        chain = sharechain.make_chain(5, chain_length=20, txs_per_share=5)
+        peers = make_peers(chain, 6)
+        shares = list(chain.tracker.get_chain(chain.tip, 5))
+        shares[0].peer_addr = peers[0].addr
+
+        def broadcast(encoder):
+            for peer in peers:
+                peer.transport.clear()
+                peer.sendShares([share for share in shares if share.peer_addr != peer.addr], chain.tracker, chain.known_txs,
+                    include_txs_with=[shares[0].hash], encoder=encoder)
+            return [peer.transport.value() for peer in peers]
+
+        expected = broadcast(None)
+        encoder = p2p.BroadcastEncoder()
+        assert broadcast(encoder) == expected
+        # the peer the newest share came from is sent the others only
+        assert encoder.encoded == 2 and encoder.reused == 4
+        assert all(peer.remote_remembered_txs_size == 0 for peer in peers)
+
+    def test_remember_tx_too_long(self):
+        chain = sharechain.make_chain(5, chain_length=20, txs_per_share=5)
+        peer, = make_peers(chain, 1)
+        peer._max_payload_length = 500
+        txs = [(tx_hash, chain.known_txs[tx_hash]) for tx_hash in sorted(chain.known_txs)[:10]]
+        frames = p2p.BroadcastEncoder().get_remember_tx_frames(peer, [], txs)
+        assert len(frames) > 1
+        assert all(len(frame) - len(peer._message_prefix) - 20 <= 500 for frame in frames)
+
+    def test_plan_batches(self):
+        assert p2p.plan_batches([], 10) == [(0, 0)]
+        assert p2p.plan_batches([3, 3, 3, 3], 10) == [(0, 3), (3, 4)]
+        assert p2p.plan_batches([3, 3, 3, 3], 10, overhead=3) == [(0, 2), (2, 4)]
+        self.assertRaises(p2protocol.TooLong, p2p.plan_batches, [3, 10, 3], 10)
+
+    def test_batches_match_fragment(self):
+        chain = sharechain.make_chain(40, chain_length=40, txs_per_share=5)
+        peer, = make_peers(chain, 1)
+        txs = sorted(chain.known_txs.iteritems())
+        tx_hashes = [tx_hash for tx_hash, tx in txs[:30]]
+        shares = chain.shares
+        for max_payload_length in [100000, 5000, 2000, 1000]:
+            peer._max_payload_length = max_payload_length
+            for command, lists, frames in [
+                ('shares', dict(shares=[share.as_share() for share in shares]), p2p.BroadcastEncoder().get_frames(peer, shares)),
+                ('remember_tx', dict(tx_hashes=tx_hashes, txs=[tx for tx_hash, tx in txs]), p2p.BroadcastEncoder().get_remember_tx_frames(peer, tx_hashes, txs)),
+            ]:
+                expected = fragment_frames(peer, command, lists)
+                if len(expected) == 1:
+                    assert frames == expected
+                assert len(frames) <= len(expected)
+                assert all(len(frame) - len(peer._message_prefix) - 20 <= max_payload_length for frame in frames)
+                assert unframe(peer, command, frames) == unframe(peer, command, expected)
+
+def fragment_frames(peer, command, lists):
+    # the recursive splitting sendShares used before plan_batches
+    frames = []
+    def fragment(**kwargs):
+        try:
+            frames.append(peer.encodePacket(command, kwargs))
+        except p2protocol.TooLong:
+            fragment(**dict((k, v[:len(v)//2]) for k, v in kwargs.iteritems()))
+            fragment(**dict((k, v[len(v)//2:]) for k, v in kwargs.iteritems()))
+    fragment(**lists)
+    return frames
+
+def unframe(peer, command, frames):
+    type_ = getattr(peer, 'message_' + command)
+    lists = {}
+    for frame in frames:
+        record = type_.unpack(frame[len(peer._message_prefix) + 20:])
+        for k in record.keys():
+            lists.setdefault(k, []).extend(record[k])
+    return lists
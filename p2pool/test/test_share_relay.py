@@ -0,0 +1,66 @@
+import unittest
+
+from twisted.internet import task
+
+from p2pool import p2p
+from p2pool.test.bench import sharechain, share_relay
+
+class Test(unittest.TestCase):
+    def setUp(self):
+        self.chain = sharechain.make_chain(15, chain_length=15, txs_per_share=8)
+    
+    def run_relay(self, **kwargs):
+        options = dict(shares=10, missing=0, stale=0, delay=.05, rate=1e6)
+        options.update(kwargs)
+        args = type('Args', (object,), options)
+        return dict((mode, share_relay.run_mode(mode, args, self.chain)) for mode in share_relay.MODES)
+    
+    def test_compact_relay(self):
+        results = self.run_relay(missing=.2)
+        assert results['compact']['bytes_per_share'] < results['shares']['bytes_per_share']
+        for r in results.itervalues():
+            assert r['round_trips'] == 0 and r['fallbacks'] == 0
+            assert r['max_latency_ms'] < 60
+    
+    def test_stale_view(self):
+        # the sender thinks the receiver has transactions it lacks: they are fetched with getsharetxs
+        r = self.run_relay(missing=.3, stale=1)['compact']
+        assert r['round_trips'] > 0 and r['fallbacks'] == 0
+        assert 150 < r['max_latency_ms'] < 160
+    
+    def make_link(self, receiver_txs):
+        clock = task.Clock()
+        args = type('Args', (object,), dict(delay=.05, rate=1e6))
+        (sender_node, receiver_node), (sender, receiver) = share_relay.make_link(self.chain, clock, args,
+            p2p.Protocol.COMPACT_SHARE_VERSION, receiver_txs, set(receiver_txs))
+        return clock, receiver_node, receiver
+    
+    def get_entry(self, share, key):
+        tx_hashes = share.share_info['new_transaction_hashes']
+        return dict(
+            hash=share.hash,
+            type=share.VERSION,
+            contents=p2p.BroadcastEncoder().get_compact_contents(share),
+            short_ids=[p2p.compact_short_id(key, tx_hash) for tx_hash in tx_hashes],
+            prefilled=[],
+        )
+    
+    def test_short_id_mismatch(self):
+        share = self.chain.shares[-1]
+        clock, receiver_node, receiver = self.make_link(self.chain.known_txs)
+        encoder = p2p.BroadcastEncoder()
+        entry = self.get_entry(share, encoder.key)
+        entry['short_ids'][0] = '\0'*6 # no transaction has it, and the one fetched for it doesn't match
+        receiver.handle_cmpctshares(encoder.nonce, [entry])
+        assert receiver.share_txs_requests == 1
+        for i in xrange(10):
+            clock.advance(.05)
+        assert receiver_node.requested == [share.hash] and share.hash not in receiver_node.received
+    
+    def test_bad_prefilled_index(self):
+        share = self.chain.shares[-1]
+        clock, receiver_node, receiver = self.make_link(self.chain.known_txs)
+        encoder = p2p.BroadcastEncoder()
+        entry = self.get_entry(share, encoder.key)
+        entry['prefilled'] = [dict(index=len(entry['short_ids']), tx=self.chain.known_txs[share.share_info['new_transaction_hashes'][0]])]
+        self.assertRaises(p2p.PeerMisbehavingError, receiver.handle_cmpctshares, encoder.nonce, [entry])
@@ -0,0 +1,149 @@
+import random
+import unittest
+
+from twisted.internet import defer, task
+
+from p2pool import data as p2pool_data, node as p2pool_node, p2p
+from p2pool.test.bench import sharechain
+
+chain = None
+
+def get_chain():
+    global chain
+    if chain is None:
+        chain = sharechain.make_chain(400, chain_length=400, txs_per_share=1)
+    return chain
+
+class FakePeer(object):
+    '''Answers get_shares from the whole chain after `delay` seconds (or delay(parents)), as P2PNode.handle_get_shares would'''
+
+    def __init__(self, addr, clock, delay, have=True, max_count=None):
+        self.addr = addr
+        self.clock = clock
+        self.delay = delay
+        self.have = have
+        self.max_count = max_count # asked for more shares than this, it replies 'too long' as peers from before replies were cut to fit do
+        self.requests = []
+
+    def get_shares(self, hashes, parents, stops):
+        self.requests.append((hashes, parents, stops))
+        tracker = get_chain().tracker
+        shares = []
+        if self.have:
+            for share_hash in hashes:
+                for share in tracker.get_chain(share_hash, min(parents + 1, tracker.get_height(share_hash))):
+                    if share.hash in stops:
+                        break
+                    shares.append(share)
+        df = defer.Deferred()
+        delay = self.delay(parents) if callable(self.delay) else self.delay
+        if self.have == 'error':
+            self.clock.callLater(delay, df.errback, defer.TimeoutError())
+        elif self.max_count is not None and parents + 1 > self.max_count:
+            self.clock.callLater(delay, df.errback, p2p.Protocol.ShareReplyError('too long'))
+        else:
+            self.clock.callLater(delay, df.callback, shares)
+        return df
+
+class Test(unittest.TestCase):
+    def setUp(self):
+        self.chain = get_chain()
+        self.clock = task.Clock()
+        self.tracker = p2pool_data.OkayTracker(self.chain.net)
+        self.batches = []
+
+    def get_desired(self):
+        if self.chain.tip not in self.tracker.items:
+            return [(None, self.chain.tip)]
+        height, last = self.tracker.get_height_and_last(self.chain.tip)
+        return [(None, last)] if height < self.window and last is not None else []
+
+    def handle_shares(self, shares):
+        self.batches.append(shares)
+        for share in shares:
+            self.tracker.add(share)
+        self.downloader.poll()
+
+    def sync(self, peers, window=300, **kwargs):
+        self.window = window
+        self.downloader = p2pool_node.ShareDownloader(self.tracker, self.get_desired, lambda: peers, self.handle_shares,
+            walk_length=window, clock=self.clock, **kwargs)
+        self.downloader.poll()
+        self.max_held = 0
+        for i in xrange(10000):
+            if not self.downloader.walks and not self.get_desired():
+                break
+            self.clock.advance(.01)
+            self.max_held = max(self.max_held, self.downloader.get_stats()['held_shares'])
+        self.downloader.stop()
+        assert self.tracker.get_height(self.chain.tip) >= window
+        assert not self.downloader.covered
+
+    def check_batches(self):
+        # parent first, each batch attaching to the shares handed on before it
+        expected = self.chain.tip
+        for batch in self.batches:
+            assert batch[-1].hash == expected
+            for parent, child in zip(batch, batch[1:]):
+                assert child.previous_hash == parent.hash
+            expected = batch[0].previous_hash
+
+    def test_pipelined(self):
+        rng = random.Random(0)
+        peers = [FakePeer(('10.0.0.%i' % (i,), 9333), self.clock, rng.uniform(.05, .3)) for i in xrange(4)]
+        self.sync(peers, request_size=60)
+        self.check_batches()
+        requests = [request for peer in peers for request in peer.requests]
+        # walks go on from far_share_hash while the 99 shares above it are fetched as an exact range
+        gaps = [(hashes, parents, stops) for hashes, parents, stops in requests if parents == 98]
+        assert gaps
+        for hashes, parents, stops in gaps:
+            assert self.chain.tracker.get_nth_parent_hash(hashes[0], 99) == stops[0]
+        assert sum(len(batch) for batch in self.batches) == self.tracker.get_height(self.chain.tip)
+        assert len(self.tracker.items) < 300 + 60
+        assert len([peer for peer in peers if peer.requests]) > 1
+
+    def test_out_of_order(self):
+        # the ranges between far_share_hashes come slowly, so the bottom of the walk arrives before the ranges above it
+        delay = lambda parents: .5 if parents == 98 else .05
+        peers = [FakePeer(('10.0.0.%i' % (i,), 9333), self.clock, delay) for i in xrange(3)]
+        self.sync(peers, request_size=100, max_requests=3, hedge_after=10)
+        self.check_batches()
+        assert self.max_held >= 100
+        assert not self.downloader.busy
+        assert len(self.batches) < len([request for peer in peers for request in peer.requests])
+
+    def test_failover(self):
+        peers = [
+            FakePeer(('10.0.0.1', 9333), self.clock, .05, have=False),
+            FakePeer(('10.0.0.2', 9333), self.clock, .05, have='error'),
+            FakePeer(('10.0.0.3', 9333), self.clock, 50),
+            FakePeer(('10.0.0.4', 9333), self.clock, .1),
+        ]
+        self.sync(peers, window=150, request_size=100, hedge_after=1)
+        self.check_batches()
+        assert self.clock.seconds() < 10
+        assert peers[3].requests
+
+    def test_too_long(self):
+        # the only peer there is rejects the full ranges, which are split until they fit without using up attempts
+        peer = FakePeer(('10.0.0.1', 9333), self.clock, .05, max_count=40)
+        self.sync([peer], request_size=120)
+        self.check_batches()
+        counts = [parents + 1 for hashes, parents, stops in peer.requests]
+        assert counts[:3] == [120, 60, 30]
+        assert 99 in counts and 50 in counts
+        assert sum(len(batch) for batch in self.batches) == self.tracker.get_height(self.chain.tip)
+    
+    def test_nobody_has_it(self):
+        peers = [FakePeer(('10.0.0.%i' % (i,), 9333), self.clock, .05, have=False) for i in xrange(2)]
+        self.window = 100
+        self.downloader = p2pool_node.ShareDownloader(self.tracker, self.get_desired, lambda: peers, self.handle_shares,
+            walk_length=100, clock=self.clock)
+        self.downloader.poll()
+        for i in xrange(50):
+            self.clock.advance(.01)
+        # both peers were asked once and the walk given up, until the next poll
+        assert [len(peer.requests) for peer in peers] == [1, 1]
+        assert not self.downloader.walks and not self.downloader.covered
+        self.downloader.stop()
@@ -0,0 +1,134 @@
+import random
+import unittest
+
+from twisted.internet import reactor, task
+from twisted.python import failure
+from twisted.test import proto_helpers
+
+from p2pool import node as p2pool_node, p2p, txstore
+from p2pool.dash import data as dash_data
+from p2pool.test.bench import sharechain
+from p2pool.util import p2protocol, variable
+
+def get_hash(tx):
+    return dash_data.hash256(dash_data.tx_type.pack(tx))
+
+def make_txs(count):
+    rng = random.Random(0)
+    txs = [sharechain.make_tx(rng) for i in xrange(count)]
+    return [(get_hash(tx), tx) for tx in txs]
+
+def get_messages(peer):
+    '''(command, unpacked payload) of the messages peer sent since the last call'''
+    decoder = p2protocol.FrameDecoder(peer._message_prefix, peer._max_payload_length)
+    frames = decoder.feed(peer.transport.value())
+    peer.transport.clear()
+    return [(command, getattr(peer, 'message_' + command).unpack(payload)) for command, length, checksum, payload in frames]
+
+class Test(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.node = p2p.Node(lambda: None, 0, sharechain.make_net(),
+            known_txs_var=variable.VariableDict({}), mining_txs_var=variable.Variable({}))
+        self.peer = peer = p2p.Protocol(self.node, False)
+        peer.transport = proto_helpers.StringTransport()
+        peer.addr = '10.0.0.1', 8999
+        peer.nonce = 1
+        peer.remote_tx_hashes = set()
+        peer.remote_tx_short_ids = set()
+        peer.remote_remembered_txs_size = 0
+        peer.known_txs_cache = {}
+        peer.tx_announcer = p2p.TxAnnouncer(peer, .1, self.clock)
+        self.node.peers[peer.nonce] = peer
+        self.stop = self.node.watch_txs()
+    
+    def tearDown(self):
+        self.stop()
+        for call in reactor.getDelayedCalls():
+            if call.func == self.peer.known_txs_cache.pop:
+                call.cancel()
+    
+    def test_known_txs(self):
+        (a, tx_a), (b, tx_b), (c, tx_c) = make_txs(3)
+        self.node.known_txs_var.add({a: tx_a})
+        self.node.known_txs_var.add({b: tx_b})
+        self.node.known_txs_var.add({c: tx_c})
+        self.node.known_txs_var.set({a: tx_a, c: tx_c})
+        assert get_messages(self.peer) == []
+        self.clock.advance(.1)
+        messages = get_messages(self.peer)
+        # b was added and removed again within the window, so is never announced
+        assert [command for command, payload in messages] == ['have_tx']
+        assert sorted(messages[0][1]['tx_hashes']) == sorted([a, c])
+        # though it is kept for the peer in case it referenced it meanwhile
+        assert any(b in cache for cache in self.peer.known_txs_cache.itervalues())
+        
+        self.node.known_txs_var.set({c: tx_c})
+        self.clock.advance(.1)
+        assert [(command, payload['tx_hashes']) for command, payload in get_messages(self.peer)] == [('losing_tx', [a])]
+    
+    def test_mining_txs(self):
+        (a, tx_a), (b, tx_b) = make_txs(2)
+        self.node.mining_txs_var.set({a: tx_a, b: tx_b})
+        self.clock.advance(.1)
+        messages = get_messages(self.peer)
+        assert [command for command, payload in messages] == ['remember_tx']
+        assert sorted(map(get_hash, messages[0][1]['txs'])) == sorted([a, b])
+        size = self.peer.remote_remembered_txs_size
+        assert size == sum(100 + dash_data.tx_type.packed_size(tx) for tx in [tx_a, tx_b])
+        
+        # dropped from and back in the template within the window: the peer keeps remembering it
+        self.node.mining_txs_var.set({b: tx_b})
+        self.node.mining_txs_var.set({a: tx_a, b: tx_b})
+        self.clock.advance(.1)
+        assert get_messages(self.peer) == []
+        assert self.peer.remote_remembered_txs_size == size
+        
+        self.node.mining_txs_var.set({})
+        self.clock.advance(.1)
+        assert [command for command, payload in get_messages(self.peer)] == ['forget_tx']
+        assert self.peer.remote_remembered_txs_size == 0
+    
+    def test_flushed_before_shares(self):
+        chain = sharechain.make_chain(5, chain_length=5)
+        share = chain.shares[-1]
+        assert share.share_info['new_transaction_hashes']
+        tx_hashes = share.share_info['new_transaction_hashes']
+        self.node.mining_txs_var.set(dict((tx_hash, chain.known_txs[tx_hash]) for tx_hash in tx_hashes))
+        self.peer.sendShares([share], chain.tracker, chain.known_txs, include_txs_with=[share.hash])
+        # the peer has to remember the shares' mining txs before it gets the shares
+        messages = get_messages(self.peer)
+        assert [command for command, payload in messages] == ['remember_tx', 'remember_tx', 'shares', 'forget_tx']
+        assert sorted(map(get_hash, messages[0][1]['txs'])) == sorted(tx_hashes)
+        assert messages[1][1]['txs'] == [] and messages[3][1]['tx_hashes'] == []
+        self.clock.advance(.1)
+        assert get_messages(self.peer) == []
+    
+    def test_remember_tx_refs(self):
+        (a, tx_a), (b, tx_b) = make_txs(2)
+        class FakeNode(object):
+            net = self.node.net
+            best_share_var = variable.Variable(None)
+            known_txs_var = variable.VariableDict(txstore.TxStore({a: tx_a}))
+            mining_txs_var = variable.Variable({})
+        node = p2pool_node.P2PNode(FakeNode(), port=0)
+        store = node.known_txs_var.value
+        store.set_refs('template', [a])
+        peer = p2p.Protocol(node, True)
+        peer.transport = proto_helpers.StringTransport()
+        peer.addr = '10.0.0.2', 8999
+        peer.nonce = 2
+        peer.remembered_txs = {}
+        peer.remembered_txs_size = 0
+        peer.known_txs_cache = {}
+        node.peers[peer.nonce] = peer
+        # a misbehaving peer is dropped half way through a remember_tx, after a and b went into remembered_txs
+        peer.handle_remember_tx([a], [tx_b, tx_b])
+        assert sorted(peer.remembered_txs) == sorted([a, b])
+        assert store.entries[a].refs == 2 and store.entries[b].refs == 1
+        node.lost_conn(peer, failure.Failure(Exception('gone')))
+        # the template's ref on a is left alone
+        assert store.entries[a].refs == 1 and store.entries[b].refs == 0
+        for i in xrange(3):
+            node.known_txs_var.remove(store.advance())
+        assert a in store and b not in store
@@ -0,0 +1,36 @@
+import random
+
+from twisted.trial import unittest
+
+from p2pool import p2p
+from p2pool.test.bench import sharechain, tx_recon
+
+class Test(unittest.TestCase):
+    def test_sketch(self):
+        mempools = tx_recon.make_mempools(random.Random(0), 1000, .02)
+        peers = tx_recon.make_pair(sharechain.make_net(), mempools, p2p.Protocol.TX_SKETCH_VERSION)
+        sent = tx_recon.exchange(peers)
+        assert sent < 32*1000/4
+        common = set(mempools[0]) & set(mempools[1])
+        assert all(peer.remote_tx_hashes == common for peer in peers)
+        
+        # the short ids of the peer's txs we lack are kept until it loses them
+        peer, other = peers
+        other_only = set(mempools[1]) - common
+        assert len(peer.remote_tx_short_ids) == len(other_only) == 20
+        peer.handle_losing_tx(list(other_only)[:5])
+        assert len(peer.remote_tx_short_ids) == 15
+
+    def test_fallback(self):
+        # too different to reconcile: resketch until a have_tx is smaller
+        mempools = tx_recon.make_mempools(random.Random(1), 1000, .6)
+        peers = tx_recon.make_pair(sharechain.make_net(), mempools, p2p.Protocol.TX_SKETCH_VERSION)
+        tx_recon.exchange(peers)
+        assert all(peer.remote_tx_hashes == set(other) for peer, other in zip(peers, mempools[::-1]))
+        assert all(0 < peer.tx_resketches <= p2p.Protocol.MAX_TX_RESKETCHES for peer in peers)
+
+    def test_old_peer(self):
+        mempools = tx_recon.make_mempools(random.Random(2), 100, .02)
+        peers = tx_recon.make_pair(sharechain.make_net(), mempools, 1700)
+        assert tx_recon.exchange(peers) > 2*32*100
+        assert all(peer.remote_tx_hashes == set(other) for peer, other in zip(peers, mempools[::-1]))
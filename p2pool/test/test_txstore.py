@@ -0,0 +1,88 @@
+import random
+import unittest
+
+from p2pool import p2p, txstore
+from p2pool.dash import data as dash_data
+from p2pool.test.bench import sharechain
+from p2pool.util import variable
+
+def make_txs(count, seed=0):
+    rng = random.Random(seed)
+    txs = [sharechain.make_tx(rng) for i in xrange(count)]
+    return dict((dash_data.hash256(dash_data.tx_type.pack(tx)), tx) for tx in txs)
+
+def advance(store):
+    '''advance() and forget what expired, as Node.forget_old_txs does'''
+    expired = store.advance()
+    for tx_hash in expired:
+        del store[tx_hash]
+    return expired
+
+class Test(unittest.TestCase):
+    def test_unreferenced_expire(self):
+        txs = make_txs(4)
+        a, b, c, d = sorted(txs)
+        store = txstore.TxStore(dict((h, txs[h]) for h in [a, b]))
+        assert advance(store) == {}
+        store.update(dict((h, txs[h]) for h in [c]))
+        # a and b were added two generations ago
+        assert sorted(advance(store)) == [a, b]
+        store.update(dict((h, txs[h]) for h in [a, b, c, d]))
+        assert sorted(advance(store)) == [c]
+        assert store.get_stats()['generation'] == 3
+
+    def test_refs(self):
+        txs = make_txs(4)
+        a, b, c, d = sorted(txs)
+        store = txstore.TxStore(txs)
+        store.set_refs('template', [a, b, 12345])
+        store.ref([c])
+        store.ref([c])
+        assert store.holders['template'] == set([a, b])
+        assert store.get_stats()['referenced'] == 3
+        assert advance(store) == {}
+        assert advance(store).keys() == [d]
+
+        store.unref([c])
+        store.set_refs('template', [b])
+        advance(store)
+        # a stopped being referred to one generation ago, c still is
+        assert advance(store).keys() == [a]
+        store.unref([c])
+        store.unref([c]) # more unrefs than refs are ignored
+        assert store.entries[c].refs == 0
+        store.set_refs('template', [])
+        assert 'template' not in store.holders
+        advance(store)
+        assert sorted(advance(store)) == sorted([b, c])
+
+    def test_delete(self):
+        txs = make_txs(2)
+        a, b = sorted(txs)
+        store = txstore.TxStore(txs)
+        store.set_refs('share', [a])
+        del store[a]
+        del store[b]
+        assert not store and not store.entries and store.holders == dict(share=set())
+        advance(store)
+        assert advance(store) == {}
+        assert store.get_stats() == dict(txs=0, referenced=0, unreferenced=0, generation=2)
+
+    def test_packed(self):
+        txs = make_txs(1)
+        store = txstore.TxStore(txs)
+        tx_hash, = txs
+        assert store.get_packed(tx_hash) == dash_data.tx_type.pack(txs[tx_hash])
+        assert store.get_packed(tx_hash) is store.get_packed(tx_hash)
+        # broadcasts take the packed form the store keeps rather than packing again
+        assert p2p.BroadcastEncoder(store).get_packed_tx(tx_hash, txs[tx_hash]) is store.get_packed(tx_hash)
+
+    def test_variable_remove(self):
+        txs = make_txs(3)
+        var = variable.VariableDict(txstore.TxStore(txs))
+        removed = []
+        var.removed.watch(removed.append)
+        store = var.value
+        store.advance()
+        var.remove(store.advance())
+        assert removed == [txs] and not var.value
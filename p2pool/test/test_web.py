@@ -0,0 +1,262 @@
+from __future__ import division
+
+import gzip
+import json
+import os
+import StringIO
+
+from twisted.internet import defer, reactor
+from twisted.trial import unittest
+from twisted.web import client, http_headers, resource, server
+from twisted.web.test import requesthelper
+
+from p2pool import events, node, p2p, web
+from p2pool.test.bench import sharechain
+from p2pool.util import deferral, variable
+
+def parse_openmetrics(text):
+    assert text.endswith('# EOF\n'), text[-100:]
+    samples = {}
+    for line in text.splitlines():
+        if not line or line.startswith('#'):
+            continue
+        name, value = line.rsplit(' ', 1)
+        samples[name] = float(value)
+    return samples
+
+class FakeWorkerBridge(object):
+    def __init__(self, node):
+        self.node = node
+        self.share_received = variable.Event()
+        self.pseudoshare_received = variable.Event()
+
+class SnapshotTest(unittest.TestCase):
+    def test_stats_snapshot_cache(self):
+        best_share_var = variable.Variable(None)
+        computed = []
+        def compute():
+            computed.append(best_share_var.value)
+            if best_share_var.value == 'bad':
+                raise ValueError()
+            return dict(best=best_share_var.value)
+        cache = web.StatsSnapshotCache(compute, best_share_var, min_interval=2, max_age=10)
+
+        self.assertEqual(cache.get('best'), None)
+        self.assertEqual(cache.get_json('best'), 'null')
+        self.assertTrue(isinstance(cache.get_json('best'), web.EncodedJSON))
+        self.assertEqual(len(computed), 1)
+
+        # changes within min_interval are coalesced
+        best_share_var.set(1)
+        best_share_var.set(2)
+        self.assertEqual(cache.get('best'), None)
+        cache.snapshot.timestamp -= 2
+        self.assertEqual(cache.get('best'), 2)
+        self.assertEqual(len(computed), 2)
+
+        # an unchanged snapshot is only refreshed once it is max_age old
+        cache.snapshot.timestamp -= 5
+        cache.get('best')
+        self.assertEqual(len(computed), 2)
+        cache.snapshot.timestamp -= 5
+        cache.get('best')
+        self.assertEqual(len(computed), 3)
+
+        # a failing recompute keeps serving the previous snapshot
+        best_share_var.set('bad')
+        cache.snapshot.timestamp -= 2
+        self.flushLoggedErrors(ValueError)
+        self.assertEqual(cache.get('best'), 2)
+        self.assertEqual(len(self.flushLoggedErrors(ValueError)), 1)
+
+class CheckRequestTest(unittest.TestCase):
+    def setUp(self):
+        self.limiter = web.web_rate_limiter
+        web.web_rate_limiter = web.WebRateLimiter(requests_per_minute=60, burst_limit=2)
+
+    def tearDown(self):
+        web.web_rate_limiter = self.limiter
+
+    def test_rate_limit(self):
+        # the JSON endpoints, the dashboard snapshot, metrics and the event stream share one check
+        for res in [web.MetricsResource(), web.DashboardSnapshotResource(None), events.EventStreamResource(events.EventBus())]:
+            request = requesthelper.DummyRequest([''])
+            web.web_rate_limiter.ip_requests.clear()
+            web.web_rate_limiter.check_rate_limit(request.getClientIP())
+            web.web_rate_limiter.check_rate_limit(request.getClientIP())
+            self.assertEqual(json.loads(res.render_GET(request))['error'], 'Rate limit exceeded')
+            self.assertEqual(request.responseCode, 429)
+        request = requesthelper.DummyRequest([''])
+        self.assertEqual(web.check_request(request, rate_limit=False), None)
+
+class PrecompressedTest(unittest.TestCase):
+    def setUp(self):
+        self.inputs = dict(key=1, value='a')
+        self.built = []
+        def build():
+            self.built.append(self.inputs['value'])
+            if self.inputs['value'] == 'bad':
+                raise ValueError()
+            return dict(value=self.inputs['value'])
+        self.cache = web.DashboardSnapshotCache(build, lambda: self.inputs['key'])
+
+        static_dir = self.mktemp()
+        os.mkdir(static_dir)
+        with open(os.path.join(static_dir, 'page.html'), 'wb') as f:
+            f.write('<html>%s</html>' % ('dashboard '*100,))
+        with open(os.path.join(static_dir, 'image.png'), 'wb') as f:
+            f.write('\x89PNG')
+
+        root = resource.Resource()
+        root.putChild('dashboard_snapshot', web.DashboardSnapshotResource(self.cache))
+        root.putChild('static', web.PrecompressedFile(static_dir))
+        self.port = reactor.listenTCP(0, server.Site(root), interface='127.0.0.1')
+        self.agent = client.Agent(reactor)
+
+    def tearDown(self):
+        return self.port.stopListening()
+
+    @defer.inlineCallbacks
+    def fetch(self, path, **headers):
+        response = yield self.agent.request('GET', 'http://127.0.0.1:%i/%s' % (self.port.getHost().port, path),
+            http_headers.Headers(dict((name.replace('_', '-'), [value]) for name, value in headers.iteritems())))
+        body = yield client.readBody(response)
+        defer.returnValue((response.code, dict((name.lower(), values[0]) for name, values in response.headers.getAllRawHeaders()), body))
+
+    @defer.inlineCallbacks
+    def test_dashboard_snapshot(self):
+        code, headers, body = yield self.fetch('dashboard_snapshot')
+        self.assertEqual(code, 200)
+        self.assertEqual(json.loads(body), dict(value='a'))
+        etag = headers['etag']
+
+        code, headers, gzipped = yield self.fetch('dashboard_snapshot', Accept_Encoding='gzip, deflate')
+        self.assertEqual(headers['content-encoding'], 'gzip')
+        self.assertEqual(gzip.GzipFile(fileobj=StringIO.StringIO(gzipped)).read(), body)
+        gzip_etag = headers['etag']
+        self.assertNotEqual(gzip_etag, etag)
+
+        # unchanged inputs: no rebuild, and a revalidating client gets a 304
+        code, headers, body = yield self.fetch('dashboard_snapshot', Accept_Encoding='gzip', If_None_Match=gzip_etag)
+        self.assertEqual((code, body), (304, ''))
+        self.assertEqual(self.built, ['a'])
+
+        # changed inputs rebuild it
+        self.inputs.update(key=2, value='b')
+        code, headers, body = yield self.fetch('dashboard_snapshot', If_None_Match=etag)
+        self.assertEqual(code, 200)
+        self.assertEqual(json.loads(body), dict(value='b'))
+        self.assertEqual(self.cache.build_count, 2)
+
+        # a failing build keeps serving the previous document
+        self.inputs.update(key=3, value='bad')
+        code, headers, body = yield self.fetch('dashboard_snapshot')
+        self.assertEqual(json.loads(body), dict(value='b'))
+        self.assertEqual(len(self.flushLoggedErrors(ValueError)), 1)
+        self.assertEqual(self.built, ['a', 'b', 'bad'])
+
+    @defer.inlineCallbacks
+    def test_static(self):
+        code, headers, plain = yield self.fetch('static/page.html')
+        self.assertEqual(code, 200)
+        self.assertTrue(plain.startswith('<html>'))
+        self.assertTrue('max-age' in headers['cache-control'])
+
+        code, headers, gzipped = yield self.fetch('static/page.html', Accept_Encoding='gzip')
+        self.assertEqual(headers['content-encoding'], 'gzip')
+        self.assertTrue(len(gzipped) < len(plain)/4)
+        code, headers, body = yield self.fetch('static/page.html', Accept_Encoding='gzip', If_None_Match=headers['etag'])
+        self.assertEqual(code, 304)
+
+        # binary files are left to static.File
+        code, headers, body = yield self.fetch('static/image.png', Accept_Encoding='gzip')
+        self.assertEqual((code, body), (200, '\x89PNG'))
+        self.assertTrue('content-encoding' not in headers)
+
+class MetricsTest(unittest.TestCase):
+    def setUp(self):
+        self.chain = sharechain.make_chain(30, chain_length=20, txs_per_share=5)
+
+        self.n = node.Node(None, None, [], [], self.chain.net)
+        self.n.best_share_var = variable.Variable(None)
+        self.n.known_txs_var = variable.VariableDict({})
+        self.n.mining_txs_var = variable.Variable({})
+        self.n.p2p_node = p2p.Node(lambda: self.n.best_share_var.value, 0, self.chain.net, {}, set(), 0, 0, 10,
+            known_txs_var=self.n.known_txs_var, mining_txs_var=self.n.mining_txs_var)
+        self.wb = FakeWorkerBridge(self.n)
+        web.watch_node_metrics(self.n, self.wb)
+
+        self.port = reactor.listenTCP(0, server.Site(web.MetricsResource()), interface='127.0.0.1')
+
+    def tearDown(self):
+        return self.port.stopListening()
+
+    @defer.inlineCallbacks
+    def scrape(self):
+        res = yield client.getPage('http://127.0.0.1:%i/' % (self.port.getHost().port,))
+        defer.returnValue(parse_openmetrics(res))
+
+    @defer.inlineCallbacks
+    def test_node_metrics(self):
+        samples = yield self.scrape()
+        self.assertEqual(samples['p2pool_tracker_shares{set="all"}'], 0)
+        self.assertEqual(samples['p2pool_known_txs'], 0)
+        shares_before = samples.get('p2pool_local_shares_total{state="good"}', 0)
+
+        for share in self.chain.shares[:20]:
+            self.n.tracker.add(share)
+        for share in self.chain.shares[:10]:
+            self.n.tracker.verified.add(share)
+        self.n.best_share_var.set(self.chain.shares[19].hash)
+        self.n.known_txs_var.add(self.chain.known_txs)
+        self.wb.share_received.happened(2**32, False, self.chain.shares[19].hash)
+        self.wb.pseudoshare_received.happened(2**20, True, 'user')
+
+        # scraping must only read values maintained by the events above
+        def no_chain_walk(*args, **kwargs):
+            raise AssertionError('chain walked during scrape')
+        self.n.tracker.get_chain = self.n.tracker.get_height = no_chain_walk
+
+        samples = yield self.scrape()
+        self.assertEqual(samples['p2pool_tracker_shares{set="all"}'], 20)
+        self.assertEqual(samples['p2pool_tracker_heads{set="all"}'], 1)
+        self.assertEqual(samples['p2pool_tracker_tails{set="all"}'], 1)
+        self.assertEqual(samples['p2pool_tracker_shares{set="verified"}'], 10)
+        self.assertEqual(samples['p2pool_best_share_height'], 20)
+        self.assertEqual(samples['p2pool_known_txs'], len(self.chain.known_txs))
+        self.assertEqual(samples['p2pool_local_shares_total{state="good"}'], shares_before + 1)
+        self.assertTrue(samples['p2pool_pseudoshare_work_total{state="dead"}'] >= 2**20)
+
+        self.n.known_txs_var.set({})
+        samples = yield self.scrape()
+        self.assertEqual(samples['p2pool_known_txs'], 0)
+
+    @defer.inlineCallbacks
+    def test_peer_metrics(self):
+        self.n.p2p_node.start()
+        other = p2p.Node(lambda: None, 0, self.chain.net, {}, set([('127.0.0.1', self.n.p2p_node.serverfactory.listen_port.getHost().port)]), 0, 0, 10)
+        samples = yield self.scrape()
+        peers_before = samples.get('p2pool_peers{direction="incoming"}', 0)
+        version_before = samples.get('p2pool_p2p_bytes_total{protocol="p2pool",direction="in",command="version"}', 0)
+
+        other.start()
+        try:
+            for i in xrange(50):
+                if self.n.p2p_node.peers:
+                    break
+                yield deferral.sleep(.1)
+            self.assertEqual(len(self.n.p2p_node.peers), 1)
+
+            samples = yield self.scrape()
+            self.assertEqual(samples['p2pool_peers{direction="incoming"}'], peers_before + 1)
+            self.assertTrue(samples['p2pool_p2p_bytes_total{protocol="p2pool",direction="in",command="version"}'] > version_before)
+            self.assertTrue(samples['p2pool_p2p_messages_total{protocol="p2pool",direction="out",command="version"}'] >= 2)
+        finally:
+            yield other.stop()
+            yield self.n.p2p_node.stop()
+        for i in xrange(50):
+            if not self.n.p2p_node.peers:
+                break
+            yield deferral.sleep(.1)
+        samples = yield self.scrape()
+        self.assertEqual(samples['p2pool_peers{direction="incoming"}'], peers_before)
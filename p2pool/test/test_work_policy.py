@@ -0,0 +1,90 @@
+from __future__ import division
+
+from twisted.internet import task
+from twisted.trial import unittest
+
+from p2pool import work_policy
+from p2pool.util import variable
+
+def make_work(previous_block=1, fees=()):
+    return dict(version=0x20000000, previous_block=previous_block, bits=0x1d00ffff,
+        transactions=['tx%i' % (i,) for i in xrange(len(fees))], transaction_fees=list(fees))
+
+class Test(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.event = variable.Event()
+        self.pushed = []
+        self.event.watch(lambda: self.pushed.append(self.clock.seconds()))
+        self.policy = work_policy.TemplateUpdatePolicy(self.event, fee_threshold=10000, max_age=30,
+            get_block_rate=lambda: 1/600, clock=self.clock)
+        self.current = make_work(fees=[1000])
+        self.policy.set_work(self.current)
+
+    def step(self, work, dt=1):
+        self.clock.advance(dt)
+        before, self.current = self.current, work
+        self.policy.work_changed(before, work)
+
+    def test_script(self):
+        # (seconds since the previous step, template, pushed right away?)
+        script = [
+            (1, make_work(fees=[1000, 500]), False), # mempool churn is held
+            (1, make_work(fees=[1000, 500, 800]), False),
+            (1, make_work(fees=[1000, 500, 800, 20000]), True), # a high-fee tx is worth a notify
+            (5, make_work(fees=[1000, 500, 800, 20000, 300]), False),
+            (1, make_work(previous_block=2), True), # a new block always is
+            (1, make_work(previous_block=2, fees=[700]), True), # and so are its first transactions
+            (2, make_work(previous_block=2, fees=[700, 100]), False),
+        ]
+        for dt, work, immediate in script:
+            n = len(self.pushed)
+            self.step(work, dt)
+            assert (len(self.pushed) == n + 1) == immediate, (work, immediate)
+        assert self.policy.pushes == dict(fees=1, block=1, first_transactions=1)
+        assert self.policy.held == 4
+        assert self.policy.pending_work is self.current
+
+        # the held update goes out once the last push is max_age seconds old
+        self.clock.advance(27)
+        assert len(self.pushed) == 3
+        self.clock.advance(1)
+        assert self.pushed[-1] == 40
+        assert self.policy.pushes['max_age'] == 1
+        assert self.policy.pushed_work is self.current
+        assert self.policy.pending_work is None
+        # 1300 satoshis held for 2 seconds, 300 for 1 and 100 for 28
+        assert abs(self.policy.fees_given_up - (1300*2 + 300*1 + 100*28)/600) < 1e-9
+
+    def test_share_push_takes_pending(self):
+        self.step(make_work(fees=[1000, 500]))
+        assert self.pushed == []
+        self.clock.advance(4)
+        self.policy.push('share')
+        assert self.pushed == [5]
+        assert self.policy.pushed_work is self.current
+        assert abs(self.policy.fees_given_up - 500*4/600) < 1e-9
+        # nothing is held anymore, so the max_age timer is gone
+        self.clock.advance(60)
+        assert self.pushed == [5]
+        self.policy.push('merged')
+        assert self.policy.pushes == dict(share=1, merged=1)
+
+    def test_notifies_per_minute(self):
+        for i in xrange(10):
+            self.step(make_work(previous_block=i + 2), dt=10)
+        assert self.policy.notifies_per_minute() == 6
+        self.clock.advance(55)
+        assert self.policy.notifies_per_minute() == 1
+        stats = self.policy.get_stats()
+        assert stats['notifies_per_minute'] == 1
+        assert stats['pushes'] == dict(block=10)
+
+    def test_block_rate_error(self):
+        def get_block_rate():
+            raise ZeroDivisionError()
+        self.policy.get_block_rate = get_block_rate
+        self.step(make_work(fees=[1000, 500]))
+        self.policy.push('share')
+        assert len(self.pushed) == 1 and self.policy.pending_work is None
+        assert len(self.flushLoggedErrors(ZeroDivisionError)) == 1
@@ -0,0 +1,44 @@
+import random
+import unittest
+
+from p2pool.util import iblt
+
+class Test(unittest.TestCase):
+    def test_difference(self):
+        rng = random.Random(0)
+        common = [rng.getrandbits(64) for i in xrange(2000)]
+        decoded = 0
+        for trial in xrange(20):
+            a = set(rng.getrandbits(64) for i in xrange(rng.randrange(50)))
+            b = set(rng.getrandbits(64) for i in xrange(rng.randrange(50)))
+            cell_count = iblt.get_cell_count(0, minimum=int(1.5*(len(a) + len(b))) + 30)
+            table = iblt.IBLT.from_keys(cell_count, common + list(a))
+            other = iblt.IBLT.from_cells(iblt.IBLT.from_keys(cell_count, list(b) + common).get_cells())
+            result = table.subtract(other).decode()
+            if result is not None:
+                assert result == (a, b)
+                decoded += 1
+        assert decoded >= 17
+
+    def test_too_small(self):
+        rng = random.Random(1)
+        keys = [rng.getrandbits(64) for i in xrange(100)]
+        assert iblt.IBLT.from_keys(30, keys).subtract(iblt.IBLT(30)).decode() is None
+
+    def test_peeling_cycle(self):
+        # one cell of a key at one of its indices: peeling it makes its other cells pure, and peeling those undoes it
+        key = 12345
+        table = iblt.IBLT(30)
+        index = table._get_indices(key)[0]
+        cells = table.get_cells()
+        cells[index] = dict(count=1, key_sum=key, check_sum=iblt.IBLT._get_check(key))
+        assert iblt.IBLT(30).subtract(iblt.IBLT.from_cells(cells)).decode() is None
+
+    def test_short_id(self):
+        assert iblt.short_id('a', 5) == iblt.short_id('a', 5) != iblt.short_id('b', 5)
+        assert 0 <= iblt.short_id('a', 5) < 2**64
+
+    def test_invalid_cells(self):
+        self.assertRaises(ValueError, iblt.IBLT.from_cells, [])
+        self.assertRaises(ValueError, iblt.IBLT.from_cells, iblt.IBLT(6).get_cells()[:5])
+        self.assertRaises(ValueError, iblt.IBLT(6).subtract, iblt.IBLT(9))
@@ -0,0 +1,111 @@
+from twisted.internet import defer, error as twisted_error, reactor
+from twisted.trial import unittest
+from twisted.web import resource, server
+
+from p2pool.util import deferral, jsonrpc
+
+class Provider(object):
+    def rpc_echo(self, request, x):
+        return x
+
+    def rpc_fail(self, request):
+        raise jsonrpc.Error_for_code(-5)(u'Block not found')
+
+    def rpc_slow(self, request, delay):
+        return deferral.sleep(delay).addCallback(lambda _: delay)
+
+class Site(server.Site):
+    '''Records every connection made to it'''
+    def __init__(self, *args, **kwargs):
+        server.Site.__init__(self, *args, **kwargs)
+        self.connections = []
+
+    def buildProtocol(self, addr):
+        p = server.Site.buildProtocol(self, addr)
+        self.connections.append(p)
+        return p
+
+class Test(unittest.TestCase):
+    def setUp(self):
+        root = resource.Resource()
+        root.putChild('', jsonrpc.HTTPServer(Provider()))
+        self.site = Site(root)
+        self.port = reactor.listenTCP(0, self.site, interface='127.0.0.1')
+        self.url = 'http://127.0.0.1:%i/' % (self.port.getHost().port,)
+        self.proxies = []
+
+    @defer.inlineCallbacks
+    def tearDown(self):
+        for proxy in self.proxies:
+            yield proxy.close()
+        for p in self.site.connections:
+            p._channel.transport.loseConnection()
+        yield self.port.stopListening()
+
+    def make_proxy(self, **kwargs):
+        proxy = jsonrpc.HTTPProxy(self.url, **kwargs)
+        self.proxies.append(proxy)
+        return proxy
+
+    @defer.inlineCallbacks
+    def test_keepalive(self):
+        proxy = self.make_proxy()
+        count_before = jsonrpc.request_seconds.get(('echo',))[0]
+        for i in xrange(20):
+            res = yield proxy.rpc_echo(i)
+            assert res == i
+        assert len(self.site.connections) == 1
+        assert jsonrpc.request_seconds.get(('echo',))[0] == count_before + 20
+
+        res = yield defer.gatherResults([proxy.rpc_echo(i) for i in xrange(3)])
+        assert res == range(3)
+        assert len(self.site.connections) == 3
+
+        try:
+            yield proxy.rpc_fail()
+        except jsonrpc.Error_for_code(-5):
+            pass
+        else:
+            assert False
+
+    @defer.inlineCallbacks
+    def test_no_pool(self):
+        proxy = self.make_proxy(pool_size=0)
+        for i in xrange(3):
+            yield proxy.rpc_echo(i)
+        assert len(self.site.connections) == 3
+
+    @defer.inlineCallbacks
+    def test_reconnect(self):
+        proxy = self.make_proxy()
+        yield proxy.rpc_echo(1)
+        # the server drops the idle connection without the client noticing in time
+        self.site.connections[0]._channel.transport.abortConnection()
+        res = yield proxy.rpc_echo(2)
+        assert res == 2
+        assert len(self.site.connections) == 2
+
+    @defer.inlineCallbacks
+    def test_timeout(self):
+        proxy = self.make_proxy(timeout=.1)
+        errors_before = jsonrpc.request_errors.get(('slow',))
+        try:
+            yield proxy.rpc_slow(1)
+        except defer.TimeoutError:
+            pass
+        else:
+            assert False
+        assert jsonrpc.request_errors.get(('slow',)) == errors_before + 1
+        yield deferral.sleep(1) # let the server's handler finish
+
+    @defer.inlineCallbacks
+    def test_connection_refused(self):
+        yield self.port.stopListening()
+        proxy = self.make_proxy()
+        try:
+            yield proxy.rpc_echo(1)
+        except twisted_error.ConnectionRefusedError:
+            pass
+        else:
+            assert False
+        self.port = reactor.listenTCP(0, self.site, interface='127.0.0.1')
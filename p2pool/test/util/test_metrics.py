@@ -0,0 +1,60 @@
+import unittest
+
+from p2pool.util import metrics
+
+class Test(unittest.TestCase):
+    def test_render(self):
+        registry = metrics.Registry()
+        c = registry.counter('test_bytes', 'Bytes\nseen', ['direction', 'command'])
+        g = registry.gauge('test_size', 'Size')
+        c.inc(10, ('in', 'a"b'))
+        c.inc(5, ('in', 'a"b'))
+        g.set(1.5)
+        assert registry.render() == '\n'.join([
+            '# TYPE test_bytes counter',
+            '# HELP test_bytes Bytes\\nseen',
+            'test_bytes_total{direction="in",command="a\\"b"} 15',
+            '# TYPE test_size gauge',
+            '# HELP test_size Size',
+            'test_size 1.5',
+            '# EOF',
+        ]) + '\n'
+
+    def test_registry(self):
+        registry = metrics.Registry()
+        g = registry.gauge('test_peers', 'Peers', ['direction'])
+        assert registry.gauge('test_peers', 'Peers', ['direction']) is g
+        self.assertRaises(ValueError, registry.counter, 'test_peers', 'Peers', ['direction'])
+        self.assertRaises(ValueError, registry.counter('test_count', 'Count').inc, -1)
+        g.inc(1, ('in',))
+        g.dec(3, ('in',))
+        assert g.get(('in',)) == -2
+
+    def test_histogram(self):
+        registry = metrics.Registry()
+        h = registry.histogram('test_seconds', 'Latency', ['method'], buckets=[1, .1])
+        for value in [.05, .1, .5, 3]:
+            h.observe(value, ('getblock',))
+        assert h.get(('getblock',)) == (4, 3.65)
+        assert registry.render() == '\n'.join([
+            '# TYPE test_seconds histogram',
+            '# HELP test_seconds Latency',
+            'test_seconds_bucket{method="getblock",le="0.1"} 2',
+            'test_seconds_bucket{method="getblock",le="1.0"} 3',
+            'test_seconds_bucket{method="getblock",le="+Inf"} 4',
+            'test_seconds_sum{method="getblock"} 3.65',
+            'test_seconds_count{method="getblock"} 4',
+            '# EOF',
+        ]) + '\n'
+
+    def test_reactor_lag(self):
+        registry = metrics.Registry()
+        monitor = metrics.ReactorLagMonitor(interval=1, window=3, registry=registry)
+        monitor._tick()
+        monitor._expected -= 3 # tick ran two seconds late
+        monitor._tick()
+        assert 2 <= monitor.last_gauge.get() < 3
+        assert monitor.max_gauge.get() == monitor.last_gauge.get()
+        for i in xrange(3):
+            monitor._tick()
+        assert monitor.max_gauge.get() < 1
@@ -0,0 +1,100 @@
+import hashlib
+import random
+import struct
+import unittest
+
+from twisted.internet import task
+
+from p2pool.test.bench.slow_peer import SlowLinkTransport
+from p2pool.util import p2protocol
+
+PREFIX = '\xfe\xed\xfa\xce\x12\x34\x56\x78'
+
+def frame(command, payload, prefix=PREFIX):
+    return prefix + struct.pack('<12sI', command, len(payload)) + hashlib.sha256(hashlib.sha256(payload).digest()).digest()[:4] + payload
+
+class Test(unittest.TestCase):
+    def test_split_anywhere(self):
+        rng = random.Random(0)
+        messages = [('cmd%i' % (i,), ''.join(chr(rng.randrange(256)) for j in xrange(rng.randrange(300)))) for i in xrange(50)]
+        # garbage, including part of the prefix, before and between frames
+        stream = 'junk' + PREFIX[:5] + ''.join(frame(command, payload) + PREFIX[:rng.randrange(len(PREFIX))] for command, payload in messages)
+        for trial in xrange(20):
+            decoder = p2protocol.FrameDecoder(PREFIX, 1000)
+            frames = []
+            pos = 0
+            while pos < len(stream):
+                n = rng.choice([1, 2, 7, 24, 100, 1000])
+                frames.extend(decoder.feed(stream[pos:pos + n]))
+                pos += n
+            assert [(command, payload) for command, length, checksum, payload in frames] == messages
+            assert all(length == len(payload) for command, length, checksum, payload in frames)
+            assert len(decoder.buf) < len(PREFIX)
+
+    def test_too_long(self):
+        decoder = p2protocol.FrameDecoder(PREFIX, 10)
+        frames = decoder.feed(frame('big', 'x'*11) + frame('small', 'y'*10))
+        # the oversized frame is reported, then its payload is scanned for the next prefix
+        assert [(command, payload) for command, length, checksum, payload in frames] == [('big', None), ('small', 'y'*10)]
+        assert frames[0][1] == 11
+        assert decoder.buf == bytearray()
+
+class SendQueueTest(unittest.TestCase):
+    def make_queue(self, rate=10000, bufferSize=1000, max_wait=5):
+        clock = task.Clock()
+        transport = SlowLinkTransport(clock, rate, bufferSize)
+        queue = p2protocol.SendQueue(transport, ['share', 'tx', 'addr'], max_wait, clock=clock)
+        transport.registerProducer(queue, True)
+        return transport, queue
+
+    def test_share_overtakes_flood(self):
+        transport, queue = self.make_queue()
+        for i in xrange(100):
+            queue.write('tx', 'T%03i' % (i,) + 'x'*496)
+        assert transport.written < 2000 and sum(len(q) for q in queue.queues) > 90
+        tx_queue = queue.queues[1]
+        queue.write('share', 'SHARE')
+        # with no barriers waiting, the lanes below aren't rescanned or rebuilt
+        assert queue.queues[1] is tx_queue
+        while transport.delivered < transport.written or any(queue.queues):
+            transport.drain(.01)
+        # behind at most the transport's buffer, not the 50 kB queued before it
+        assert transport.get_delivery_time('SHARE') <= .25
+        assert transport.value().index('SHARE') < 3000
+        assert [int(x[:3]) for x in transport.value().replace('SHARE', '').split('T')[1:]] == range(100)
+
+    def test_barriers_keep_order(self):
+        transport, queue = self.make_queue()
+        queue.write('tx', 'F'*2000)
+        queue.write('addr', 'addr1')
+        queue.write('tx', 'remember1', barrier=True)
+        queue.write('tx', 'have1')
+        queue.write('share', 'share1')
+        assert list(queue.queues[0])[0][2] == 'remember1'
+        assert queue.barriers == [1, 0, 0]
+        while any(queue.queues):
+            transport.drain(.01)
+        assert queue.barriers == [0, 0, 0]
+        value = transport.value()
+        assert value.index('remember1') < value.index('share1') < value.index('have1') < value.index('addr1')
+
+    def test_max_wait(self):
+        transport, queue = self.make_queue(rate=1000, max_wait=1)
+        queue.write('share', 'S'*2000)
+        queue.write('addr', 'addr1')
+        for i in xrange(20):
+            queue.write('share', 's'*100)
+        while 'addr1' not in transport.value()[:int(transport.delivered)]:
+            transport.drain(.01)
+            for i in xrange(3):
+                queue.write('share', 's'*100)
+        assert transport.clock.seconds() < 5
+
+    def test_stop(self):
+        transport, queue = self.make_queue()
+        queue.write('tx', 'F'*2000)
+        queue.write('tx', 'x')
+        assert queue.get_stats()['tx'] == dict(messages=1, bytes=1)
+        queue.stopProducing()
+        queue.write('share', 'y')
+        assert not any(queue.queues) and 'y' not in transport.value()
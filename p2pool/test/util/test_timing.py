@@ -0,0 +1,54 @@
+import unittest
+
+from p2pool.util import timing
+
+class Test(unittest.TestCase):
+    def test_disabled(self):
+        r = timing.Registry()
+        @r.timed('f')
+        def f(x):
+            return x + 1
+        assert f(1) == 2
+        with r.get_timer('g'):
+            pass
+        r.count('c')
+        assert r.get_stats()['timers'] == {}
+        assert r.get_stats()['counters'] == {}
+    
+    def test_enabled(self):
+        r = timing.Registry()
+        r.enabled = True
+        @r.timed('f')
+        def f(x):
+            if x is None:
+                raise ValueError()
+            return x + 1
+        for i in xrange(10):
+            assert f(i) == i + 1
+        self.assertRaises(ValueError, f, None)
+        timer = r.get_timer('g')
+        with timer:
+            with timer:
+                pass
+        r.count('c', 3)
+        stats = r.get_stats()
+        assert stats['timers']['f']['count'] == 11
+        assert stats['timers']['g']['count'] == 2
+        assert stats['counters'] == {'c': 3}
+        r.reset()
+        assert r.get_stats()['timers'] == {}
+    
+    def test_percentiles(self):
+        t = timing.Registry().get_timer('t')
+        assert t.percentile(50) is None
+        for i in xrange(90):
+            t.add(1e-3)
+        for i in xrange(10):
+            t.add(1.)
+        assert abs(t.percentile(50) - 1e-3) < 1e-9
+        assert abs(t.percentile(90) - 1e-3) < 1e-9
+        assert t.percentile(99) == 1.
+        assert t.percentile(100) == t.max == 1.
+        t.add(1e-9)
+        t.add(1e6)
+        assert t.buckets[0] == 1 and t.buckets[-1] == 1
@@ -0,0 +1,127 @@
+'''
+Generational store of known transactions.
+
+TxStore is the value of Node.known_txs_var: a dict of tx hash -> tx
+that also keeps an entry for every transaction with how many holders
+refer to it. Holders are the block template, the shares in the window
+of the best chain that blocks are built from (set_refs(key, tx_hashes)
+replaces what one of them refers to) and the peers that remembered
+transactions for their shares (ref() and unref()).
+
+Transactions no holder refers to are kept in the bucket of the
+generation they were added, or stopped being referred to, in. advance()
+starts a new generation and returns the transactions of the buckets
+that have grown too old, so forgetting them costs as much as there are
+to forget rather than a rebuild of the whole dict. Transactions arrive
+decoded, so it's their packed form that is only made when asked for.
+'''
+
+from __future__ import division
+
+from p2pool.dash import data as dash_data
+from p2pool.util import metrics
+
+evicted_counter = metrics.counter('p2pool_known_txs_evicted', 'Known transactions forgotten after no share, block template or peer referred to them for a while')
+
+class TxEntry(object):
+    __slots__ = ['hash', '_packed', 'refs', 'generation']
+
+    def __init__(self, tx_hash, generation):
+        self.hash = tx_hash
+        self._packed = None
+        self.refs = 0
+        self.generation = generation
+
+class TxStore(dict):
+    def __init__(self, txs={}, generations=2):
+        dict.__init__(self)
+        self.generations = generations # an unreferenced transaction is forgotten by the advance() this many after it was last referred to
+        self.generation = 0
+        self.entries = {} # tx hash -> TxEntry
+        self.buckets = {self.generation: set()} # generation -> hashes of unreferenced transactions that became so in it
+        self.holders = {} # key -> set of tx hashes it refers to
+        self.update(txs)
+
+    def __setitem__(self, tx_hash, tx):
+        self.update({tx_hash: tx})
+
+    def update(self, txs):
+        '''Adds the items of the dict txs that aren't known yet'''
+        bucket = self.buckets[self.generation]
+        for tx_hash in set(txs).difference(self.entries):
+            dict.__setitem__(self, tx_hash, txs[tx_hash])
+            self.entries[tx_hash] = TxEntry(tx_hash, self.generation)
+            bucket.add(tx_hash)
+
+    def __delitem__(self, tx_hash):
+        dict.__delitem__(self, tx_hash)
+        entry = self.entries.pop(tx_hash)
+        if entry.refs:
+            for tx_hashes in self.holders.itervalues():
+                tx_hashes.discard(tx_hash)
+        else:
+            self._discard(entry)
+
+    def get_packed(self, tx_hash):
+        entry = self.entries[tx_hash]
+        if entry._packed is None:
+            entry._packed = dash_data.tx_type.pack(self[tx_hash])
+        return entry._packed
+
+    def _discard(self, entry):
+        bucket = self.buckets[entry.generation]
+        bucket.discard(entry.hash)
+        if not bucket and entry.generation != self.generation:
+            del self.buckets[entry.generation]
+
+    def ref(self, tx_hashes):
+        '''Adds a reference to each of tx_hashes, which must be known'''
+        for tx_hash in tx_hashes:
+            entry = self.entries[tx_hash]
+            if not entry.refs:
+                self._discard(entry)
+            entry.refs += 1
+
+    def unref(self, tx_hashes):
+        for tx_hash in tx_hashes:
+            entry = self.entries.get(tx_hash)
+            if entry is None or not entry.refs:
+                continue
+            entry.refs -= 1
+            if not entry.refs:
+                entry.generation = self.generation
+                self.buckets[entry.generation].add(tx_hash)
+
+    def set_refs(self, key, tx_hashes):
+        '''Makes holder key refer to the known ones of tx_hashes and no others'''
+        old = self.holders.pop(key, set())
+        new = set(tx_hashes).intersection(self.entries)
+        if new:
+            self.holders[key] = new
+        self.ref(new - old)
+        self.unref(old - new)
+
+    def advance(self):
+        '''
+        Starts a new generation and returns the transactions (tx hash -> tx)
+        that have gone unreferenced too long, for the caller to remove
+        '''
+        self.generation += 1
+        self.buckets[self.generation] = set()
+        expired = {}
+        for generation in sorted(self.buckets):
+            if generation > self.generation - self.generations:
+                break
+            for tx_hash in self.buckets[generation]:
+                expired[tx_hash] = self[tx_hash]
+        evicted_counter.inc(len(expired))
+        return expired
+
+    def get_stats(self):
+        unreferenced = sum(len(bucket) for bucket in self.buckets.itervalues())
+        return dict(
+            txs=len(self),
+            referenced=len(self) - unreferenced,
+            unreferenced=unreferenced,
+            generation=self.generation,
+        )
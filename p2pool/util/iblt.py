@@ -0,0 +1,118 @@
+'''
+Invertible Bloom lookup tables of 64-bit keys, for reconciling two sets
+by exchanging a sketch the size of their difference rather than the sets.
+
+Each key is added to one cell in each of HASHES equal parts of the
+table; a cell holds the number of keys added to it, the XOR of those
+keys and the XOR of their checksums. Subtracting the table of one set
+from the table of another cancels the keys they share, and decode()
+peels the difference one pure cell (count +-1, matching checksum) at a
+time. Keys are expected to be random already, like short_id()s.
+'''
+
+from __future__ import division
+
+import hashlib
+import struct
+
+MASK64 = 2**64 - 1
+
+def mix(x):
+    '''splitmix64 finalizer'''
+    x &= MASK64
+    x = (x ^ (x >> 30))*0xbf58476d1ce4e5b9 & MASK64
+    x = (x ^ (x >> 27))*0x94d049bb133111eb & MASK64
+    return x ^ (x >> 31)
+
+def short_id(salt, tx_hash):
+    '''64-bit id of tx_hash under salt; peers agree on the salt so that ids can't be ground to collide in advance'''
+    return struct.unpack('<Q', hashlib.sha256(salt + '%064x' % (tx_hash,)).digest()[:8])[0]
+
+def get_cell_count(size, divergence=.05, minimum=24):
+    '''Cells for a sketch of a set of size keys expected to differ from the other set in about divergence*size keys'''
+    return max(minimum, int(1.5*divergence*size))
+
+class IBLT(object):
+    HASHES = 3
+    CELL_SIZE = 16 # packed bytes per cell, see p2p.Protocol.message_tx_sketch
+
+    def __init__(self, cell_count):
+        self.cell_count = cell_count - cell_count % self.HASHES or self.HASHES
+        self.counts = [0]*self.cell_count
+        self.key_sums = [0]*self.cell_count
+        self.check_sums = [0]*self.cell_count
+
+    @classmethod
+    def from_keys(cls, cell_count, keys):
+        self = cls(cell_count)
+        for key in keys:
+            self.add(key)
+        return self
+
+    @classmethod
+    def from_cells(cls, cells):
+        '''cells as returned by get_cells(); raises ValueError if their number is not a multiple of HASHES'''
+        if not cells or len(cells) % cls.HASHES:
+            raise ValueError('invalid number of cells')
+        self = cls(len(cells))
+        for i, cell in enumerate(cells):
+            self.counts[i], self.key_sums[i], self.check_sums[i] = cell['count'], cell['key_sum'], cell['check_sum']
+        return self
+
+    def get_cells(self):
+        return [dict(count=count, key_sum=key_sum, check_sum=check_sum)
+            for count, key_sum, check_sum in zip(self.counts, self.key_sums, self.check_sums)]
+
+    def _get_indices(self, key):
+        part = self.cell_count//self.HASHES
+        return [i*part + ((mix(key + i*0x9e3779b97f4a7c15) >> 32)*part >> 32) for i in xrange(self.HASHES)]
+
+    @staticmethod
+    def _get_check(key):
+        return mix(key ^ 0x5bd1e9955bd1e995) >> 32
+
+    def add(self, key, count=1):
+        check = self._get_check(key)
+        for i in self._get_indices(key):
+            self.counts[i] += count
+            self.key_sums[i] ^= key
+            self.check_sums[i] ^= check
+
+    def subtract(self, other):
+        '''Returns the table of this set minus other, which must have as many cells'''
+        if other.cell_count != self.cell_count:
+            raise ValueError('tables have different sizes')
+        res = IBLT(self.cell_count)
+        res.counts = [a - b for a, b in zip(self.counts, other.counts)]
+        res.key_sums = [a ^ b for a, b in zip(self.key_sums, other.key_sums)]
+        res.check_sums = [a ^ b for a, b in zip(self.check_sums, other.check_sums)]
+        return res
+
+    def decode(self):
+        '''
+        Returns (keys only in this set, keys only in the other set) of a
+        table made by subtract(), or None if the difference is too large
+        for the table. Consumes the table.
+        '''
+        mine, theirs = set(), set()
+        pending = range(self.cell_count)
+        while pending:
+            next_pending = []
+            for i in pending:
+                count = self.counts[i]
+                if count not in (1, -1):
+                    continue
+                key = self.key_sums[i]
+                if self.check_sums[i] != self._get_check(key):
+                    continue
+                if key in mine or key in theirs or len(mine) + len(theirs) >= self.cell_count:
+                    # a crafted table can have peeling undo itself forever
+                    return None
+                (mine if count == 1 else theirs).add(key)
+                indices = self._get_indices(key)
+                self.add(key, -count)
+                next_pending.extend(indices)
+            pending = next_pending
+        if any(self.counts) or any(self.key_sums) or any(self.check_sums):
+            return None
+        return mine, theirs
@@ -1,14 +1,16 @@
 from __future__ import division
 
 import json
+import time
 import weakref
 
-from twisted.internet import defer
+from twisted.internet import defer, reactor
 from twisted.protocols import basic
 from twisted.python import failure, log
-from twisted.web import client, error
+from twisted.web import client, error, http_headers, iweb
+from zope.interface import implements
 
-from p2pool.util import deferral, deferred_resource, memoize
+from p2pool.util import deferral, deferred_resource, memoize, metrics
 
 class Error(Exception):
     def __init__(self, code, message, data=None):
@@ -46,17 +48,28 @@ def Error_for_code(code):
 
 
 class Proxy(object):
-    def __init__(self, func, services=[]):
+    def __init__(self, func, services=[], batch_func=None):
         self._func = func
         self._services = services
+        self._batch_func = batch_func
     
     def __getattr__(self, attr):
         if attr.startswith('rpc_'):
             return lambda *params: self._func('.'.join(self._services + [attr[len('rpc_'):]]), params)
         elif attr.startswith('svc_'):
-            return Proxy(self._func, self._services + [attr[len('svc_'):]])
+            return Proxy(self._func, self._services + [attr[len('svc_'):]], self._batch_func)
         else:
             raise AttributeError('%r object has no attribute %r' % (self.__class__.__name__, attr))
+    
+    def batch(self, calls):
+        '''
+        Sends calls, a list of (method, params), as a single batch request.
+        Fires with a list holding, for each call, its result or the Error
+        instance it failed with.
+        '''
+        if self._batch_func is None:
+            raise TypeError('this proxy does not support batch requests')
+        return self._batch_func([('.'.join(self._services + [method]), list(params)) for method, params in calls])
 
 @defer.inlineCallbacks
 def _handle(data, provider, preargs=(), response_handler=None):
@@ -111,37 +124,158 @@ def _handle(data, provider, preargs=(), response_handler=None):
 
 # HTTP
 
-@defer.inlineCallbacks
-def _http_do(url, headers, timeout, method, params):
-    id_ = 0
-    
-    try:
-        data = yield client.getPage(
-            url=url,
-            method='POST',
-            headers=dict(headers, **{'Content-Type': 'application/json'}),
-            postdata=json.dumps({
-                'jsonrpc': '2.0',
-                'method': method,
-                'params': params,
-                'id': id_,
-            }),
-            timeout=timeout,
-        )
-    except error.Error, e:
+request_seconds = metrics.histogram('p2pool_jsonrpc_request_seconds', 'Latency of JSON-RPC requests made over HTTP, by method', ['method'])
+request_errors = metrics.counter('p2pool_jsonrpc_request_errors', 'JSON-RPC requests over HTTP that failed before returning a response, by method', ['method'])
+
+def _error_from_obj(obj):
+    return Error_for_code(obj['code'])(obj['message'], obj.get('data', None))
+
+class _StringProducer(object):
+    # writes the whole body at once instead of through FileBodyProducer's cooperator
+    implements(iweb.IBodyProducer)
+    
+    def __init__(self, data):
+        self.data = data
+        self.length = len(data)
+    
+    def startProducing(self, consumer):
+        consumer.write(self.data)
+        return defer.succeed(None)
+    
+    def pauseProducing(self):
+        pass
+    
+    def resumeProducing(self):
+        pass
+    
+    def stopProducing(self):
+        pass
+
+class HTTPClient(object):
+    '''
+    Sends JSON-RPC requests over HTTP/1.1 keep-alive connections.
+    
+    Up to pool_size idle connections are kept open for idle_timeout seconds,
+    which should be shorter than the server's own idle timeout (dashd's
+    -rpcservertimeout defaults to 30). pool_size=0 opens a new connection
+    for every request. A request that fails because a kept-alive connection
+    was closed under it is retried once on a fresh connection after dropping
+    the other idle ones; any other connection error is raised right away.
+    '''
+    
+    def __init__(self, url, headers={}, timeout=5, pool_size=4, idle_timeout=20):
+        self.url = url
+        self.timeout = timeout
+        self._headers = http_headers.Headers(dict((k, [v]) for k, v in dict(headers, **{'Content-Type': 'application/json'}).iteritems()))
+        self.pool = client.HTTPConnectionPool(reactor, persistent=pool_size > 0)
+        self.pool.maxPersistentPerHost = pool_size
+        self.pool.cachedConnectionTimeout = idle_timeout
+        self.pool.retryAutomatically = False # POSTs are retried by _post
+        self.agent = client.Agent(reactor, pool=self.pool)
+    
+    @defer.inlineCallbacks
+    def _post(self, data):
+        for attempt in xrange(2):
+            try:
+                response = yield self.agent.request('POST', self.url, self._headers, _StringProducer(data))
+                body = yield client.readBody(response)
+            except (client.ResponseNeverReceived, client.RequestTransmissionFailed), e:
+                if any(reason.check(defer.CancelledError) for reason in e.reasons):
+                    raise defer.CancelledError()
+                if attempt:
+                    raise
+                # the connection was most likely closed while idle, and so are the rest
+                yield self.pool.closeCachedConnections()
+                continue
+            defer.returnValue((response, body))
+    
+    @defer.inlineCallbacks
+    def _request(self, label, req):
+        start = time.time()
+        d = self._post(json.dumps(req))
+        timed_out = []
+        def on_timeout():
+            timed_out.append(True)
+            d.cancel()
+        timeout_call = reactor.callLater(self.timeout, on_timeout)
         try:
-            resp = json.loads(e.response)
+            response, body = yield d
         except:
-            raise e
-    else:
-        resp = json.loads(data)
+            request_errors.inc(1, (label,))
+            if timed_out:
+                raise defer.TimeoutError('Getting %s took longer than %s seconds.' % (self.url, self.timeout))
+            raise
+        finally:
+            if timeout_call.active():
+                timeout_call.cancel()
+        request_seconds.observe(time.time() - start, (label,))
+        
+        try:
+            resp = json.loads(body)
+        except ValueError:
+            if response.code != 200:
+                raise error.Error(str(response.code), response.phrase, body)
+            raise
+        defer.returnValue(resp)
+    
+    @defer.inlineCallbacks
+    def call(self, method, params):
+        id_ = 0
+        resp = yield self._request(method, {
+            'jsonrpc': '2.0',
+            'method': method,
+            'params': params,
+            'id': id_,
+        })
+        if resp['id'] != id_:
+            raise ValueError('invalid id')
+        if 'error' in resp and resp['error'] is not None:
+            raise _error_from_obj(resp['error'])
+        defer.returnValue(resp['result'])
+    
+    @defer.inlineCallbacks
+    def batch(self, calls):
+        if not calls:
+            defer.returnValue([])
+        
+        methods = set(method for method, params in calls)
+        resp = yield self._request('batch:' + methods.pop() if len(methods) == 1 else 'batch', [{
+            'jsonrpc': '2.0',
+            'method': method,
+            'params': params,
+            'id': id_,
+        } for id_, (method, params) in enumerate(calls)])
+        
+        if isinstance(resp, dict):
+            # the batch as a whole was rejected
+            if resp.get('error') is not None:
+                raise _error_from_obj(resp['error'])
+            raise ValueError('expected a batch response')
+        
+        results = {}
+        for item in resp:
+            id_ = item.get('id')
+            if not isinstance(id_, (int, long)) or not 0 <= id_ < len(calls) or id_ in results:
+                raise ValueError('invalid id')
+            if item.get('error') is not None:
+                results[id_] = _error_from_obj(item['error'])
+            else:
+                results[id_] = item['result']
+        if len(results) != len(calls):
+            raise ValueError('missing responses in batch')
+        defer.returnValue([results[id_] for id_ in xrange(len(calls))])
+    
+    def close(self):
+        return self.pool.closeCachedConnections()
+
+class HTTPProxy(Proxy):
+    def __init__(self, url, headers={}, timeout=5, pool_size=4, idle_timeout=20):
+        self._client = HTTPClient(url, headers, timeout, pool_size, idle_timeout)
+        Proxy.__init__(self, self._client.call, batch_func=self._client.batch)
     
-    if resp['id'] != id_:
-        raise ValueError('invalid id')
-    if 'error' in resp and resp['error'] is not None:
-        raise Error_for_code(resp['error']['code'])(resp['error']['message'], resp['error'].get('data', None))
-    defer.returnValue(resp['result'])
-HTTPProxy = lambda url, headers={}, timeout=5: Proxy(lambda method, params: _http_do(url, headers, timeout, method, params))
+    def close(self):
+        '''Closes the idle kept-alive connections'''
+        return self._client.close()
 
 class HTTPServer(deferred_resource.DeferredResource):
     def __init__(self, provider):
@@ -153,7 +287,7 @@ class HTTPServer(deferred_resource.DeferredResource):
         data = yield _handle(request.content.read(), self._provider, preargs=[request])
         assert data is not None
         request.setHeader('Content-Type', 'application/json')
-        request.setHeader('Content-Length', len(data))
+        request.setHeader('Content-Length', str(len(data)))
         request.write(data)
 
 class LineBasedPeer(basic.LineOnlyReceiver):
@@ -1,20 +1,24 @@
-import itertools
+import collections
 
 class LRUDict(object):
     def __init__(self, n):
         self.n = n
-        self.inner = {}
-        self.counter = itertools.count()
+        self.inner = collections.OrderedDict() # least recently used first
     def get(self, key, default=None):
         if key in self.inner:
-            x, value = self.inner[key]
-            self.inner[key] = self.counter.next(), value
+            value = self.inner.pop(key)
+            self.inner[key] = value
             return value
         return default
     def __setitem__(self, key, value):
-        self.inner[key] = self.counter.next(), value
+        self.inner.pop(key, None)
+        self.inner[key] = value
         while len(self.inner) > self.n:
-            self.inner.pop(min(self.inner, key=lambda k: self.inner[k][0]))
+            self.inner.popitem(last=False)
+    def __contains__(self, key):
+        return key in self.inner
+    def __len__(self):
+        return len(self.inner)
 
 _nothing = object()
 
@@ -0,0 +1,202 @@
+'''
+Pre-aggregated counters and gauges rendered as OpenMetrics text.
+
+    peers = metrics.gauge('p2pool_peers', 'Connected p2pool peers', ['direction'])
+    peers.inc(1, ('incoming',))
+
+    bytes = metrics.counter('p2pool_p2p_bytes', 'P2P traffic in bytes', ['direction'])
+    bytes.inc(len(data), ('in',))
+
+    latency = metrics.histogram('p2pool_rpc_seconds', 'RPC latency', ['method'])
+    latency.observe(end - start, ('getblocktemplate',))
+
+Values are updated where the event happens, so rendering only walks the
+stored samples. Rates (submits, shares, traffic) are exported as counters;
+the scraper derives them, e.g. rate(p2pool_stratum_submits_total[5m]).
+'''
+
+from __future__ import absolute_import, division
+
+import bisect
+import collections
+import math
+import time
+
+from p2pool.util import deferral
+
+CONTENT_TYPE = 'application/openmetrics-text; version=1.0.0; charset=utf-8'
+
+def _escape_label(value):
+    return str(value).replace('\\', r'\\').replace('\n', r'\n').replace('"', r'\"')
+
+def _escape_help(value):
+    return value.replace('\\', r'\\').replace('\n', r'\n')
+
+def _format_value(value):
+    if isinstance(value, (int, long)):
+        return '%i' % (value,)
+    if math.isnan(value):
+        return 'NaN'
+    if math.isinf(value):
+        return '+Inf' if value > 0 else '-Inf'
+    return repr(float(value))
+
+class Metric(object):
+    TYPE = None
+    SAMPLE_SUFFIX = ''
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.values = {} # label values tuple -> value
+
+    def get(self, labels=()):
+        return self.values.get(labels, 0)
+
+    def remove(self, labels=()):
+        self.values.pop(labels, None)
+
+    def _header(self):
+        return [
+            '# TYPE %s %s' % (self.name, self.TYPE),
+            '# HELP %s %s' % (self.name, _escape_help(self.help)),
+        ]
+
+    def _sample(self, suffix, labelnames, labels, value):
+        if labels:
+            label_str = '{%s}' % (','.join('%s="%s"' % (k, _escape_label(v)) for k, v in zip(labelnames, labels)),)
+        else:
+            label_str = ''
+        return '%s%s%s %s' % (self.name, suffix, label_str, _format_value(value))
+
+    def render(self):
+        lines = self._header()
+        for labels, value in sorted(self.values.iteritems()):
+            lines.append(self._sample(self.SAMPLE_SUFFIX, self.labelnames, labels, value))
+        return lines
+
+class Counter(Metric):
+    TYPE = 'counter'
+    SAMPLE_SUFFIX = '_total'
+
+    def inc(self, amount=1, labels=()):
+        if amount < 0:
+            raise ValueError('counters can only increase')
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+class Gauge(Metric):
+    TYPE = 'gauge'
+
+    def set(self, value, labels=()):
+        self.values[labels] = value
+
+    def inc(self, amount=1, labels=()):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def dec(self, amount=1, labels=()):
+        self.values[labels] = self.values.get(labels, 0) - amount
+
+DEFAULT_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+
+class Histogram(Metric):
+    TYPE = 'histogram'
+
+    def __init__(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        Metric.__init__(self, name, help, labelnames)
+        self.buckets = tuple(sorted(float(bound) for bound in buckets))
+        # self.values: label values tuple -> [per-bucket counts (last is +Inf), sum]
+
+    def observe(self, value, labels=()):
+        if labels not in self.values:
+            self.values[labels] = [[0]*(len(self.buckets) + 1), 0]
+        counts, total = self.values[labels]
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.values[labels][1] = total + value
+
+    def get(self, labels=()):
+        '''Returns (count, sum) of the observations'''
+        if labels not in self.values:
+            return 0, 0
+        counts, total = self.values[labels]
+        return sum(counts), total
+
+    def render(self):
+        lines = self._header()
+        bucket_labelnames = self.labelnames + ('le',)
+        for labels, (counts, total) in sorted(self.values.iteritems()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                lines.append(self._sample('_bucket', bucket_labelnames, labels + (_format_value(bound),), cumulative))
+            lines.append(self._sample('_sum', self.labelnames, labels, total))
+            lines.append(self._sample('_count', self.labelnames, labels, cumulative))
+        return lines
+
+class Registry(object):
+    def __init__(self):
+        self.metrics = {}
+
+    def _get(self, cls, name, help, labelnames, **kwargs):
+        if name in self.metrics:
+            metric = self.metrics[name]
+            if type(metric) is not cls or metric.labelnames != tuple(labelnames):
+                raise ValueError('metric %r already registered with a different type or labels' % (name,))
+            return metric
+        metric = self.metrics[name] = cls(name, help, labelnames, **kwargs)
+        return metric
+
+    def counter(self, name, help, labelnames=()):
+        return self._get(Counter, name, help, labelnames)
+
+    def gauge(self, name, help, labelnames=()):
+        return self._get(Gauge, name, help, labelnames)
+
+    def histogram(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._get(Histogram, name, help, labelnames, buckets=buckets)
+
+    def render(self):
+        lines = []
+        for name, metric in sorted(self.metrics.iteritems()):
+            lines.extend(metric.render())
+        lines.append('# EOF')
+        return '\n'.join(lines) + '\n'
+
+registry = Registry()
+counter = registry.counter
+gauge = registry.gauge
+histogram = registry.histogram
+
+class ReactorLagMonitor(object):
+    '''
+    Schedules a call every `interval` seconds and records how late it ran,
+    i.e. how long the reactor was blocked by other work.
+    '''
+
+    def __init__(self, interval=1, window=60, registry=registry):
+        self.interval = interval
+        self.samples = collections.deque(maxlen=max(1, int(window/interval)))
+        self.last_gauge = registry.gauge('p2pool_reactor_lag_seconds', 'Delay of the most recent reactor lag probe')
+        self.max_gauge = registry.gauge('p2pool_reactor_lag_max_seconds', 'Largest reactor lag probe delay over the last %i seconds' % (window,))
+        self._expected = None
+        self._stop = None
+
+    def _tick(self):
+        now = time.time()
+        if self._expected is not None:
+            lag = max(0, now - self._expected)
+            self.samples.append(lag)
+            self.last_gauge.set(lag)
+            self.max_gauge.set(max(self.samples))
+        self._expected = now + self.interval
+        return self.interval
+
+    def start(self):
+        assert self._stop is None
+        self._expected = None
+        self._stop = deferral.run_repeatedly(self._tick)
+
+    def stop(self):
+        if self._stop is not None:
+            self._stop()
+            self._stop = None
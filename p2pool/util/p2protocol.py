@@ -3,43 +3,204 @@
 Generic message-based protocol used by Bitcoin and P2Pool for P2P communication
 '''
 
+import collections
 import hashlib
+import itertools
 import struct
 
-from twisted.internet import protocol
+from twisted.internet import protocol, reactor
 from twisted.python import log
 
 import p2pool
-from p2pool.util import datachunker, variable
+from p2pool.util import metrics, variable
+
+traffic_bytes = metrics.counter('p2pool_p2p_bytes', 'P2P message bytes by protocol, direction and command', ['protocol', 'direction', 'command'])
+traffic_messages = metrics.counter('p2pool_p2p_messages', 'P2P messages by protocol, direction and command', ['protocol', 'direction', 'command'])
+send_queue_messages = metrics.gauge('p2pool_p2p_send_queue_messages', 'Outbound P2P messages waiting for the socket, by protocol and lane', ['protocol', 'lane'])
+send_queue_bytes = metrics.gauge('p2pool_p2p_send_queue_bytes', 'Outbound P2P bytes waiting for the socket, by protocol and lane', ['protocol', 'lane'])
+send_queue_wait = metrics.histogram('p2pool_p2p_send_queue_wait_seconds', 'Time outbound P2P messages waited for the socket, by protocol and lane', ['protocol', 'lane'])
 
 class TooLong(Exception):
     pass
 
+class FrameDecoder(object):
+    '''
+    Splits a byte stream into messages of the form
+    
+        prefix, command (12 bytes, NUL-padded), payload length (uint32 LE),
+        checksum (4 bytes), payload
+    
+    Received data is appended to one bytearray; the prefix is searched for
+    with find() and the header is read with a single unpack_from().
+    '''
+    
+    HEADER = struct.Struct('<12sI4s')
+    
+    def __init__(self, prefix, max_payload_length):
+        self.prefix = prefix
+        self.max_payload_length = max_payload_length
+        self.buf = bytearray()
+    
+    def feed(self, data):
+        '''
+        Returns the frames completed by data as (command, length, checksum,
+        payload) tuples. A frame whose length exceeds max_payload_length is
+        skipped with payload None; scanning resumes after its header.
+        '''
+        buf = self.buf
+        buf += data
+        prefix_len = len(self.prefix)
+        header_end = prefix_len + self.HEADER.size
+        frames = []
+        pos = 0
+        while True:
+            start = buf.find(self.prefix, pos)
+            if start == -1:
+                # keep what could be the beginning of a split prefix
+                pos = max(pos, len(buf) - prefix_len + 1)
+                break
+            pos = start
+            if len(buf) - pos < header_end:
+                break
+            command, length, checksum = self.HEADER.unpack_from(buf, pos + prefix_len)
+            command = command.rstrip('\0')
+            if length > self.max_payload_length:
+                frames.append((command, length, checksum, None))
+                pos += header_end
+                continue
+            end = pos + header_end + length
+            if len(buf) < end:
+                break
+            frames.append((command, length, checksum, str(buf[pos + header_end:end])))
+            pos = end
+        if pos:
+            del buf[:pos]
+        return frames
+
+class SendQueue(object):
+    '''
+    Outbound scheduler of one connection, registered with its transport as
+    a push producer. Messages are written straight through until the
+    transport's buffer passes its high-water mark and it pauses us; from
+    then on they wait in priority lanes (lanes[0] first) and are written
+    as it drains, so a message in a higher lane overtakes bulk traffic
+    queued in lower ones.
+    
+    Two rules keep that safe:
+    - barrier messages keep their order relative to everything written
+      after them in higher lanes: queueing a message moves the barriers
+      waiting in lower lanes ahead of it, into its lane.
+    - a lane whose oldest message has waited max_wait seconds is served
+      before higher lanes, so none is starved for long.
+    '''
+    
+    def __init__(self, transport, lanes, max_wait=5, metrics_label='p2p', clock=reactor):
+        self.transport = transport
+        self.lanes = lanes
+        self.max_wait = max_wait
+        self.metrics_label = metrics_label
+        self.clock = clock
+        self.queues = [collections.deque() for lane in lanes] # of (queued time, seq, data, is barrier)
+        self.barriers = [0 for lane in lanes] # barrier messages waiting in each lane, so lanes without any are skipped
+        self._seq = itertools.count()
+        self.paused = False
+        self.stopped = False
+    
+    def write(self, lane, data, barrier=False):
+        if self.stopped:
+            return
+        index = self.lanes.index(lane)
+        if not self.paused and not any(self.queues):
+            self.transport.write(data)
+            send_queue_wait.observe(0, (self.metrics_label, lane))
+            return
+        queue = self.queues[index]
+        barriers = []
+        for lower in xrange(index + 1, len(self.queues)):
+            if self.barriers[lower]:
+                barriers.extend((lower, entry) for entry in self.queues[lower] if entry[3])
+                self.queues[lower] = collections.deque(entry for entry in self.queues[lower] if not entry[3])
+                self.barriers[lower] = 0
+        for lower, entry in sorted(barriers, key=lambda barrier: barrier[1][1]):
+            self._count(lower, entry[2], -1)
+            queue.append(entry)
+            self._count(index, entry[2], 1)
+        self.barriers[index] += len(barriers) + bool(barrier)
+        queue.append((self.clock.seconds(), self._seq.next(), data, barrier))
+        self._count(index, data, 1)
+        self._flush()
+    
+    def _count(self, index, data, sign):
+        labels = self.metrics_label, self.lanes[index]
+        send_queue_messages.inc(sign, labels)
+        send_queue_bytes.inc(sign*len(data), labels)
+    
+    def _next_lane(self):
+        heads = [(queue[0][0], index) for index, queue in enumerate(self.queues) if queue]
+        if not heads:
+            return None
+        oldest_time, oldest = min(heads)
+        if self.clock.seconds() - oldest_time >= self.max_wait:
+            return oldest
+        return heads[0][1]
+    
+    def _flush(self):
+        while not self.paused and not self.stopped:
+            index = self._next_lane()
+            if index is None:
+                break
+            queued_time, seq, data, barrier = self.queues[index].popleft()
+            self.barriers[index] -= barrier
+            self._count(index, data, -1)
+            send_queue_wait.observe(self.clock.seconds() - queued_time, (self.metrics_label, self.lanes[index]))
+            self.transport.write(data) # may pause us
+    
+    def get_stats(self):
+        return dict((lane, dict(messages=len(queue), bytes=sum(len(entry[2]) for entry in queue)))
+            for lane, queue in zip(self.lanes, self.queues))
+    
+    # IPushProducer
+    
+    def pauseProducing(self):
+        self.paused = True
+    
+    def resumeProducing(self):
+        self.paused = False
+        self._flush()
+    
+    def stopProducing(self):
+        self.stopped = True
+        for index, queue in enumerate(self.queues):
+            for entry in queue:
+                self._count(index, entry[2], -1)
+            queue.clear()
+            self.barriers[index] = 0
+
 class Protocol(protocol.Protocol):
+    metrics_label = 'p2p' # protocol label of this class's traffic metrics
+    
+    # outbound scheduling, used once startSendQueue is called: lanes in
+    # priority order, the lane of each command (others go in the first
+    # lane) and the commands that are barriers (see SendQueue)
+    send_lanes = None
+    send_lane_commands = {}
+    send_barriers = set()
+    send_high_water = 2**14 # bytes buffered by the transport before it pauses the queue
+    send_queue = None
+    
     def __init__(self, message_prefix, max_payload_length, traffic_happened=variable.Event(), ignore_trailing_payload=False):
         self._message_prefix = message_prefix
         self._max_payload_length = max_payload_length
-        self.dataReceived2 = datachunker.DataChunker(self.dataReceiver())
+        self._decoder = FrameDecoder(message_prefix, max_payload_length)
         self.traffic_happened = traffic_happened
         self.ignore_trailing_payload = ignore_trailing_payload
     
     def dataReceived(self, data):
         self.traffic_happened.happened('p2p/in', len(data))
-        self.dataReceived2(data)
-    
-    def dataReceiver(self):
-        while True:
-            start = ''
-            while start != self._message_prefix:
-                start = (start + (yield 1))[-len(self._message_prefix):]
-            
-            command = (yield 12).rstrip('\0')
-            length, = struct.unpack('<I', (yield 4))
-            if length > self._max_payload_length:
+        for command, length, checksum, payload in self._decoder.feed(data):
+            if payload is None:
                 print 'length too large'
                 continue
-            checksum = yield 4
-            payload = yield length
             
             if hashlib.sha256(hashlib.sha256(payload).digest()).digest()[:4] != checksum:
                 print 'invalid hash for', self.transport.getPeer().host, repr(command), length, checksum.encode('hex')
@@ -49,6 +210,9 @@ class Protocol(protocol.Protocol):
                 continue
             
             type_ = getattr(self, 'message_' + command, None)
+            labels = self.metrics_label, 'in', command if type_ is not None else 'unknown'
+            traffic_bytes.inc(len(self._message_prefix) + 20 + length, labels)
+            traffic_messages.inc(1, labels)
             if type_ is None:
                 if p2pool.DEBUG:
                     print 'no type for', repr(command)
@@ -82,19 +246,43 @@ class Protocol(protocol.Protocol):
     def badPeerHappened(self):
         self.disconnect()
     
-    def sendPacket(self, command, payload2):
+    def encodePacket(self, command, payload2):
+        '''Returns the framed message; it can be sent to any peer of the same protocol with sendEncoded'''
         if len(command) >= 12:
             raise ValueError('command too long')
         type_ = getattr(self, 'message_' + command, None)
         if type_ is None:
             raise ValueError('invalid command')
         #print 'SEND', command, repr(payload2)[:500]
-        payload = type_.pack(payload2)
+        return self.framePayload(command, type_.pack(payload2))
+    
+    def framePayload(self, command, payload):
+        '''Frames an already packed payload'''
         if len(payload) > self._max_payload_length:
             raise TooLong('payload too long')
-        data = self._message_prefix + struct.pack('<12sI', command, len(payload)) + hashlib.sha256(hashlib.sha256(payload).digest()).digest()[:4] + payload
+        return self._message_prefix + struct.pack('<12sI', command, len(payload)) + hashlib.sha256(hashlib.sha256(payload).digest()).digest()[:4] + payload
+    
+    def sendPacket(self, command, payload2):
+        self.sendEncoded(command, self.encodePacket(command, payload2))
+    
+    def sendEncoded(self, command, data):
         self.traffic_happened.happened('p2p/out', len(data))
-        self.transport.write(data)
+        labels = self.metrics_label, 'out', command
+        traffic_bytes.inc(len(data), labels)
+        traffic_messages.inc(1, labels)
+        if self.send_queue is None:
+            self.transport.write(data)
+        else:
+            self.send_queue.write(self.send_lane_commands.get(command, self.send_lanes[0]), data, command in self.send_barriers)
+    
+    def startSendQueue(self, clock=reactor):
+        '''Schedules this connection's outbound messages with a SendQueue'''
+        if hasattr(self.transport, 'setTcpNoDelay'):
+            self.transport.setTcpNoDelay(True)
+        if hasattr(self.transport, 'bufferSize'):
+            self.transport.bufferSize = self.send_high_water
+        self.send_queue = SendQueue(self.transport, self.send_lanes, metrics_label=self.metrics_label, clock=clock)
+        self.transport.registerProducer(self.send_queue, True)
     
     def __getattr__(self, attr):
         prefix = 'send_'
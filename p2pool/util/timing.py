@@ -0,0 +1,143 @@
+'''
+Named hot-path timers with log-bucketed latency histograms.
+
+    think_timer = timing.get_timer('data.OkayTracker.think')
+    with think_timer:
+        ...
+
+    @timing.timed('work.get_work')
+    def get_work(...):
+        ...
+
+Timing is off until registry.enabled is set (main.py does this for --bench).
+While off, a timed call costs one attribute check on top of the call itself.
+'''
+
+from __future__ import absolute_import, division
+
+import functools
+import math
+import time
+
+BUCKETS_PER_DECADE = 10
+MIN_DURATION = 1e-6 # first bucket upper bound, seconds
+DECADES = 8 # 1 us .. 100 s; slower calls land in the last bucket
+NUM_BUCKETS = BUCKETS_PER_DECADE*DECADES + 1
+
+def bucket_upper_bound(i):
+    return MIN_DURATION*10**(i/BUCKETS_PER_DECADE)
+
+class Timer(object):
+    def __init__(self, registry, name):
+        self.registry = registry
+        self.name = name
+        self._starts = []
+        self.reset()
+
+    def reset(self):
+        self.count = 0
+        self.total = 0
+        self.max = 0
+        self.buckets = [0]*NUM_BUCKETS
+
+    def add(self, duration):
+        self.count += 1
+        self.total += duration
+        if duration > self.max:
+            self.max = duration
+        if duration <= MIN_DURATION:
+            i = 0
+        else:
+            i = min(NUM_BUCKETS - 1, int(math.ceil(math.log10(duration/MIN_DURATION)*BUCKETS_PER_DECADE - 1e-9)))
+        self.buckets[i] += 1
+
+    def __enter__(self):
+        if self.registry.enabled:
+            self._starts.append(time.time())
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if self._starts:
+            self.add(time.time() - self._starts.pop())
+
+    def percentile(self, p):
+        '''Upper bound of the bucket holding the p-th percentile (0 < p <= 100); None if empty.'''
+        if not self.count:
+            return None
+        rank = max(1, int(math.ceil(self.count*p/100)))
+        seen = 0
+        for i, n in enumerate(self.buckets):
+            seen += n
+            if seen >= rank:
+                return min(bucket_upper_bound(i), self.max)
+        return self.max
+
+    def get_stats(self, percentiles=(50, 90, 99, 99.9)):
+        return dict(
+            count=self.count,
+            total=self.total,
+            mean=self.total/self.count if self.count else None,
+            max=self.max if self.count else None,
+            percentiles=dict(('p%s' % (p,), self.percentile(p)) for p in percentiles),
+        )
+
+class Registry(object):
+    def __init__(self):
+        self.enabled = False
+        self.timers = {}
+        self.counters = {}
+        self.reset_time = time.time()
+
+    def get_timer(self, name):
+        if name not in self.timers:
+            self.timers[name] = Timer(self, name)
+        return self.timers[name]
+
+    def count(self, name, n=1):
+        if self.enabled:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def timed(self, name):
+        '''Decorator that records every call of the decorated function in timer `name`.'''
+        timer = self.get_timer(name)
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                if not self.enabled:
+                    return func(*args, **kwargs)
+                start = time.time()
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    timer.add(time.time() - start)
+            return wrapper
+        return decorator
+
+    def reset(self):
+        for timer in self.timers.itervalues():
+            timer.reset()
+        self.counters.clear()
+        self.reset_time = time.time()
+
+    def get_stats(self):
+        return dict(
+            enabled=self.enabled,
+            since=self.reset_time,
+            timers=dict((name, timer.get_stats()) for name, timer in self.timers.iteritems() if timer.count),
+            counters=dict(self.counters),
+        )
+
+    def format_summary(self):
+        lines = []
+        for name, timer in sorted(self.timers.iteritems()):
+            if not timer.count:
+                continue
+            lines.append('%-40s %8i calls  p50 %9.3f ms  p99 %9.3f ms  max %9.3f ms' % (
+                name, timer.count, timer.percentile(50)*1e3, timer.percentile(99)*1e3, timer.max*1e3))
+        for name, value in sorted(self.counters.iteritems()):
+            lines.append('%-40s %8i' % (name, value))
+        return '\n'.join(lines)
+
+registry = Registry()
+get_timer = registry.get_timer
+count = registry.count
+timed = registry.timed
@@ -3,20 +3,22 @@ from __future__ import division
 
 import base64
 import errno
+import hashlib
 import json
 import os
 import sys
 import time
 import traceback
+import zlib
 
 from twisted.internet import defer, reactor, task
 from twisted.python import log
-from twisted.web import resource, static
+from twisted.web import http, resource, static
 
 import p2pool
-from dash import data as bitcoin_data
-from . import data as p2pool_data, p2p
-from util import deferral, deferred_resource, graph, math, memory, pack, variable
+from dash import backends, block_status, data as bitcoin_data, rpc_cache, rpc_scheduler
+from . import data as p2pool_data, events, p2p
+from util import deferral, deferred_resource, graph, math, memory, metrics, pack, timing, variable
 from util import security_config
 
 
@@ -101,6 +103,32 @@ class WebRateLimiter(object):
 # Global rate limiter for web endpoints
 web_rate_limiter = WebRateLimiter(requests_per_minute=300, burst_limit=50)
 
+def check_request(request, rate_limit=True):
+    """
+    Applies the web interface's HTTP Basic Authentication (if enabled) and
+    per-IP rate limit to a request. Returns None if it may be served, or
+    else the body of the 401 or 429 response it has set up.
+    """
+    sec_config = security_config.security_config
+    if sec_config.get('web_auth_enabled', False):
+        username, password = sec_config.parse_basic_auth(request.getHeader('Authorization'))
+        if username is None or not sec_config.check_web_auth(username, password):
+            request.setResponseCode(401)
+            request.setHeader('WWW-Authenticate', 'Basic realm="P2Pool Web Interface"')
+            request.setHeader('Content-Type', 'application/json')
+            return json.dumps({'error': 'Authentication required'})
+    if rate_limit:
+        allowed, retry_after = web_rate_limiter.check_rate_limit(request.getClientIP())
+        if not allowed:
+            request.setResponseCode(429)
+            request.setHeader('Content-Type', 'application/json')
+            request.setHeader('Retry-After', str(retry_after))
+            return json.dumps({
+                'error': 'Rate limit exceeded',
+                'retry_after': retry_after,
+            })
+    return None
+
 
 def _atomic_read(filename):
     try:
@@ -131,7 +159,247 @@ def _atomic_write(filename, data):
         os.remove(filename)
         os.rename(filename + '.new', filename)
 
-def get_web_root(wb, datadir_path, bitcoind_getinfo_var, stop_event=variable.Event(), static_dir=None):
+
+# ==============================================================================
+# OPENMETRICS EXPOSITION
+# ==============================================================================
+
+def watch_node_metrics(node, wb):
+    """
+    Keep the node's /metrics gauges and counters current by watching its
+    events, so that a scrape only formats stored values and never walks the
+    share chain.
+    """
+    tracker_shares = metrics.gauge('p2pool_tracker_shares', 'Shares held by the tracker', ['set'])
+    tracker_heads = metrics.gauge('p2pool_tracker_heads', 'Chain heads in the tracker', ['set'])
+    tracker_tails = metrics.gauge('p2pool_tracker_tails', 'Chain tails in the tracker', ['set'])
+    for set_name, tracker in [('all', node.tracker), ('verified', node.tracker.verified)]:
+        def update_tracker(_=None, tracker=tracker, labels=(set_name,)):
+            tracker_shares.set(len(tracker.items), labels)
+            tracker_heads.set(len(tracker.heads), labels)
+            tracker_tails.set(len(tracker.tails), labels)
+        update_tracker()
+        tracker.added.watch(update_tracker)
+        tracker.removed.watch(update_tracker)
+
+    best_share_height = metrics.gauge('p2pool_best_share_height', 'Height of the best share in the tracker')
+    @node.best_share_var.changed.run_and_watch
+    def _(_=None):
+        best_share_height.set(node.tracker.get_height(node.best_share_var.value) if node.best_share_var.value is not None else 0)
+
+    known_txs = metrics.gauge('p2pool_known_txs', 'Transactions in known_txs')
+    update_known_txs = lambda _=None: known_txs.set(len(node.known_txs_var.value))
+    node.known_txs_var.added.watch(update_known_txs)
+    node.known_txs_var.removed.watch(update_known_txs)
+    node.known_txs_var.changed.run_and_watch(update_known_txs)
+    mining_txs = metrics.gauge('p2pool_mining_txs', 'Transactions in the current block template')
+    node.mining_txs_var.changed.run_and_watch(lambda _=None: mining_txs.set(len(node.mining_txs_var.value)))
+
+    local_shares = metrics.counter('p2pool_local_shares', 'Shares found by local miners', ['state'])
+    @wb.share_received.watch
+    def _(work, dead, share_hash):
+        local_shares.inc(1, ('dead' if dead else 'good',))
+    pseudoshares = metrics.counter('p2pool_pseudoshares', 'Pseudoshares submitted by local miners', ['state'])
+    pseudoshare_work = metrics.counter('p2pool_pseudoshare_work', 'Expected hashes represented by local pseudoshares', ['state'])
+    @wb.pseudoshare_received.watch
+    def _(work, dead, user):
+        labels = ('dead' if dead else 'good',)
+        pseudoshares.inc(1, labels)
+        pseudoshare_work.inc(work, labels)
+
+class MetricsResource(resource.Resource):
+    """Serves the metrics registry in OpenMetrics text format."""
+    isLeaf = True
+
+    def render_GET(self, request):
+        error = check_request(request)
+        if error is not None:
+            return error
+        request.setHeader('Content-Type', metrics.CONTENT_TYPE)
+        return metrics.registry.render()
+
+
+# ==============================================================================
+# STATS SNAPSHOTS
+# ==============================================================================
+
+class EncodedJSON(str):
+    """Already encoded JSON, which WebInterface sends without encoding again"""
+
+class StatsSnapshot(object):
+    """
+    One consistent set of computed stats. It is never modified once built;
+    StatsSnapshotCache replaces it as a whole.
+    """
+    def __init__(self, values, timestamp):
+        self.values = values
+        self.timestamp = timestamp
+        self._encoded = {}
+
+    def get_json(self, name):
+        """Encode a value once, no matter how many requests serve it"""
+        if name not in self._encoded:
+            self._encoded[name] = EncodedJSON(json.dumps(self.values[name]))
+        return self._encoded[name]
+
+class StatsSnapshotCache(object):
+    """
+    Serves chain-walking stats from a shared snapshot instead of computing
+    them per request. compute_func returns a dict of stats. It is called on
+    the first read after best_share_var changes, but at most once per
+    min_interval seconds, and also once the snapshot is max_age seconds old,
+    so time-based values (rates, uptime) stay fresh.
+    """
+    def __init__(self, compute_func, best_share_var, min_interval=2, max_age=10):
+        self.compute_func = compute_func
+        self.min_interval = min_interval
+        self.max_age = max_age
+        self.snapshot = None
+        self.dirty = True
+        self.recompute_count = 0
+        best_share_var.changed.watch(lambda _: self.invalidate())
+
+    def invalidate(self):
+        self.dirty = True
+
+    def get_snapshot(self):
+        now = time.time()
+        if self.snapshot is not None:
+            age = now - self.snapshot.timestamp
+            if age < self.min_interval or (not self.dirty and age < self.max_age):
+                return self.snapshot
+        try:
+            values = self.compute_func()
+        except:
+            if self.snapshot is None:
+                raise
+            log.err(None, 'Error computing stats snapshot, serving previous one:')
+            # retry after min_interval rather than on every request
+            self.snapshot = StatsSnapshot(self.snapshot.values, now)
+            return self.snapshot
+        self.snapshot = StatsSnapshot(values, now)
+        self.dirty = False
+        self.recompute_count += 1
+        return self.snapshot
+
+    def get(self, name):
+        return self.get_snapshot().values[name]
+
+    def get_json(self, name):
+        return self.get_snapshot().get_json(name)
+
+
+# ==============================================================================
+# PRECOMPRESSED RESPONSES
+# ==============================================================================
+
+def gzip_bytes(data, level=9):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+class PrecompressedBody(object):
+    """A response body with its gzipped form and an ETag, computed once"""
+    def __init__(self, body):
+        self.body = body
+        self.gzipped = gzip_bytes(body)
+        self.etag = hashlib.sha1(body).hexdigest()[:20]
+
+def render_precompressed(request, document, mime_type, cache_control='no-cache'):
+    """
+    Serves a PrecompressedBody, gzipped if the client accepts it. A client
+    that already has this version (If-None-Match) gets an empty 304.
+    """
+    use_gzip = 'gzip' in (request.getHeader('Accept-Encoding') or '')
+    request.setHeader('Content-Type', mime_type)
+    request.setHeader('Vary', 'Accept-Encoding')
+    request.setHeader('Cache-Control', cache_control)
+    if request.setETag('"%s%s"' % (document.etag, '-gzip' if use_gzip else '')) is http.CACHED:
+        return ''
+    if use_gzip:
+        request.setHeader('Content-Encoding', 'gzip')
+        return document.gzipped
+    return document.body
+
+class DashboardSnapshotCache(object):
+    """
+    Everything the dashboard shows, as one precompressed JSON document.
+    build_func returns the document's contents; it is only called again
+    once get_key() returns something different from the last build's key.
+    """
+    def __init__(self, build_func, get_key):
+        self.build_func = build_func
+        self.get_key = get_key
+        self.document = None
+        self.key = None
+        self.build_count = 0
+
+    def get_document(self):
+        key = self.get_key()
+        if self.document is not None and key == self.key:
+            return self.document
+        try:
+            value = self.build_func()
+        except:
+            if self.document is None:
+                raise
+            log.err(None, 'Error building dashboard snapshot, serving previous one:')
+            self.key = key # retry once the inputs change again
+            return self.document
+        self.document = PrecompressedBody(json.dumps(value, sort_keys=True))
+        self.key = key
+        self.build_count += 1
+        return self.document
+
+class DashboardSnapshotResource(resource.Resource):
+    """Serves a DashboardSnapshotCache, behind the same auth and rate limit as the JSON endpoints"""
+    isLeaf = True
+
+    def __init__(self, cache):
+        resource.Resource.__init__(self)
+        self.cache = cache
+
+    def render_GET(self, request):
+        error = check_request(request)
+        if error is not None:
+            return error
+        request.setHeader('Access-Control-Allow-Origin', '*')
+        return render_precompressed(request, self.cache.get_document(), 'application/json')
+
+class PrecompressedFile(static.File):
+    """
+    static.File that serves text assets from an in-memory gzipped copy,
+    rebuilt when the file changes, with an ETag and Cache-Control so
+    browsers revalidate with a 304 instead of downloading them again.
+    Everything else is served by static.File as usual.
+    """
+    COMPRESSIBLE_TYPES = set(['application/javascript', 'application/x-javascript', 'application/json', 'image/svg+xml'])
+    MAX_AGE = 300
+    _documents = {} # path -> ((mtime, size), PrecompressedBody)
+
+    def render_GET(self, request):
+        self.restat(False)
+        if self.type is None:
+            self.type, self.encoding = static.getTypeAndEncoding(self.basename(),
+                self.contentTypes, self.contentEncodings, self.defaultType)
+        if (not self.exists() or self.isdir() or self.encoding is not None or
+                not (self.type.startswith('text/') or self.type in self.COMPRESSIBLE_TYPES)):
+            return static.File.render_GET(self, request)
+
+        stat = self.getModificationTime(), self.getsize()
+        entry = self._documents.get(self.path)
+        if entry is None or entry[0] != stat:
+            try:
+                with open(self.path, 'rb') as f:
+                    entry = stat, PrecompressedBody(f.read())
+            except IOError:
+                return static.File.render_GET(self, request)
+            self._documents[self.path] = entry
+        if request.setLastModified(stat[0]) is http.CACHED:
+            return ''
+        return render_precompressed(request, entry[1], self.type, 'max-age=%i' % (self.MAX_AGE,))
+    render_HEAD = render_GET
+
+def get_web_root(wb, datadir_path, bitcoind_getinfo_var, stop_event=variable.Event(), static_dir=None, event_bus=None):
     node = wb.node
     start_time = time.time()
     
@@ -148,7 +416,7 @@ def get_web_root(wb, datadir_path, bitcoind_getinfo_var, stop_event=variable.Eve
         return res
     
     def get_current_scaled_txouts(scale, trunc=0):
-        txouts = node.get_current_txouts()
+        txouts = stats_cache.get('current_txouts')
         total = sum(txouts.itervalues())
         results = dict((addr, value*scale//total) for addr, value in txouts.iteritems())
         if trunc > 0:
@@ -273,6 +541,39 @@ def get_web_root(wb, datadir_path, bitcoind_getinfo_var, stop_event=variable.Eve
             fee=wb.worker_fee,
         )
     
+    def get_current_payouts(current_txouts):
+        current_payouts = {}
+        for script, value in current_txouts.iteritems():
+            address = bitcoin_data.script2_to_address(script, node.net.PARENT)
+            if address is not None:
+                current_payouts[address] = value/1e8
+        return current_payouts
+    
+    def get_global_stale_prop():
+        if node.tracker.get_height(node.best_share_var.value) < 10:
+            return None
+        return p2pool_data.get_average_stale_prop(node.tracker, node.best_share_var.value, decent_height())
+    
+    def compute_stats_snapshot():
+        # each value on its own, so one that can't be computed doesn't take the endpoints serving the others down
+        values = {}
+        def compute(name, func, default=None):
+            try:
+                values[name] = func()
+            except:
+                log.err(None, 'Error computing %s for stats snapshot:' % (name,))
+                values[name] = default
+        compute('users', get_users, {})
+        compute('global_stats', get_global_stats)
+        compute('local_stats', get_local_stats)
+        compute('current_txouts', node.get_current_txouts, {})
+        compute('current_payouts', lambda: get_current_payouts(values['current_txouts']), {})
+        compute('local_rates', wb.get_local_rates, ({}, {}))
+        compute('global_stale_prop', get_global_stale_prop)
+        return values
+    # Shared by the dashboard endpoints, so concurrent clients don't each walk the chain
+    stats_cache = StatsSnapshotCache(compute_stats_snapshot, node.best_share_var)
+    
     # Initialize security config with datadir
     sec_config = security_config.security_config
     sec_config.set_datadir(datadir_path)
@@ -287,59 +588,23 @@ def get_web_root(wb, datadir_path, bitcoind_getinfo_var, stop_event=variable.Eve
         def getChild(self, child, request):
             return WebInterface(self.func, self.mime_type, self.args + (child,), self.rate_limit, self.require_auth)
         
-        def _check_auth(self, request):
-            """Check HTTP Basic Authentication"""
-            if not sec_config.get('web_auth_enabled', False):
-                return True
-            
-            auth_header = request.getHeader('Authorization')
-            username, password = sec_config.parse_basic_auth(auth_header)
-            
-            if username is None:
-                return False
-            
-            return sec_config.check_web_auth(username, password)
-        
-        def _send_auth_required(self, request):
-            """Send 401 Unauthorized response"""
-            request.setResponseCode(401)
-            request.setHeader('WWW-Authenticate', 'Basic realm="P2Pool Web Interface"')
-            request.setHeader('Content-Type', 'application/json')
-            return json.dumps({'error': 'Authentication required'})
-        
         @defer.inlineCallbacks
         def render_GET(self, request):
-            # Check authentication if required or if globally enabled
-            if self.require_auth or sec_config.get('web_auth_enabled', False):
-                if not self._check_auth(request):
-                    defer.returnValue(self._send_auth_required(request))
-                    return
-            
-            # Apply rate limiting
-            if self.rate_limit:
-                client_ip = request.getClientIP()
-                allowed, retry_after = web_rate_limiter.check_rate_limit(client_ip)
-                if not allowed:
-                    request.setResponseCode(429)
-                    request.setHeader('Content-Type', 'application/json')
-                    request.setHeader('Retry-After', str(retry_after))
-                    defer.returnValue(json.dumps({
-                        'error': 'Rate limit exceeded',
-                        'retry_after': retry_after,
-                    }))
-                    return
+            error = check_request(request, self.rate_limit)
+            if error is not None:
+                defer.returnValue(error)
             
             request.setHeader('Content-Type', self.mime_type)
             request.setHeader('Access-Control-Allow-Origin', '*')
             res = yield self.func(*self.args)
-            defer.returnValue(json.dumps(res) if self.mime_type == 'application/json' else res)
+            defer.returnValue(json.dumps(res) if self.mime_type == 'application/json' and not isinstance(res, EncodedJSON) else res)
     
     # Protected static files wrapper for authentication
     class ProtectedFile(resource.Resource):
         """Wrapper for static.File that adds authentication"""
         def __init__(self, path):
             resource.Resource.__init__(self)
-            self.static_resource = static.File(path)
+            self.static_resource = PrecompressedFile(path)
         
         def _check_auth(self, request):
             """Check HTTP Basic Authentication"""
@@ -380,18 +645,15 @@ def get_web_root(wb, datadir_path, bitcoind_getinfo_var, stop_event=variable.Eve
         return min(node.tracker.get_height(node.best_share_var.value), 720)
     web_root.putChild('rate', WebInterface(lambda: p2pool_data.get_pool_attempts_per_second(node.tracker, node.best_share_var.value, decent_height())/(1-p2pool_data.get_average_stale_prop(node.tracker, node.best_share_var.value, decent_height()))))
     web_root.putChild('difficulty', WebInterface(lambda: bitcoin_data.target_to_difficulty(node.tracker.items[node.best_share_var.value].max_target)))
-    web_root.putChild('users', WebInterface(get_users))
+    web_root.putChild('users', WebInterface(lambda: stats_cache.get_json('users')))
     web_root.putChild('user_stales', WebInterface(lambda:
         p2pool_data.get_user_stale_props(node.tracker, node.best_share_var.value,
             node.tracker.get_height(node.best_share_var.value), node.net.PARENT)))
     web_root.putChild('fee', WebInterface(lambda: wb.worker_fee))
-    web_root.putChild('current_payouts', WebInterface(lambda: dict(
-        (bitcoin_data.script2_to_address(script, node.net.PARENT), value/1e8)
-        for script, value in node.get_current_txouts().iteritems()
-        if bitcoin_data.script2_to_address(script, node.net.PARENT) is not None)))
+    web_root.putChild('current_payouts', WebInterface(lambda: stats_cache.get_json('current_payouts')))
     web_root.putChild('patron_sendmany', WebInterface(get_patron_sendmany, 'text/plain'))
-    web_root.putChild('global_stats', WebInterface(get_global_stats))
-    web_root.putChild('local_stats', WebInterface(get_local_stats))
+    web_root.putChild('global_stats', WebInterface(lambda: stats_cache.get_json('global_stats')))
+    web_root.putChild('local_stats', WebInterface(lambda: stats_cache.get_json('local_stats')))
     
     # ==== NEW: Stratum statistics endpoint ====
     def get_stratum_stats():
@@ -436,7 +698,7 @@ def get_web_root(wb, datadir_path, bitcoind_getinfo_var, stop_event=variable.Eve
         if not address:
             return {'error': 'No address provided'}
         
-        miner_hash_rates, miner_dead_hash_rates = wb.get_local_rates()
+        miner_hash_rates, miner_dead_hash_rates = stats_cache.get('local_rates')
         
         # Extract base address and find all matching workers
         # Supported formats: address.worker, address_worker, address+diff, address/diff
@@ -466,7 +728,7 @@ def get_web_root(wb, datadir_path, bitcoind_getinfo_var, stop_event=variable.Eve
         try:
             # Use same parsing logic as stratum.py line 673
             payout_address = address.split('+')[0].split('/')[0].split('.')[0].split('_')[0]
-            current_txouts = node.get_current_txouts()
+            current_txouts = stats_cache.get('current_txouts')
             address_script = bitcoin_data.address_to_script2(payout_address, node.net.PARENT)
             current_payout = current_txouts.get(address_script, 0) / 1e8 if address_script else 0
         except (ValueError, KeyError, IndexError):
@@ -485,7 +747,7 @@ def get_web_root(wb, datadir_path, bitcoind_getinfo_var, stop_event=variable.Eve
         time_to_share = attempts_to_share / hashrate if hashrate > 0 else float('inf')
         
         # Get global stats for context
-        global_stale_prop = p2pool_data.get_average_stale_prop(node.tracker, node.best_share_var.value, min(node.tracker.get_height(node.best_share_var.value), 720))
+        global_stale_prop = stats_cache.get('global_stale_prop')
         
         return dict(
             address=address,
@@ -502,12 +764,10 @@ def get_web_root(wb, datadir_path, bitcoind_getinfo_var, stop_event=variable.Eve
     web_root.putChild('miner_stats', WebInterface(get_miner_stats))
     
     # ==== Individual miner payouts endpoint ====
-    @defer.inlineCallbacks
     def get_miner_payouts(address=None):
         """Get payout history for a specific miner address"""
         if not address:
-            defer.returnValue({'error': 'No address provided'})
-            return
+            return {'error': 'No address provided'}
         
         miner_blocks = []
         total_rewards = 0
@@ -517,35 +777,14 @@ def get_web_root(wb, datadir_path, bitcoind_getinfo_var, stop_event=variable.Eve
         # Find all blocks mined by this address
         for block_hash, block_data in block_history.items():
             if block_data.get('miner') == address:
-                status = yield get_block_status(block_hash)
+                status = get_block_status(block_hash)
                 
                 # Get block reward (may not be available yet)
                 block_reward = block_data.get('block_reward')
                 
-                # Retry fetching reward if it's missing/None/0 and block is confirmed
+                # A missing reward is fetched in the background by block_reconciler
                 if not block_reward and status == 'confirmed':
-                    try:
-                        # Use verbosity=2 to get full tx data without needing txindex
-                        block_info = yield wb.dashd.rpc_getblock(block_hash, 2)
-                        if block_info and 'tx' in block_info and len(block_info['tx']) > 0:
-                            # With verbosity=2, tx[0] is the full coinbase transaction object
-                            coinbase_tx = block_info['tx'][0]
-                            if isinstance(coinbase_tx, dict) and 'vout' in coinbase_tx:
-                                block_reward = sum(vout['value'] for vout in coinbase_tx['vout'])
-                                block_data['block_reward'] = block_reward
-                                save_block_history()
-                            else:
-                                # Fallback: try getrawtransaction (requires txindex)
-                                coinbase_txid = coinbase_tx if isinstance(coinbase_tx, str) else coinbase_tx.get('txid', '')
-                                if coinbase_txid:
-                                    tx_info = yield wb.dashd.rpc_getrawtransaction(coinbase_txid, 1)
-                                    if tx_info and 'vout' in tx_info:
-                                        block_reward = sum(vout['value'] for vout in tx_info['vout'])
-                                        block_data['block_reward'] = block_reward
-                                        save_block_history()
-                    except Exception as e:
-                        print 'Error fetching block reward for %s: %s' % (block_hash[:16], str(e))
-                        block_reward = 0  # Set to 0 on error
+                    block_reward = block_reconciler.get_reward(block_hash)
                 
                 # Ensure block_reward is a number (not None)
                 if block_reward is None:
@@ -553,7 +792,7 @@ def get_web_root(wb, datadir_path, bitcoind_getinfo_var, stop_event=variable.Eve
                 
                 # Calculate miner's share of the reward
                 # The miner gets their proportional share based on their shares in the window
-                current_txouts = node.get_current_txouts()
+                current_txouts = stats_cache.get('current_txouts')
                 address_script = bitcoin_data.address_to_script2(address, node.net.PARENT)
                 
                 # Calculate actual payout using PPLNS formula
@@ -629,14 +868,14 @@ def get_web_root(wb, datadir_path, bitcoind_getinfo_var, stop_event=variable.Eve
         # Sort by timestamp descending
         miner_blocks.sort(key=lambda x: x['timestamp'], reverse=True)
         
-        defer.returnValue({
+        return {
             'address': address,
             'blocks_found': len(miner_blocks),
             'total_estimated_rewards': total_rewards,
             'confirmed_rewards': confirmed_rewards,
             'maturing_rewards': pending_rewards,  # Rewards in coinbase maturity period
             'blocks': miner_blocks[:50],  # Limit to 50 most recent
-        })
+        }
     
     web_root.putChild('miner_payouts', WebInterface(get_miner_payouts))
     
@@ -669,6 +908,21 @@ def get_web_root(wb, datadir_path, bitcoind_getinfo_var, stop_event=variable.Eve
     
     web_root.putChild('web_rate_stats', WebInterface(get_web_rate_stats, rate_limit=False))
     
+    # Hot path latency percentiles (populated when started with --bench)
+    web_root.putChild('timings', WebInterface(timing.registry.get_stats))
+    
+    # Hit rates of the immutable dashd query cache, per endpoint
+    web_root.putChild('rpc_cache_stats', WebInterface(lambda: wb.dashd.cache.get_stats() if isinstance(wb.dashd, rpc_cache.CachingProxy) else None))
+    web_root.putChild('work_updates', WebInterface(lambda: wb.work_policy.get_stats()))
+    web_root.putChild('dashd_backends', WebInterface(lambda: backends.find(wb.dashd).get_stats() if backends.find(wb.dashd) is not None else None))
+    
+    # OpenMetrics exposition of event-maintained counters and gauges
+    watch_node_metrics(node, wb)
+    lag_monitor = metrics.ReactorLagMonitor()
+    lag_monitor.start()
+    stop_event.watch(lag_monitor.stop)
+    web_root.putChild('metrics', MetricsResource())
+    
     web_root.putChild('peer_addresses', WebInterface(lambda: ' '.join('%s%s' % (peer.transport.getPeer().host, ':'+str(peer.transport.getPeer().port) if peer.transport.getPeer().port != node.net.P2P_PORT else '') for peer in node.p2p_node.peers.itervalues())))
     web_root.putChild('peer_txpool_sizes', WebInterface(lambda: dict(('%s:%i' % (peer.transport.getPeer().host, peer.transport.getPeer().port), peer.remembered_txs_size) for peer in node.p2p_node.peers.itervalues())))
     web_root.putChild('pings', WebInterface(defer.inlineCallbacks(lambda: defer.returnValue(
@@ -762,6 +1016,24 @@ def get_web_root(wb, datadir_path, bitcoind_getinfo_var, stop_event=variable.Eve
         except Exception as e:
             log.err(e, 'Error saving block history:')
     
+    # dashd calls made for the dashboard queue behind block submission, templates and lookups
+    if isinstance(wb.dashd, (rpc_scheduler.RPCScheduler, rpc_cache.CachingProxy)):
+        stop_event.watch(lambda: wb.dashd.cancel('stats'))
+    
+    # Found blocks' status and coinbase value are refreshed from dashd in the
+    # background with batched RPC; endpoints only read block_reconciler's cache
+    block_reconciler = block_status.BlockStatusReconciler(rpc_cache.view(wb.dashd, 'block_status', 'stats'), os.path.join(datadir_path, 'block_status_cache.json'))
+    for block_hash in block_history:
+        block_reconciler.track(block_hash)
+    def got_block_reward(block_hash, reward):
+        if block_hash in block_history and not block_history[block_hash].get('block_reward'):
+            block_history[block_hash]['block_reward'] = reward
+            save_block_history()
+            print 'Updated block %s reward: %.8f DASH' % (block_hash[:16], reward)
+    block_reconciler.reward_found.watch(got_block_reward)
+    block_reconciler.start()
+    stop_event.watch(block_reconciler.stop)
+    
     def backfill_block_history_from_sharechain():
         """Populate block_history from current sharechain blocks if not already recorded."""
         if not node.best_share_var.value:
@@ -846,25 +1118,6 @@ def get_web_root(wb, datadir_path, bitcoind_getinfo_var, stop_event=variable.Eve
         except Exception as e:
             log.err(e, 'Error calculating hashrate for block record:')
         
-        # Try to get block reward from dashd (async, will update later if not available now)
-        @defer.inlineCallbacks
-        def fetch_block_reward():
-            try:
-                block_info = yield wb.dashd.rpc_getblock(block_hash)
-                if block_info and 'tx' in block_info and len(block_info['tx']) > 0:
-                    # Get coinbase transaction
-                    coinbase_txid = block_info['tx'][0]
-                    tx_info = yield wb.dashd.rpc_getrawtransaction(coinbase_txid, 1)
-                    if tx_info and 'vout' in tx_info:
-                        # Sum all outputs (block reward + fees)
-                        reward = sum(vout['value'] for vout in tx_info['vout'])
-                        block_history[block_hash]['block_reward'] = reward
-                        save_block_history()
-                        print 'Updated block %s reward: %.8f DASH' % (block_hash[:16], reward)
-            except Exception as e:
-                print 'Error fetching block reward for block %s: %s' % (block_hash[:16], str(e))
-                log.err(e, 'Error fetching block reward for block %s:' % block_hash[:16])
-        
         block_history[block_hash] = {
             'ts': ts,
             'block_height': block_height,
@@ -885,8 +1138,8 @@ def get_web_root(wb, datadir_path, bitcoind_getinfo_var, stop_event=variable.Eve
         # Save to disk
         save_block_history()
         
-        # Fetch reward asynchronously (start the deferred chain)
-        fetch_block_reward().addErrback(lambda f: log.err(f, 'Error in fetch_block_reward:'))
+        # Status and reward are filled in by block_reconciler
+        block_reconciler.track(block_hash, want_reward=True)
     
     def get_block_history_data(block_hash):
         """Get historical data for a block if available."""
@@ -1049,6 +1302,8 @@ def get_web_root(wb, datadir_path, bitcoind_getinfo_var, stop_event=variable.Eve
     # Backfill on startup after sharechain is loaded
     reactor.callLater(30, backfill_net_diff_from_sharechain)
     
+    backfill_dashd = rpc_cache.view(wb.dashd, 'net_diff_backfill', 'stats')
+    
     @defer.inlineCallbacks
     def backfill_net_diff_from_dashd():
         """Backfill network difficulty from dashd RPC for periods before sharechain coverage.
@@ -1128,8 +1383,8 @@ def get_web_root(wb, datadir_path, bitcoind_getinfo_var, stop_event=variable.Eve
             fetched = 0
             for h in range(start_height, end_height):
                 try:
-                    block_hash = yield wb.dashd.rpc_getblockhash(h)
-                    header = yield wb.dashd.rpc_getblockheader(block_hash)
+                    block_hash = yield backfill_dashd.rpc_getblockhash(h)
+                    header = yield backfill_dashd.rpc_getblockheader(block_hash)
                     
                     if header and 'time' in header and 'difficulty' in header:
                         block_ts = header['time']
@@ -1588,78 +1843,10 @@ def get_web_root(wb, datadir_path, bitcoind_getinfo_var, stop_event=variable.Eve
             save_net_diff_samples()
     stop_event.watch(save_samples_on_shutdown)
     
-    # Cache for block status to avoid repeated RPC calls
-    block_status_cache = {}  # {block_hash: {'status': 'confirmed'|'orphaned'|'pending', 'checked': timestamp, 'confirmations': N}}
-    BLOCK_CACHE_TTL = 60  # 1 minute cache for pending status
-    BLOCK_ORPHAN_RECHECK_TTL = 300  # 5 minutes before re-checking orphaned blocks
-    BLOCK_CONFIRMED_CACHE_TTL = 600  # 10 minutes cache for confirmed (until block is old enough)
-    
-    @defer.inlineCallbacks
     def get_block_status(block_hash):
-        """Check if a block is confirmed, orphaned, or pending."""
-        # Validate block_hash is a string
-        # Silently return unknown for non-string hashes (expected from sharechain)
-        if not isinstance(block_hash, (str, unicode)):
-            #print 'Error: get_block_status called with non-string hash: %r (type: %s)' % (block_hash, type(block_hash).__name__)
-            defer.returnValue('unknown')
-        
-        now = time.time()
-        
-        # Check cache first
-        if block_hash in block_status_cache:
-            cached = block_status_cache[block_hash]
-            # Confirmed blocks with 100+ confirmations are cached longer
-            # But blocks with < 150 confirmations should be rechecked periodically
-            if cached['status'] == 'confirmed':
-                cached_confirmations = cached.get('confirmations', 999)
-                # If block had 150+ confirmations when cached, it's permanently confirmed
-                if cached_confirmations >= 150:
-                    defer.returnValue(cached['status'])
-                # Otherwise, recheck after TTL (might have been confirmed with old 6-conf logic)
-                elif now - cached['checked'] < BLOCK_CONFIRMED_CACHE_TTL:
-                    defer.returnValue(cached['status'])
-            # Orphaned blocks get rechecked periodically (in case of false positive)
-            elif cached['status'] == 'orphaned':
-                if now - cached['checked'] < BLOCK_ORPHAN_RECHECK_TTL:
-                    defer.returnValue(cached['status'])
-            # Pending blocks get rechecked frequently
-            elif now - cached['checked'] < BLOCK_CACHE_TTL:
-                defer.returnValue(cached['status'])
-        
-        try:
-            block_info = yield wb.dashd.rpc_getblock(block_hash)
-            confirmations = block_info.get('confirmations', 0)
-            chainlock = block_info.get('chainlock', False)
-            
-            # Dash coinbase maturity is 100 blocks (COINBASE_MATURITY)
-            # ChainLock provides instant finality but does NOT reduce maturity requirement
-            if confirmations >= 100:
-                status = 'confirmed'
-            elif confirmations >= 1:
-                status = 'pending'  # Maturing (waiting for 100 confirmations)
-            elif confirmations == 0:
-                status = 'pending'  # Just mined, in mempool or first confirmation
-            else:
-                status = 'orphaned'  # Negative confirmations = orphaned/replaced
-            
-            # Cache with confirmation count for smart TTL
-            block_status_cache[block_hash] = {
-                'status': status, 
-                'checked': now,
-                'confirmations': confirmations
-            }
-            defer.returnValue(status)
-        except Exception as e:
-            # RPC error - don't mark as orphaned, keep as pending or use cached status
-            if block_hash in block_status_cache:
-                # Keep existing status on RPC error
-                defer.returnValue(block_status_cache[block_hash]['status'])
-            else:
-                # New block with RPC error - mark as pending, not orphaned
-                block_status_cache[block_hash] = {'status': 'pending', 'checked': now}
-                defer.returnValue('pending')
+        """Check if a block is confirmed, orphaned, or pending (from block_reconciler's cache)."""
+        return block_reconciler.get_status(block_hash)
     
-    @defer.inlineCallbacks
     def get_recent_blocks(limit=None):
         """Get recent blocks from both persistent storage and sharechain.
         
@@ -1693,12 +1880,12 @@ def get_web_root(wb, datadir_path, bitcoind_getinfo_var, stop_event=variable.Eve
                 
                 # Recheck if pending, or if "confirmed" but might have < 100 confirmations
                 if old_status == 'pending':
-                    status = yield get_block_status(block_hash)
+                    status = get_block_status(block_hash)
                 elif old_status == 'confirmed' and block_height > 0 and current_height > 0:
                     confirmations = current_height - block_height
                     # Recheck if less than 100 confirmations (might be from old 6-conf logic)
                     if confirmations < 100:
-                        status = yield get_block_status(block_hash)
+                        status = get_block_status(block_hash)
                     else:
                         status = old_status  # Definitely confirmed with 100+
                 else:
@@ -1708,9 +1895,10 @@ def get_web_root(wb, datadir_path, bitcoind_getinfo_var, stop_event=variable.Eve
                 # Calculate Hash Diff for historical blocks if not present
                 actual_hash_difficulty = hist_data.get('actual_hash_difficulty')
                 if actual_hash_difficulty is None:
-                    # We need to fetch the actual block hash from blockchain
-                    # This will be done asynchronously later if needed
-                    actual_hash_difficulty = None
+                    hash_int = int(block_hash, 16)
+                    max_target = 0x00000000FFFF0000000000000000000000000000000000000000000000000000
+                    actual_hash_difficulty = float(max_target) / float(hash_int) if hash_int > 0 else 0
+                    hist_data['actual_hash_difficulty'] = actual_hash_difficulty
                 
                 blocks_dict[block_hash] = {
                     'ts': hist_data.get('ts', 0),
@@ -1725,7 +1913,6 @@ def get_web_root(wb, datadir_path, bitcoind_getinfo_var, stop_event=variable.Eve
                     'actual_hash_difficulty': actual_hash_difficulty,
                     'explorer_url': node.net.PARENT.BLOCK_EXPLORER_URL_PREFIX + block_hash,
                     'from_history': True,
-                    'needs_hash_fetch': actual_hash_difficulty is None,
                 }
                 
                 # Update persistent storage with latest status
@@ -1746,7 +1933,7 @@ def get_web_root(wb, datadir_path, bitcoind_getinfo_var, stop_event=variable.Eve
                                 block_number = 0
                             
                             # Check block status
-                            status = yield get_block_status(block_hash)
+                            status = get_block_status(block_hash)
                             
                             # Calculate actual hash difficulty (based on the hash value itself)
                             hash_int = int(block_hash, 16)
@@ -1794,28 +1981,6 @@ def get_web_root(wb, datadir_path, bitcoind_getinfo_var, stop_event=variable.Eve
         if limit:
             blocks = blocks[:limit]
         
-        # Fetch Hash Diff for historical blocks that need it
-        for block in blocks:
-            if block.get('needs_hash_fetch') and block.get('number'):
-                try:
-                    # Get block hash from blockchain by height
-                    block_hash_from_chain = yield wb.dashd.rpc_getblockhash(block['number'])
-                    if block_hash_from_chain:
-                        # Calculate Hash Diff from the actual block hash
-                        hash_int = int(block_hash_from_chain, 16)
-                        max_target = 0x00000000FFFF0000000000000000000000000000000000000000000000000000
-                        actual_hash_difficulty = float(max_target) / float(hash_int) if hash_int > 0 else 0
-                        block['actual_hash_difficulty'] = actual_hash_difficulty
-                        # Update persistent storage with Hash Diff
-                        if block['hash'] in block_history:
-                            block_history[block['hash']]['actual_hash_difficulty'] = actual_hash_difficulty
-                except Exception as e:
-                    # Silently skip if we can't fetch - Hash Diff will remain None
-                    pass
-                
-                # Remove the internal flag
-                block.pop('needs_hash_fetch', None)
-        
         # Calculate luck for each block using AVERAGE hashrate between blocks
         # Luck = expected_time / actual_time * 100%
         # For accurate luck: use average of (prev_block_hashrate + current_block_hashrate) / 2
@@ -2002,30 +2167,29 @@ def get_web_root(wb, datadir_path, bitcoind_getinfo_var, stop_event=variable.Eve
                     else:
                         blocks[0]['luck_note'] = "Luck is approximate (uses current pool hashrate)"
         
-        defer.returnValue(blocks)
+        return blocks
     
-    @defer.inlineCallbacks
     def get_luck_stats():
         """Get pool luck statistics based on blocks found."""
-        blocks = yield get_recent_blocks()
+        blocks = get_recent_blocks()
         
         if not blocks:
-            defer.returnValue(dict(
+            return dict(
                 blocks_found=0,
                 luck_available=False,
                 message="No blocks found yet"
-            ))
+            )
         
         # Calculate luck statistics
         valid_blocks = [b for b in blocks if b.get('luck') is not None]
         
         if len(valid_blocks) < 1:
             # Only one block or no luck calculated, can't show stats
-            defer.returnValue(dict(
+            return dict(
                 blocks_found=len(blocks),
                 luck_available=False,
                 message="Need at least 2 blocks to calculate luck"
-            ))
+            )
         
         luck_values = [b['luck'] for b in valid_blocks]
         times_to_find = [b['time_to_find'] for b in valid_blocks if b.get('time_to_find') and b.get('time_to_find') > 0]
@@ -2121,7 +2285,7 @@ def get_web_root(wb, datadir_path, bitcoind_getinfo_var, stop_event=variable.Eve
             # No found blocks yet, use current round luck
             avg_luck = current_luck_trend
         
-        defer.returnValue(dict(
+        return dict(
             blocks_found=len(blocks),
             blocks_with_luck=len(valid_blocks),
             luck_available=True,
@@ -2155,7 +2319,7 @@ def get_web_root(wb, datadir_path, bitcoind_getinfo_var, stop_event=variable.Eve
                 expected_time=b.get('expected_time'),
                 status=b.get('status'),
             ) for b in sorted(blocks, key=lambda x: x['ts'], reverse=True)]
-        ))
+        )
     
     web_root.putChild('recent_blocks', WebInterface(lambda: get_recent_blocks(limit=10)))
     web_root.putChild('luck_stats', WebInterface(get_luck_stats))
@@ -2441,6 +2605,31 @@ def get_web_root(wb, datadir_path, bitcoind_getinfo_var, stop_event=variable.Eve
     from dash import helper
     web_root.putChild('broadcaster_status', WebInterface(lambda: helper.get_broadcaster_status(), require_auth=False))
     
+    # Everything the dashboard polls, in one document. The stats snapshot is
+    # replaced on new best shares and at least every max_age seconds when
+    # read, so the time-based panels (luck, uptimes) are at most that stale.
+    def build_dashboard_snapshot():
+        stats = stats_cache.get_snapshot()
+        return dict(
+            local_stats=stats.values['local_stats'],
+            global_stats=stats.values['global_stats'],
+            users=stats.values['users'],
+            current_payouts=stats.values['current_payouts'],
+            payout_addrs=[bitcoin_data.pubkey_hash_to_address(pubkey_hash, node.net.PARENT) for pubkey_hash in wb.pubkeys.keys],
+            recent_blocks=get_recent_blocks(limit=10),
+            luck_stats=get_luck_stats(),
+            peer_list=get_peer_list(),
+            broadcaster_status=helper.get_broadcaster_status(),
+            timestamp=stats.timestamp,
+        )
+    dashboard_cache = DashboardSnapshotCache(build_dashboard_snapshot, lambda: (
+        stats_cache.get_snapshot(), len(block_history), sorted(node.p2p_node.peers)))
+    web_root.putChild('dashboard_snapshot', DashboardSnapshotResource(dashboard_cache))
+    
+    if event_bus is not None:
+        web_root.putChild('events', events.EventStreamResource(event_bus))
+        web_root.putChild('event_stats', WebInterface(event_bus.get_stats))
+    
     def get_last_block_info():
         """Get info about the last found block for luck calculation."""
         if not block_history:
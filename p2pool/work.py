@@ -12,11 +12,13 @@ from twisted.python import log
 
 import dash.getwork as dash_getwork, dash.data as dash_data
 from dash import helper, script, worker_interface
-from util import forest, jsonrpc, variable, deferral, math, pack
-import p2pool, p2pool.data as p2pool_data
+from util import forest, jsonrpc, variable, deferral, math, pack, timing
+import p2pool, p2pool.data as p2pool_data, p2pool.work_policy as work_policy
 
 print_throttle = 0.0
 
+got_response_timer = timing.registry.get_timer('work.got_response') # got_response is made on every get_work, so it times its body instead of being decorated
+
 class WorkerBridge(worker_interface.WorkerBridge):
     COINBASE_NONCE_LENGTH = 8
 
@@ -135,16 +137,28 @@ class WorkerBridge(worker_interface.WorkerBridge):
         compute_work()
 
         self.new_work_event = variable.Event()
-        @self.current_work.transitioned.watch
-        def _(before, after):
-            # trigger LP if version/previous_block/bits changed or transactions changed from nothing
-            if any(before[x] != after[x] for x in ['version', 'previous_block', 'bits']) or (not before['transactions'] and after['transactions']):
-                self.new_work_event.happened()
-        self.merged_work.changed.watch(lambda _: self.new_work_event.happened())
-        self.node.best_share_var.changed.watch(lambda _: self.new_work_event.happened())
+        def get_block_rate():
+            # expected blocks per second found by the pool
+            best_share_hash = self.node.best_share_var.value
+            height = self.node.tracker.get_height(best_share_hash) if best_share_hash is not None else 0
+            if height < 3:
+                return 0
+            attempts_per_second = p2pool_data.get_pool_attempts_per_second(self.node.tracker, best_share_hash, min(height - 1, 720))
+            return attempts_per_second/dash_data.target_to_average_attempts(self.current_work.value['bits'].target)
+        # new blocks and best shares trigger LP at once, mempool-only template changes when worth it
+        self.work_policy = work_policy.TemplateUpdatePolicy(self.new_work_event,
+            fee_threshold=int(args.work_update_fee_threshold*1e8),
+            max_age=args.work_update_max_age,
+            get_block_rate=get_block_rate,
+        )
+        self.work_policy.set_work(self.current_work.value)
+        self.current_work.transitioned.watch(self.work_policy.work_changed)
+        self.merged_work.changed.watch(lambda _: self.work_policy.push('merged'))
+        self.node.best_share_var.changed.watch(lambda _: self.work_policy.push('share'))
 
     def stop(self):
         self.running = False
+        self.work_policy.stop()
 
     def get_stale_counts(self):
         '''Returns (orphans, doas), total, (orphans_recorded_in_chain, doas_recorded_in_chain)'''
@@ -263,9 +277,9 @@ class WorkerBridge(worker_interface.WorkerBridge):
             addr_hash_rates[datum['pubkey_hash']] = addr_hash_rates.get(datum['pubkey_hash'], 0) + datum['work']/dt
         return addr_hash_rates
 
+    @timing.timed('work.get_work')
     def get_work(self, pubkey_hash, desired_share_target, desired_pseudoshare_target):
         global print_throttle
-        t0 = time.time()  # Benchmarking start
         
         # Removed peer connection check - allow solo mining
         # P2Pool can work standalone even with PERSIST=True
@@ -431,135 +445,132 @@ class WorkerBridge(worker_interface.WorkerBridge):
         def got_response(header, user, coinbase_nonce, submitted_target=None):
             # submitted_target: optional override for the target the miner was actually working at
             # This is needed for vardiff - stratum adjusts target after get_work() returns
-            effective_target = submitted_target if submitted_target is not None else target
+            with got_response_timer:
+                effective_target = submitted_target if submitted_target is not None else target
             
-            assert len(coinbase_nonce) == self.COINBASE_NONCE_LENGTH
-            new_packed_gentx = packed_gentx[:-coinbase_payload_data_size-self.COINBASE_NONCE_LENGTH-4] + coinbase_nonce + packed_gentx[-coinbase_payload_data_size-4:] if coinbase_nonce != '\0'*self.COINBASE_NONCE_LENGTH else packed_gentx
-            new_gentx = dash_data.tx_type.unpack(new_packed_gentx) if coinbase_nonce != '\0'*self.COINBASE_NONCE_LENGTH else gentx
+                assert len(coinbase_nonce) == self.COINBASE_NONCE_LENGTH
+                new_packed_gentx = packed_gentx[:-coinbase_payload_data_size-self.COINBASE_NONCE_LENGTH-4] + coinbase_nonce + packed_gentx[-coinbase_payload_data_size-4:] if coinbase_nonce != '\0'*self.COINBASE_NONCE_LENGTH else packed_gentx
+                new_gentx = dash_data.tx_type.unpack(new_packed_gentx) if coinbase_nonce != '\0'*self.COINBASE_NONCE_LENGTH else gentx
 
-            header_hash = self.node.net.PARENT.BLOCKHASH_FUNC(dash_data.block_header_type.pack(header))
-            pow_hash = self.node.net.PARENT.POW_FUNC(dash_data.block_header_type.pack(header))
-            try:
-                if pow_hash <= header['bits'].target or p2pool.DEBUG:
-                    if pow_hash <= header['bits'].target:
-                        print
-                        print '#' * 70
-                        print '### DASH BLOCK FOUND! ###'
-                        print '#' * 70
-                        print 'Time:        %s' % time.strftime('%Y-%m-%d %H:%M:%S')
-                        print 'Miner:       %s' % user
-                        print 'Block hash:  %064x' % header_hash
-                        print 'POW hash:    %064x' % pow_hash
-                        print 'Target:      %064x' % header['bits'].target
-                        if 'height' in share_info:
-                            print 'Height:      %d' % share_info['height']
-                        print 'Txs:         %d' % (1 + len(other_transactions))
-                        print 'Explorer:    %s%064x' % (self.node.net.PARENT.BLOCK_EXPLORER_URL_PREFIX, header_hash)
-                        print '#' * 70
-                        print
-                    # Submit block and add error callback to catch any failures
-                    block_submission = helper.submit_block(dict(header=header, txs=[new_gentx] + other_transactions), False, self.node.factory, self.node.dashd, self.node.dashd_work, self.node.net)
-                    @block_submission.addErrback
-                    def block_submit_error(err):
-                        print >>sys.stderr, '*** CRITICAL: Block submission failed! ***'
-                        log.err(err, 'Block submission error:')
-                    if pow_hash <= header['bits'].target:
-                        # New block found
-                        self.node.factory.new_block.happened(header_hash)
-            except:
-                log.err(None, 'Error while processing potential block:')
-
-            user, _, _, _ = self.get_user_details(user)
-            assert header['previous_block'] == ba['previous_block']
-            assert header['merkle_root'] == dash_data.check_merkle_link(dash_data.hash256(new_packed_gentx), merkle_link)
-            assert header['bits'] == ba['bits']
-
-            # Allow shares that are within 3 work events of current (grace period for network latency)
-            # Work events fire on new blocks, new best shares, etc. - can be rapid
-            work_event_diff = self.new_work_event.times - lp_count
-            on_time = work_event_diff <= 3  # Allow up to 3 work events behind
-
-            for aux_work, index, hashes in mm_later:
+                header_hash = self.node.net.PARENT.BLOCKHASH_FUNC(dash_data.block_header_type.pack(header))
+                pow_hash = self.node.net.PARENT.POW_FUNC(dash_data.block_header_type.pack(header))
                 try:
-                    if pow_hash <= aux_work['target'] or p2pool.DEBUG:
-                        df = deferral.retry('Error submitting merged block: (will retry)', 10, 10)(aux_work['merged_proxy'].rpc_getauxblock)(
-                            pack.IntType(256, 'big').pack(aux_work['hash']).encode('hex'),
-                            dash_data.aux_pow_type.pack(dict(
-                                merkle_tx=dict(
-                                    tx=new_gentx,
-                                    block_hash=header_hash,
-                                    merkle_link=merkle_link,
-                                ),
-                                merkle_link=dash_data.calculate_merkle_link(hashes, index),
-                                parent_block_header=header,
-                            )).encode('hex'),
-                        )
-                        @df.addCallback
-                        def _(result, aux_work=aux_work):
-                            if result != (pow_hash <= aux_work['target']):
-                                print >>sys.stderr, 'Merged block submittal result: %s Expected: %s' % (result, pow_hash <= aux_work['target'])
-                            else:
-                                print 'Merged block submittal result: %s' % (result,)
-                        @df.addErrback
-                        def _(err):
-                            log.err(err, 'Error submitting merged block:')
+                    if pow_hash <= header['bits'].target or p2pool.DEBUG:
+                        if pow_hash <= header['bits'].target:
+                            print
+                            print '#' * 70
+                            print '### DASH BLOCK FOUND! ###'
+                            print '#' * 70
+                            print 'Time:        %s' % time.strftime('%Y-%m-%d %H:%M:%S')
+                            print 'Miner:       %s' % user
+                            print 'Block hash:  %064x' % header_hash
+                            print 'POW hash:    %064x' % pow_hash
+                            print 'Target:      %064x' % header['bits'].target
+                            if 'height' in share_info:
+                                print 'Height:      %d' % share_info['height']
+                            print 'Txs:         %d' % (1 + len(other_transactions))
+                            print 'Explorer:    %s%064x' % (self.node.net.PARENT.BLOCK_EXPLORER_URL_PREFIX, header_hash)
+                            print '#' * 70
+                            print
+                        # Submit block and add error callback to catch any failures
+                        block_submission = helper.submit_block(dict(header=header, txs=[new_gentx] + other_transactions), False, self.node.factory, self.node.dashd, self.node.dashd_work, self.node.net)
+                        @block_submission.addErrback
+                        def block_submit_error(err):
+                            print >>sys.stderr, '*** CRITICAL: Block submission failed! ***'
+                            log.err(err, 'Block submission error:')
+                        if pow_hash <= header['bits'].target:
+                            # New block found
+                            self.node.factory.new_block.happened(header_hash)
                 except:
-                    log.err(None, 'Error while processing merged mining POW:')
-
-            if pow_hash <= share_info['bits'].target and header_hash not in received_header_hashes:
-                last_txout_nonce = pack.IntType(8*self.COINBASE_NONCE_LENGTH).unpack(coinbase_nonce)
-                share = get_share(header, last_txout_nonce)
-
-                print 'GOT SHARE! %s %s prev %s age %.2fs%s' % (
-                    user,
-                    p2pool_data.format_hash(share.hash),
-                    p2pool_data.format_hash(share.previous_hash),
-                    time.time() - getwork_time,
-                    ' DEAD ON ARRIVAL' if not on_time else '',
-                )
-                self.my_share_hashes.add(share.hash)
-                if not on_time:
-                    self.my_doa_share_hashes.add(share.hash)
+                    log.err(None, 'Error while processing potential block:')
+
+                user, _, _, _ = self.get_user_details(user)
+                assert header['previous_block'] == ba['previous_block']
+                assert header['merkle_root'] == dash_data.check_merkle_link(dash_data.hash256(new_packed_gentx), merkle_link)
+                assert header['bits'] == ba['bits']
+
+                # Allow shares that are within 3 work events of current (grace period for network latency)
+                # Work events fire on new blocks, new best shares, etc. - can be rapid
+                work_event_diff = self.new_work_event.times - lp_count
+                on_time = work_event_diff <= 3  # Allow up to 3 work events behind
+
+                for aux_work, index, hashes in mm_later:
+                    try:
+                        if pow_hash <= aux_work['target'] or p2pool.DEBUG:
+                            df = deferral.retry('Error submitting merged block: (will retry)', 10, 10)(aux_work['merged_proxy'].rpc_getauxblock)(
+                                pack.IntType(256, 'big').pack(aux_work['hash']).encode('hex'),
+                                dash_data.aux_pow_type.pack(dict(
+                                    merkle_tx=dict(
+                                        tx=new_gentx,
+                                        block_hash=header_hash,
+                                        merkle_link=merkle_link,
+                                    ),
+                                    merkle_link=dash_data.calculate_merkle_link(hashes, index),
+                                    parent_block_header=header,
+                                )).encode('hex'),
+                            )
+                            @df.addCallback
+                            def _(result, aux_work=aux_work):
+                                if result != (pow_hash <= aux_work['target']):
+                                    print >>sys.stderr, 'Merged block submittal result: %s Expected: %s' % (result, pow_hash <= aux_work['target'])
+                                else:
+                                    print 'Merged block submittal result: %s' % (result,)
+                            @df.addErrback
+                            def _(err):
+                                log.err(err, 'Error submitting merged block:')
+                    except:
+                        log.err(None, 'Error while processing merged mining POW:')
+
+                if pow_hash <= share_info['bits'].target and header_hash not in received_header_hashes:
+                    last_txout_nonce = pack.IntType(8*self.COINBASE_NONCE_LENGTH).unpack(coinbase_nonce)
+                    share = get_share(header, last_txout_nonce)
+
+                    print 'GOT SHARE! %s %s prev %s age %.2fs%s' % (
+                        user,
+                        p2pool_data.format_hash(share.hash),
+                        p2pool_data.format_hash(share.previous_hash),
+                        time.time() - getwork_time,
+                        ' DEAD ON ARRIVAL' if not on_time else '',
+                    )
+                    self.my_share_hashes.add(share.hash)
+                    if not on_time:
+                        self.my_doa_share_hashes.add(share.hash)
 
-                self.node.tracker.add(share)
-                self.node.set_best_share()
+                    self.node.tracker.add(share)
+                    self.node.set_best_share()
 
-                try:
-                    if (pow_hash <= header['bits'].target or p2pool.DEBUG) and self.node.p2p_node is not None:
-                        self.node.p2p_node.broadcast_share(share.hash)
-                except:
-                    log.err(None, 'Error forwarding block solution:')
+                    try:
+                        if (pow_hash <= header['bits'].target or p2pool.DEBUG) and self.node.p2p_node is not None:
+                            self.node.p2p_node.broadcast_share(share.hash)
+                    except:
+                        log.err(None, 'Error forwarding block solution:')
 
-                self.share_received.happened(dash_data.target_to_average_attempts(share.target), not on_time, share.hash)
+                    self.share_received.happened(dash_data.target_to_average_attempts(share.target), not on_time, share.hash)
                 
-                # Update local rate monitor for shares (they are also pseudoshares)
-                # Use effective_target (vardiff target) for work calculation
-                # Use 'user' which contains full worker name (e.g. address.worker) for proper tracking
-                self.local_rate_monitor.add_datum(dict(work=dash_data.target_to_average_attempts(effective_target), dead=not on_time, user=user, share_target=share_info['bits'].target))
-                self.local_addr_rate_monitor.add_datum(dict(work=dash_data.target_to_average_attempts(effective_target), pubkey_hash=pubkey_hash))
-                received_header_hashes.add(header_hash)
-            elif pow_hash > effective_target:
-                print 'Worker %s submitted share with hash > target:' % (user,)
-                print '    Hash:   %56x' % (pow_hash,)
-                print '    Target: %56x' % (effective_target,)
-            elif header_hash in received_header_hashes:
-                print >>sys.stderr, 'Worker %s submitted share more than once!' % (user,)
-            else:
-                received_header_hashes.add(header_hash)
-
-                work_value = dash_data.target_to_average_attempts(effective_target)
-                self.pseudoshare_received.happened(work_value, not on_time, user)
-                self.recent_shares_ts_work.append((time.time(), work_value))
-                while len(self.recent_shares_ts_work) > 50:
-                    self.recent_shares_ts_work.pop(0)
-                # Use 'user' which contains full worker name (e.g. address.worker) for proper tracking
-                self.local_rate_monitor.add_datum(dict(work=work_value, dead=not on_time, user=user, share_target=share_info['bits'].target))
-                self.local_addr_rate_monitor.add_datum(dict(work=work_value, pubkey_hash=pubkey_hash))
-
-            return on_time
-
-        t1 = time.time()
-        if p2pool.BENCH:
-            print "%8.3f ms for work.py:get_work(%s)" % ((t1-t0)*1000., dash_data.pubkey_hash_to_address(pubkey_hash, self.node.net.PARENT))
-        
+                    # Update local rate monitor for shares (they are also pseudoshares)
+                    # Use effective_target (vardiff target) for work calculation
+                    # Use 'user' which contains full worker name (e.g. address.worker) for proper tracking
+                    self.local_rate_monitor.add_datum(dict(work=dash_data.target_to_average_attempts(effective_target), dead=not on_time, user=user, share_target=share_info['bits'].target))
+                    self.local_addr_rate_monitor.add_datum(dict(work=dash_data.target_to_average_attempts(effective_target), pubkey_hash=pubkey_hash))
+                    received_header_hashes.add(header_hash)
+                elif pow_hash > effective_target:
+                    print 'Worker %s submitted share with hash > target:' % (user,)
+                    print '    Hash:   %56x' % (pow_hash,)
+                    print '    Target: %56x' % (effective_target,)
+                elif header_hash in received_header_hashes:
+                    print >>sys.stderr, 'Worker %s submitted share more than once!' % (user,)
+                else:
+                    received_header_hashes.add(header_hash)
+
+                    work_value = dash_data.target_to_average_attempts(effective_target)
+                    self.pseudoshare_received.happened(work_value, not on_time, user)
+                    self.recent_shares_ts_work.append((time.time(), work_value))
+                    while len(self.recent_shares_ts_work) > 50:
+                        self.recent_shares_ts_work.pop(0)
+                    # Use 'user' which contains full worker name (e.g. address.worker) for proper tracking
+                    self.local_rate_monitor.add_datum(dict(work=work_value, dead=not on_time, user=user, share_target=share_info['bits'].target))
+                    self.local_addr_rate_monitor.add_datum(dict(work=work_value, pubkey_hash=pubkey_hash))
+
+                return on_time
+
         return ba, got_response
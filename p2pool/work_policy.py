@@ -0,0 +1,136 @@
+'''
+Decides when a change of work is pushed to miners.
+
+Every push fires WorkerBridge.new_work_event, which sends a new job to
+every stratum connection and answers every getwork long poll. A new
+block (previous block, version or bits changed), a template getting its
+first transactions, a new best share and new merged work are pushed
+right away. A template that only differs in its transactions is held:
+it is pushed once the fees it adds over the last pushed template reach
+fee_threshold, or once the last push is max_age seconds old.
+
+Holding an update gives up its extra fees on any block found meanwhile.
+That is estimated as fee gain * held seconds * the pool's expected blocks
+per second (from get_block_rate, if given).
+'''
+
+from __future__ import division
+
+import collections
+
+from twisted.internet import reactor
+from twisted.python import log
+
+from p2pool.util import metrics
+
+pushes_counter = metrics.counter('p2pool_work_pushes', 'New work pushed to miners, by reason', ['reason'])
+held_counter = metrics.counter('p2pool_work_updates_held', 'Mempool-only template updates held back instead of pushed')
+fees_given_up_gauge = metrics.gauge('p2pool_work_fees_given_up', 'Estimated fees (in satoshis) given up by holding back mempool-only template updates')
+
+IMMEDIATE_FIELDS = ['version', 'previous_block', 'bits']
+
+def template_fees(work):
+    return sum(fee for fee in work.get('transaction_fees', []) if fee is not None)
+
+class TemplateUpdatePolicy(object):
+    def __init__(self, new_work_event, fee_threshold=100000, max_age=30, get_block_rate=None, clock=reactor):
+        self.new_work_event = new_work_event
+        self.fee_threshold = fee_threshold
+        self.max_age = max_age
+        self.get_block_rate = get_block_rate
+        self.clock = clock
+
+        self.pushed_work = None # the template miners were last sent
+        self.pushed_at = None
+        self.pending_work = None # a held mempool-only update
+        self.pending_since = None
+        self._max_age_call = None
+
+        self.push_times = collections.deque() # of the last minute
+        self.pushes = collections.defaultdict(int) # reason -> count
+        self.held = 0
+        self.fees_given_up = 0
+
+    def set_work(self, work):
+        '''Sets the template miners start with, without pushing it'''
+        self.pushed_work = work
+        self.pushed_at = self.clock.seconds()
+
+    def work_changed(self, before, after):
+        if self.pushed_work is None or any(self.pushed_work[x] != after[x] for x in IMMEDIATE_FIELDS):
+            self.push('block', after)
+        elif not self.pushed_work['transactions'] and after['transactions']:
+            self.push('first_transactions', after)
+        elif template_fees(after) - template_fees(self.pushed_work) >= self.fee_threshold:
+            self.push('fees', after)
+        else:
+            if self.pending_work is None:
+                self.pending_since = self.clock.seconds()
+            self.pending_work = after
+            self.held += 1
+            held_counter.inc()
+            if self._max_age_call is None:
+                self._max_age_call = self.clock.callLater(max(0, self.pushed_at + self.max_age - self.clock.seconds()), self._push_pending)
+
+    def _push_pending(self):
+        self._max_age_call = None
+        if self.pending_work is not None:
+            self.push('max_age', self.pending_work)
+
+    def push(self, reason, work=None):
+        '''Pushes new work to miners; work is the current template, if the push was caused by a template change'''
+        now = self.clock.seconds()
+        if self.pending_work is not None:
+            self._account_hold(now)
+            if work is None:
+                work = self.pending_work
+            self.pending_work = None
+        if self._max_age_call is not None:
+            if self._max_age_call.active():
+                self._max_age_call.cancel()
+            self._max_age_call = None
+        if work is not None:
+            self.pushed_work = work
+        self.pushed_at = now
+        self.push_times.append(now)
+        self._trim_push_times(now)
+        self.pushes[reason] += 1
+        pushes_counter.inc(1, (reason,))
+        self.new_work_event.happened()
+
+    def _account_hold(self, now):
+        gain = template_fees(self.pending_work) - template_fees(self.pushed_work)
+        if gain <= 0 or self.get_block_rate is None:
+            return
+        # only an estimate, so it never gets in the way of the push
+        try:
+            block_rate = self.get_block_rate()
+        except:
+            log.err(None, 'Error estimating fees given up:')
+            return
+        self.fees_given_up += gain*(now - self.pending_since)*block_rate
+        fees_given_up_gauge.set(self.fees_given_up)
+
+    def _trim_push_times(self, now):
+        while self.push_times and self.push_times[0] <= now - 60:
+            self.push_times.popleft()
+
+    def notifies_per_minute(self):
+        self._trim_push_times(self.clock.seconds())
+        return len(self.push_times)
+
+    def get_stats(self):
+        return dict(
+            notifies_per_minute=self.notifies_per_minute(),
+            pushes=dict(self.pushes),
+            held_updates=self.held,
+            pending=self.pending_work is not None,
+            fees_given_up=self.fees_given_up,
+            fee_threshold=self.fee_threshold,
+            max_age=self.max_age,
+        )
+
+    def stop(self):
+        if self._max_age_call is not None and self._max_age_call.active():
+            self._max_age_call.cancel()
+        self._max_age_call = None